@@ -3,4 +3,8 @@ from django.apps import AppConfig
 
 class AgentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'apps.agents' 
\ No newline at end of file
+    name = 'apps.agents'
+
+    def ready(self):
+        from .services.registry import warm_up_on_startup
+        warm_up_on_startup()
@@ -1,20 +1,125 @@
 import json
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from .services.registry import get_agent_manager, get_rag_service, get_tracer
+from .services.chat_context import abuild_chat_context, asave_chat_turn
+from .services.tracing import span
+
+logger = logging.getLogger(__name__)
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    Chat en tiempo real con los agentes: la respuesta se envía token a token.
+
+    Mensajes del cliente:
+    - {"userId", "text", "agent_type"?, "context"?}: nueva consulta
+    - {"type": "cancel"}: cancelar la respuesta en curso
+
+    Mensajes del servidor (todos con 'from': 'agent'):
+    - {"type": "start", "agent_used", "agent_name"}
+    - {"type": "token", "text"}
+    - {"type": "end", "response", "agent_used", "response_time", ...}
+    - {"type": "error", "error", "response"}
+    """
+
     async def connect(self):
+        self.stream_task = None
         await self.accept()
 
     async def disconnect(self, code):
-        pass
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        user_id = data.get('userId')
-        text = data.get('text')
-        # Lógica de agente dummy (por ejemplo, llamar a OpenAI aquí)
-        response_text = f"Respuesta en tiempo real: «{text}»"
-        await self.send(text_data=json.dumps({
-            'from': 'agent',
-            'text': response_text
-        })) 
\ No newline at end of file
+        # El cliente se fue: cancelar la llamada al proveedor
+        await self._cancel_stream()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data or '{}')
+        except json.JSONDecodeError:
+            await self._send_event({'type': 'error', 'error': 'Mensaje JSON inválido'})
+            return
+
+        if data.get('type') == 'cancel':
+            await self._cancel_stream()
+            return
+
+        user_id = data.get('userId') or 'default-user'
+        message = data.get('text') or data.get('message') or data.get('query')
+        if not message:
+            await self._send_event({
+                'type': 'error',
+                'error': "El campo 'text', 'message' o 'query' es requerido."
+            })
+            return
+
+        # Una sola respuesta en curso por socket
+        await self._cancel_stream()
+        self.stream_task = asyncio.ensure_future(self._stream_response(
+            user_id, message, data.get('agent_type'), data.get('context')
+        ))
+
+    async def _send_event(self, event):
+        await self.send(text_data=json.dumps({'from': 'agent', **event}))
+
+    async def _cancel_stream(self):
+        # Cancelar la tarea cierra el stream HTTP del proveedor
+        if self.stream_task and not self.stream_task.done():
+            self.stream_task.cancel()
+            try:
+                await self.stream_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self.stream_task = None
+
+    async def _stream_response(self, user_id, message, agent_type, explicit_context):
+        with get_tracer().trace('chat.request', endpoint='ws', agent_type=agent_type or 'auto'):
+            await self._respond(user_id, message, agent_type, explicit_context)
+
+    async def _respond(self, user_id, message, agent_type, explicit_context):
+        try:
+            # El primer uso construye el AgentManager (y quizá RAG y router): fuera del loop
+            agent_manager = await sync_to_async(get_agent_manager, thread_sensitive=False)()
+            # Memoria con redis.asyncio en el loop; solo RAG y perfil usan threads
+            context, memory = await abuild_chat_context(
+                user_id, message,
+                agent_type=agent_type,
+                explicit_context=explicit_context,
+                rag_service=await sync_to_async(get_rag_service, thread_sensitive=False)()
+            )
+        except Exception as e:
+            logger.error(f"Error construyendo contexto en ChatConsumer: {e}")
+            await self._send_error_event()
+            return
+
+        final_event = None
+        events = agent_manager.astream_query(message, agent_type=agent_type, context=context)
+        try:
+            async for event in events:
+                if event['type'] in ('end', 'error'):
+                    final_event = event
+                await self._send_event(event)
+        except Exception as e:
+            logger.error(f"Error enviando la respuesta en ChatConsumer: {e}")
+            await self._send_error_event()
+            return
+        finally:
+            await events.aclose()
+
+        if final_event and final_event.get('success'):
+            try:
+                with span('memory.write', agent=final_event['agent_used']):
+                    await asave_chat_turn(
+                        user_id, memory, final_event['agent_used'], message, final_event['response']
+                    )
+            except Exception as e:
+                logger.warning(f"Error guardando turno del chat: {e}")
+
+    async def _send_error_event(self):
+        # El socket puede estar cerrado: el error ya quedó registrado
+        try:
+            await self._send_event({'type': 'error', 'error': 'Error interno del servidor'})
+        except Exception as e:
+            logger.debug(f"No se pudo enviar el error al cliente: {e}")
@@ -0,0 +1,80 @@
+"""
+Prueba de carga del chat de agentes.
+
+    python manage.py agents_loadtest --url http://localhost:8000 --endpoint chat-async \
+        --concurrency 50 --duration 120 --output resultados.json
+
+Para no gastar crédito de API, arrancar el servidor con LLM_PROVIDER_BACKEND=fake
+y el proveedor simulado (python manage.py run_fake_llm).
+"""
+
+import json
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.agents.services.load_generator import ENDPOINTS, LoadGenerator, load_mix
+
+
+class Command(BaseCommand):
+    help = 'Generador de carga asyncio: throughput, p50/p95/p99, TTFT y tasa de error por agente'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000', help='URL base del backend')
+        parser.add_argument('--endpoint', choices=sorted(ENDPOINTS), default='chat')
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--duration', type=float, default=60.0, help='Segundos de prueba')
+        parser.add_argument('--requests', type=int, dest='total_requests', help='Número máximo de peticiones')
+        parser.add_argument('--rate', type=float, help='Llegadas por segundo (bucle abierto)')
+        parser.add_argument('--users', type=int, default=100, help='Usuarios simulados distintos')
+        parser.add_argument('--timeout', type=float, default=60.0)
+        parser.add_argument('--mix', help='JSON con la mezcla de consultas por agente')
+        parser.add_argument('--output', help='Guardar el informe completo en un JSON')
+
+    def handle(self, *args, **options):
+        try:
+            generator = LoadGenerator(
+                base_url=options['url'],
+                endpoint=options['endpoint'],
+                concurrency=options['concurrency'],
+                duration=options['duration'],
+                total_requests=options['total_requests'],
+                rate=options['rate'],
+                users=options['users'],
+                timeout=options['timeout'],
+                mix=load_mix(options['mix'])
+            )
+        except (ValueError, OSError, KeyError) as e:
+            raise CommandError(str(e))
+
+        if options['endpoint'] == 'ws':
+            try:
+                import websockets  # noqa: F401
+            except ImportError:
+                raise CommandError("El modo ws requiere el paquete 'websockets'")
+
+        self.stdout.write(f"Carga contra {options['url']}{ENDPOINTS[options['endpoint']]} ...")
+        report = asyncio.run(generator.run())
+
+        self._print_summary('TOTAL', report['overall'])
+        for agent, summary in report['agents'].items():
+            self._print_summary(agent, summary)
+        if report['ttft_measure'] != 'first_token':
+            self.stdout.write("(TTFT medido como primer byte: el endpoint HTTP no hace streaming)")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f"Informe guardado en {options['output']}"))
+
+    def _print_summary(self, label, summary):
+        latency = summary['latency_ms']
+        ttft = summary['ttft_ms']
+        self.stdout.write(
+            f"{label:<16} req={summary['requests']:<6} ok={summary['successful']:<6} "
+            f"rps={summary['throughput_rps']:<7} err={summary['error_rate']:.2%}  "
+            f"lat p50/p95/p99={latency['p50']}/{latency['p95']}/{latency['p99']} ms  "
+            f"ttft p50/p95/p99={ttft['p50']}/{ttft['p95']}/{ttft['p99']} ms"
+        )
+        if summary['errors']:
+            self.stdout.write(f"{'':<16} errores: {summary['errors']}")
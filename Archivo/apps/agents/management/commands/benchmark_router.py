@@ -0,0 +1,90 @@
+"""
+Micro-benchmark del routing por keywords.
+
+    python manage.py benchmark_router --scale 10 --iterations 20000
+
+Compara la búsqueda por subcadena original (agentes × keywords por consulta)
+con el KeywordRouter compilado, sin caché y con la LRU caliente, sobre la
+tabla real o ampliada --scale veces con keywords sintéticas.
+"""
+
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.agents.services.agent_manager import AgentManager
+from apps.agents.services.load_generator import DEFAULT_MIX
+from apps.agents.services.router import KeywordRouter
+
+
+def legacy_scores(routing_config, query):
+    """Puntajes como los calculaba _determine_best_agent antes del router"""
+    query_lower = query.lower()
+    agent_scores = {}
+    for agent_id, config in routing_config.items():
+        score = sum(1 for keyword in config['keywords'] if keyword in query_lower)
+        agent_scores[agent_id] = score * (1.0 / config['priority'])
+    return agent_scores
+
+
+def scaled_config(routing_config, scale, seed=0):
+    """Tabla con (scale - 1) keywords sintéticas extra por cada keyword real"""
+    rng = random.Random(seed)
+    scaled = {}
+    for agent_id, config in routing_config.items():
+        keywords = list(config['keywords'])
+        for keyword in config['keywords']:
+            for _ in range(scale - 1):
+                keywords.append(''.join(rng.choices(string.ascii_lowercase, k=max(4, len(keyword)))))
+        scaled[agent_id] = dict(config, keywords=keywords)
+    return scaled
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark del routing por keywords (subcadenas vs regex compilada vs LRU)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=int, default=10, help='Multiplicador del tamaño de la tabla')
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def _measure(self, label, fn, queries, iterations):
+        started = time.perf_counter()
+        for i in range(iterations):
+            fn(queries[i % len(queries)])
+        per_query = (time.perf_counter() - started) / iterations * 1e6
+        self.stdout.write(f"  {label:<24} {per_query:8.2f} µs/consulta")
+        return per_query
+
+    def handle(self, *args, **options):
+        scale = max(1, options['scale'])
+        iterations = options['iterations']
+        routing_config = scaled_config(AgentManager._setup_routing_config(), scale)
+        queries = [query for _, _, entries in DEFAULT_MIX for query in entries]
+
+        compiled = KeywordRouter(routing_config, cache_size=0)
+        cached = KeywordRouter(routing_config, cache_size=1024)
+        for query in queries:
+            cached.scores(query)
+
+        def best(scores):
+            top = max(scores, key=scores.get)
+            return top if scores[top] > 0 else 'tutor'
+
+        agreement = sum(
+            best(legacy_scores(routing_config, q)) == (compiled.route(q) or 'tutor') for q in queries
+        )
+
+        keywords = sum(len(c['keywords']) for c in routing_config.values())
+        self.stdout.write(f"Tabla: {len(routing_config)} agentes, {keywords} keywords (x{scale}); "
+                          f"{len(queries)} consultas, {iterations} iteraciones")
+        legacy = self._measure('subcadenas (original)', lambda q: legacy_scores(routing_config, q),
+                               queries, iterations)
+        regex = self._measure('regex compilada', compiled.scores, queries, iterations)
+        lru = self._measure('regex + LRU', cached.scores, queries, iterations)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Speedup: x{legacy / regex:.1f} compilada, x{legacy / lru:.1f} con LRU; "
+            f"mismo agente en {agreement}/{len(queries)} consultas"
+        ))
@@ -0,0 +1,91 @@
+"""
+Retención y compactación de la memoria conversacional en Redis.
+
+    python manage.py conversation_retention --batch-size 1000 --pause-ms 5 \
+        --archive-dir /var/archive/conversations --output retencion.json
+
+Recorre conversation:*, session:* y metadata:* con SCAN, archiva en frío
+(.jsonl.gz) y borra las conversaciones que expiran o superan la edad máxima,
+y repara las claves sin expiración. Con --dry-run solo cuenta. Pensado para
+cron; ver ConversationRetention para el detalle.
+"""
+
+import os
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.agents.services.conversation_retention import ConversationArchive, ConversationRetention
+from apps.agents.services.registry import get_redis_client
+
+
+class Command(BaseCommand):
+    help = 'Retención de conversaciones: SCAN por lotes, archivo en frío y borrado de claves expiradas o huérfanas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-days', type=int, help='Edad máxima (por defecto CONVERSATION_MAX_AGE_DAYS)')
+        parser.add_argument('--expiring-hours', type=float,
+                            help='Archivar lo que expira antes de este plazo (por defecto 24; sin efecto con --no-archive)')
+        parser.add_argument('--batch-size', type=int, help='Claves por SCAN y por pipeline (por defecto 1000)')
+        parser.add_argument('--pause-ms', type=float, default=0.0, help='Pausa entre lotes para no acaparar Redis')
+        parser.add_argument('--archive-dir', help='Directorio del almacenamiento frío')
+        parser.add_argument('--no-archive', action='store_true', help='Borrar sin archivar')
+        parser.add_argument('--dry-run', action='store_true', help='Solo contar lo que se haría')
+        parser.add_argument('--output', help='Guardar el informe en un JSON')
+
+    def handle(self, *args, **options):
+        try:
+            redis_client = get_redis_client()
+            redis_client.ping()
+        except Exception as e:
+            raise CommandError(f"Redis no disponible: {e}")
+
+        archive = None
+        # En dry run el archivo no se escribe (se abre en el primer lote), pero
+        # decide igual qué conversaciones se adelantarían
+        if not options['no_archive']:
+            archive_dir = (options['archive_dir'] or os.getenv('CONVERSATION_ARCHIVE_DIR')
+                           or os.path.join(settings.BASE_DIR, 'conversation_archive'))
+            archive = ConversationArchive(archive_dir)
+
+        retention = ConversationRetention(
+            redis_client,
+            archive=archive,
+            max_age_days=options['max_age_days'],
+            expiring_hours=options['expiring_hours'],
+            batch_size=options['batch_size'],
+            pause=options['pause_ms'] / 1000,
+            dry_run=options['dry_run'],
+            progress=self._print_progress
+        )
+        self.stdout.write(
+            f"Retención{' (dry run)' if options['dry_run'] else ''}: SCAN de {retention.batch_size} claves por lote, "
+            f"edad máxima {retention.max_age // 86400} días, archivo: {archive.directory if archive else 'no'}"
+        )
+        report = retention.run()
+
+        self._print_progress(report)
+        verb = 'se borrarían' if report['dry_run'] else 'borradas'
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['scanned_total']} claves en {report['elapsed_seconds']}s "
+            f"({report['keys_per_second']} claves/s, {report['scan_calls']} SCAN, {report['pipelines']} pipelines); "
+            f"conversaciones {verb}: {report['deleted']}, archivadas: {report['archived']}"
+        ))
+        if report['archive']:
+            self.stdout.write(f"Archivo: {report['archive']}")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f"Informe guardado en {options['output']}"))
+
+    def _print_progress(self, report):
+        scanned = report['scanned']
+        self.stdout.write(
+            f"  {report['elapsed_seconds']:>8}s  conversation={scanned['conversation']} "
+            f"session={scanned['session']} metadata={scanned['metadata']}  "
+            f"{report['keys_per_second']} claves/s  borradas={report['deleted']} "
+            f"conservadas={report['kept_after_write']} expire={report['expire_set']} "
+            f"huérfanas={report['orphans_deleted']}"
+        )
@@ -0,0 +1,48 @@
+"""
+Arrancar el proveedor LLM simulado para pruebas de carga.
+
+    python manage.py run_fake_llm --port 8765 --latency-ms 600 --error-rate 0.02
+
+Los agentes lo usan con LLM_PROVIDER_BACKEND=fake (y FAKE_LLM_URL si no es el
+puerto por defecto).
+"""
+
+from django.core.management.base import BaseCommand
+
+from apps.agents.services.fake_llm import FakeLLMConfig, run_server
+
+
+class Command(BaseCommand):
+    help = 'Servidor local que imita las APIs de OpenAI y Anthropic (latencia, streaming y errores configurables)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency-ms', type=float, dest='latency_ms',
+                            help='Mediana del tiempo hasta el primer token')
+        parser.add_argument('--latency-sigma', type=float, dest='latency_sigma',
+                            help='Dispersión log-normal de la latencia (0 = fija)')
+        parser.add_argument('--tokens-per-second', type=float, dest='tokens_per_second')
+        parser.add_argument('--response-tokens', dest='response_tokens', help='Tamaño de respuesta "min-max"')
+        parser.add_argument('--error-rate', type=float, dest='error_rate')
+        parser.add_argument('--error-kinds', dest='error_kinds', help='Errores inyectados, p.ej. "429,500,timeout"')
+        parser.add_argument('--hang-seconds', type=float, dest='hang_seconds')
+
+    def handle(self, *args, **options):
+        config = FakeLLMConfig(**{
+            name: options[name] for name in (
+                'latency_ms', 'latency_sigma', 'tokens_per_second', 'response_tokens',
+                'error_rate', 'error_kinds', 'hang_seconds'
+            )
+        })
+        server = run_server(options['host'], options['port'], config)
+        self.stdout.write(self.style.SUCCESS(
+            f"Fake LLM en http://{options['host']}:{options['port']} - {config.as_dict()}"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Peticiones atendidas: {server.get_stats()}")
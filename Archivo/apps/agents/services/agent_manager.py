@@ -2,10 +2,20 @@
 Agent Manager - Sistema central de gestión de agentes especializados
 """
 
+import asyncio
 import logging
-from typing import Dict, Any, Optional, List
+import threading
+from typing import Dict, Any, Optional, List, Type, Iterator, AsyncIterator
 from datetime import datetime
 
+from .ai_service import BaseAIService
+from .router import KeywordRouter
+from .registry import get_circuit_breakers, get_context_cache, get_rate_limiter, get_tracer, get_metrics
+from .tracing import current_span, span
+from .errors import (
+    ProviderError, ProviderUnavailableError, ProviderThrottledError,
+    ProviderTimeoutError, ProviderRateLimitError
+)
 from .tutor_agent import TutorAgent
 from .evaluator_agent import EvaluatorAgent
 from .counselor_agent import CounselorAgent
@@ -15,6 +25,58 @@ from .content_creator_agent import ContentCreatorAgent
 
 logger = logging.getLogger(__name__)
 
+class AgentSlot:
+    """
+    Slot perezoso para un agente especializado.
+    
+    El agente se construye la primera vez que se solicita (thread-safe),
+    de modo que el arranque y la memoria del worker escalan con los agentes
+    realmente usados.
+    """
+    
+    def __init__(self, agent_id: str, agent_class: Type[BaseAIService]):
+        self.agent_id = agent_id
+        self.agent_class = agent_class
+        self.instance: Optional[BaseAIService] = None
+        self.last_error: Optional[str] = None
+        self.loaded_at: Optional[str] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def is_loaded(self) -> bool:
+        return self.instance is not None
+    
+    def get(self) -> BaseAIService:
+        """Obtener el agente, construyéndolo si es necesario"""
+        instance = self.instance
+        if instance is not None:
+            return instance
+        
+        with self._lock:
+            if self.instance is None:
+                self.instance = self._build()
+            return self.instance
+    
+    def reload(self) -> BaseAIService:
+        """Reconstruir el agente"""
+        with self._lock:
+            self.instance = self._build()
+            return self.instance
+    
+    def _build(self) -> BaseAIService:
+        try:
+            instance = self.agent_class()
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error(f"❌ Error inicializando agente {self.agent_id}: {e}")
+            raise
+        
+        self.last_error = None
+        self.loaded_at = datetime.now().isoformat()
+        logger.info(f"✅ Agente {self.agent_id} inicializado")
+        return instance
+
+
 class AgentManager:
     """
     Gestor central para todos los agentes especializados.
@@ -27,69 +89,101 @@ class AgentManager:
     - Balanceamiento de carga
     """
     
+    # Registro de agentes disponibles: id -> clase
+    AGENT_CLASSES: Dict[str, Type[BaseAIService]] = {
+        'tutor': TutorAgent,
+        'evaluator': EvaluatorAgent,
+        'counselor': CounselorAgent,
+        'curriculum': CurriculumPlannerAgent,
+        'analytics': AnalyticsAgent,
+        'content_creator': ContentCreatorAgent,
+    }
+    
     def __init__(self):
         """Inicializar el gestor de agentes"""
         self.logger = logging.getLogger(self.__class__.__name__)
         
-        # Inicializar todos los agentes
-        self.agents = self._initialize_agents()
+        # Slots perezosos: los agentes se construyen al primer uso
+        self.agent_slots = {
+            agent_id: AgentSlot(agent_id, agent_class)
+            for agent_id, agent_class in self.AGENT_CLASSES.items()
+        }
         
         # Configuración de routing
         self.routing_config = self._setup_routing_config()
+        self.router = KeywordRouter(self.routing_config)
+        # Routing por centroides de embeddings (opcional; lo asigna el registro de servicios)
+        self.semantic_router = None
         
-        # Métricas y monitoreo
-        self.metrics = {
-            'total_queries': 0,
-            'agent_usage': {agent_id: 0 for agent_id in self.agents.keys()},
-            'average_response_time': 0,
-            'errors': 0
-        }
-        
-        self.logger.info(f"AgentManager inicializado con {len(self.agents)} agentes")
-    
-    def _initialize_agents(self) -> Dict[str, Any]:
-        """Inicializar todos los agentes especializados"""
-        agents = {}
-        
-        try:
-            agents['tutor'] = TutorAgent()
-            self.logger.info("✅ Tutor Agent inicializado")
-        except Exception as e:
-            self.logger.error(f"❌ Error inicializando Tutor Agent: {e}")
+        # Caché semántica de respuestas (la asigna el registro de servicios)
+        self.response_cache = None
+        # Coalescencia de consultas idénticas en curso (la asigna el registro de servicios)
+        self.single_flight = None
         
-        try:
-            agents['evaluator'] = EvaluatorAgent()
-            self.logger.info("✅ Evaluator Agent inicializado")
-        except Exception as e:
-            self.logger.error(f"❌ Error inicializando Evaluator Agent: {e}")
+        # Métricas y monitoreo: contadores e histogramas del proceso, agregados entre workers
+        self.metrics_registry = get_metrics()
         
-        try:
-            agents['counselor'] = CounselorAgent()
-            self.logger.info("✅ Counselor Agent inicializado")
-        except Exception as e:
-            self.logger.error(f"❌ Error inicializando Counselor Agent: {e}")
+        self.logger.info(f"AgentManager inicializado con {len(self.agent_slots)} agentes registrados")
+    
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Resumen de uso de este worker (mismas claves que el antiguo dict de métricas)
         
-        try:
-            agents['curriculum'] = CurriculumPlannerAgent()
-            self.logger.info("✅ Curriculum Agent inicializado")
-        except Exception as e:
-            self.logger.error(f"❌ Error inicializando Curriculum Agent: {e}")
+        Se lee de los contadores locales, sin volcar ni consultar Redis: la vista
+        agregada de todos los workers es /metrics (MetricsRegistry.collect).
+        """
+        usage = self.metrics_registry.local_counter_by('agent_requests_total', 'agent')
+        outcomes = self.metrics_registry.local_counter_by('agent_requests_total', 'outcome')
+        latency = self.metrics_registry.local_histogram('agent_request_duration_seconds')
         
-        try:
-            agents['analytics'] = AnalyticsAgent()
-            self.logger.info("✅ Analytics Agent inicializado")
-        except Exception as e:
-            self.logger.error(f"❌ Error inicializando Analytics Agent: {e}")
+        return {
+            'total_queries': int(sum(usage.values())),
+            'agent_usage': {agent_id: int(usage.get(agent_id, 0)) for agent_id in self.agent_slots},
+            'average_response_time': latency.mean,
+            'errors': int(outcomes.get('error', 0)),
+            'cache_hits': int(outcomes.get('cache_hit', 0)),
+            'latency': latency.summary()
+        }
+    
+    @property
+    def agents(self) -> Dict[str, BaseAIService]:
+        """Agentes ya construidos (no fuerza la construcción de los demás)"""
+        return {
+            agent_id: slot.instance
+            for agent_id, slot in self.agent_slots.items()
+            if slot.is_loaded
+        }
+    
+    def get_agent(self, agent_id: str) -> BaseAIService:
+        """
+        Obtener un agente, construyéndolo la primera vez que se usa
         
-        try:
-            agents['content_creator'] = ContentCreatorAgent()
-            self.logger.info("✅ Content Creator Agent inicializado")
-        except Exception as e:
-            self.logger.error(f"❌ Error inicializando Content Creator Agent: {e}")
+        Raises:
+            ValueError: Si el agente no está registrado
+        """
+        if agent_id not in self.agent_slots:
+            raise ValueError(f"Agente '{agent_id}' no disponible")
+        return self.agent_slots[agent_id].get()
+    
+    def preload_agents(self, agent_ids: Optional[List[str]] = None) -> Dict[str, bool]:
+        """
+        Construir agentes por adelantado (warm-up)
         
-        return agents
+        Args:
+            agent_ids: Agentes a precargar (por defecto todos)
+        """
+        results = {}
+        for agent_id in agent_ids or list(self.agent_slots.keys()):
+            try:
+                self.get_agent(agent_id)
+                results[agent_id] = True
+            except Exception:
+                results[agent_id] = False
+        return results
     
-    def _setup_routing_config(self) -> Dict[str, Dict[str, Any]]:
+    @staticmethod
+    def _setup_routing_config() -> Dict[str, Dict[str, Any]]:
         """Configurar reglas de routing para cada agente"""
         return {
             'tutor': {
@@ -99,6 +193,11 @@ class AgentManager:
                     'tarea', 'homework', 'doubt', 'pregunta', 'ayuda'
                 ],
                 'description': 'Enseñanza, explicaciones y apoyo académico',
+                'examples': [
+                    '¿Me puedes explicar cómo se resuelve una ecuación de segundo grado?',
+                    'No entiendo por qué el cielo es azul',
+                    'Ayúdame a comprender la tabla periódica paso a paso'
+                ],
                 'priority': 1
             },
             'evaluator': {
@@ -108,6 +207,11 @@ class AgentManager:
                     'corrección', 'assessment', 'grade', 'score'
                 ],
                 'description': 'Evaluación y calificación académica',
+                'examples': [
+                    '¿Qué nota le pondrías a mi redacción?',
+                    'Revisa si mi respuesta del problema está bien',
+                    'Hazme un examen corto sobre fracciones'
+                ],
                 'priority': 2
             },
             'counselor': {
@@ -117,6 +221,11 @@ class AgentManager:
                     'guidance', 'advice', 'support', 'emotional', 'personal'
                 ],
                 'description': 'Orientación académica y apoyo socioemocional',
+                'examples': [
+                    'Me siento muy agobiado con los estudios',
+                    '¿Qué carrera debería elegir si me gustan las ciencias?',
+                    'No tengo ganas de estudiar, ¿cómo recupero la motivación?'
+                ],
                 'priority': 2
             },
             'curriculum': {
@@ -126,6 +235,11 @@ class AgentManager:
                     'diseño', 'estructura', 'planning', 'course'
                 ],
                 'description': 'Diseño curricular y planificación educativa',
+                'examples': [
+                    'Organiza los temas de álgebra para un trimestre',
+                    'Propón una secuencia de unidades para enseñar geometría',
+                    '¿Qué objetivos de aprendizaje debería tener un curso de biología?'
+                ],
                 'priority': 3
             },
             'analytics': {
@@ -135,6 +249,11 @@ class AgentManager:
                     'data', 'analytics', 'dashboard', 'report'
                 ],
                 'description': 'Análisis de datos educativos y reportes',
+                'examples': [
+                    '¿Cómo va mi progreso en matemáticas este mes?',
+                    'Muéstrame en qué temas tengo más errores',
+                    'Resume el rendimiento del grupo en el último examen'
+                ],
                 'priority': 3
             },
             'content_creator': {
@@ -144,6 +263,11 @@ class AgentManager:
                     'laboratorio', 'experimento', 'visual', 'manipulativo'
                 ],
                 'description': 'Creación de contenido interactivo y simulaciones matemáticas',
+                'examples': [
+                    'Hazme una actividad interactiva sobre el teorema de Pitágoras',
+                    'Inventa un juego para practicar las tablas de multiplicar',
+                    'Prepara una simulación de caída libre'
+                ],
                 'priority': 2
             }
         }
@@ -166,22 +290,23 @@ class AgentManager:
         
         try:
             # Determinar agente apropiado
-            if agent_type and agent_type in self.agents:
-                selected_agent_id = agent_type
-            else:
-                selected_agent_id = self._determine_best_agent(query)
+            selected_agent_id = self._select_agent(query, agent_type, context.get('query_embedding'))
             
-            # Verificar que el agente existe
-            if selected_agent_id not in self.agents:
-                raise ValueError(f"Agente '{selected_agent_id}' no disponible")
+            # Caché semántica: consulta equivalente sobre los mismos documentos
+            cached = self._lookup_cached_response(query, selected_agent_id, context)
+            if cached:
+                return self._build_cached_result(query, selected_agent_id, cached, start_time)
             
-            agent = self.agents[selected_agent_id]
+            # Obtener (o construir en el primer uso) el agente seleccionado
+            agent = self.get_agent(selected_agent_id)
             
             # Enriquecer contexto
             enriched_context = self._enrich_context(context, selected_agent_id)
             
-            # Procesar consulta
-            response = agent.process_query(query, enriched_context)
+            # Procesar consulta (lanza ProviderError si ningún proveedor responde);
+            # las consultas idénticas en curso comparten una sola llamada
+            response = self._coalesced_generate(agent, selected_agent_id, query, context, enriched_context)
+            self._store_cached_response(query, selected_agent_id, context, response, agent)
             
             # Calcular tiempo de respuesta
             response_time = (datetime.now() - start_time).total_seconds()
@@ -199,6 +324,7 @@ class AgentManager:
                 'response': response,
                 'response_time': response_time,
                 'context_used': enriched_context,
+                'cache_hit': False,
                 'timestamp': datetime.now().isoformat()
             }
             
@@ -213,39 +339,344 @@ class AgentManager:
             return {
                 'success': False,
                 'error': str(e),
+                'error_type': self._error_type(e),
                 'agent_used': selected_agent_id if 'selected_agent_id' in locals() else None,
                 'response': self._get_fallback_response(),
                 'response_time': response_time,
                 'timestamp': datetime.now().isoformat()
             }
     
-    def _determine_best_agent(self, query: str) -> str:
+    def stream_query(self, query: str, agent_type: Optional[str] = None,
+                     context: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
         """
-        Determinar el mejor agente para una consulta basándose en análisis de contenido
+        Versión streaming de route_query.
+        
+        Produce eventos a medida que el agente genera la respuesta:
+        - {'type': 'start', ...}: agente seleccionado
+        - {'type': 'token', 'text': ...}: fragmento de la respuesta
+        - {'type': 'end', ...} o {'type': 'error', ...}: resultado final
+        
+        Cerrar el generador cancela la llamada al proveedor.
+        """
+        start_time = datetime.now()
+        context = context or {}
+        selected_agent_id = None
+        
+        try:
+            selected_agent_id = self._select_agent(query, agent_type, context.get('query_embedding'))
+            
+            cached = self._lookup_cached_response(query, selected_agent_id, context)
+            if cached:
+                yield from self._cached_stream_events(
+                    self._build_cached_result(query, selected_agent_id, cached, start_time)
+                )
+                return
+            
+            agent = self.get_agent(selected_agent_id)
+            enriched_context = self._enrich_context(context, selected_agent_id)
+            
+            yield {
+                'type': 'start',
+                'agent_used': selected_agent_id,
+                'agent_name': agent.get_agent_name()
+            }
+            
+            chunks = []
+            agent_stream = agent.stream_query(query, enriched_context)
+            try:
+                for delta in agent_stream:
+                    chunks.append(delta)
+                    yield {'type': 'token', 'text': delta}
+            finally:
+                agent_stream.close()
+            
+            response = ''.join(chunks)
+            self._store_cached_response(query, selected_agent_id, context, response, agent)
+            response_time = (datetime.now() - start_time).total_seconds()
+            self._update_metrics(selected_agent_id, response_time, success=True)
+            self._log_interaction(query, selected_agent_id, response, response_time)
+            
+            yield {
+                'type': 'end',
+                'success': True,
+                'agent_used': selected_agent_id,
+                'agent_name': agent.get_agent_name(),
+                'response': response,
+                'response_time': response_time,
+                'cache_hit': False,
+                'timestamp': datetime.now().isoformat()
+            }
+            
+        except Exception as e:
+            response_time = (datetime.now() - start_time).total_seconds()
+            self._update_metrics(selected_agent_id or 'unknown', response_time, success=False)
+            
+            self.logger.error(f"Error en streaming de consulta: {e}")
+            
+            yield {
+                'type': 'error',
+                'success': False,
+                'error': str(e),
+                'error_type': self._error_type(e),
+                'agent_used': selected_agent_id,
+                'response': self._get_fallback_response(),
+                'response_time': response_time,
+                'timestamp': datetime.now().isoformat()
+            }
+    
+    async def aroute_query(self, query: str, agent_type: Optional[str] = None,
+                           context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Versión async de route_query (usa BaseAIService.agenerate)
+        """
+        start_time = datetime.now()
+        context = context or {}
+        selected_agent_id = None
+        
+        try:
+            selected_agent_id = self._select_agent(query, agent_type, context.get('query_embedding'))
+            
+            # Embedding y Redis son bloqueantes: fuera del event loop
+            cached = await asyncio.to_thread(self._lookup_cached_response, query, selected_agent_id, context)
+            if cached:
+                return self._build_cached_result(query, selected_agent_id, cached, start_time)
+            
+            # La primera consulta de un agente lo construye (clientes, tokenizer): fuera del loop
+            agent = await asyncio.to_thread(self.get_agent, selected_agent_id)
+            enriched_context = self._enrich_context(context, selected_agent_id)
+            
+            response = await self._acoalesced_generate(
+                agent, selected_agent_id, query, context, enriched_context
+            )
+            await asyncio.to_thread(
+                self._store_cached_response, query, selected_agent_id, context, response, agent
+            )
+            
+            response_time = (datetime.now() - start_time).total_seconds()
+            self._update_metrics(selected_agent_id, response_time, success=True)
+            self._log_interaction(query, selected_agent_id, response, response_time)
+            
+            return {
+                'success': True,
+                'agent_used': selected_agent_id,
+                'agent_name': agent.get_agent_name(),
+                'response': response,
+                'response_time': response_time,
+                'context_used': enriched_context,
+                'cache_hit': False,
+                'timestamp': datetime.now().isoformat()
+            }
+            
+        except Exception as e:
+            response_time = (datetime.now() - start_time).total_seconds()
+            self._update_metrics(selected_agent_id or 'unknown', response_time, success=False)
+            
+            self.logger.error(f"Error procesando consulta async: {e}")
+            
+            return {
+                'success': False,
+                'error': str(e),
+                'error_type': self._error_type(e),
+                'agent_used': selected_agent_id,
+                'response': self._get_fallback_response(),
+                'response_time': response_time,
+                'timestamp': datetime.now().isoformat()
+            }
+    
+    async def astream_query(self, query: str, agent_type: Optional[str] = None,
+                            context: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
         """
-        query_lower = query.lower()
-        agent_scores = {}
+        Versión async de stream_query. Cancelar la tarea que lo consume
+        cancela la llamada al proveedor.
+        """
+        start_time = datetime.now()
+        context = context or {}
+        selected_agent_id = None
         
-        # Analizar keywords para cada agente
-        for agent_id, config in self.routing_config.items():
-            score = 0
-            keywords = config['keywords']
+        try:
+            selected_agent_id = self._select_agent(query, agent_type, context.get('query_embedding'))
+            
+            cached = await asyncio.to_thread(self._lookup_cached_response, query, selected_agent_id, context)
+            if cached:
+                for event in self._cached_stream_events(
+                    self._build_cached_result(query, selected_agent_id, cached, start_time)
+                ):
+                    yield event
+                return
+            
+            agent = await asyncio.to_thread(self.get_agent, selected_agent_id)
+            enriched_context = self._enrich_context(context, selected_agent_id)
+            
+            yield {
+                'type': 'start',
+                'agent_used': selected_agent_id,
+                'agent_name': agent.get_agent_name()
+            }
+            
+            chunks = []
+            agent_stream = agent.astream_query(query, enriched_context)
+            try:
+                async for delta in agent_stream:
+                    chunks.append(delta)
+                    yield {'type': 'token', 'text': delta}
+            finally:
+                await agent_stream.aclose()
+            
+            response = ''.join(chunks)
+            await asyncio.to_thread(
+                self._store_cached_response, query, selected_agent_id, context, response, agent
+            )
+            response_time = (datetime.now() - start_time).total_seconds()
+            self._update_metrics(selected_agent_id, response_time, success=True)
+            self._log_interaction(query, selected_agent_id, response, response_time)
             
-            # Contar matches de keywords
-            for keyword in keywords:
-                if keyword in query_lower:
-                    score += 1
+            yield {
+                'type': 'end',
+                'success': True,
+                'agent_used': selected_agent_id,
+                'agent_name': agent.get_agent_name(),
+                'response': response,
+                'response_time': response_time,
+                'cache_hit': False,
+                'timestamp': datetime.now().isoformat()
+            }
+            
+        except Exception as e:
+            response_time = (datetime.now() - start_time).total_seconds()
+            self._update_metrics(selected_agent_id or 'unknown', response_time, success=False)
+            
+            self.logger.error(f"Error en streaming async de consulta: {e}")
             
-            # Aplicar factor de prioridad
-            priority_factor = 1.0 / config['priority']
-            agent_scores[agent_id] = score * priority_factor
+            yield {
+                'type': 'error',
+                'success': False,
+                'error': str(e),
+                'error_type': self._error_type(e),
+                'agent_used': selected_agent_id,
+                'response': self._get_fallback_response(),
+                'response_time': response_time,
+                'timestamp': datetime.now().isoformat()
+            }
+    
+    def _coalesced_generate(self, agent: BaseAIService, agent_id: str, query: str,
+                            context: Dict[str, Any], enriched_context: Dict[str, Any]) -> str:
+        """Generar la respuesta compartiendo la llamada con consultas idénticas en curso"""
+        with span('agent.generate', agent=agent_id):
+            if self.single_flight is None:
+                return agent.generate(query, enriched_context)
+            key = self.single_flight.make_key(agent_id, query, context)
+            return self.single_flight.do(key, lambda: agent.generate(query, enriched_context))
+    
+    async def _acoalesced_generate(self, agent: BaseAIService, agent_id: str, query: str,
+                                   context: Dict[str, Any], enriched_context: Dict[str, Any]) -> str:
+        """Versión async de _coalesced_generate"""
+        with span('agent.generate', agent=agent_id):
+            if self.single_flight is None:
+                return await agent.agenerate(query, enriched_context)
+            key = self.single_flight.make_key(agent_id, query, context)
+            return await self.single_flight.ado(key, lambda: agent.agenerate(query, enriched_context))
+    
+    def _lookup_cached_response(self, query: str, agent_id: str,
+                                context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Buscar una respuesta equivalente en la caché semántica"""
+        if self.response_cache is None:
+            return None
+        with span('cache.lookup', agent=agent_id) as lookup_span:
+            cached = self.response_cache.lookup(query, agent_id, context)
+            lookup_span.set('cache_hit', cached is not None)
+        current_span().set('cache_hit', cached is not None)
+        return cached
+    
+    def _store_cached_response(self, query: str, agent_id: str, context: Dict[str, Any],
+                               response: str, agent: BaseAIService):
+        """Guardar la respuesta en la caché si es una respuesta real del proveedor"""
+        if self.response_cache is None or not response:
+            return
+        # No cachear mensajes de validación (los errores del proveedor llegan como excepción)
+        if agent._validate_query(query):
+            return
+        with span('cache.store', agent=agent_id):
+            self.response_cache.store(query, agent_id, context, response, agent.get_agent_name())
+    
+    @staticmethod
+    def _error_type(error: Exception) -> str:
+        """Tipo de error para el cliente: 'provider_timeout', 'provider_rate_limit', ..."""
+        if isinstance(error, ProviderTimeoutError):
+            return 'provider_timeout'
+        if isinstance(error, ProviderRateLimitError):
+            return 'provider_rate_limit'
+        if isinstance(error, ProviderThrottledError):
+            return 'provider_throttled'
+        if isinstance(error, ProviderUnavailableError):
+            return 'provider_unavailable'
+        if isinstance(error, ProviderError):
+            return 'provider_error'
+        return 'internal_error'
+    
+    def _build_cached_result(self, query: str, agent_id: str, cached: Dict[str, Any],
+                             start_time: datetime) -> Dict[str, Any]:
+        """Resultado de route_query para un hit de la caché"""
+        response_time = (datetime.now() - start_time).total_seconds()
+        self._update_metrics(agent_id, response_time, success=True, cache_hit=True)
+        self._log_interaction(query, agent_id, cached['response'], response_time)
+        
+        return {
+            'success': True,
+            'agent_used': agent_id,
+            'agent_name': cached.get('agent_name') or self.AGENT_CLASSES[agent_id].agent_name,
+            'response': cached['response'],
+            'response_time': response_time,
+            'cache_hit': True,
+            'cache_similarity': cached['similarity'],
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    @staticmethod
+    def _cached_stream_events(result: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """Eventos de streaming para una respuesta cacheada (un único token)"""
+        yield {'type': 'start', 'agent_used': result['agent_used'], 'agent_name': result['agent_name']}
+        yield {'type': 'token', 'text': result['response']}
+        yield {'type': 'end', **result}
+    
+    def _select_agent(self, query: str, agent_type: Optional[str] = None,
+                      query_embedding: Optional[Any] = None) -> str:
+        """Usar el agente solicitado si existe; si no, routing automático"""
+        with span('routing', requested=agent_type or 'auto') as routing_span:
+            if agent_type and agent_type in self.agent_slots:
+                selected = agent_type
+            else:
+                selected = self._determine_best_agent(query, query_embedding)
+            routing_span.set('agent', selected)
+        current_span().set('agent', selected)
+        return selected
+    
+    def _determine_best_agent(self, query: str, query_embedding: Optional[Any] = None) -> str:
+        """
+        Determinar el mejor agente para una consulta basándose en análisis de contenido
+        """
+        # Routing semántico con el embedding que ya calculó la etapa RAG
+        if self.semantic_router is not None and query_embedding is not None:
+            decision = self.semantic_router.route(query_embedding)
+            if decision is not None:
+                agent_id, similarity, margin = decision
+                current_span().update(method='semantic', similarity=round(similarity, 3))
+                self.metrics_registry.inc('routing_decisions_total', method='semantic')
+                self.logger.info(f"Query routing: '{query[:50]}...' -> {agent_id} "
+                                 f"(similitud: {similarity:.3f}, margen: {margin:.3f})")
+                return agent_id
+        
+        # Tabla de keywords compilada en una sola regex (ver router.py);
+        # puntajes = keywords encontradas × factor de prioridad
+        agent_scores = self.router.scores(query)
         
         # Si no hay matches claros, usar tutor como default
         if not any(score > 0 for score in agent_scores.values()):
+            self.metrics_registry.inc('routing_decisions_total', method='default')
             return 'tutor'
         
         # Retornar agente con mayor score
         best_agent = max(agent_scores, key=agent_scores.get)
+        self.metrics_registry.inc('routing_decisions_total', method='keyword')
         
         self.logger.info(f"Query routing: '{query[:50]}...' -> {best_agent} (score: {agent_scores[best_agent]})")
         return best_agent
@@ -266,19 +697,11 @@ class AgentManager:
         
         return enriched_context
     
-    def _update_metrics(self, agent_id: str, response_time: float, success: bool):
+    def _update_metrics(self, agent_id: str, response_time: float, success: bool, cache_hit: bool = False):
         """Actualizar métricas de rendimiento"""
-        self.metrics['total_queries'] += 1
-        
-        if agent_id in self.metrics['agent_usage']:
-            self.metrics['agent_usage'][agent_id] += 1
-        
-        # Actualizar tiempo promedio de respuesta
-        total_time = self.metrics['average_response_time'] * (self.metrics['total_queries'] - 1)
-        self.metrics['average_response_time'] = (total_time + response_time) / self.metrics['total_queries']
-        
-        if not success:
-            self.metrics['errors'] += 1
+        outcome = 'error' if not success else ('cache_hit' if cache_hit else 'success')
+        self.metrics_registry.inc('agent_requests_total', agent=agent_id, outcome=outcome)
+        self.metrics_registry.observe('agent_request_duration_seconds', response_time, agent=agent_id)
     
     def _log_interaction(self, query: str, agent_id: str, response: str, response_time: float):
         """Registrar interacción en logs"""
@@ -302,45 +725,57 @@ Por favor, intenta reformular tu pregunta o especifica qué tipo de ayuda necesi
 """
     
     def _get_session_metrics(self) -> Dict[str, Any]:
-        """Obtener métricas de la sesión actual"""
+        """
+        Métricas de este worker para el contexto de cada consulta
+        
+        Se leen de los contadores locales, como la propiedad metrics: collect()
+        vuelca y consulta Redis, y queda para /metrics.
+        """
+        outcomes = self.metrics_registry.local_counter_by('agent_requests_total', 'outcome')
+        total = sum(outcomes.values())
         return {
-            'queries_processed': self.metrics['total_queries'],
-            'average_response_time': self.metrics['average_response_time'],
-            'error_rate': self.metrics['errors'] / max(self.metrics['total_queries'], 1) * 100
+            'queries_processed': int(total),
+            'average_response_time': self.metrics_registry.local_mean('agent_request_duration_seconds'),
+            'error_rate': outcomes.get('error', 0) / max(total, 1) * 100
         }
     
     # Métodos públicos para gestión de agentes
     
     def get_available_agents(self) -> Dict[str, Dict[str, Any]]:
-        """Obtener información de todos los agentes disponibles"""
+        """Obtener información de todos los agentes disponibles (sin construirlos)"""
         agents_info = {}
+        agent_usage = self.metrics['agent_usage']
         
-        for agent_id, agent in self.agents.items():
+        for agent_id, slot in self.agent_slots.items():
             agents_info[agent_id] = {
                 'id': agent_id,
-                'name': agent.get_agent_name(),
+                'name': slot.agent_class.agent_name,
                 'description': self.routing_config.get(agent_id, {}).get('description', 'N/A'),
-                'status': 'active' if agent else 'inactive',
+                'status': 'inactive' if slot.last_error else 'active',
+                'loaded': slot.is_loaded,
                 'capabilities': self.get_agent_capabilities(agent_id),
-                'usage_count': self.metrics['agent_usage'].get(agent_id, 0)
+                'usage_count': agent_usage.get(agent_id, 0)
             }
         
         return agents_info
     
     def get_agent_capabilities(self, agent_id: str) -> Dict[str, Any]:
         """Obtener capacidades específicas de un agente"""
-        if agent_id not in self.agents:
+        if agent_id not in self.agent_slots:
             return {}
         
-        agent = self.agents[agent_id]
+        slot = self.agent_slots[agent_id]
         
         try:
-            if hasattr(agent, 'get_specialized_capabilities'):
-                return agent.get_specialized_capabilities()
-            elif hasattr(agent, 'get_capabilities'):
+            # Agente ya construido: capacidades reales de la instancia
+            if slot.is_loaded:
+                agent = slot.instance
+                if hasattr(agent, 'get_specialized_capabilities'):
+                    return agent.get_specialized_capabilities()
                 return agent.get_capabilities()
-            else:
-                return {'basic_ai_capabilities': True}
+            
+            # Agente aún no construido: metadatos de clase
+            return slot.agent_class.describe_capabilities()
         except Exception as e:
             self.logger.warning(f"Error obteniendo capacidades del agente {agent_id}: {e}")
             return {}
@@ -349,20 +784,23 @@ Por favor, intenta reformular tu pregunta o especifica qué tipo de ayuda necesi
         """Verificar estado de salud del sistema de agentes"""
         health_status = {
             'status': 'healthy',
-            'agents_online': len(self.agents),
-            'total_agents': 5,  # Número esperado de agentes
-            'metrics': self.metrics.copy(),
+            'agents_online': sum(1 for slot in self.agent_slots.values() if not slot.last_error),
+            'agents_loaded': sum(1 for slot in self.agent_slots.values() if slot.is_loaded),
+            'total_agents': len(self.agent_slots),
+            'metrics': self.metrics,
             'timestamp': datetime.now().isoformat()
         }
         
-        # Verificar estado de cada agente
+        # Verificar estado de cada agente (sin construir los que no se usaron)
         agent_health = {}
-        for agent_id, agent in self.agents.items():
+        for agent_id, slot in self.agent_slots.items():
             try:
-                if hasattr(agent, 'health_check'):
-                    agent_status = agent.health_check()
+                if slot.is_loaded:
+                    agent_status = slot.instance.health_check()
+                elif slot.last_error:
+                    agent_status = {'status': 'error', 'message': slot.last_error, 'loaded': False}
                 else:
-                    agent_status = {'status': 'unknown', 'message': 'Health check not implemented'}
+                    agent_status = slot.agent_class.describe_health()
                 
                 agent_health[agent_id] = agent_status
             except Exception as e:
@@ -370,59 +808,57 @@ Por favor, intenta reformular tu pregunta o especifica qué tipo de ayuda necesi
         
         health_status['agents_status'] = agent_health
         
+        # Estado de los circuit breakers (compartidos por todos los agentes)
+        circuit_breakers = get_circuit_breakers()
+        health_status['circuit_breakers'] = circuit_breakers.snapshot()
+        
         # Determinar estado general
         failed_agents = sum(1 for status in agent_health.values() 
                           if status.get('status') != 'healthy')
         
         if failed_agents > 0:
-            health_status['status'] = 'degraded' if failed_agents < len(self.agents) / 2 else 'unhealthy'
+            health_status['status'] = 'degraded' if failed_agents < len(self.agent_slots) / 2 else 'unhealthy'
+        elif circuit_breakers.any_open():
+            health_status['status'] = 'degraded'
         
         return health_status
     
     def get_usage_statistics(self) -> Dict[str, Any]:
         """Obtener estadísticas de uso detalladas"""
+        metrics = self.metrics
         return {
-            'total_queries': self.metrics['total_queries'],
-            'agent_usage_distribution': self.metrics['agent_usage'].copy(),
-            'average_response_time': self.metrics['average_response_time'],
-            'error_rate': self.metrics['errors'] / max(self.metrics['total_queries'], 1) * 100,
-            'most_used_agent': max(self.metrics['agent_usage'], 
-                                 key=self.metrics['agent_usage'].get) if self.metrics['agent_usage'] else None,
+            'total_queries': metrics['total_queries'],
+            'agent_usage_distribution': metrics['agent_usage'],
+            'average_response_time': metrics['average_response_time'],
+            'error_rate': metrics['errors'] / max(metrics['total_queries'], 1) * 100,
+            'most_used_agent': max(metrics['agent_usage'], 
+                                 key=metrics['agent_usage'].get) if any(metrics['agent_usage'].values()) else None,
+            'latency_percentiles': self.metrics_registry.summary(),
+            'response_cache': self.response_cache.get_stats() if self.response_cache else None,
+            'rate_limiter': get_rate_limiter().get_stats(),
+            'coalescing': self.single_flight.get_stats() if self.single_flight else None,
+            'tracing': get_tracer().get_stats(),
+            'routing_cache': self.router.cache_info(),
+            'context_cache': get_context_cache().get_stats(),
             'uptime': 'Sistema activo',  # Se podría calcular tiempo real
             'last_updated': datetime.now().isoformat()
         }
     
     def reset_metrics(self):
         """Reiniciar métricas de uso"""
-        self.metrics = {
-            'total_queries': 0,
-            'agent_usage': {agent_id: 0 for agent_id in self.agents.keys()},
-            'average_response_time': 0,
-            'errors': 0
-        }
+        self.metrics_registry.reset()
         self.logger.info("Métricas reiniciadas")
     
     def reload_agent(self, agent_id: str) -> bool:
         """Recargar un agente específico"""
-        if agent_id not in self.agents:
+        if agent_id not in self.agent_slots:
             return False
         
         try:
-            # Mapeo de IDs a clases
-            agent_classes = {
-                'tutor': TutorAgent,
-                'evaluator': EvaluatorAgent,
-                'counselor': CounselorAgent,
-                'curriculum': CurriculumPlannerAgent,
-                'analytics': AnalyticsAgent
-            }
-            
-            if agent_id in agent_classes:
-                self.agents[agent_id] = agent_classes[agent_id]()
-                self.logger.info(f"Agente {agent_id} recargado exitosamente")
-                return True
-            
+            self.agent_slots[agent_id].reload()
+            self.logger.info(f"Agente {agent_id} recargado exitosamente")
+            return True
         except Exception as e:
             self.logger.error(f"Error recargando agente {agent_id}: {e}")
         
-        return False 
\ No newline at end of file
+        return False
@@ -4,31 +4,66 @@ Este módulo contiene la clase base que todos los agentes especializados heredar
 """
 
 import os
+import time
 import logging
 import asyncio
 from abc import ABC, abstractmethod
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterator, AsyncIterator, Tuple
 from datetime import datetime
 
-import tiktoken
 from openai import OpenAI
 from anthropic import Anthropic
 from django.conf import settings
 
+from .registry import (
+    get_llm_clients, get_circuit_breakers, get_prompt_assembler, get_rate_limiter, get_metrics
+)
+from .prompt_assembler import PromptSection, AssembledPrompt
+from .circuit_breaker import OPEN as CIRCUIT_OPEN
+from .errors import ProviderError, ProviderUnavailableError, ProviderRateLimitError, classify_provider_error
+from .hedging import (
+    StreamFactory, AsyncStreamFactory, hedged_stream, ahedged_stream,
+    hedge_delay, hedging_enabled, latency_tracker, register_stream, attempt_cancelled
+)
+from .tracing import span
+
 # Configurar logging
 logger = logging.getLogger(__name__)
 
+EXPLICIT_CONTEXT_HEADER = """
+--- Contexto Explícito Proporcionado por el Usuario ---
+El usuario ha seleccionado el siguiente texto del documento para que lo uses como contexto principal para tu respuesta. Préstale especial atención:
+
+<context>
+"""
+
 class BaseAIService(ABC):
     """
     Clase base para todos los servicios de IA.
     Proporciona funcionalidad común para interactuar con APIs de IA.
     """
     
+    # Metadatos de clase: cada agente los sobrescribe para que el AgentManager
+    # pueda describirlo sin construirlo (clientes, tokenizer, etc.)
+    agent_name: str = ''
+    specialized_capabilities: Dict[str, Any] = {}
+    
     def __init__(self):
         """Inicializar el servicio base de IA"""
         # Configurar logging primero
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.encoding = tiktoken.get_encoding("cl100k_base")
+        
+        # Tokenizer y clientes compartidos por todos los agentes del proceso
+        self.llm_clients = get_llm_clients()
+        self.encoding = self.llm_clients.encoding
+        # Circuit breakers por proveedor, compartidos por todos los agentes
+        self.circuit_breakers = get_circuit_breakers()
+        # Ensamblador de prompts con presupuesto de tokens por modelo
+        self.prompt_assembler = get_prompt_assembler()
+        # Cupos de peticiones/tokens por proveedor y modelo
+        self.rate_limiter = get_rate_limiter()
+        # Histogramas de latencia por proveedor y etapa
+        self.metrics_registry = get_metrics()
         
         self.openai_client = self._init_openai_client()
         self.claude_client = self._init_claude_client()
@@ -39,28 +74,12 @@ class BaseAIService(ABC):
         self.timeout = int(os.getenv('AGENT_RESPONSE_TIMEOUT', 30))
     
     def _init_openai_client(self) -> Optional[OpenAI]:
-        """Inicializar cliente de OpenAI"""
-        try:
-            api_key = os.getenv('OPENAI_API_KEY')
-            if not api_key or api_key == 'sk-your-openai-key-here':
-                self.logger.warning("OpenAI API key no configurada")
-                return None
-            return OpenAI(api_key=api_key)
-        except Exception as e:
-            self.logger.error(f"Error inicializando cliente OpenAI: {e}")
-            return None
+        """Obtener el cliente compartido de OpenAI"""
+        return self.llm_clients.get_openai_client()
     
     def _init_claude_client(self) -> Optional[Anthropic]:
-        """Inicializar cliente de Claude"""
-        try:
-            api_key = os.getenv('ANTHROPIC_API_KEY')
-            if not api_key or api_key == 'your-claude-key-here':
-                self.logger.warning("Claude API key no configurada")
-                return None
-            return Anthropic(api_key=api_key)
-        except Exception as e:
-            self.logger.error(f"Error inicializando cliente Claude: {e}")
-            return None
+        """Obtener el cliente compartido de Claude"""
+        return self.llm_clients.get_claude_client()
     
     @abstractmethod
     def get_system_prompt(self) -> str:
@@ -101,9 +120,10 @@ class BaseAIService(ABC):
             char_limit = max_tokens * 4  # Aproximación
             return text[:char_limit] + "..." if len(text) > char_limit else text
     
-    def _build_context_prompt(self, query: str, context: Dict[str, Any]) -> str:
+    def _build_prompt_sections(self, query: str, context: Dict[str, Any]) -> List[PromptSection]:
         """
-        Construir el prompt con contexto para el agente.
+        Secciones del prompt con su prioridad (menor = más importante).
+        La consulta y la instrucción final son obligatorias.
         """
         user_level = context.get('user_level', 'Estudiante')
         subject = context.get('subject', 'General')
@@ -112,91 +132,301 @@ class BaseAIService(ABC):
         user_profile = context.get('user_profile', {})
         explicit_context = context.get('explicit_context', None)
         
-        # Construir contexto explícito del usuario
-        explicit_context_prompt = ""
+        sections = []
+        
+        # Contexto explícito del usuario
         if explicit_context:
-            explicit_context_prompt = f"""
---- Contexto Explícito Proporcionado por el Usuario ---
-El usuario ha seleccionado el siguiente texto del documento para que lo uses como contexto principal para tu respuesta. Préstale especial atención:
-
-<context>
-{explicit_context}
-</context>
-"""
-
-        # Construir contexto de conversación
-        conversation_context = ""
+            sections.append(PromptSection(
+                'explicit_context', f"{explicit_context}\n</context>\n",
+                header=EXPLICIT_CONTEXT_HEADER, priority=10
+            ))
+        
+        # Perfil de usuario
+        if user_profile:
+            sections.append(PromptSection(
+                'user_profile',
+                f"Nombre: {user_profile.get('name', 'Usuario')}\n"
+                f"Nivel: {user_level}\n"
+                f"Área de interés: {subject}\n",
+                header="\n--- Perfil del Usuario ---\n", priority=20, truncate=None
+            ))
+        
+        # Historial de conversación: si no cabe se conservan los mensajes más recientes
         if conversation_history:
-            conversation_context = "\n--- Historial de Conversación Reciente ---\n"
-            for msg in conversation_history[-5:]:  # Últimos 5 mensajes
-                role = msg.get('role', 'unknown')
-                content = msg.get('content', '')
-                conversation_context += f"{role.upper()}: {content}\n"
-        
-        # Construir contexto de documentos
-        documents_context = ""
+            history = ''.join(
+                f"{msg.get('role', 'unknown').upper()}: {msg.get('content', '')}\n"
+                for msg in conversation_history[-5:]  # Últimos 5 mensajes
+            )
+            sections.append(PromptSection(
+                'conversation_history', history,
+                header="\n--- Historial de Conversación Reciente ---\n", priority=30, truncate='head'
+            ))
+        
+        # Documentos relevantes: ordenados por relevancia, se trunca por el final
         if relevant_documents:
-            documents_context = "\n--- Documentos Relevantes ---\n"
-            for i, doc in enumerate(relevant_documents[:3]):  # Top 3 documentos
-                documents_context += f"Documento {i+1}: {doc[:300]}...\n"
+            documents = ''.join(
+                f"Documento {i+1}: {doc[:300]}...\n"
+                for i, doc in enumerate(relevant_documents[:3])  # Top 3 documentos
+            )
+            sections.append(PromptSection(
+                'relevant_documents', documents,
+                header="\n--- Documentos Relevantes ---\n", priority=40
+            ))
         
-        # Construir perfil de usuario
-        profile_context = ""
-        if user_profile:
-            profile_context = f"\n--- Perfil del Usuario ---\n"
-            profile_context += f"Nombre: {user_profile.get('name', 'Usuario')}\n"
-            profile_context += f"Nivel: {user_level}\n"
-            profile_context += f"Área de interés: {subject}\n"
-        
-        # Prompt final
-        context_prompt = f"""
-{explicit_context_prompt}
-{profile_context}
-{conversation_context}
-{documents_context}
-
---- Consulta Actual ---
-{query}
-
-Por favor, responde como {self.get_agent_name()} considerando todo el contexto proporcionado.
-"""
+        sections.append(PromptSection(
+            'query', f"{query}\n",
+            header="\n--- Consulta Actual ---\n", required=True, truncate=None
+        ))
+        sections.append(PromptSection(
+            'instructions',
+            f"\nPor favor, responde como {self.get_agent_name()} considerando todo el contexto proporcionado.\n",
+            required=True, truncate=None, static=True
+        ))
+        return sections
+    
+    def _assemble_prompt(self, query: str, context: Dict[str, Any],
+                         model: Optional[str] = None) -> AssembledPrompt:
+        """Ensamblar sistema + contexto dentro del presupuesto de tokens del modelo"""
+        system_prompt = self.get_system_prompt()
+        # Prefijo compartido por un lote de llamadas (p.ej. rúbrica en calificación masiva):
+        # va en el sistema para que el prefijo sea idéntico y su conteo se cachee
+        shared_prefix = context.get('shared_prefix')
+        if shared_prefix:
+            system_prompt = f"{system_prompt}\n{shared_prefix}"
+        started = time.monotonic()
+        with span('prompt.build', agent=self.__class__.__name__, model=model or '') as build_span:
+            prompt = self.prompt_assembler.assemble(
+                system_prompt, self._build_prompt_sections(query, context), model=model
+            )
+            self.metrics_registry.observe(
+                'chat_stage_duration_seconds', time.monotonic() - started, stage='prompt.build'
+            )
+            build_span.update(
+                system_tokens=prompt.system_tokens,
+                prompt_tokens=prompt.prompt_tokens,
+                truncated=','.join(prompt.truncated),
+                dropped=','.join(prompt.dropped)
+            )
+        return prompt
+    
+    def _build_context_prompt(self, query: str, context: Dict[str, Any]) -> str:
+        """
+        Construir el prompt con contexto para el agente.
+        """
+        return self._assemble_prompt(query, context).prompt
+    
+    def _validate_query(self, query: str) -> Optional[str]:
+        """Validar la consulta; devuelve el mensaje de error o None si es válida"""
+        if not query or not query.strip():
+            return "Por favor, proporciona una consulta válida."
         
-        return context_prompt
+        max_length = int(os.getenv('MAX_INPUT_LENGTH', 5000))
+        if len(query) > max_length:
+            return f"La consulta es demasiado larga. Máximo {max_length} caracteres."
+        
+        return None
     
-    def process_query_with_openai(self, query: str, context: Dict[str, Any]) -> str:
+    UNAVAILABLE_MESSAGE = (
+        "Lo siento, los servicios de IA no están disponibles en este momento. "
+        "Por favor, configura las API keys en el archivo .env."
+    )
+    
+    # Llamadas directas a cada proveedor: lanzan ProviderError tipado
+    
+    @staticmethod
+    def _model(provider: str) -> str:
+        """Modelo configurado para el proveedor"""
+        if provider == 'openai':
+            return os.getenv('OPENAI_MODEL', 'gpt-4-turbo')
+        return os.getenv('CLAUDE_MODEL', 'claude-3-sonnet-20240229')
+    
+    def _openai_request(self, query: str, context: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
         """
-        Procesar consulta usando OpenAI GPT.
+        Parámetros de la llamada a OpenAI.
+        
+        Returns:
+            (parámetros, tokens estimados: prompt + respuesta máxima)
+        """
+        model = self._model('openai')
+        prompt = self._assemble_prompt(query, context, model)
+        self.logger.info(f"Procesando consulta con OpenAI - Tokens: {prompt.total_tokens}")
+        return {
+            'model': model,
+            'messages': [
+                {"role": "system", "content": prompt.system_prompt},
+                {"role": "user", "content": prompt.prompt}
+            ],
+            'temperature': self.temperature,
+            'max_tokens': self.max_tokens,
+            'timeout': self.timeout
+        }, prompt.total_tokens + self.max_tokens
+    
+    def _claude_request(self, query: str, context: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+        """
+        Parámetros de la llamada a Claude.
+        
+        Returns:
+            (parámetros, tokens estimados: prompt + respuesta máxima)
         """
+        model = self._model('claude')
+        prompt = self._assemble_prompt(query, context, model)
+        self.logger.info(f"Procesando consulta con Claude - Tokens: {prompt.total_tokens}")
+        return {
+            'model': model,
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+            'system': prompt.system_prompt,
+            'messages': [
+                {"role": "user", "content": prompt.prompt}
+            ]
+        }, prompt.total_tokens + self.max_tokens
+    
+    def _admit(self, provider: str, tokens: int, context: Dict[str, Any]):
+        """Esperar turno en el rate limiter del proveedor (el chat tiene prioridad sobre los lotes)"""
+        started = time.monotonic()
+        with span('rate_limit.wait', provider=provider, tokens=tokens):
+            self.rate_limiter.acquire(
+                provider, self._model(provider), tokens, priority=context.get('priority', 'interactive')
+            )
+        self.metrics_registry.observe('chat_stage_duration_seconds', time.monotonic() - started,
+                                      stage='rate_limit.wait')
+    
+    async def _aadmit(self, provider: str, tokens: int, context: Dict[str, Any]):
+        """Versión async de _admit"""
+        started = time.monotonic()
+        with span('rate_limit.wait', provider=provider, tokens=tokens):
+            await self.rate_limiter.aacquire(
+                provider, self._model(provider), tokens, priority=context.get('priority', 'interactive')
+            )
+        self.metrics_registry.observe('chat_stage_duration_seconds', time.monotonic() - started,
+                                      stage='rate_limit.wait')
+    
+    def _provider_error(self, provider: str, error: BaseException) -> ProviderError:
+        """Clasificar el error; un 429 del proveedor vacía su cubeta en el rate limiter"""
+        provider_error = classify_provider_error(provider, error)
+        if isinstance(provider_error, ProviderRateLimitError):
+            self.rate_limiter.report_rate_limited(provider, self._model(provider))
+        return provider_error
+    
+    @staticmethod
+    def _record_usage(call_span, provider: str, response):
+        """Tokens reales de la respuesta en el span de la llamada"""
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return
+        if provider == 'openai':
+            call_span.update(input_tokens=usage.prompt_tokens, output_tokens=usage.completion_tokens)
+        else:
+            call_span.update(input_tokens=usage.input_tokens, output_tokens=usage.output_tokens)
+    
+    def call_openai(self, query: str, context: Dict[str, Any]) -> str:
+        """Llamar a OpenAI; lanza ProviderError si falla"""
         if not self.openai_client:
-            return "Lo siento, el servicio de OpenAI no está disponible en este momento."
+            raise ProviderUnavailableError('openai', "El servicio de OpenAI no está configurado")
+        with span('llm.call', provider='openai', model=self._model('openai'), stream=False) as call_span:
+            try:
+                request, tokens = self._openai_request(query, context)
+                self._admit('openai', tokens, context)
+                response = self.openai_client.chat.completions.create(**request)
+                with span('llm.parse'):
+                    self._record_usage(call_span, 'openai', response)
+                    return response.choices[0].message.content
+            except Exception as e:
+                raise self._provider_error('openai', e) from e
+    
+    def call_claude(self, query: str, context: Dict[str, Any]) -> str:
+        """Llamar a Claude; lanza ProviderError si falla"""
+        if not self.claude_client:
+            raise ProviderUnavailableError('claude', "El servicio de Claude no está configurado")
+        with span('llm.call', provider='claude', model=self._model('claude'), stream=False) as call_span:
+            try:
+                request, tokens = self._claude_request(query, context)
+                self._admit('claude', tokens, context)
+                response = self.claude_client.messages.create(**request)
+                with span('llm.parse'):
+                    self._record_usage(call_span, 'claude', response)
+                    return response.content[0].text
+            except Exception as e:
+                raise self._provider_error('claude', e) from e
+    
+    @staticmethod
+    def _close_stream(stream):
+        """Cerrar un stream del SDK liberando la conexión HTTP"""
+        try:
+            if hasattr(stream, 'close'):
+                stream.close()
+            elif hasattr(stream, 'response'):
+                stream.response.close()
+        except Exception:
+            pass
+    
+    def stream_query_with_openai(self, query: str, context: Dict[str, Any]) -> Iterator[str]:
+        """
+        Procesar consulta con OpenAI en modo streaming.
+        Produce fragmentos de texto a medida que llegan; lanza ProviderError si falla.
+        """
+        if not self.openai_client:
+            raise ProviderUnavailableError('openai', "El servicio de OpenAI no está configurado")
         
         try:
-            # Construir prompt con contexto
-            context_prompt = self._build_context_prompt(query, context)
-            system_prompt = self.get_system_prompt()
-            
-            # Verificar límites de tokens
-            total_tokens = self.count_tokens(system_prompt + context_prompt)
-            if total_tokens > 3000:  # Dejar espacio para la respuesta
-                context_prompt = self.truncate_to_token_limit(context_prompt, 2000)
-            
-            self.logger.info(f"Procesando consulta con OpenAI - Tokens: {total_tokens}")
-            
-            # Llamada a OpenAI
-            response = self.openai_client.chat.completions.create(
-                model=os.getenv('OPENAI_MODEL', 'gpt-4-turbo'),
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": context_prompt}
-                ],
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                timeout=self.timeout
-            )
-            
-            return response.choices[0].message.content
-            
+            request, tokens = self._openai_request(query, context)
+            self._admit('openai', tokens, context)
+            stream = self.openai_client.chat.completions.create(stream=True, **request)
+            register_stream(lambda: self._close_stream(stream))
+        except Exception as e:
+            raise self._provider_error('openai', e) from e
+        
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
         except Exception as e:
+            raise self._provider_error('openai', e) from e
+        finally:
+            # También se ejecuta al cancelar (close() del generador)
+            self._close_stream(stream)
+    
+    def stream_query_with_claude(self, query: str, context: Dict[str, Any]) -> Iterator[str]:
+        """
+        Procesar consulta con Claude en modo streaming.
+        Produce fragmentos de texto a medida que llegan; lanza ProviderError si falla.
+        """
+        if not self.claude_client:
+            raise ProviderUnavailableError('claude', "El servicio de Claude no está configurado")
+        
+        try:
+            request, tokens = self._claude_request(query, context)
+            self._admit('claude', tokens, context)
+            stream = self.claude_client.messages.create(stream=True, **request)
+            register_stream(lambda: self._close_stream(stream))
+        except Exception as e:
+            raise self._provider_error('claude', e) from e
+        
+        try:
+            for event in stream:
+                if getattr(event, 'type', None) == 'content_block_delta':
+                    text = getattr(event.delta, 'text', None)
+                    if text:
+                        yield text
+        except Exception as e:
+            raise self._provider_error('claude', e) from e
+        finally:
+            self._close_stream(stream)
+    
+    # API legacy: devuelve el texto del error en lugar de lanzar excepción
+    
+    def process_query_with_openai(self, query: str, context: Dict[str, Any]) -> str:
+        """
+        Procesar consulta usando OpenAI GPT.
+        """
+        try:
+            return self.call_openai(query, context)
+        except ProviderUnavailableError:
+            return "Lo siento, el servicio de OpenAI no está disponible en este momento."
+        except ProviderError as e:
             self.logger.error(f"Error procesando consulta con OpenAI: {e}")
             return f"Lo siento, hubo un error procesando tu consulta: {str(e)}"
     
@@ -204,65 +434,565 @@ Por favor, responde como {self.get_agent_name()} considerando todo el contexto p
         """
         Procesar consulta usando Claude de Anthropic.
         """
-        if not self.claude_client:
-            return "Lo siento, el servicio de Claude no está disponible en este momento."
-        
         try:
-            # Construir prompt con contexto
-            context_prompt = self._build_context_prompt(query, context)
-            system_prompt = self.get_system_prompt()
-            
-            self.logger.info(f"Procesando consulta con Claude")
-            
-            # Llamada a Claude
-            response = self.claude_client.messages.create(
-                model=os.getenv('CLAUDE_MODEL', 'claude-3-sonnet-20240229'),
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                system=system_prompt,
-                messages=[
-                    {"role": "user", "content": context_prompt}
-                ]
-            )
-            
-            return response.content[0].text
-            
-        except Exception as e:
+            return self.call_claude(query, context)
+        except ProviderUnavailableError:
+            return "Lo siento, el servicio de Claude no está disponible en este momento."
+        except ProviderError as e:
             self.logger.error(f"Error procesando consulta con Claude: {e}")
             return f"Lo siento, hubo un error procesando tu consulta: {str(e)}"
     
+    # Selección de proveedores: fallback secuencial o hedging
+    
+    def _configured_providers(self) -> List[str]:
+        """Proveedores configurados en orden de preferencia"""
+        providers = []
+        if self.openai_client:
+            providers.append('openai')
+        if self.claude_client:
+            providers.append('claude')
+        return providers
+    
+    def _available_providers(self) -> List[str]:
+        """
+        Proveedores configurados cuyo circuito no está abierto.
+        
+        Solo consulta el estado: la llamada de prueba del half-open se reserva
+        con allow_request justo antes de llamar a cada proveedor (_admit_provider),
+        no para los que quizá nunca se llamen.
+        
+        Raises:
+            ProviderUnavailableError: Si no queda ningún proveedor utilizable
+        """
+        configured = self._configured_providers()
+        if not configured:
+            raise ProviderUnavailableError('all', "No hay proveedores de IA configurados")
+        
+        providers = [p for p in configured if self.circuit_breakers.get(p).state != CIRCUIT_OPEN]
+        if not providers:
+            raise ProviderUnavailableError('all', "Circuito abierto en todos los proveedores de IA")
+        return providers
+    
+    def _record_call(self, provider: str, elapsed: float, error: Optional[ProviderError] = None):
+        """Contador por resultado e histograma de duración de las llamadas al proveedor"""
+        outcome = type(error).__name__ if error is not None else 'success'
+        self.metrics_registry.inc('llm_requests_total', provider=provider, outcome=outcome)
+        if error is None:
+            self.metrics_registry.observe('llm_request_duration_seconds', elapsed, provider=provider)
+    
+    def _admit_provider(self, provider: str):
+        """
+        Reservar la llamada al proveedor en su circuit breaker justo antes de hacerla.
+        
+        Raises:
+            ProviderUnavailableError: Si el circuito la rechaza (se pasa al siguiente proveedor)
+        """
+        breaker = self.circuit_breakers.get(provider)
+        if not breaker.allow_request():
+            raise ProviderUnavailableError(provider, f"Circuito abierto para {provider}")
+        return breaker
+    
+    def _guarded_call(self, provider: str, call, query: str, context: Dict[str, Any]) -> str:
+        """Llamada a un proveedor registrando el resultado en su circuit breaker"""
+        breaker = self._admit_provider(provider)
+        started = time.monotonic()
+        settled = False
+        try:
+            response = call(query, context)
+            settled = True
+        except ProviderError as e:
+            settled = True
+            breaker.record_failure(e)
+            self._record_call(provider, time.monotonic() - started, e)
+            raise
+        finally:
+            if not settled:
+                breaker.release_probe()
+        breaker.record_success(time.monotonic() - started)
+        self._record_call(provider, time.monotonic() - started)
+        return response
+    
+    def _guarded_stream(self, provider: str, stream: Iterator[str]) -> Iterator[str]:
+        """
+        Stream de un proveedor registrando el resultado en su circuit breaker.
+        El éxito se registra con el primer token; cancelar el stream no cuenta como
+        fallo y devuelve la llamada de prueba del half-open si no llegó a usarse.
+        """
+        try:
+            breaker = self._admit_provider(provider)
+        except ProviderUnavailableError:
+            stream.close()
+            raise
+        # Span sin activar: la ContextVar no puede quedar fijada entre yields
+        call_span = span('llm.call', provider=provider, model=self._model(provider), stream=True)
+        started = time.monotonic()
+        reported = False
+        chunks = 0
+        try:
+            for delta in stream:
+                if not reported:
+                    breaker.record_success(time.monotonic() - started)
+                    call_span.set('ttft_ms', round((time.monotonic() - started) * 1000, 1))
+                    self.metrics_registry.observe('llm_ttft_seconds', time.monotonic() - started,
+                                                  provider=provider)
+                    reported = True
+                chunks += 1
+                yield delta
+            if not reported:
+                breaker.record_success(time.monotonic() - started)
+            self._record_call(provider, time.monotonic() - started)
+        except ProviderError as e:
+            # Cerrado por perder la carrera de hedging: no es un fallo del proveedor
+            if not attempt_cancelled():
+                reported = True
+                breaker.record_failure(e)
+                call_span.record_error(e)
+                self._record_call(provider, time.monotonic() - started, e)
+            raise
+        finally:
+            if not reported:
+                breaker.release_probe()
+            stream.close()
+            call_span.set('chunks', chunks)
+            call_span.end()
+    
+    def _stream_candidates(self, query: str, context: Dict[str, Any],
+                           providers: List[str]) -> List[StreamFactory]:
+        methods = {'openai': self.stream_query_with_openai, 'claude': self.stream_query_with_claude}
+        return [
+            (provider, lambda p=provider, m=methods[provider]: self._guarded_stream(p, m(query, context)))
+            for provider in providers
+        ]
+    
+    def generate(self, query: str, context: Dict[str, Any]) -> str:
+        """
+        Generar la respuesta del agente.
+        
+        Con LLM_HEDGING_ENABLED el proveedor secundario se lanza en carrera si el
+        primario no emite el primer token a tiempo; si no, fallback secuencial.
+        
+        Raises:
+            ProviderError: Si ningún proveedor pudo responder
+        """
+        start_time = datetime.now()
+        
+        validation_error = self._validate_query(query)
+        if validation_error:
+            return validation_error
+        
+        providers = self._available_providers()
+        
+        if hedging_enabled() and len(providers) > 1:
+            candidates = self._stream_candidates(query, context, providers)
+            chunks = []
+            winner = None
+            for winner, delta in hedged_stream(candidates, hedge_delay(providers[0])):
+                chunks.append(delta)
+            processing_time = (datetime.now() - start_time).total_seconds()
+            self.logger.info(f"Consulta procesada con {winner} (hedging) en {processing_time:.2f}s")
+            return ''.join(chunks)
+        
+        callers = {'openai': self.call_openai, 'claude': self.call_claude}
+        last_error = None
+        for provider in providers:
+            try:
+                response = self._guarded_call(provider, callers[provider], query, context)
+                processing_time = (datetime.now() - start_time).total_seconds()
+                self.logger.info(f"Consulta procesada con {provider} en {processing_time:.2f}s")
+                return response
+            except ProviderError as e:
+                self.logger.error(f"Error procesando consulta: {e}")
+                last_error = e
+        
+        raise last_error
+    
     def process_query(self, query: str, context: Dict[str, Any]) -> str:
         """
         Método principal para procesar consultas.
         Intenta OpenAI primero, luego Claude como fallback.
         """
+        try:
+            return self.generate(query, context)
+        except ProviderError as e:
+            self.logger.error(f"Ningún proveedor pudo procesar la consulta: {e}")
+            return self.UNAVAILABLE_MESSAGE
+    
+    def stream_query(self, query: str, context: Dict[str, Any]) -> Iterator[str]:
+        """
+        Versión streaming de generate.
+        Sin hedging, cae al siguiente proveedor solo si todavía no se emitió ningún token.
+        
+        Raises:
+            ProviderError: Si ningún proveedor pudo responder
+        """
+        start_time = time.monotonic()
+        
+        validation_error = self._validate_query(query)
+        if validation_error:
+            yield validation_error
+            return
+        
+        providers = self._available_providers()
+        
+        candidates = self._stream_candidates(query, context, providers)
+        if hedging_enabled() and len(providers) > 1:
+            for _, delta in hedged_stream(candidates, hedge_delay(providers[0])):
+                yield delta
+            return
+        
+        last_error = None
+        for provider, factory in candidates:
+            emitted = False
+            provider_start = time.monotonic()
+            try:
+                for delta in factory():
+                    if not emitted:
+                        latency_tracker.record(provider, time.monotonic() - provider_start)
+                    emitted = True
+                    yield delta
+                
+                self.logger.info(f"Streaming completado con {provider} en {time.monotonic() - start_time:.2f}s")
+                return
+            except ProviderError as e:
+                self.logger.error(f"Error en streaming: {e}")
+                # No se puede cambiar de proveedor a mitad de una respuesta
+                if emitted:
+                    raise
+                last_error = e
+        
+        raise last_error
+    
+    # Ruta async: mismos pasos que la ruta sync, usando AsyncOpenAI/AsyncAnthropic
+    # para no bloquear un thread del worker durante la llamada al proveedor
+    
+    async def acall_openai(self, query: str, context: Dict[str, Any]) -> str:
+        """Versión async de call_openai"""
+        client = self.llm_clients.get_async_openai_client()
+        if not client:
+            raise ProviderUnavailableError('openai', "El servicio de OpenAI no está configurado")
+        with span('llm.call', provider='openai', model=self._model('openai'), stream=False) as call_span:
+            try:
+                request, tokens = self._openai_request(query, context)
+                await self._aadmit('openai', tokens, context)
+                response = await client.chat.completions.create(**request)
+                with span('llm.parse'):
+                    self._record_usage(call_span, 'openai', response)
+                    return response.choices[0].message.content
+            except Exception as e:
+                raise self._provider_error('openai', e) from e
+    
+    async def acall_claude(self, query: str, context: Dict[str, Any]) -> str:
+        """Versión async de call_claude"""
+        client = self.llm_clients.get_async_claude_client()
+        if not client:
+            raise ProviderUnavailableError('claude', "El servicio de Claude no está configurado")
+        with span('llm.call', provider='claude', model=self._model('claude'), stream=False) as call_span:
+            try:
+                request, tokens = self._claude_request(query, context)
+                await self._aadmit('claude', tokens, context)
+                response = await client.messages.create(**request)
+                with span('llm.parse'):
+                    self._record_usage(call_span, 'claude', response)
+                    return response.content[0].text
+            except Exception as e:
+                raise self._provider_error('claude', e) from e
+    
+    @staticmethod
+    async def _aclose_stream(stream):
+        """Cerrar un stream async del SDK liberando la conexión HTTP"""
+        try:
+            if hasattr(stream, 'close'):
+                await stream.close()
+            elif hasattr(stream, 'response'):
+                await stream.response.aclose()
+        except Exception:
+            pass
+    
+    async def astream_query_with_openai(self, query: str, context: Dict[str, Any]) -> AsyncIterator[str]:
+        """
+        Versión async de stream_query_with_openai.
+        """
+        client = self.llm_clients.get_async_openai_client()
+        if not client:
+            raise ProviderUnavailableError('openai', "El servicio de OpenAI no está configurado")
+        
+        try:
+            request, tokens = self._openai_request(query, context)
+            await self._aadmit('openai', tokens, context)
+            stream = await client.chat.completions.create(stream=True, **request)
+        except Exception as e:
+            raise self._provider_error('openai', e) from e
+        
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        except Exception as e:
+            raise self._provider_error('openai', e) from e
+        finally:
+            # También se ejecuta al cancelar la tarea
+            await self._aclose_stream(stream)
+    
+    async def astream_query_with_claude(self, query: str, context: Dict[str, Any]) -> AsyncIterator[str]:
+        """
+        Versión async de stream_query_with_claude.
+        """
+        client = self.llm_clients.get_async_claude_client()
+        if not client:
+            raise ProviderUnavailableError('claude', "El servicio de Claude no está configurado")
+        
+        try:
+            request, tokens = self._claude_request(query, context)
+            await self._aadmit('claude', tokens, context)
+            stream = await client.messages.create(stream=True, **request)
+        except Exception as e:
+            raise self._provider_error('claude', e) from e
+        
+        try:
+            async for event in stream:
+                if getattr(event, 'type', None) == 'content_block_delta':
+                    text = getattr(event.delta, 'text', None)
+                    if text:
+                        yield text
+        except Exception as e:
+            raise self._provider_error('claude', e) from e
+        finally:
+            await self._aclose_stream(stream)
+    
+    async def aprocess_query_with_openai(self, query: str, context: Dict[str, Any]) -> str:
+        """
+        Versión async de process_query_with_openai.
+        """
+        try:
+            return await self.acall_openai(query, context)
+        except ProviderUnavailableError:
+            return "Lo siento, el servicio de OpenAI no está disponible en este momento."
+        except ProviderError as e:
+            self.logger.error(f"Error procesando consulta async con OpenAI: {e}")
+            return f"Lo siento, hubo un error procesando tu consulta: {str(e)}"
+    
+    async def aprocess_query_with_claude(self, query: str, context: Dict[str, Any]) -> str:
+        """
+        Versión async de process_query_with_claude.
+        """
+        try:
+            return await self.acall_claude(query, context)
+        except ProviderUnavailableError:
+            return "Lo siento, el servicio de Claude no está disponible en este momento."
+        except ProviderError as e:
+            self.logger.error(f"Error procesando consulta async con Claude: {e}")
+            return f"Lo siento, hubo un error procesando tu consulta: {str(e)}"
+    
+    async def _aguarded_call(self, provider: str, call, query: str, context: Dict[str, Any]) -> str:
+        """Versión async de _guarded_call"""
+        breaker = self._admit_provider(provider)
+        started = time.monotonic()
+        settled = False
+        try:
+            response = await call(query, context)
+            settled = True
+        except ProviderError as e:
+            settled = True
+            breaker.record_failure(e)
+            self._record_call(provider, time.monotonic() - started, e)
+            raise
+        finally:
+            if not settled:
+                breaker.release_probe()
+        breaker.record_success(time.monotonic() - started)
+        self._record_call(provider, time.monotonic() - started)
+        return response
+    
+    async def _aguarded_stream(self, provider: str, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Versión async de _guarded_stream"""
+        try:
+            breaker = self._admit_provider(provider)
+        except ProviderUnavailableError:
+            await stream.aclose()
+            raise
+        call_span = span('llm.call', provider=provider, model=self._model(provider), stream=True)
+        started = time.monotonic()
+        reported = False
+        chunks = 0
+        try:
+            async for delta in stream:
+                if not reported:
+                    breaker.record_success(time.monotonic() - started)
+                    call_span.set('ttft_ms', round((time.monotonic() - started) * 1000, 1))
+                    self.metrics_registry.observe('llm_ttft_seconds', time.monotonic() - started,
+                                                  provider=provider)
+                    reported = True
+                chunks += 1
+                yield delta
+            if not reported:
+                breaker.record_success(time.monotonic() - started)
+            self._record_call(provider, time.monotonic() - started)
+        except ProviderError as e:
+            reported = True
+            breaker.record_failure(e)
+            call_span.record_error(e)
+            self._record_call(provider, time.monotonic() - started, e)
+            raise
+        finally:
+            # Cancelado (perdió el hedging) o cerrado antes del primer token
+            if not reported:
+                breaker.release_probe()
+            await stream.aclose()
+            call_span.set('chunks', chunks)
+            call_span.end()
+    
+    def _astream_candidates(self, query: str, context: Dict[str, Any],
+                            providers: List[str]) -> List[AsyncStreamFactory]:
+        methods = {'openai': self.astream_query_with_openai, 'claude': self.astream_query_with_claude}
+        return [
+            (provider, lambda p=provider, m=methods[provider]: self._aguarded_stream(p, m(query, context)))
+            for provider in providers
+        ]
+    
+    async def agenerate(self, query: str, context: Dict[str, Any]) -> str:
+        """
+        Versión async de generate.
+        
+        Raises:
+            ProviderError: Si ningún proveedor pudo responder
+        """
         start_time = datetime.now()
         
-        # Validar entrada
-        if not query or not query.strip():
-            return "Por favor, proporciona una consulta válida."
+        validation_error = self._validate_query(query)
+        if validation_error:
+            return validation_error
         
-        max_length = int(os.getenv('MAX_INPUT_LENGTH', 5000))
-        if len(query) > max_length:
-            return f"La consulta es demasiado larga. Máximo {max_length} caracteres."
+        providers = self._available_providers()
         
-        # Intentar con OpenAI primero
-        if self.openai_client:
-            response = self.process_query_with_openai(query, context)
-            if not response.startswith("Lo siento"):
+        if hedging_enabled() and len(providers) > 1:
+            candidates = self._astream_candidates(query, context, providers)
+            chunks = []
+            winner = None
+            async for winner, delta in ahedged_stream(candidates, hedge_delay(providers[0])):
+                chunks.append(delta)
+            processing_time = (datetime.now() - start_time).total_seconds()
+            self.logger.info(f"Consulta async procesada con {winner} (hedging) en {processing_time:.2f}s")
+            return ''.join(chunks)
+        
+        callers = {'openai': self.acall_openai, 'claude': self.acall_claude}
+        last_error = None
+        for provider in providers:
+            try:
+                response = await self._aguarded_call(provider, callers[provider], query, context)
                 processing_time = (datetime.now() - start_time).total_seconds()
-                self.logger.info(f"Consulta procesada exitosamente en {processing_time:.2f}s")
+                self.logger.info(f"Consulta async procesada con {provider} en {processing_time:.2f}s")
                 return response
+            except ProviderError as e:
+                self.logger.error(f"Error procesando consulta async: {e}")
+                last_error = e
         
-        # Fallback a Claude
-        if self.claude_client:
-            response = self.process_query_with_claude(query, context)
-            processing_time = (datetime.now() - start_time).total_seconds()
-            self.logger.info(f"Consulta procesada con Claude en {processing_time:.2f}s")
-            return response
+        raise last_error
+    
+    async def aprocess_query(self, query: str, context: Dict[str, Any]) -> str:
+        """
+        Versión async de process_query.
+        Intenta OpenAI primero, luego Claude como fallback.
+        """
+        try:
+            return await self.agenerate(query, context)
+        except ProviderError as e:
+            self.logger.error(f"Ningún proveedor pudo procesar la consulta async: {e}")
+            return self.UNAVAILABLE_MESSAGE
+    
+    async def astream_query(self, query: str, context: Dict[str, Any]) -> AsyncIterator[str]:
+        """
+        Versión async de stream_query.
+        
+        Raises:
+            ProviderError: Si ningún proveedor pudo responder
+        """
+        start_time = time.monotonic()
+        
+        validation_error = self._validate_query(query)
+        if validation_error:
+            yield validation_error
+            return
         
-        # Si ninguno está disponible
-        return "Lo siento, los servicios de IA no están disponibles en este momento. Por favor, configura las API keys en el archivo .env."
+        providers = self._available_providers()
+        
+        candidates = self._astream_candidates(query, context, providers)
+        if hedging_enabled() and len(providers) > 1:
+            hedged = ahedged_stream(candidates, hedge_delay(providers[0]))
+            try:
+                async for _, delta in hedged:
+                    yield delta
+            finally:
+                await hedged.aclose()
+            return
+        
+        last_error = None
+        for provider, factory in candidates:
+            emitted = False
+            provider_start = time.monotonic()
+            stream = factory()
+            try:
+                async for delta in stream:
+                    if not emitted:
+                        latency_tracker.record(provider, time.monotonic() - provider_start)
+                    emitted = True
+                    yield delta
+                
+                self.logger.info(f"Streaming async completado con {provider} en {time.monotonic() - start_time:.2f}s")
+                return
+            except ProviderError as e:
+                self.logger.error(f"Error en streaming async: {e}")
+                if emitted:
+                    raise
+                last_error = e
+            finally:
+                await stream.aclose()
+        
+        raise last_error
+    
+    @staticmethod
+    def _provider_configured(env_var: str, placeholder: str) -> bool:
+        """Verificar si la API key de un proveedor está configurada"""
+        if os.getenv('LLM_PROVIDER_BACKEND', 'real').lower() == 'fake':
+            return True
+        api_key = os.getenv(env_var)
+        return bool(api_key) and api_key != placeholder
+    
+    @classmethod
+    def describe_capabilities(cls) -> Dict[str, Any]:
+        """
+        Capacidades del agente a partir de metadatos de clase,
+        sin crear clientes ni tokenizer.
+        """
+        capabilities = {
+            'agent_name': cls.agent_name,
+            'openai_available': cls._provider_configured('OPENAI_API_KEY', 'sk-your-openai-key-here'),
+            'claude_available': cls._provider_configured('ANTHROPIC_API_KEY', 'your-claude-key-here'),
+            'max_tokens': int(os.getenv('OPENAI_MAX_TOKENS', 1500)),
+            'temperature': float(os.getenv('OPENAI_TEMPERATURE', 0.7)),
+            'timeout': int(os.getenv('AGENT_RESPONSE_TIMEOUT', 30))
+        }
+        capabilities.update(cls.specialized_capabilities)
+        return capabilities
+    
+    @classmethod
+    def describe_health(cls) -> Dict[str, Any]:
+        """
+        Estado de salud esperado del agente sin construirlo.
+        """
+        openai_configured = cls._provider_configured('OPENAI_API_KEY', 'sk-your-openai-key-here')
+        claude_configured = cls._provider_configured('ANTHROPIC_API_KEY', 'your-claude-key-here')
+        return {
+            'agent_name': cls.agent_name,
+            'status': 'healthy' if (openai_configured or claude_configured) else 'unhealthy',
+            'openai_configured': openai_configured,
+            'claude_configured': claude_configured,
+            'circuit_breakers': get_circuit_breakers().snapshot(),
+            'loaded': False,
+            'timestamp': datetime.now().isoformat()
+        }
     
     def get_capabilities(self) -> Dict[str, Any]:
         """
@@ -281,10 +1011,22 @@ Por favor, responde como {self.get_agent_name()} considerando todo el contexto p
         """
         Verificar el estado de salud del servicio.
         """
+        breakers = self.circuit_breakers.snapshot()
+        configured = self._configured_providers()
+        if not configured:
+            status = 'unhealthy'
+        elif all(breakers[p]['state'] == 'open' for p in configured):
+            # Configurado pero sin ningún proveedor aceptando llamadas
+            status = 'degraded'
+        else:
+            status = 'healthy'
+        
         return {
             'agent_name': self.get_agent_name(),
-            'status': 'healthy' if (self.openai_client or self.claude_client) else 'unhealthy',
+            'status': status,
             'openai_configured': self.openai_client is not None,
             'claude_configured': self.claude_client is not None,
+            'circuit_breakers': breakers,
+            'loaded': True,
             'timestamp': datetime.now().isoformat()
         } 
\ No newline at end of file
@@ -22,9 +22,20 @@ class AnalyticsAgent(BaseAIService):
     - Métricas de efectividad pedagógica
     """
     
+    # Metadatos de clase (disponibles sin construir el agente)
+    agent_name = "Analytics - Análisis de Datos Educativos"
+    specialized_capabilities = {
+        'statistical_analysis': True,
+        'pattern_recognition': True,
+        'predictive_modeling': True,
+        'data_visualization': True,
+        'institutional_reporting': True,
+        'performance_tracking': True
+    }
+    
     def get_agent_name(self) -> str:
         """Nombre del agente"""
-        return "Analytics - Análisis de Datos Educativos"
+        return self.agent_name
     
     def get_system_prompt(self) -> str:
         """Prompt del sistema para el Analytics Agent"""
@@ -331,12 +342,5 @@ Adapta el nivel técnico según la audiencia especificada.
     def get_specialized_capabilities(self) -> Dict[str, Any]:
         """Capacidades específicas del Analytics Agent"""
         base_capabilities = self.get_capabilities()
-        base_capabilities.update({
-            'statistical_analysis': True,
-            'pattern_recognition': True,
-            'predictive_modeling': True,
-            'data_visualization': True,
-            'institutional_reporting': True,
-            'performance_tracking': True
-        })
+        base_capabilities.update(self.specialized_capabilities)
         return base_capabilities 
\ No newline at end of file
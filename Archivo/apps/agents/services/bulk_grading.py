@@ -0,0 +1,265 @@
+"""
+Bulk Grading - Calificación masiva de entregas con el EvaluatorAgent
+
+Calificar una clase de 300 estudiantes con grade_submission era una llamada
+bloqueante tras otra. Este pipeline ejecuta las entregas de una misma
+evaluación con concurrencia acotada y ritmo limitado por proveedor, emite cada
+resultado en cuanto termina, guarda un checkpoint en Redis para reanudar un
+lote interrumpido y comparte el prefijo rúbrica + instrucciones entre llamadas.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from .errors import ProviderError, ProviderRateLimitError, ProviderThrottledError, ProviderUnavailableError
+from .registry import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class RequestPacer:
+    """
+    Espaciado mínimo entre llamadas al proveedor (compartido por los threads del lote).
+    Tras un 429 el ritmo se reduce a la mitad durante el resto del lote.
+    """
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def slow_down(self):
+        with self._lock:
+            self.interval = max(self.interval * 2, 0.5)
+
+
+class BulkGradingPipeline:
+    """
+    Pipeline de calificación masiva para una evaluación.
+
+    Configuración (variables de entorno):
+    - BULK_GRADING_CONCURRENCY: entregas calificadas en paralelo (también el máximo
+      que puede pedir una petición con max_concurrency)
+    - BULK_GRADING_REQUESTS_PER_MINUTE: ritmo máximo de llamadas al proveedor
+    - BULK_GRADING_MAX_RETRIES: reintentos por entrega ante 429 o timeout
+    - BULK_GRADING_CHECKPOINT_TTL: segundos que se conserva el checkpoint en Redis
+    """
+
+    REDIS_PREFIX = 'bulk_grading'
+
+    def __init__(self, evaluator, max_concurrency: Optional[int] = None, redis_client=None):
+        self.evaluator = evaluator
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        concurrency_limit = max(1, int(os.getenv('BULK_GRADING_CONCURRENCY', 8)))
+        self.max_concurrency = max(1, min(int(max_concurrency or concurrency_limit), concurrency_limit))
+        self.requests_per_minute = float(os.getenv('BULK_GRADING_REQUESTS_PER_MINUTE', 120))
+        self.max_retries = int(os.getenv('BULK_GRADING_MAX_RETRIES', 3))
+        self.checkpoint_ttl = int(os.getenv('BULK_GRADING_CHECKPOINT_TTL', 7 * 24 * 3600))
+
+        self.redis_client = redis_client if redis_client is not None else self._init_redis_client()
+
+    def _init_redis_client(self):
+        """Cliente Redis compartido del proceso (sin conexión ni PING por pipeline)"""
+        try:
+            return get_redis_client()
+        except Exception as e:
+            self.logger.warning(f"Redis no disponible, la calificación masiva no podrá reanudarse: {e}")
+            return None
+
+    # Checkpoint
+
+    @staticmethod
+    def make_job_id(assessment_id: str, submissions: List[Dict]) -> str:
+        """ID determinista: la misma evaluación con las mismas entregas reanuda el mismo lote"""
+        digest = hashlib.sha1(assessment_id.encode('utf-8'))
+        for student_id in sorted(str(s.get('student_id')) for s in submissions):
+            digest.update(b'\x00')
+            digest.update(student_id.encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+    def _checkpoint_key(self, job_id: str) -> str:
+        return f"{self.REDIS_PREFIX}:{job_id}"
+
+    def load_checkpoint(self, job_id: str) -> Dict[str, Dict[str, Any]]:
+        """Resultados ya calificados de un lote (student_id -> resultado)"""
+        if self.redis_client is None:
+            return {}
+        try:
+            raw = self.redis_client.hgetall(self._checkpoint_key(job_id))
+        except Exception as e:
+            self.logger.warning(f"Error leyendo checkpoint {job_id}: {e}")
+            return {}
+
+        # El cliente compartido es binario (decode_responses=False)
+        results = {}
+        for student_id, value in raw.items():
+            if isinstance(student_id, bytes):
+                student_id = student_id.decode('utf-8')
+            try:
+                results[student_id] = json.loads(value)
+            except ValueError:
+                continue
+        return results
+
+    def _save_checkpoint(self, job_id: str, student_id: str, result: Dict[str, Any]):
+        if self.redis_client is None:
+            return
+        try:
+            key = self._checkpoint_key(job_id)
+            pipe = self.redis_client.pipeline()
+            pipe.hset(key, student_id, json.dumps(result, ensure_ascii=False))
+            pipe.expire(key, self.checkpoint_ttl)
+            pipe.execute()
+        except Exception as e:
+            self.logger.warning(f"Error guardando checkpoint {job_id}/{student_id}: {e}")
+
+    def get_progress(self, job_id: str) -> Dict[str, Any]:
+        """Progreso de un lote a partir de su checkpoint"""
+        results = self.load_checkpoint(job_id)
+        return {
+            'job_id': job_id,
+            'graded': len(results),
+            'student_ids': sorted(results.keys()),
+            'resumable': self.redis_client is not None
+        }
+
+    # Ejecución
+
+    def _grade_one(self, job_id: str, student_id: str, submission: Dict[str, Any], assessment_id: str,
+                   rubric: Optional[Dict], grading_prefix: str, pacer: RequestPacer) -> Dict[str, Any]:
+        """Calificar una entrega con reintentos y guardarla en el checkpoint (en el thread del pool)"""
+        attempt = 0
+        while True:
+            pacer.wait()
+            try:
+                result = self.evaluator.grade_submission_with_prefix(
+                    assessment_id, submission.get('responses', []), grading_prefix, rubric
+                )
+                result['student_id'] = student_id
+                self._save_checkpoint(job_id, student_id, result)
+                return result
+            except ProviderThrottledError:
+                # Sin turno en el rate limiter: reintentar sin contar como fallo del proveedor
+                if attempt >= self.max_retries:
+                    raise
+            except ProviderUnavailableError:
+                raise
+            except ProviderRateLimitError:
+                pacer.slow_down()
+                if attempt >= self.max_retries:
+                    raise
+            except ProviderError:
+                if attempt >= self.max_retries:
+                    raise
+            attempt += 1
+            time.sleep(min(30.0, 2 ** attempt))
+
+    def run(self, assessment_id: str, submissions: List[Dict[str, Any]],
+            rubric: Optional[Dict] = None, job_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Calificar las entregas y producir eventos a medida que terminan.
+
+        Eventos:
+        - {'type': 'start', 'job_id', 'total', 'already_graded'}
+        - {'type': 'result', 'student_id', 'result', 'resumed'}: entrega calificada
+        - {'type': 'error', 'student_id', 'error', 'error_type'}: entrega no calificada
+          (no se guarda en el checkpoint: se reintenta al reanudar)
+        - {'type': 'end', 'job_id', 'graded', 'failed', 'elapsed'}
+
+        Cerrar el generador deja de lanzar entregas nuevas; las que ya están en
+        curso terminan y se guardan en el checkpoint.
+        """
+        start_time = time.monotonic()
+        job_id = job_id or self.make_job_id(assessment_id, submissions)
+        completed = self.load_checkpoint(job_id)
+
+        pending = []
+        for index, submission in enumerate(submissions):
+            student_id = str(submission.get('student_id', index))
+            if student_id not in completed:
+                pending.append((student_id, submission))
+
+        yield {
+            'type': 'start',
+            'job_id': job_id,
+            'assessment_id': assessment_id,
+            'total': len(submissions),
+            'already_graded': len(submissions) - len(pending),
+            'timestamp': datetime.now().isoformat()
+        }
+
+        for student_id, result in completed.items():
+            yield {'type': 'result', 'student_id': student_id, 'result': result, 'resumed': True}
+
+        grading_prefix = self.evaluator.build_grading_prefix(assessment_id, rubric)
+        pacer = RequestPacer(self.requests_per_minute)
+        graded = len(completed)
+        failed = 0
+
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='bulk-grading')
+        in_flight = {}
+        queue = iter(pending)
+        try:
+            # Ventana acotada de entregas en curso: no se encolan las 300 de golpe
+            for student_id, submission in queue:
+                in_flight[executor.submit(
+                    self._grade_one, job_id, student_id, submission, assessment_id, rubric, grading_prefix, pacer
+                )] = student_id
+                if len(in_flight) >= self.max_concurrency:
+                    break
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    student_id = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                        graded += 1
+                        yield {'type': 'result', 'student_id': student_id, 'result': result, 'resumed': False}
+                    except Exception as e:
+                        failed += 1
+                        self.logger.error(f"Error calificando entrega {student_id}: {e}")
+                        yield {
+                            'type': 'error',
+                            'student_id': student_id,
+                            'error': str(e),
+                            'error_type': type(e).__name__
+                        }
+
+                    next_item = next(queue, None)
+                    if next_item is not None:
+                        next_student_id, submission = next_item
+                        in_flight[executor.submit(
+                            self._grade_one, job_id, next_student_id, submission,
+                            assessment_id, rubric, grading_prefix, pacer
+                        )] = next_student_id
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        yield {
+            'type': 'end',
+            'job_id': job_id,
+            'graded': graded,
+            'failed': failed,
+            'total': len(submissions),
+            'elapsed': round(time.monotonic() - start_time, 2),
+            'timestamp': datetime.now().isoformat()
+        }
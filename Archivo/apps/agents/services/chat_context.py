@@ -0,0 +1,416 @@
+"""
+Chat Context - Construcción del contexto de una consulta de chat
+
+Lógica compartida por la API REST (AgentChatAPIView) y el WebSocket
+(ChatConsumer): memoria conversacional, búsqueda RAG, perfil de usuario
+y guardado del turno una vez que el agente respondió.
+
+Las etapas del contexto (historial, RAG, perfil, metadatos de sesión) son
+independientes: se ejecutan en paralelo en un pool compartido, cada una con su
+plazo. Una etapa lenta o fallida se sustituye por un valor vacío y queda
+anotada en context['degraded_stages'], en lugar de retrasar toda la respuesta.
+Una etapa que vence sigue ocupando su thread hasta terminar: si ya hay
+CHAT_STAGE_MAX_ABANDONED llamadas de esa etapa en ese estado, ni se lanza y se
+degrada directamente, para que un backend colgado no agote el pool. El
+guardado del turno usa su propio pool y no queda detrás de etapas colgadas.
+
+abuild_chat_context y asave_chat_turn son las variantes para el WebSocket y
+las vistas async: la memoria se lee y escribe con redis.asyncio en el propio
+event loop y solo el RAG y el perfil pasan por threads.
+
+Configuración (variables de entorno):
+- CHAT_PARALLEL_STAGES: ejecutar las etapas en paralelo
+- CHAT_STAGE_WORKERS: threads del pool de etapas
+- CHAT_STAGE_MAX_ABANDONED: llamadas vencidas en curso por etapa antes de omitirla
+- CHAT_SAVE_WORKERS: threads del pool de guardados en segundo plano
+- CHAT_STAGE_TIMEOUTS: plazos en segundos por etapa ("rag=1.5,history=0.5,...")
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, Awaitable, Callable, Optional, Tuple
+
+from .conversation_memory import ConversationMemory
+from .registry import get_metrics
+from .tracing import bind_context, current_span, span
+
+logger = logging.getLogger(__name__)
+
+# Plazo por etapa en segundos (CHAT_STAGE_TIMEOUTS los sobrescribe)
+DEFAULT_STAGE_TIMEOUTS = {
+    'history': 0.5,
+    'rag': 1.5,
+    'profile': 0.3,
+    'session_metadata': 0.3,
+}
+
+# Span de cada etapa en la traza de la petición
+STAGE_SPANS = {
+    'history': 'memory.read',
+    'rag': 'rag.search',
+    'profile': 'profile.read',
+    'session_metadata': 'memory.session',
+}
+
+_executor: Optional[ThreadPoolExecutor] = None
+_save_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+# Llamadas por etapa que vencieron su plazo pero siguen ocupando un thread
+_abandoned: Dict[str, int] = {}
+_abandoned_lock = threading.Lock()
+
+
+def _parallel_enabled() -> bool:
+    return os.getenv('CHAT_PARALLEL_STAGES', 'True').lower() == 'true'
+
+
+def _stage_timeouts() -> Dict[str, float]:
+    timeouts = dict(DEFAULT_STAGE_TIMEOUTS)
+    for item in os.getenv('CHAT_STAGE_TIMEOUTS', '').split(','):
+        name, _, value = item.partition('=')
+        if name.strip() and value.strip():
+            try:
+                timeouts[name.strip()] = float(value)
+            except ValueError:
+                logger.warning(f"Plazo de etapa inválido en CHAT_STAGE_TIMEOUTS: {item}")
+    return timeouts
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Pool compartido por las etapas del contexto"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=int(os.getenv('CHAT_STAGE_WORKERS', 16)),
+                    thread_name_prefix='chat-stage'
+                )
+    return _executor
+
+
+def _get_save_executor() -> ThreadPoolExecutor:
+    """Pool de los guardados en segundo plano, aparte del de las etapas"""
+    global _save_executor
+    if _save_executor is None:
+        with _executor_lock:
+            if _save_executor is None:
+                _save_executor = ThreadPoolExecutor(
+                    max_workers=int(os.getenv('CHAT_SAVE_WORKERS', 4)),
+                    thread_name_prefix='chat-save'
+                )
+    return _save_executor
+
+
+def _stage_saturated(name: str) -> bool:
+    """La etapa ya tiene demasiadas llamadas vencidas ocupando threads"""
+    limit = int(os.getenv('CHAT_STAGE_MAX_ABANDONED', 2))
+    with _abandoned_lock:
+        return _abandoned.get(name, 0) >= limit
+
+
+def _abandon(name: str, future: Future):
+    """Contar una llamada vencida que sigue en curso hasta que termine"""
+    if future.cancel() or future.done():
+        # Seguía en cola (o acaba de terminar): no ocupa ningún thread
+        return
+    with _abandoned_lock:
+        _abandoned[name] = _abandoned.get(name, 0) + 1
+
+    def release(_):
+        with _abandoned_lock:
+            _abandoned[name] -= 1
+
+    future.add_done_callback(release)
+
+
+async def _in_stage_pool(name: str, fn: Callable[[], Any]) -> Any:
+    """Ejecutar fn en el pool de etapas desde el event loop, contándola si vence"""
+    future = _get_executor().submit(bind_context(fn))
+    try:
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        _abandon(name, future)
+        raise
+
+
+def get_user_profile(user_id: str) -> Dict[str, Any]:
+    """Obtener perfil del usuario (placeholder - implementar según modelo User)"""
+    return {
+        'user_id': user_id,
+        'name': 'Usuario',
+        'level': '7mo Grado',
+        'preferences': {},
+        'last_active': None
+    }
+
+
+def build_chat_context(user_id: str, message: str, agent_type: Optional[str] = None,
+                       explicit_context: Optional[str] = None,
+                       rag_service=None) -> Tuple[Dict[str, Any], ConversationMemory]:
+    """
+    Construir el contexto para el AgentManager
+
+    Args:
+        user_id: ID del usuario
+        message: Consulta del usuario
+        agent_type: Agente solicitado (None para routing automático)
+        explicit_context: Texto seleccionado explícitamente por el usuario
+        rag_service: Servicio RAG compartido (opcional)
+
+    Returns:
+        (contexto, memoria conversacional usada para leer el historial)
+    """
+    # Si no se especifica agente, usar routing automático
+    conversation_agent_type = agent_type or 'tutor'  # Default temporal
+    memory = ConversationMemory(user_id, conversation_agent_type)
+
+    shared = {}
+
+    def search_documents():
+        if not rag_service:
+            return []
+        # Un solo encode por petición: el mismo embedding busca documentos y enruta
+        shared['query_embedding'] = rag_service.embed_query(message)
+        documents = rag_service.search_relevant_content(
+            message, user_id, top_k=5, query_embedding=shared['query_embedding']
+        )
+        current_span().set('documents', len(documents))
+        return documents
+
+    stages = {
+        'history': (lambda: memory.get_context(limit=10), []),
+        'rag': (search_documents, []),
+        'profile': (lambda: get_user_profile(user_id), {'user_id': user_id}),
+        'session_metadata': (memory.get_session_metadata, {}),
+    }
+    results, degraded = run_stages(stages)
+
+    return _assemble_context(user_id, explicit_context, results, degraded, shared), memory
+
+
+async def abuild_chat_context(user_id: str, message: str, agent_type: Optional[str] = None,
+                              explicit_context: Optional[str] = None,
+                              rag_service=None) -> Tuple[Dict[str, Any], ConversationMemory]:
+    """
+    Versión async de build_chat_context: historial y metadatos de sesión con
+    redis.asyncio en el event loop; RAG y perfil en el pool de threads
+    """
+    conversation_agent_type = agent_type or 'tutor'  # Default temporal
+    memory = ConversationMemory(user_id, conversation_agent_type)
+
+    shared = {}
+
+    def search_documents():
+        if not rag_service:
+            return []
+        shared['query_embedding'] = rag_service.embed_query(message)
+        documents = rag_service.search_relevant_content(
+            message, user_id, top_k=5, query_embedding=shared['query_embedding']
+        )
+        current_span().set('documents', len(documents))
+        return documents
+
+    stages = {
+        'history': (lambda: memory.aget_context(limit=10), []),
+        'rag': (lambda: _in_stage_pool('rag', search_documents), []),
+        'profile': (lambda: _in_stage_pool('profile', lambda: get_user_profile(user_id)),
+                    {'user_id': user_id}),
+        'session_metadata': (memory.aget_session_metadata, {}),
+    }
+    results, degraded = await arun_stages(stages)
+
+    return _assemble_context(user_id, explicit_context, results, degraded, shared), memory
+
+
+def _assemble_context(user_id: str, explicit_context: Optional[str], results: Dict[str, Any],
+                      degraded: list, shared: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'user_id': user_id,
+        'conversation_history': results['history'],
+        'relevant_documents': results['rag'],
+        'user_profile': results['profile'],
+        'session_metadata': results['session_metadata'],
+        'explicit_context': explicit_context,
+        'degraded_stages': degraded,
+        'query_embedding': shared.get('query_embedding') if 'rag' not in degraded else None,
+    }
+
+
+def run_stages(stages: Dict[str, Tuple[Callable[[], Any], Any]]) -> Tuple[Dict[str, Any], list]:
+    """
+    Ejecutar etapas independientes en paralelo, cada una con su plazo
+
+    Args:
+        stages: nombre -> (función, valor por defecto si falla o vence el plazo)
+
+    Returns:
+        (resultados por etapa, nombres de las etapas degradadas)
+    """
+    results = {}
+    degraded = []
+    metrics = get_metrics()
+
+    def timed(name, fn):
+        stage = STAGE_SPANS.get(name, f"context.{name}")
+
+        def run():
+            started = time.monotonic()
+            try:
+                with span(stage):
+                    return fn()
+            finally:
+                metrics.observe('chat_stage_duration_seconds', time.monotonic() - started, stage=stage)
+        return run
+
+    if not _parallel_enabled():
+        for name, (fn, fallback) in stages.items():
+            try:
+                results[name] = timed(name, fn)()
+            except Exception as e:
+                logger.warning(f"Etapa {name} del contexto falló: {e}")
+                results[name] = fallback
+                degraded.append(name)
+        return results, degraded
+
+    timeouts = _stage_timeouts()
+    start = time.monotonic()
+    executor = _get_executor()
+    futures = {}
+    for name, (fn, fallback) in stages.items():
+        if _stage_saturated(name):
+            logger.warning(f"Etapa {name} del contexto omitida: llamadas anteriores vencidas siguen en curso")
+            results[name] = fallback
+            degraded.append(name)
+            continue
+        # Copia del contexto: el span de cada etapa cuelga de la traza de la petición
+        futures[name] = executor.submit(bind_context(timed(name, fn)))
+
+    # Los plazos cuentan desde el lanzamiento común: el total es el de la etapa más lenta
+    for name, future in futures.items():
+        fallback = stages[name][1]
+        remaining = timeouts.get(name, 1.0) - (time.monotonic() - start)
+        try:
+            results[name] = future.result(timeout=max(0.0, remaining))
+        except FutureTimeoutError:
+            # Ya no se espera su resultado; si sigue en curso cuenta contra su límite
+            _abandon(name, future)
+            logger.warning(f"Etapa {name} del contexto superó {timeouts.get(name, 1.0)}s")
+            results[name] = fallback
+            degraded.append(name)
+        except Exception as e:
+            logger.warning(f"Etapa {name} del contexto falló: {e}")
+            results[name] = fallback
+            degraded.append(name)
+
+    if degraded:
+        current_span().set('degraded_stages', ','.join(degraded))
+    return results, degraded
+
+
+async def arun_stages(stages: Dict[str, Tuple[Callable[[], Awaitable[Any]], Any]]) -> Tuple[Dict[str, Any], list]:
+    """
+    Versión async de run_stages: cada etapa es una corrutina con su plazo
+    (mismos plazos, spans y métricas que run_stages)
+    """
+    results = {}
+    degraded = []
+    metrics = get_metrics()
+    timeouts = _stage_timeouts()
+
+    async def timed(name, fn):
+        stage = STAGE_SPANS.get(name, f"context.{name}")
+        started = time.monotonic()
+        try:
+            with span(stage):
+                return await asyncio.wait_for(fn(), timeouts.get(name, 1.0))
+        finally:
+            metrics.observe('chat_stage_duration_seconds', time.monotonic() - started, stage=stage)
+
+    names = []
+    for name, (_, fallback) in stages.items():
+        if _stage_saturated(name):
+            logger.warning(f"Etapa {name} del contexto omitida: llamadas anteriores vencidas siguen en curso")
+            results[name] = fallback
+            degraded.append(name)
+        else:
+            names.append(name)
+
+    if _parallel_enabled():
+        # Cada gather crea una tarea con copia del contexto: los spans cuelgan de la petición
+        outcomes = await asyncio.gather(*(timed(name, stages[name][0]) for name in names),
+                                        return_exceptions=True)
+    else:
+        outcomes = []
+        for name in names:
+            try:
+                outcomes.append(await timed(name, stages[name][0]))
+            except Exception as e:
+                outcomes.append(e)
+
+    for name, outcome in zip(names, outcomes):
+        if isinstance(outcome, asyncio.TimeoutError):
+            logger.warning(f"Etapa {name} del contexto superó {timeouts.get(name, 1.0)}s")
+        elif isinstance(outcome, Exception):
+            logger.warning(f"Etapa {name} del contexto falló: {outcome}")
+        else:
+            results[name] = outcome
+            continue
+        results[name] = stages[name][1]
+        degraded.append(name)
+
+    if degraded:
+        current_span().set('degraded_stages', ','.join(degraded))
+    return results, degraded
+
+
+def save_chat_turn(user_id: str, memory: ConversationMemory, agent_used: str,
+                   message: str, response: str):
+    """
+    Guardar el turno (usuario + asistente) en la memoria del agente que respondió
+    """
+    if agent_used != memory.agent_type:
+        # Cambiar a la memoria del agente correcto
+        memory = ConversationMemory(user_id, agent_used)
+
+    # Un único round trip a Redis para los dos mensajes
+    memory.add_messages([
+        {'role': 'user', 'content': message},
+        {'role': 'assistant', 'content': response},
+    ])
+
+
+async def asave_chat_turn(user_id: str, memory: ConversationMemory, agent_used: str,
+                          message: str, response: str):
+    """
+    Versión async de save_chat_turn (un único MULTI/EXEC con redis.asyncio)
+    """
+    if agent_used != memory.agent_type:
+        memory = ConversationMemory(user_id, agent_used)
+
+    await memory.aadd_messages([
+        {'role': 'user', 'content': message},
+        {'role': 'assistant', 'content': response},
+    ])
+
+
+def schedule_chat_turn_save(user_id: str, memory: ConversationMemory, agent_used: str,
+                            message: str, response: str):
+    """
+    Guardar el turno en segundo plano, fuera del camino de la respuesta
+    """
+    def save():
+        started = time.monotonic()
+        with span('memory.write', agent=agent_used):
+            try:
+                save_chat_turn(user_id, memory, agent_used, message, response)
+            except Exception as e:
+                logger.warning(f"Error guardando turno del chat: {e}")
+        get_metrics().observe('chat_stage_duration_seconds', time.monotonic() - started, stage='memory.write')
+
+    _get_save_executor().submit(bind_context(save))
@@ -0,0 +1,416 @@
+"""
+Circuit Breaker - Cortocircuito por proveedor de IA
+
+Cuando OpenAI se degrada, cada petición pagaba el timeout completo antes de
+caer a Claude. El breaker observa una ventana deslizante de errores y llamadas
+lentas por proveedor (compartida por todos los agentes del proceso y,
+opcionalmente, por toda la flota vía Redis) y abre el circuito para que
+BaseAIService salte directamente al siguiente proveedor.
+
+Estados:
+- closed: las llamadas pasan y se registran en la ventana
+- open: las llamadas se rechazan hasta que pase LLM_BREAKER_OPEN_SECONDS
+- half_open: se permite un número limitado de llamadas de prueba; si salen
+  bien el circuito se cierra, si fallan vuelve a abrirse
+
+El nivel Redis nunca bloquea al llamador (que puede ser el event loop de
+agenerate/astream_query): las escrituras de la ventana y la consulta del
+estado de la flota van a un thread propio, y el estado de la flota se lee de
+una copia local refrescada como mucho cada LLM_BREAKER_FLEET_CHECK_SECONDS.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from .errors import ProviderUnavailableError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_redis_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_redis_executor() -> ThreadPoolExecutor:
+    """Un thread para las llamadas a Redis de todos los breakers (fuera del event loop)"""
+    global _redis_executor
+    if _redis_executor is None:
+        with _executor_lock:
+            if _redis_executor is None:
+                _redis_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='llm-breaker-redis')
+    return _redis_executor
+
+
+def _text(value: Any) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de un proveedor con ventana deslizante de error y latencia.
+
+    Configuración (variables de entorno):
+    - LLM_BREAKER_ENABLED: activar los breakers
+    - LLM_BREAKER_WINDOW: segundos de la ventana deslizante
+    - LLM_BREAKER_MIN_CALLS: llamadas mínimas en la ventana para evaluar
+    - LLM_BREAKER_ERROR_RATE: proporción de errores que abre el circuito
+    - LLM_BREAKER_SLOW_CALL_SECONDS: latencia a partir de la cual una llamada es lenta
+    - LLM_BREAKER_SLOW_CALL_RATE: proporción de llamadas lentas que abre el circuito
+    - LLM_BREAKER_OPEN_SECONDS: tiempo en estado abierto antes de probar (half-open)
+    - LLM_BREAKER_HALF_OPEN_CALLS: llamadas de prueba simultáneas en half-open
+    - LLM_BREAKER_FLEET_CHECK_SECONDS: antigüedad máxima del estado de la flota leído de Redis
+    """
+
+    REDIS_PREFIX = 'llm_breaker'
+    # La ventana en Redis se agrega en ranuras de tiempo fijas
+    REDIS_SLOTS = 6
+
+    def __init__(self, provider: str, redis_client=None):
+        self.provider = provider
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.enabled = os.getenv('LLM_BREAKER_ENABLED', 'True').lower() == 'true'
+        self.window = float(os.getenv('LLM_BREAKER_WINDOW', 60))
+        self.min_calls = int(os.getenv('LLM_BREAKER_MIN_CALLS', 10))
+        self.error_rate_threshold = float(os.getenv('LLM_BREAKER_ERROR_RATE', 0.5))
+        self.slow_call_seconds = float(os.getenv('LLM_BREAKER_SLOW_CALL_SECONDS', 15))
+        self.slow_call_rate_threshold = float(os.getenv('LLM_BREAKER_SLOW_CALL_RATE', 0.8))
+        self.open_seconds = float(os.getenv('LLM_BREAKER_OPEN_SECONDS', 30))
+        self.half_open_calls = int(os.getenv('LLM_BREAKER_HALF_OPEN_CALLS', 1))
+        self.fleet_check_seconds = float(os.getenv('LLM_BREAKER_FLEET_CHECK_SECONDS', 1))
+
+        self.redis_client = redis_client
+        # Última lectura del estado de la flota (la refresca el thread de Redis)
+        self._fleet_state = False
+        self._fleet_checked_at: Optional[float] = None
+        self._fleet_refreshing = False
+
+        self._lock = threading.Lock()
+        # (timestamp, fallo, lenta)
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        self._state = CLOSED
+        self._opened_at: Optional[float] = None
+        self._probes_in_flight = 0
+        self._probe_started_at: Optional[float] = None
+        self.stats = {
+            'opened': 0,
+            'rejected': 0,
+            'successes': 0,
+            'failures': 0
+        }
+
+    # API pública
+
+    def allow_request(self) -> bool:
+        """
+        Decidir si se puede llamar al proveedor ahora.
+        En half-open reserva una de las llamadas de prueba.
+        """
+        if not self.enabled:
+            return True
+
+        if self._fleet_open():
+            with self._lock:
+                self.stats['rejected'] += 1
+            return False
+
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+
+            if state == HALF_OPEN:
+                now = time.monotonic()
+                # Una prueba que nunca reportó resultado (p.ej. perdió el hedging) caduca
+                if self._probes_in_flight and self._probe_started_at \
+                        and now - self._probe_started_at > self.open_seconds:
+                    self._probes_in_flight = 0
+                if self._probes_in_flight < self.half_open_calls:
+                    self._probes_in_flight += 1
+                    self._probe_started_at = now
+                    return True
+
+            self.stats['rejected'] += 1
+            return False
+
+    def release_probe(self):
+        """
+        Devolver la llamada de prueba reservada por allow_request cuando al
+        final no se usó (perdió el hedging, el cliente cerró el stream antes
+        del primer token...). Sin esto el half-open queda bloqueado hasta que
+        la prueba caduca.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes_in_flight:
+                self._probes_in_flight -= 1
+
+    def record_success(self, latency: float):
+        """Registrar una llamada correcta y su latencia (segundos)"""
+        if not self.enabled:
+            return
+
+        slow = latency >= self.slow_call_seconds
+        with self._lock:
+            self.stats['successes'] += 1
+            if self._current_state() == HALF_OPEN:
+                if slow:
+                    self._open()
+                else:
+                    self._close()
+                return
+
+            self._append(False, slow)
+            opened = self._evaluate()
+
+        self._record_redis(False, slow, opened)
+
+    def record_failure(self, error: Optional[BaseException] = None):
+        """Registrar una llamada fallida (timeout, 429, 5xx...)"""
+        if not self.enabled:
+            return
+        # No configurado o rechazado por el propio breaker: no es un fallo del proveedor
+        if isinstance(error, ProviderUnavailableError):
+            return
+
+        with self._lock:
+            self.stats['failures'] += 1
+            if self._current_state() == HALF_OPEN:
+                self._open()
+                opened = True
+            else:
+                self._append(True, False)
+                opened = self._evaluate()
+
+        self._record_redis(True, False, opened)
+
+    @property
+    def state(self) -> str:
+        """Estado actual sin reservar llamadas de prueba (para filtrar proveedores)"""
+        if not self.enabled:
+            return CLOSED
+        if self._fleet_open():
+            return OPEN
+        with self._lock:
+            return self._current_state()
+
+    def reset(self):
+        """Cerrar el circuito y vaciar la ventana"""
+        with self._lock:
+            self._close()
+            self._fleet_state = False
+        if self.redis_client is not None:
+            try:
+                self.redis_client.delete(self._redis_state_key())
+            except Exception as e:
+                self.logger.warning(f"Error reseteando breaker de {self.provider} en Redis: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Estado del breaker para los health checks"""
+        state = self.state
+        with self._lock:
+            self._prune(time.monotonic())
+            calls = len(self._calls)
+            failures = sum(1 for _, failed, _ in self._calls if failed)
+            slow = sum(1 for _, _, is_slow in self._calls if is_slow)
+            retry_in = None
+            if self._state == OPEN and self._opened_at is not None:
+                retry_in = round(max(0.0, self._opened_at + self.open_seconds - time.monotonic()), 2)
+            stats = dict(self.stats)
+
+        return {
+            'provider': self.provider,
+            'enabled': self.enabled,
+            'state': state,
+            'window_calls': calls,
+            'error_rate': round(failures / calls, 3) if calls else 0,
+            'slow_call_rate': round(slow / calls, 3) if calls else 0,
+            'retry_in_seconds': retry_in,
+            'shared': self.redis_client is not None,
+            **stats
+        }
+
+    # Ventana local (llamar con el lock tomado)
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+            self.logger.info(f"Circuito de {self.provider} en half-open")
+        return self._state
+
+    def _append(self, failed: bool, slow: bool):
+        now = time.monotonic()
+        self._calls.append((now, failed, slow))
+        self._prune(now)
+
+    def _prune(self, now: float):
+        while self._calls and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
+
+    def _evaluate(self) -> bool:
+        """Abrir el circuito si la ventana supera los umbrales"""
+        calls = len(self._calls)
+        if self._state != CLOSED or calls < self.min_calls:
+            return False
+
+        failures = sum(1 for _, failed, _ in self._calls if failed)
+        slow = sum(1 for _, _, is_slow in self._calls if is_slow)
+        if failures / calls >= self.error_rate_threshold or slow / calls >= self.slow_call_rate_threshold:
+            self._open()
+            return True
+        return False
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._probes_in_flight = 0
+        self.stats['opened'] += 1
+        self.logger.warning(f"Circuito de {self.provider} abierto durante {self.open_seconds:.0f}s")
+
+    def _close(self):
+        if self._state != CLOSED:
+            self.logger.info(f"Circuito de {self.provider} cerrado")
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes_in_flight = 0
+        self._calls.clear()
+
+    # Nivel Redis (compartido por la flota)
+
+    def _redis_state_key(self) -> str:
+        return f"{self.REDIS_PREFIX}:{self.provider}:open"
+
+    def _redis_slot_key(self, slot: int) -> str:
+        return f"{self.REDIS_PREFIX}:{self.provider}:window:{slot}"
+
+    def _slot_seconds(self) -> float:
+        return max(1.0, self.window / self.REDIS_SLOTS)
+
+    def _fleet_open(self) -> bool:
+        """
+        Otro worker abrió el circuito: adoptar el estado abierto localmente.
+        Lee la copia local y, si está caducada, pide el refresco en segundo plano.
+        """
+        if self.redis_client is None:
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            refresh = not self._fleet_refreshing and (
+                self._fleet_checked_at is None or now - self._fleet_checked_at >= self.fleet_check_seconds
+            )
+            if refresh:
+                self._fleet_refreshing = True
+            fleet_open = self._fleet_state
+        if refresh:
+            try:
+                _get_redis_executor().submit(self._refresh_fleet_state)
+            except RuntimeError:  # intérprete cerrándose
+                with self._lock:
+                    self._fleet_refreshing = False
+
+        if not fleet_open:
+            return False
+        with self._lock:
+            if self._state == CLOSED:
+                self._open()
+        return True
+
+    def _refresh_fleet_state(self):
+        fleet_open = False
+        try:
+            fleet_open = bool(self.redis_client.exists(self._redis_state_key()))
+        except Exception as e:
+            self.logger.warning(f"Error consultando breaker de {self.provider} en Redis: {e}")
+        finally:
+            with self._lock:
+                self._fleet_state = fleet_open
+                self._fleet_checked_at = time.monotonic()
+                self._fleet_refreshing = False
+
+    def _record_redis(self, failed: bool, slow: bool, opened: bool):
+        if self.redis_client is None:
+            return
+        try:
+            _get_redis_executor().submit(self._write_redis, failed, slow, opened)
+        except RuntimeError:  # intérprete cerrándose
+            pass
+
+    def _write_redis(self, failed: bool, slow: bool, opened: bool):
+        try:
+            slot_seconds = self._slot_seconds()
+            current = int(time.time() // slot_seconds)
+            ttl = int(self.window + slot_seconds) + 1
+
+            pipe = self.redis_client.pipeline()
+            slot_key = self._redis_slot_key(current)
+            pipe.hincrby(slot_key, 'calls', 1)
+            if failed:
+                pipe.hincrby(slot_key, 'failures', 1)
+            if slow:
+                pipe.hincrby(slot_key, 'slow', 1)
+            pipe.expire(slot_key, ttl)
+            if opened:
+                pipe.set(self._redis_state_key(), '1', ex=int(self.open_seconds))
+            pipe.execute()
+
+            # Solo un fallo o una llamada lenta pueden abrir el circuito
+            if not opened and (failed or slow):
+                self._evaluate_fleet(current)
+        except Exception as e:
+            self.logger.warning(f"Error registrando breaker de {self.provider} en Redis: {e}")
+
+    def _evaluate_fleet(self, current_slot: int):
+        pipe = self.redis_client.pipeline()
+        for slot in range(current_slot - self.REDIS_SLOTS + 1, current_slot + 1):
+            pipe.hgetall(self._redis_slot_key(slot))
+
+        calls = failures = slow = 0
+        for counters in pipe.execute():
+            counters = {_text(field): int(value) for field, value in counters.items()}
+            calls += counters.get('calls', 0)
+            failures += counters.get('failures', 0)
+            slow += counters.get('slow', 0)
+
+        if calls < self.min_calls:
+            return
+        if failures / calls >= self.error_rate_threshold or slow / calls >= self.slow_call_rate_threshold:
+            # NX: el primer worker que lo detecta fija la ventana de apertura
+            if self.redis_client.set(self._redis_state_key(), '1', ex=int(self.open_seconds), nx=True):
+                self.logger.warning(f"Circuito de {self.provider} abierto para toda la flota")
+            with self._lock:
+                self._fleet_state = True
+                if self._state == CLOSED:
+                    self._open()
+
+
+class CircuitBreakerRegistry:
+    """
+    Un breaker por proveedor, compartido por todos los agentes del proceso.
+
+    Con LLM_BREAKER_REDIS el registro de servicios le pasa el cliente Redis
+    compartido del proceso y la ventana se agrega para toda la flota.
+    """
+
+    PROVIDERS = ('openai', 'claude')
+
+    def __init__(self, redis_client=None):
+        self.breakers = {provider: CircuitBreaker(provider, redis_client) for provider in self.PROVIDERS}
+
+    def get(self, provider: str) -> CircuitBreaker:
+        return self.breakers[provider]
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {provider: breaker.snapshot() for provider, breaker in self.breakers.items()}
+
+    def any_open(self) -> bool:
+        return any(breaker.state == OPEN for breaker in self.breakers.values())
+
@@ -19,9 +19,12 @@ class ContentCreatorAgent(BaseAIService):
     - Adaptar contenido al nivel educativo
     """
     
+    # Metadatos de clase (disponibles sin construir el agente)
+    agent_name = "Creador de Contenido Interactivo"
+    
     def get_agent_name(self) -> str:
         """Nombre del agente"""
-        return "Creador de Contenido Interactivo"
+        return self.agent_name
     
     def get_system_prompt(self) -> str:
         """Prompt del sistema para el Creador de Contenido"""
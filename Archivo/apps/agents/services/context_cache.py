@@ -0,0 +1,251 @@
+"""
+Context Cache - Caché en proceso de la ventana reciente de cada conversación
+
+Cada petición de chat releía de Redis los últimos mensajes de la conversación
+aunque el mismo worker los hubiera escrito segundos antes. Esta LRU guarda,
+por (usuario, agente), la ventana de mensajes recientes ya decodificados junto
+con la versión de la conversación.
+
+Coherencia entre workers:
+- Cada escritura incrementa conversation_version:{user}:{agent} en la misma
+  transacción y publica la clave en un canal de invalidación.
+- El worker que escribe actualiza su entrada si la versión nueva es la
+  siguiente a la cacheada (nadie más escribió entre medias); si no, la descarta.
+- Los demás workers reciben la publicación y descartan su entrada.
+- Mientras el listener está suscrito, una entrada se sirve sin tocar Redis
+  hasta CONVERSATION_CACHE_TTL; sin listener (o pasado el TTL) se revalida con
+  un GET de la versión, mucho más barato que LRANGE + decodificar la ventana.
+- Una lectura toma read_token() antes de ir a Redis: si mientras tanto llegó
+  una invalidación de esa clave (o la caché ya tiene una versión posterior),
+  store() descarta la ventana leída en vez de cachear una versión vieja.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+CHANNEL = 'agents:conversation_invalidations'
+
+
+def invalidation_message(worker_id: str, key: str) -> str:
+    """Mensaje publicado en CHANNEL; el worker que lo envía lo ignora"""
+    return f"{worker_id} {key}"
+
+
+class ContextEntry:
+    """Ventana reciente de una conversación (más reciente primero)"""
+
+    __slots__ = ('version', 'messages', 'complete', 'stored_at')
+
+    def __init__(self, version: int, messages: List[Dict[str, Any]], complete: bool):
+        self.version = version
+        self.messages = messages
+        self.complete = complete  # la ventana contiene la conversación entera
+        self.stored_at = time.monotonic()
+
+    def covers(self, limit: int) -> bool:
+        return self.complete or len(self.messages) >= limit
+
+
+class ConversationContextCache:
+    """
+    LRU en proceso de ventanas de conversación con invalidación por versión.
+
+    Configuración (variables de entorno):
+    - CONVERSATION_CACHE_SIZE: conversaciones en la LRU (0 = desactivada)
+    - CONVERSATION_CACHE_WINDOW: mensajes recientes guardados por conversación
+    - CONVERSATION_CACHE_TTL: segundos que una entrada se sirve sin revalidar
+    - CONVERSATION_CACHE_PUBSUB: escuchar las invalidaciones de otros workers
+    """
+
+    def __init__(self, redis_client=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.max_size = int(os.getenv('CONVERSATION_CACHE_SIZE', 10000))
+        self.window = int(os.getenv('CONVERSATION_CACHE_WINDOW', 20))
+        self.ttl = float(os.getenv('CONVERSATION_CACHE_TTL', 60))
+        self.use_pubsub = os.getenv('CONVERSATION_CACHE_PUBSUB', 'True').lower() == 'true'
+
+        self.redis_client = redis_client
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._entries: "OrderedDict[str, ContextEntry]" = OrderedDict()
+        # Secuencia de la última invalidación por clave (acotado: las más
+        # antiguas se olvidan y suben el suelo, que descarta por precaución)
+        self._sequence = 0
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        self._floor = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._listener: Optional[threading.Thread] = None
+        self.listening = False
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'updates': 0, 'invalidations': 0,
+                      'stale_reads': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def _count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    # Lectura
+
+    def lookup(self, key: str, limit: int) -> Optional[ContextEntry]:
+        """Entrada que cubre `limit` mensajes (sin validar su versión)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not entry.covers(limit):
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def trusted(self, entry: ContextEntry) -> bool:
+        """Servible sin revalidar: el listener recibe las invalidaciones y no caducó"""
+        return self.listening and time.monotonic() - entry.stored_at < self.ttl
+
+    def hit(self, entry: ContextEntry, revalidated: bool = False):
+        if revalidated:
+            entry.stored_at = time.monotonic()
+        self._count('revalidated' if revalidated else 'hits')
+
+    def read_token(self) -> int:
+        """Marca a tomar antes de leer de Redis la ventana que se pasará a store()"""
+        with self._lock:
+            return self._sequence
+
+    def store(self, key: str, version: int, messages: List[Dict[str, Any]], complete: bool, token: int):
+        """
+        Cachear una ventana leída de Redis, salvo que haya llegado una
+        invalidación de la clave desde read_token() o ya haya una versión posterior
+        """
+        self._count('misses')
+        entry = ContextEntry(version, messages[:self.window], complete)
+        with self._lock:
+            current = self._entries.get(key)
+            if token < self._floor or self._invalidated.get(key, 0) > token \
+                    or (current is not None and current.version > version):
+                self.stats['stale_reads'] += 1
+                return
+            self._put_locked(key, entry)
+
+    def _put(self, key: str, entry: ContextEntry):
+        with self._lock:
+            self._put_locked(key, entry)
+
+    def _put_locked(self, key: str, entry: ContextEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _mark_invalidated(self, key: str):
+        """Registrar la invalidación para las lecturas en curso (con el lock tomado)"""
+        self._sequence += 1
+        self._invalidated[key] = self._sequence
+        self._invalidated.move_to_end(key)
+        while len(self._invalidated) > max(self.max_size, 1):
+            _, sequence = self._invalidated.popitem(last=False)
+            self._floor = max(self._floor, sequence)
+
+    # Escritura e invalidación
+
+    def apply_write(self, key: str, version: int, new_messages: List[Dict[str, Any]]):
+        """
+        Reflejar una escritura propia (mensajes en orden cronológico).
+        Solo se conserva la entrada si nadie escribió desde que se cacheó.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version - 1:
+                messages = list(reversed(new_messages)) + entry.messages
+                self._mark_invalidated(key)
+                self._put_locked(key, ContextEntry(version, messages[:self.window],
+                                                   entry.complete and len(messages) <= self.window))
+                self.stats['updates'] += 1
+                return
+        self.invalidate(key)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._mark_invalidated(key)
+            removed = self._entries.pop(key, None)
+        if removed is not None:
+            self._count('invalidations')
+
+    def invalidation_message(self, key: str) -> str:
+        return invalidation_message(self.worker_id, key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            # Las lecturas en curso pueden ser de antes de lo que se perdió
+            self._sequence += 1
+            self._floor = self._sequence
+            self._invalidated.clear()
+
+    # Listener de invalidaciones (un thread por proceso)
+
+    def start(self):
+        """Arrancar el listener de invalidaciones (idempotente)"""
+        if not self.enabled or not self.use_pubsub or self.redis_client is None:
+            return
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._stop.clear()
+            self._listener = threading.Thread(target=self._listen, name='context-cache-listener', daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(CHANNEL)
+                # Durante la desconexión pudieron perderse invalidaciones
+                self.clear()
+                self.listening = True
+                backoff = 1.0
+                while not self._stop.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message.get('type') == 'message':
+                        self._on_message(message['data'])
+            except Exception as e:
+                if not self._stop.is_set():
+                    self.logger.warning(f"Listener de invalidaciones desconectado: {e}")
+            finally:
+                self.listening = False
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def _on_message(self, data: Any):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        worker_id, _, key = data.partition(' ')
+        if worker_id != self.worker_id and key:
+            self.invalidate(key)
+
+    def shutdown(self):
+        self._stop.set()
+        self.listening = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._entries)
+        served = stats['hits'] + stats['revalidated']
+        stats.update(
+            enabled=self.enabled,
+            listening=self.listening,
+            hit_rate=round(served / max(served + stats['misses'], 1), 4)
+        )
+        return stats
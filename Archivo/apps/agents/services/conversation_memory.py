@@ -1,17 +1,131 @@
 """
 Conversation Memory - Sistema de memoria conversacional para agentes
+
+Todas las instancias comparten el cliente Redis del proceso (un único pool de
+conexiones, ver registry.get_redis_client). Un turno completo se escribe con
+add_messages en una sola transacción MULTI/EXEC: LPUSH de todos los mensajes,
+LTRIM, EXPIRE y SETEX de la sesión viajan en un único round trip.
+
+La API async (aadd_messages, aget_context, aget_session_metadata) usa
+redis.asyncio con el pool compartido del event loop y las mismas claves
+(conversation:, session:, metadata:), así que las rutas sync y async leen y
+escriben la misma memoria. ChatConsumer y las vistas async la usan sin pasar
+por el pool de threads.
+
+Los mensajes se guardan con la codificación compacta de message_codec.py
+(msgpack versionado, zstd opcional) y las entradas JSON antiguas se siguen
+leyendo; por eso los clientes Redis de la memoria son binarios
+(decode_responses=False).
+
+get_context sirve la ventana reciente desde una LRU en proceso
+(context_cache.py) invalidada con el contador conversation_version:{user}:{agent},
+que cada escritura incrementa en la misma transacción.
+
+La misma transacción mantiene el hash conversation_summary:{user}: mensajes
+por agente y rol, primera/última actividad y tiempo total de sesión por agente
+(los huecos entre escrituras de hasta SESSION_TIMEOUT_MINUTES). Los resúmenes
+y la analítica de un usuario se responden con un HGETALL en lugar de leer y
+ordenar el historial completo de cada agente. Los usuarios con historial
+anterior a los contadores se completan una sola vez en la primera lectura
+(_backfill_summary), que marca el hash con el campo 'v'.
+
+Los contadores cuentan la conversación entera desde su primer mensaje,
+incluidos los que LTRIM ya descartó por MAX_CONVERSATION_HISTORY (el
+recorrido del historial, sin Redis, solo ve los conservados). Vuelven a cero
+con la conversación: el primer turno tras expirar o borrarse la lista los
+reinicia, y mientras tanto la lectura los ignora si la última actividad es
+anterior a CONVERSATION_MAX_AGE_DAYS (el hash, compartido por los agentes del
+usuario, sigue vivo aunque la lista de uno haya expirado).
+
+Configuración (variables de entorno):
+- MAX_CONVERSATION_HISTORY: mensajes conservados por conversación
+- CONVERSATION_MAX_AGE_DAYS: expiración de la conversación
+- SESSION_TIMEOUT_MINUTES: expiración de los metadatos de sesión
+- CONVERSATION_MEMORY_LUA: escribir el turno con un script Lua (EVALSHA) en
+  lugar de MULTI/EXEC
+- CONVERSATION_ENCODING, CONVERSATION_ZSTD_MIN_BYTES, CONVERSATION_ZSTD_LEVEL:
+  ver MessageCodec
+- CONVERSATION_CACHE_*: ver ConversationContextCache
 """
 
 import json
+import time
 import logging
-from typing import Dict, Any, List, Optional
+from collections import Counter
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime, timedelta
+from asgiref.sync import sync_to_async
 from django.core.cache import cache
-import redis
+from redis.exceptions import WatchError
 import os
 
+from .context_cache import CHANNEL as INVALIDATION_CHANNEL
+from .message_codec import MessageCodec
+from .registry import get_async_redis_client, get_context_cache, get_redis_client
+
 logger = logging.getLogger(__name__)
 
+# Versión del hash de resumen: sin este campo falta contar el historial anterior
+SUMMARY_SCHEMA = '1'
+
+# Intentos del backfill si una escritura concurrente modifica el hash (WATCH)
+SUMMARY_BACKFILL_ATTEMPTS = 3
+
+# Conversación nueva (no existía o expiró): sus contadores del resumen vuelven
+# a cero antes del LPUSH
+# KEYS: conversación, resumen del usuario
+# ARGV: campos del agente en el resumen...
+RESET_SUMMARY_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('HDEL', KEYS[2], unpack(ARGV))
+end
+"""
+
+# Tiempo de sesión y última actividad del agente (leer :last antes de pisarlo)
+# KEYS: resumen del usuario
+# ARGV: agente, epoch, expiración de la sesión
+SESSION_TIME_LUA = """
+local last = tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':last'))
+local gap = tonumber(ARGV[2]) - (last or tonumber(ARGV[2]))
+if gap > 0 and gap <= tonumber(ARGV[3]) then
+    redis.call('HINCRBY', KEYS[1], ARGV[1] .. ':session', gap)
+end
+redis.call('HSET', KEYS[1], ARGV[1] .. ':last', ARGV[2])
+"""
+
+# LPUSH + LTRIM + EXPIRE de la conversación, SETEX de la sesión, nueva versión,
+# invalidación y contadores del resumen en una sola llamada; devuelve la versión
+# KEYS: conversación, sesión, versión, resumen del usuario
+# ARGV: máx. mensajes, expiración conversación, expiración sesión, metadatos,
+#       canal, mensaje de invalidación, agente, epoch, roles ("user,assistant"),
+#       mensajes...
+APPEND_TURN_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    for _, field in ipairs({'user', 'assistant', 'system', 'first', 'last', 'session'}) do
+        redis.call('HDEL', KEYS[4], ARGV[7] .. ':' .. field)
+    end
+end
+redis.call('LPUSH', KEYS[1], unpack(ARGV, 10))
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SETEX', KEYS[2], ARGV[3], ARGV[4])
+local version = redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+redis.call('PUBLISH', ARGV[5], ARGV[6])
+for role in string.gmatch(ARGV[9], '[^,]+') do
+    redis.call('HINCRBY', KEYS[4], ARGV[7] .. ':' .. role, 1)
+end
+redis.call('HSETNX', KEYS[4], ARGV[7] .. ':first', ARGV[8])
+local last = tonumber(redis.call('HGET', KEYS[4], ARGV[7] .. ':last'))
+local gap = tonumber(ARGV[8]) - (last or tonumber(ARGV[8]))
+if gap > 0 and gap <= tonumber(ARGV[3]) then
+    redis.call('HINCRBY', KEYS[4], ARGV[7] .. ':session', gap)
+end
+redis.call('HSET', KEYS[4], ARGV[7] .. ':last', ARGV[8])
+redis.call('EXPIRE', KEYS[4], ARGV[2])
+return version
+"""
+
 class ConversationMemory:
     """
     Sistema de memoria conversacional que mantiene el contexto de las conversaciones
@@ -25,7 +139,7 @@ class ConversationMemory:
     - Análisis de patrones conversacionales
     """
     
-    def __init__(self, user_id: str, agent_type: str, redis_client=None):
+    def __init__(self, user_id: str, agent_type: str, redis_client=None, async_redis_client=None):
         """
         Inicializar memoria conversacional para un usuario y agente específico
         
@@ -33,35 +147,52 @@ class ConversationMemory:
             user_id: ID único del usuario
             agent_type: Tipo de agente (tutor, evaluator, etc.)
             redis_client: Cliente Redis personalizado (opcional)
+            async_redis_client: Cliente redis.asyncio personalizado (opcional)
         """
         self.user_id = user_id
         self.agent_type = agent_type
         self.logger = logging.getLogger(f"{self.__class__.__name__}_{agent_type}")
         
-        # Configurar cliente Redis
+        # Configurar cliente Redis (el async se resuelve en el loop que lo use)
         self.redis_client = redis_client or self._init_redis_client()
+        self._async_redis_client = async_redis_client
         
         # Configuración de memoria
         self.max_messages = int(os.getenv('MAX_CONVERSATION_HISTORY', 50))
         self.max_age_days = int(os.getenv('CONVERSATION_MAX_AGE_DAYS', 30))
         self.session_timeout = int(os.getenv('SESSION_TIMEOUT_MINUTES', 60))
+        self.use_lua = os.getenv('CONVERSATION_MEMORY_LUA', 'False').lower() == 'true'
+        self.codec = MessageCodec()
         
         # Claves Redis
         self.conversation_key = f"conversation:{user_id}:{agent_type}"
         self.session_key = f"session:{user_id}:{agent_type}"
         self.metadata_key = f"metadata:{user_id}:{agent_type}"
+        self.version_key = f"conversation_version:{user_id}:{agent_type}"
+        self.summary_key = self.summary_key_for(user_id)
+        
+        # Ventana reciente en proceso, compartida por todas las instancias
+        self.context_cache = get_context_cache() if self.redis_client else None
         
         self.logger.info(f"ConversationMemory inicializada para {user_id}/{agent_type}")
     
     def _init_redis_client(self):
-        """Inicializar cliente Redis"""
+        """Cliente Redis compartido del proceso (un pool para todas las instancias)"""
         try:
-            redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
-            return redis.from_url(redis_url, decode_responses=True)
+            return get_redis_client()
         except Exception as e:
             self.logger.warning(f"Error conectando a Redis: {e}. Usando cache de Django.")
             return None
     
+    def _async_client(self):
+        """Cliente redis.asyncio del loop actual (None si Redis no está disponible)"""
+        if self._async_redis_client is None and self.redis_client is not None:
+            try:
+                self._async_redis_client = get_async_redis_client()
+            except Exception as e:
+                self.logger.warning(f"Error conectando a Redis (async): {e}")
+        return self._async_redis_client
+    
     def add_message(self, role: str, content: str, metadata: Optional[Dict[str, Any]] = None) -> bool:
         """
         Agregar mensaje a la memoria conversacional
@@ -74,42 +205,154 @@ class ConversationMemory:
         Returns:
             bool: True si se guardó exitosamente
         """
+        return self.add_messages([{'role': role, 'content': content, 'metadata': metadata}])
+    
+    def add_messages(self, messages: List[Dict[str, Any]]) -> bool:
+        """
+        Agregar varios mensajes (p.ej. un turno usuario + asistente) de forma atómica
+        
+        Args:
+            messages: Dicts con 'role', 'content' y 'metadata' opcional, en orden cronológico
+        
+        Returns:
+            bool: True si se guardaron exitosamente
+        """
+        if not messages:
+            return True
         try:
-            message = {
-                'role': role,
-                'content': content,
-                'timestamp': datetime.now().isoformat(),
-                'metadata': metadata or {}
-            }
+            messages = self._build_messages(messages)
             
             if self.redis_client:
-                # Usar Redis
-                self._add_message_redis(message)
+                # Usar Redis: mensajes, recorte, expiración y sesión en un round trip
+                self._add_messages_redis(messages)
             else:
                 # Usar cache de Django como fallback
-                self._add_message_cache(message)
+                for message in messages:
+                    self._add_message_cache(message)
+                self._update_session_metadata()
             
-            # Actualizar metadatos de sesión
-            self._update_session_metadata()
+            self._log_added(messages)
+            return True
             
-            self.logger.info(f"Mensaje agregado: {role} - {len(content)} caracteres")
+        except Exception as e:
+            self.logger.error(f"Error agregando mensajes: {e}")
+            return False
+    
+    async def aadd_messages(self, messages: List[Dict[str, Any]]) -> bool:
+        """
+        Versión async de add_messages (redis.asyncio, sin bloquear el event loop)
+        
+        Args:
+            messages: Dicts con 'role', 'content' y 'metadata' opcional, en orden cronológico
+        
+        Returns:
+            bool: True si se guardaron exitosamente
+        """
+        if not messages:
+            return True
+        client = self._async_client()
+        if client is None:
+            # Sin Redis: el fallback de la cache de Django es bloqueante
+            return await sync_to_async(self.add_messages, thread_sensitive=False)(messages)
+        try:
+            messages = self._build_messages(messages)
+            args = self._turn_args(messages)
+            
+            if self.use_lua:
+                append_turn = client.register_script(APPEND_TURN_LUA)
+                version = await append_turn(keys=self._turn_keys(), args=args)
+            else:
+                async with client.pipeline(transaction=True) as pipe:
+                    version_index = self._queue_turn(pipe, args)
+                    version = (await pipe.execute())[version_index]
+            self._cache_write(int(version), messages)
+            
+            self._log_added(messages)
             return True
             
         except Exception as e:
-            self.logger.error(f"Error agregando mensaje: {e}")
+            self.logger.error(f"Error agregando mensajes: {e}")
             return False
     
-    def _add_message_redis(self, message: Dict[str, Any]):
-        """Agregar mensaje usando Redis"""
-        # Agregar a lista
-        self.redis_client.lpush(self.conversation_key, json.dumps(message))
+    @staticmethod
+    def _build_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        timestamp = datetime.now().isoformat()
+        return [
+            {
+                'role': message['role'],
+                'content': message['content'],
+                'timestamp': timestamp,
+                'metadata': message.get('metadata') or {}
+            }
+            for message in messages
+        ]
+    
+    def _log_added(self, messages: List[Dict[str, Any]]):
+        self.logger.info(
+            f"Mensajes agregados: {', '.join(m['role'] for m in messages)} - "
+            f"{sum(len(m['content']) for m in messages)} caracteres"
+        )
+    
+    def _turn_args(self, messages: List[Dict[str, Any]]) -> List[Any]:
+        """ARGV de APPEND_TURN_LUA (también usados por la transacción MULTI/EXEC)"""
+        # LPUSH con varios valores los inserta en orden: el último queda primero
+        return [
+            self.max_messages,
+            self.max_age_days * 24 * 60 * 60,
+            self.session_timeout * 60,
+            json.dumps(self._session_metadata()),
+            INVALIDATION_CHANNEL,
+            self.context_cache.invalidation_message(self.conversation_key),
+            self.agent_type,
+            int(time.time()),
+            ','.join(message['role'] for message in messages),
+            *[self.codec.encode(message) for message in messages]
+        ]
+    
+    def _turn_keys(self) -> List[str]:
+        return [self.conversation_key, self.session_key, self.version_key, self.summary_key]
+    
+    def _queue_turn(self, pipe, args: List[Any]) -> int:
+        """
+        Comandos de la transacción
         
-        # Mantener solo los últimos N mensajes
-        self.redis_client.ltrim(self.conversation_key, 0, self.max_messages - 1)
+        Returns:
+            Posición de la nueva versión en los resultados de execute()
+        """
+        (max_messages, expire_seconds, session_seconds, session, channel, invalidation,
+         agent, epoch, roles, *encoded) = args
+        pipe.eval(RESET_SUMMARY_LUA, 2, self.conversation_key, self.summary_key,
+                  *self.summary_fields_for(agent))
+        pipe.lpush(self.conversation_key, *encoded)
+        pipe.ltrim(self.conversation_key, 0, max_messages - 1)
+        pipe.expire(self.conversation_key, expire_seconds)
+        pipe.setex(self.session_key, session_seconds, session)
+        pipe.incr(self.version_key)
+        pipe.expire(self.version_key, expire_seconds)
+        pipe.publish(channel, invalidation)
+        for role, count in Counter(roles.split(',')).items():
+            pipe.hincrby(self.summary_key, f"{agent}:{role}", count)
+        pipe.hsetnx(self.summary_key, f"{agent}:first", epoch)
+        pipe.eval(SESSION_TIME_LUA, 1, self.summary_key, agent, epoch, session_seconds)
+        pipe.expire(self.summary_key, expire_seconds)
+        return 5
+    
+    def _add_messages_redis(self, messages: List[Dict[str, Any]]):
+        """Agregar mensajes usando Redis (MULTI/EXEC o script Lua)"""
+        args = self._turn_args(messages)
         
-        # Establecer expiración
-        expire_seconds = self.max_age_days * 24 * 60 * 60
-        self.redis_client.expire(self.conversation_key, expire_seconds)
+        if self.use_lua:
+            append_turn = self.redis_client.register_script(APPEND_TURN_LUA)
+            version = append_turn(keys=self._turn_keys(), args=args)
+        else:
+            pipe = self.redis_client.pipeline(transaction=True)
+            version_index = self._queue_turn(pipe, args)
+            version = pipe.execute()[version_index]
+        self._cache_write(int(version), messages)
+    
+    def _cache_write(self, version: int, messages: List[Dict[str, Any]]):
+        if self.context_cache.enabled:
+            self.context_cache.apply_write(self.conversation_key, version, messages)
     
     def _add_message_cache(self, message: Dict[str, Any]):
         """Agregar mensaje usando cache de Django"""
@@ -119,8 +362,10 @@ class ConversationMemory:
         # Agregar nuevo mensaje al inicio
         messages.insert(0, message)
         
-        # Mantener solo los últimos N mensajes
-        messages = messages[:self.max_messages]
+        # Mantener solo los últimos N mensajes y descartar los que superan la
+        # edad máxima (el timeout del cache se renueva con cada mensaje)
+        cutoff = (datetime.now() - timedelta(days=self.max_age_days)).isoformat()
+        messages = [m for m in messages[:self.max_messages] if m.get('timestamp', cutoff) >= cutoff]
         
         # Guardar en cache con timeout
         timeout = self.max_age_days * 24 * 60 * 60
@@ -153,16 +398,94 @@ class ConversationMemory:
             self.logger.error(f"Error obteniendo contexto: {e}")
             return []
     
+    async def aget_context(self, limit: int = 10, include_system: bool = False) -> List[Dict[str, Any]]:
+        """Versión async de get_context"""
+        client = self._async_client()
+        if client is None:
+            return await sync_to_async(self.get_context, thread_sensitive=False)(limit, include_system)
+        try:
+            messages = self._cached_context(limit)
+            if messages is None and self.context_cache.enabled:
+                entry = self.context_cache.lookup(self.conversation_key, limit)
+                if entry is not None and self._parse_version(await client.get(self.version_key)) == entry.version:
+                    self.context_cache.hit(entry, revalidated=True)
+                    messages = entry.messages[:limit]
+            if messages is None:
+                async with client.pipeline(transaction=True) as pipe:
+                    window, token = self._fetch_window(pipe, limit)
+                    messages = self._store_window(await pipe.execute(), window, token, limit)
+            if not include_system:
+                messages = [msg for msg in messages if msg.get('role') != 'system']
+            return messages[:limit]
+            
+        except Exception as e:
+            self.logger.error(f"Error obteniendo contexto: {e}")
+            return []
+    
     def _get_context_redis(self, limit: int) -> List[Dict[str, Any]]:
-        """Obtener contexto usando Redis"""
-        raw_messages = self.redis_client.lrange(self.conversation_key, 0, limit - 1)
+        """Obtener contexto usando Redis (con la ventana en proceso si está activa)"""
+        messages = self._cached_context(limit)
+        if messages is not None:
+            return messages
+        
+        if self.context_cache.enabled:
+            # Entrada sin listener o caducada: revalidar solo con la versión
+            entry = self.context_cache.lookup(self.conversation_key, limit)
+            if entry is not None and self._parse_version(self.redis_client.get(self.version_key)) == entry.version:
+                self.context_cache.hit(entry, revalidated=True)
+                return entry.messages[:limit]
+        
+        pipe = self.redis_client.pipeline(transaction=True)
+        window, token = self._fetch_window(pipe, limit)
+        return self._store_window(pipe.execute(), window, token, limit)
+    
+    def _cached_context(self, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Ventana servible sin tocar Redis (None si hay que consultar)"""
+        if not self.context_cache.enabled:
+            return None
+        entry = self.context_cache.lookup(self.conversation_key, limit)
+        if entry is None or not self.context_cache.trusted(entry):
+            return None
+        self.context_cache.hit(entry)
+        return entry.messages[:limit]
+    
+    def _fetch_window(self, pipe, limit: int) -> Tuple[int, int]:
+        """
+        Encolar versión + ventana (la ventana cacheada puede ser mayor que limit).
+        Devuelve también la marca de la caché tomada antes de la lectura.
+        """
+        if not self.context_cache.enabled:
+            window, token = limit, 0
+        else:
+            window, token = max(limit, self.context_cache.window), self.context_cache.read_token()
+        pipe.get(self.version_key)
+        pipe.lrange(self.conversation_key, 0, window - 1)
+        return window, token
+    
+    def _store_window(self, results: List[Any], window: int, token: int, limit: int) -> List[Dict[str, Any]]:
+        raw_version, raw_messages = results
+        messages = self._decode_messages(raw_messages)
+        if self.context_cache.enabled:
+            # Si llegó una invalidación durante la lectura, la ventana no se cachea
+            self.context_cache.store(
+                self.conversation_key, self._parse_version(raw_version), messages,
+                complete=len(raw_messages) < window, token=token
+            )
+        return messages[:limit]
+    
+    @staticmethod
+    def _parse_version(raw_version: Any) -> int:
+        return int(raw_version) if raw_version is not None else 0
+    
+    def _decode_messages(self, raw_messages: List[Any]) -> List[Dict[str, Any]]:
+        """Decodificar entradas de Redis (formato compacto o JSON antiguo)"""
         messages = []
         
         for raw_msg in raw_messages:
             try:
-                message = json.loads(raw_msg)
+                message = self.codec.decode(raw_msg)
                 messages.append(message)
-            except json.JSONDecodeError as e:
+            except Exception as e:
                 self.logger.warning(f"Error decodificando mensaje: {e}")
         
         return messages
@@ -182,16 +505,7 @@ class ConversationMemory:
         try:
             if self.redis_client:
                 raw_messages = self.redis_client.lrange(self.conversation_key, 0, -1)
-                messages = []
-                
-                for raw_msg in raw_messages:
-                    try:
-                        message = json.loads(raw_msg)
-                        messages.append(message)
-                    except json.JSONDecodeError:
-                        continue
-                
-                return messages
+                return self._decode_messages(raw_messages)
             else:
                 return cache.get(self.conversation_key, [])
                 
@@ -208,9 +522,14 @@ class ConversationMemory:
         """
         try:
             if self.redis_client:
-                self.redis_client.delete(self.conversation_key)
-                self.redis_client.delete(self.session_key)
-                self.redis_client.delete(self.metadata_key)
+                # La versión no se borra: sube, para invalidar las ventanas cacheadas
+                pipe = self.redis_client.pipeline(transaction=True)
+                pipe.delete(self.conversation_key, self.session_key, self.metadata_key)
+                pipe.hdel(self.summary_key, *self.summary_fields_for(self.agent_type))
+                pipe.incr(self.version_key)
+                pipe.publish(INVALIDATION_CHANNEL, self.context_cache.invalidation_message(self.conversation_key))
+                pipe.execute()
+                self.context_cache.invalidate(self.conversation_key)
             else:
                 cache.delete(self.conversation_key)
                 cache.delete(self.session_key)
@@ -227,9 +546,175 @@ class ConversationMemory:
         """
         Obtener resumen de la conversación actual
         
+        Con Redis los mensajes son los de toda la conversación, no solo los
+        MAX_CONVERSATION_HISTORY conservados (ver el docstring del módulo).
+        
         Returns:
             Dict con estadísticas y resumen de la conversación
         """
+        if self.redis_client:
+            try:
+                fields = self.summary_fields_for(self.agent_type)
+                values = self.redis_client.hmget(self.summary_key, ['v', *fields])
+                if values[0] is not None:
+                    counters = {field: value for field, value in zip(fields, values[1:]) if value is not None}
+                else:
+                    # Primera lectura del usuario: contar el historial anterior una sola vez
+                    counters = self._backfill_summary(self.user_id, self.agent_types(), self.redis_client)
+                if values[0] is not None or 'v' in counters:
+                    if self.summary_expired(counters, self.agent_type, self.max_age_days * 24 * 60 * 60):
+                        counters = {}
+                    return self.summary_from_counters(self.user_id, self.agent_type, counters)
+            except Exception as e:
+                self.logger.warning(f"Error leyendo contadores de resumen: {e}")
+        return self._summary_from_history()
+    
+    # Contadores de resumen por usuario (conversation_summary:{user})
+    
+    @staticmethod
+    def summary_key_for(user_id: str) -> str:
+        return f"conversation_summary:{user_id}"
+    
+    @staticmethod
+    def summary_fields_for(agent_type: str) -> List[str]:
+        return [f"{agent_type}:{field}" for field in ('user', 'assistant', 'system', 'first', 'last', 'session')]
+    
+    @staticmethod
+    def summary_from_counters(user_id: str, agent_type: str, counters: Dict[Any, Any]) -> Dict[str, Any]:
+        """Resumen con la misma forma que get_conversation_summary a partir de los campos del hash"""
+        def counter(field):
+            value = counters.get(f"{agent_type}:{field}")
+            return int(value) if value is not None else 0
+        
+        user_messages = counter('user')
+        assistant_messages = counter('assistant')
+        total_messages = user_messages + assistant_messages + counter('system')
+        first, last = counter('first'), counter('last')
+        
+        if not total_messages:
+            return {
+                'total_messages': 0,
+                'user_messages': 0,
+                'assistant_messages': 0,
+                'conversation_start': None,
+                'last_activity': None,
+                'topics_discussed': [],
+                'session_duration': 0
+            }
+        
+        return {
+            'total_messages': total_messages,
+            'user_messages': user_messages,
+            'assistant_messages': assistant_messages,
+            'conversation_start': datetime.fromtimestamp(first).isoformat() if first else None,
+            'last_activity': datetime.fromtimestamp(last).isoformat() if last else None,
+            'session_duration': round(counter('session') / 60, 2),  # tiempo de sesión total, en minutos
+            'agent_type': agent_type,
+            'user_id': user_id
+        }
+    
+    @staticmethod
+    def summary_expired(counters: Dict[Any, Any], agent_type: str, max_age_seconds: int) -> bool:
+        """La conversación del agente expiró aunque el hash (compartido) siga vivo"""
+        last = int(counters.get(f"{agent_type}:last") or 0)
+        return time.time() - last > max_age_seconds
+    
+    @staticmethod
+    def session_seconds(epochs: List[int], session_timeout: int) -> int:
+        """Tiempo de sesión: suma de los huecos entre mensajes de hasta session_timeout segundos"""
+        epochs = sorted(epochs)
+        return sum(gap for gap in (b - a for a, b in zip(epochs, epochs[1:])) if gap <= session_timeout)
+    
+    @staticmethod
+    def _message_epoch(message: Dict[str, Any]) -> Optional[int]:
+        try:
+            return int(datetime.fromisoformat(message['timestamp'].replace('Z', '+00:00')).timestamp())
+        except Exception:
+            return None
+    
+    @classmethod
+    def _backfill_summary(cls, user_id: str, agent_types: List[str], redis_client) -> Dict[str, Any]:
+        """
+        Sumar a los contadores del usuario el historial que escribieron versiones
+        anteriores (una sola vez: marca el hash con 'v').
+        
+        Solo se cuentan los mensajes anteriores a la primera escritura contada
+        (campo :first) y solo con HINCRBY/HSETNX, así que no se pisa lo que las
+        escrituras acumularon desde el despliegue. WATCH sobre el hash: si una
+        escritura llega durante el recorrido, se reintenta.
+        
+        Returns:
+            Campos del hash tras el backfill (sin 'v' si no pudo completarse)
+        """
+        summary_key = cls.summary_key_for(user_id)
+        counters: Dict[str, Any] = {}
+        for _ in range(SUMMARY_BACKFILL_ATTEMPTS):
+            pipe = redis_client.pipeline(transaction=True)
+            try:
+                pipe.watch(summary_key)
+                counters = {
+                    (k.decode('utf-8') if isinstance(k, bytes) else k): v
+                    for k, v in pipe.hgetall(summary_key).items()
+                }
+                if 'v' in counters:
+                    return counters
+                
+                increments: Dict[str, int] = {}
+                earliest: Dict[str, int] = {}
+                expire_seconds = 0
+                for agent_type in agent_types:
+                    memory = cls(user_id, agent_type, redis_client=redis_client)
+                    expire_seconds = memory.max_age_days * 24 * 60 * 60
+                    first = counters.get(f"{agent_type}:first")
+                    first = int(first) if first is not None else None
+                    
+                    # Los mensajes desde :first ya los contó el camino de escritura
+                    older = []
+                    for message in memory.get_full_history():
+                        epoch = cls._message_epoch(message)
+                        if first is None or (epoch is not None and epoch < first):
+                            older.append((message, epoch))
+                    if not older:
+                        continue
+                    
+                    for role, count in Counter(m.get('role', 'unknown') for m, _ in older).items():
+                        increments[f"{agent_type}:{role}"] = count
+                    epochs = [epoch for _, epoch in older if epoch is not None]
+                    if epochs:
+                        earliest[agent_type] = min(epochs)
+                        increments[f"{agent_type}:session"] = cls.session_seconds(epochs, memory.session_timeout * 60)
+                        if f"{agent_type}:last" not in counters:
+                            counters[f"{agent_type}:last"] = max(epochs)
+                
+                pipe.multi()
+                for field, value in increments.items():
+                    if value:
+                        pipe.hincrby(summary_key, field, value)
+                for agent_type, epoch in earliest.items():
+                    # Los mensajes contados son anteriores a :first: lo adelantan
+                    pipe.hset(summary_key, f"{agent_type}:first", epoch)
+                    pipe.hsetnx(summary_key, f"{agent_type}:last", counters[f"{agent_type}:last"])
+                pipe.hsetnx(summary_key, 'v', SUMMARY_SCHEMA)
+                if expire_seconds:
+                    pipe.expire(summary_key, expire_seconds)
+                pipe.execute()
+            except WatchError:
+                continue
+            finally:
+                pipe.reset()
+            
+            for field, value in increments.items():
+                counters[field] = int(counters.get(field) or 0) + value
+            for agent_type, epoch in earliest.items():
+                counters[f"{agent_type}:first"] = epoch
+            counters['v'] = SUMMARY_SCHEMA
+            return counters
+        
+        logger.warning(f"Backfill de contadores de {user_id} abortado por escrituras concurrentes")
+        return counters
+    
+    def _summary_from_history(self) -> Dict[str, Any]:
+        """Resumen recorriendo el historial completo (usuarios sin contadores o sin Redis)"""
         messages = self.get_full_history()
         
         if not messages:
@@ -252,15 +737,9 @@ class ConversationMemory:
         conversation_start = sorted_messages[0].get('timestamp') if sorted_messages else None
         last_activity = sorted_messages[-1].get('timestamp') if sorted_messages else None
         
-        # Calcular duración de sesión
-        session_duration = 0
-        if conversation_start and last_activity:
-            try:
-                start_time = datetime.fromisoformat(conversation_start.replace('Z', '+00:00'))
-                end_time = datetime.fromisoformat(last_activity.replace('Z', '+00:00'))
-                session_duration = (end_time - start_time).total_seconds() / 60  # en minutos
-            except Exception:
-                session_duration = 0
+        # Tiempo de sesión total (misma regla que los contadores), en minutos
+        epochs = [epoch for epoch in map(self._message_epoch, messages) if epoch is not None]
+        session_duration = self.session_seconds(epochs, self.session_timeout * 60) / 60
         
         return {
             'total_messages': len(messages),
@@ -273,15 +752,18 @@ class ConversationMemory:
             'user_id': self.user_id
         }
     
+    def _session_metadata(self) -> Dict[str, Any]:
+        return {
+            'last_activity': datetime.now().isoformat(),
+            'agent_type': self.agent_type,
+            'user_id': self.user_id,
+            'session_active': True
+        }
+    
     def _update_session_metadata(self):
         """Actualizar metadatos de la sesión"""
         try:
-            metadata = {
-                'last_activity': datetime.now().isoformat(),
-                'agent_type': self.agent_type,
-                'user_id': self.user_id,
-                'session_active': True
-            }
+            metadata = self._session_metadata()
             
             if self.redis_client:
                 self.redis_client.setex(
@@ -337,40 +819,108 @@ class ConversationMemory:
             self.logger.error(f"Error obteniendo metadatos: {e}")
             return {}
     
+    async def aget_session_metadata(self) -> Dict[str, Any]:
+        """Versión async de get_session_metadata"""
+        client = self._async_client()
+        if client is None:
+            return await sync_to_async(self.get_session_metadata, thread_sensitive=False)()
+        try:
+            raw_metadata = await client.get(self.session_key)
+            return json.loads(raw_metadata) if raw_metadata else {}
+            
+        except Exception as e:
+            self.logger.error(f"Error obteniendo metadatos: {e}")
+            return {}
+    
     # Métodos estáticos para gestión global
     
     @staticmethod
-    def cleanup_old_conversations(max_age_days: int = 30):
+    def cleanup_old_conversations(max_age_days: int = 30) -> Optional[Dict[str, Any]]:
         """
         Limpiar conversaciones antiguas (método para ejecutar periódicamente)
         
+        Recorre Redis con ConversationRetention (SCAN por lotes) y archiva en
+        CONVERSATION_ARCHIVE_DIR si está definido. Ver también el comando
+        conversation_retention. Con el fallback de cache de Django no hay nada
+        que recorrer: los mensajes antiguos se descartan al escribir.
+        
         Args:
             max_age_days: Edad máxima en días para mantener conversaciones
+        
+        Returns:
+            Informe de la ejecución (None si no hay Redis o falló)
         """
+        from .conversation_retention import ConversationArchive, ConversationRetention
+        
         try:
-            # Este método se implementaría como una tarea de Celery
-            # o un comando de management de Django
             logger.info(f"Iniciando limpieza de conversaciones > {max_age_days} días")
-            
-            # Lógica de limpieza específica según el backend usado
-            # Por ahora es un placeholder
+            redis_client = get_redis_client()
+            archive_dir = os.getenv('CONVERSATION_ARCHIVE_DIR')
+            archive = ConversationArchive(archive_dir) if archive_dir else None
+            return ConversationRetention(redis_client, archive=archive, max_age_days=max_age_days).run()
             
         except Exception as e:
             logger.error(f"Error en limpieza de conversaciones: {e}")
+            return None
+    
+    @staticmethod
+    def agent_types() -> List[str]:
+        """Agentes con memoria conversacional (los del AgentManager)"""
+        from .agent_manager import AgentManager
+        return list(AgentManager.AGENT_CLASSES)
     
     @staticmethod
     def get_user_conversations(user_id: str) -> List[Dict[str, Any]]:
         """
         Obtener todas las conversaciones de un usuario
         
+        Con Redis es un único round trip: el hash de contadores del usuario y
+        la sesión activa de cada agente.
+        
         Args:
             user_id: ID del usuario
         
         Returns:
             Lista de conversaciones activas del usuario
         """
+        agent_types = ConversationMemory.agent_types()
+        try:
+            redis_client = get_redis_client()
+        except Exception:
+            redis_client = None
+        if redis_client is None:
+            return ConversationMemory._user_conversations_from_history(user_id, agent_types)
+        
+        summary_key = ConversationMemory.summary_key_for(user_id)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hgetall(summary_key)
+        for agent_type in agent_types:
+            pipe.exists(f"session:{user_id}:{agent_type}")
+        counters, *active = pipe.execute()
+        counters = {
+            (k.decode('utf-8') if isinstance(k, bytes) else k): v for k, v in counters.items()
+        }
+        
+        if 'v' not in counters:
+            counters = ConversationMemory._backfill_summary(user_id, agent_types, redis_client)
+        
+        max_age = int(os.getenv('CONVERSATION_MAX_AGE_DAYS', 30)) * 24 * 60 * 60
+        conversations = []
+        for agent_type, is_active in zip(agent_types, active):
+            summary = ConversationMemory.summary_from_counters(user_id, agent_type, counters)
+            if summary['total_messages'] > 0 \
+                    and not ConversationMemory.summary_expired(counters, agent_type, max_age):
+                conversations.append({
+                    'agent_type': agent_type,
+                    'summary': summary,
+                    'is_active': bool(is_active)
+                })
+        
+        return conversations
+    
+    @staticmethod
+    def _user_conversations_from_history(user_id: str, agent_types: List[str]) -> List[Dict[str, Any]]:
         conversations = []
-        agent_types = ['tutor', 'evaluator', 'counselor', 'curriculum', 'analytics']
         
         for agent_type in agent_types:
             memory = ConversationMemory(user_id, agent_type)
@@ -428,18 +978,21 @@ class ConversationAnalytics:
     """
     
     @staticmethod
-    def analyze_conversation_patterns(user_id: str, days: int = 30) -> Dict[str, Any]:
+    def analyze_conversation_patterns(user_id: str, days: int = 30,
+                                      conversations: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
         """
         Analizar patrones conversacionales de un usuario
         
         Args:
             user_id: ID del usuario
             days: Número de días para el análisis
+            conversations: Resultado de get_user_conversations si ya se obtuvo
         
         Returns:
             Dict con análisis de patrones
         """
-        conversations = ConversationMemory.get_user_conversations(user_id)
+        if conversations is None:
+            conversations = ConversationMemory.get_user_conversations(user_id)
         
         analysis = {
             'user_id': user_id,
@@ -0,0 +1,336 @@
+"""
+Conversation Retention - Retención y compactación de la memoria conversacional
+
+La retención dependía solo del EXPIRE de cada clave: las conversaciones
+desaparecían sin dejar copia, las claves escritas sin expiración (versiones
+antiguas, un EXPIRE fallido) vivían para siempre y nadie limpiaba session: y
+metadata: huérfanas. Este job recorre Redis con SCAN por lotes (nunca KEYS,
+que bloquea el servidor con millones de claves):
+
+- conversation:*: un pipeline de TTL por lote. Las conversaciones que superan
+  la edad máxima se archivan en frío y se borran; las que expiran antes de
+  CONVERSATION_RETENTION_EXPIRING_HOURS solo se adelantan si hay archivo (sin
+  él las borra su propio EXPIRE). Las que no tienen expiración la reciben
+  según la fecha de su último mensaje.
+- session:* y metadata:*: sin expiración y sin conversación se borran; con
+  conversación reciben la expiración que les falta.
+
+El borrado es un script Lua condicional: si el usuario escribió desde la
+comprobación (cada escritura renueva el EXPIRE) la conversación se conserva.
+También sube conversation_version, publica la invalidación para las cachés
+de los workers y descuenta el agente del hash conversation_summary:{user}.
+
+El almacenamiento frío son ficheros JSONL comprimidos con gzip, uno por
+ejecución, con los mensajes ya decodificados en orden cronológico. Cada lote
+se escribe y se vacía a disco antes de borrar sus claves.
+"""
+
+import os
+import gzip
+import json
+import time
+import uuid
+import base64
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .context_cache import CHANNEL as INVALIDATION_CHANNEL, invalidation_message
+from .conversation_memory import ConversationMemory
+from .message_codec import MessageCodec
+
+# Borrar la conversación solo si su TTL no subió desde que se comprobó
+# KEYS: conversación, sesión, metadatos, versión, resumen del usuario
+# ARGV: TTL observado, expiración de la versión, canal, mensaje de invalidación,
+#       campos del agente en el resumen...
+DELETE_IF_UNCHANGED_LUA = """
+if redis.call('TTL', KEYS[1]) > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+redis.call('HDEL', KEYS[5], unpack(ARGV, 5))
+redis.call('INCR', KEYS[4])
+redis.call('EXPIRE', KEYS[4], ARGV[2])
+redis.call('PUBLISH', ARGV[3], ARGV[4])
+return 1
+"""
+
+
+def _text(value: Any) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _split_key(key: str) -> Tuple[str, str]:
+    """'conversation:{user}:{agent}' -> (user, agent); el user_id puede contener ':'"""
+    user_id, _, agent_type = key.split(':', 1)[1].rpartition(':')
+    return user_id, agent_type
+
+
+class ConversationArchive:
+    """Almacenamiento frío: un fichero .jsonl.gz por ejecución, una conversación por línea"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(
+            directory, f"conversations-{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}.jsonl.gz"
+        )
+        self.records = 0
+        self._file = None
+
+    def write(self, records: List[Dict[str, Any]]):
+        """Escribir un lote y vaciarlo a disco (legible aunque el proceso muera después)"""
+        if not records:
+            return
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records += len(records)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ConversationRetention:
+    """
+    Job de retención: SCAN por lotes, TTL en pipeline, archivo en frío y borrado.
+
+    Configuración (variables de entorno):
+    - CONVERSATION_MAX_AGE_DAYS: edad máxima de una conversación (la misma del EXPIRE de ConversationMemory)
+    - CONVERSATION_RETENTION_EXPIRING_HOURS: archivar las conversaciones que expiran antes de este plazo
+      (solo con archivo)
+    - CONVERSATION_RETENTION_BATCH: claves por SCAN (COUNT) y por pipeline
+    - CONVERSATION_ARCHIVE_DIR: directorio del almacenamiento frío (vacío = borrar sin archivar)
+    """
+
+    def __init__(self, redis_client, archive: Optional[ConversationArchive] = None,
+                 max_age_days: Optional[int] = None, expiring_hours: Optional[float] = None,
+                 batch_size: Optional[int] = None, pause: float = 0.0, dry_run: bool = False,
+                 progress: Optional[Callable[[Dict[str, Any]], None]] = None, progress_interval: float = 10.0):
+        """
+        Args:
+            redis_client: Cliente Redis binario (el compartido del proceso)
+            archive: Almacenamiento frío (None = borrar sin archivar lo que supera
+                la edad máxima y dejar que lo que expira pronto lo haga solo)
+            pause: Segundos de espera entre lotes para no acaparar Redis
+            dry_run: Solo contar lo que se haría
+            progress: Función llamada con las estadísticas cada progress_interval segundos
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.redis_client = redis_client
+        self.archive = archive
+        self.codec = MessageCodec()
+
+        # TTL con el que ConversationMemory escribe: edad = conversation_ttl - TTL restante
+        self.conversation_ttl = int(os.getenv('CONVERSATION_MAX_AGE_DAYS', 30)) * 24 * 60 * 60
+        self.session_ttl = int(os.getenv('SESSION_TIMEOUT_MINUTES', 60)) * 60
+        self.max_age = (max_age_days if max_age_days is not None
+                        else int(os.getenv('CONVERSATION_MAX_AGE_DAYS', 30))) * 24 * 60 * 60
+        self.expiring_seconds = int((expiring_hours if expiring_hours is not None
+                                     else float(os.getenv('CONVERSATION_RETENTION_EXPIRING_HOURS', 24))) * 3600)
+        self.batch_size = batch_size or int(os.getenv('CONVERSATION_RETENTION_BATCH', 1000))
+        self.pause = pause
+        self.dry_run = dry_run
+        self.progress = progress
+        self.progress_interval = progress_interval
+
+        self.worker_id = f"retention-{uuid.uuid4().hex[:8]}"
+        self._delete = redis_client.register_script(DELETE_IF_UNCHANGED_LUA)
+        self.stats = {
+            'scanned': {'conversation': 0, 'session': 0, 'metadata': 0},
+            'scan_calls': 0,
+            'pipelines': 0,
+            'archived': 0,
+            'deleted': 0,
+            'kept_after_write': 0,
+            'expire_set': 0,
+            'orphans_deleted': 0,
+            'undecodable_messages': 0
+        }
+
+    # Recorrido
+
+    def _scan(self, pattern: str) -> Iterator[List[str]]:
+        """Lotes de claves con SCAN (puede repetir claves: el proceso es idempotente)"""
+        cursor = 0
+        while True:
+            cursor, keys = self.redis_client.scan(cursor=cursor, match=pattern, count=self.batch_size)
+            self.stats['scan_calls'] += 1
+            if keys:
+                yield [_text(key) for key in keys]
+            if int(cursor) == 0:
+                return
+
+    def _pipeline(self, queue: Callable[[Any], None]) -> List[Any]:
+        pipe = self.redis_client.pipeline(transaction=False)
+        queue(pipe)
+        self.stats['pipelines'] += 1
+        return pipe.execute()
+
+    def run(self) -> Dict[str, Any]:
+        """Recorrer conversaciones, sesiones y metadatos; devuelve el informe de la ejecución"""
+        started = time.monotonic()
+        last_progress = started
+        try:
+            for prefix, process in (('conversation', self._process_conversations),
+                                    ('session', self._process_orphans),
+                                    ('metadata', self._process_orphans)):
+                for keys in self._scan(f"{prefix}:*"):
+                    self.stats['scanned'][prefix] += len(keys)
+                    process(keys)
+
+                    now = time.monotonic()
+                    if self.progress and now - last_progress >= self.progress_interval:
+                        self.progress(self.report(now - started))
+                        last_progress = now
+                    if self.pause:
+                        time.sleep(self.pause)
+        finally:
+            if self.archive is not None:
+                self.archive.close()
+
+        report = self.report(time.monotonic() - started)
+        self.logger.info(
+            f"Retención completada: {report['scanned_total']} claves en {report['elapsed_seconds']}s "
+            f"({report['keys_per_second']} claves/s), {self.stats['deleted']} conversaciones borradas"
+        )
+        return report
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        scanned = sum(self.stats['scanned'].values())
+        return {
+            **self.stats,
+            'scanned': dict(self.stats['scanned']),
+            'scanned_total': scanned,
+            'elapsed_seconds': round(elapsed, 2),
+            'keys_per_second': round(scanned / elapsed, 1) if elapsed > 0 else 0.0,
+            'dry_run': self.dry_run,
+            'archive': self.archive.path if self.archive is not None and self.archive.records else None
+        }
+
+    # Conversaciones
+
+    def _process_conversations(self, keys: List[str]):
+        ttls = self._pipeline(lambda pipe: [pipe.ttl(key) for key in keys])
+
+        # Sin expiración: la edad sale del último mensaje (el primero de la lista)
+        persistent = [key for key, ttl in zip(keys, ttls) if ttl == -1]
+        last_activity = {}
+        if persistent:
+            newest = self._pipeline(lambda pipe: [pipe.lindex(key, 0) for key in persistent])
+            last_activity = dict(zip(persistent, map(self._message_epoch, newest)))
+
+        now = time.time()
+        expired, to_expire = [], []
+        for key, ttl in zip(keys, ttls):
+            if ttl == -2:  # expiró entre SCAN y TTL
+                continue
+            if ttl == -1:
+                epoch = last_activity.get(key)
+                age = now - epoch if epoch is not None else self.max_age
+                if age >= self.max_age:
+                    expired.append((key, ttl, 'max_age'))
+                else:
+                    to_expire.append((key, int(min(self.max_age, self.conversation_ttl) - age)))
+            elif ttl <= self.expiring_seconds and self.archive is not None:
+                # Sin archivo no hay nada que adelantar: el EXPIRE ya las borra
+                expired.append((key, ttl, 'expiring'))
+            elif self.conversation_ttl - ttl >= self.max_age:
+                expired.append((key, ttl, 'max_age'))
+
+        if self.dry_run:
+            self.stats['deleted'] += len(expired)
+            self.stats['expire_set'] += len(to_expire)
+            return
+
+        if expired and self.archive is not None:
+            self._archive(expired)
+        if expired or to_expire:
+            def queue(pipe):
+                for key, ttl, _ in expired:
+                    self._queue_delete(pipe, key, ttl)
+                for key, seconds in to_expire:
+                    pipe.expire(key, max(seconds, 1))
+            results = self._pipeline(queue)
+            deleted = sum(1 for result in results[:len(expired)] if int(result) == 1)
+            self.stats['deleted'] += deleted
+            self.stats['kept_after_write'] += len(expired) - deleted
+            self.stats['expire_set'] += len(to_expire)
+
+    def _queue_delete(self, pipe, key: str, ttl: int):
+        user_id, agent_type = _split_key(key)
+        self._delete(
+            keys=[key, f"session:{user_id}:{agent_type}", f"metadata:{user_id}:{agent_type}",
+                  f"conversation_version:{user_id}:{agent_type}", ConversationMemory.summary_key_for(user_id)],
+            args=[ttl, self.conversation_ttl, INVALIDATION_CHANNEL, invalidation_message(self.worker_id, key),
+                  *ConversationMemory.summary_fields_for(agent_type)],
+            client=pipe
+        )
+
+    def _archive(self, expired: List[Tuple[str, int, str]]):
+        histories = self._pipeline(lambda pipe: [pipe.lrange(key, 0, -1) for key, _, _ in expired])
+        archived_at = datetime.now().isoformat()
+        records = []
+        for (key, _, reason), raw_messages in zip(expired, histories):
+            if not raw_messages:
+                continue
+            user_id, agent_type = _split_key(key)
+            records.append({
+                'user_id': user_id,
+                'agent_type': agent_type,
+                'reason': reason,
+                'archived_at': archived_at,
+                'messages': [self._archive_message(raw) for raw in reversed(raw_messages)]
+            })
+        self.archive.write(records)
+        self.stats['archived'] += len(records)
+
+    def _archive_message(self, raw: Any) -> Dict[str, Any]:
+        try:
+            return self.codec.decode(raw)
+        except Exception:
+            # Se guarda tal cual: el archivo no debe perder mensajes
+            self.stats['undecodable_messages'] += 1
+            raw = raw if isinstance(raw, bytes) else str(raw).encode('utf-8')
+            return {'raw': base64.b64encode(raw).decode('ascii')}
+
+    def _message_epoch(self, raw: Any) -> Optional[float]:
+        if raw is None:
+            return None
+        try:
+            return datetime.fromisoformat(self.codec.decode(raw)['timestamp']).timestamp()
+        except Exception:
+            return None
+
+    # Sesiones y metadatos huérfanos
+
+    def _process_orphans(self, keys: List[str]):
+        def queue(pipe):
+            for key in keys:
+                pipe.ttl(key)
+                pipe.exists(f"conversation:{key.split(':', 1)[1]}")
+        results = self._pipeline(queue)
+
+        orphans, to_expire = [], []
+        for key, ttl, has_conversation in zip(keys, results[0::2], results[1::2]):
+            if ttl != -1:
+                continue
+            if has_conversation:
+                to_expire.append(key)
+            else:
+                orphans.append(key)
+
+        if not self.dry_run and (orphans or to_expire):
+            def queue(pipe):
+                if orphans:
+                    pipe.delete(*orphans)
+                for key in to_expire:
+                    pipe.expire(key, self.session_ttl if key.startswith('session:') else self.conversation_ttl)
+            self._pipeline(queue)
+        self.stats['orphans_deleted'] += len(orphans)
+        self.stats['expire_set'] += len(to_expire)
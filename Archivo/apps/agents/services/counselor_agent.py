@@ -19,9 +19,22 @@ class CounselorAgent(BaseAIService):
     - Desarrollo de habilidades sociales
     """
     
+    # Metadatos de clase (disponibles sin construir el agente)
+    agent_name = "Counselor - Apoyo Estudiantil"
+    specialized_capabilities = {
+        'academic_guidance': True,
+        'emotional_support': True,
+        'study_strategies': True,
+        'career_orientation': True,
+        'learning_barriers_assessment': True,
+        'crisis_intervention': True,
+        'student_development': True,
+        'motivational_coaching': True
+    }
+    
     def get_agent_name(self) -> str:
         """Nombre del agente"""
-        return "Counselor - Apoyo Estudiantil"
+        return self.agent_name
     
     def get_system_prompt(self) -> str:
         """Prompt del sistema para el Counselor"""
@@ -471,14 +484,5 @@ Enfócate en soluciones prácticas y empoderadoras.
     def get_specialized_capabilities(self) -> Dict[str, Any]:
         """Capacidades específicas del Counselor"""
         base_capabilities = self.get_capabilities()
-        base_capabilities.update({
-            'academic_guidance': True,
-            'emotional_support': True,
-            'study_strategies': True,
-            'career_orientation': True,
-            'learning_barriers_assessment': True,
-            'crisis_intervention': True,
-            'student_development': True,
-            'motivational_coaching': True
-        })
+        base_capabilities.update(self.specialized_capabilities)
         return base_capabilities 
\ No newline at end of file
@@ -19,9 +19,22 @@ class CurriculumPlannerAgent(BaseAIService):
     - Desarrollo de progresiones de aprendizaje
     """
     
+    # Metadatos de clase (disponibles sin construir el agente)
+    agent_name = "Curriculum Planner - Diseño Curricular"
+    specialized_capabilities = {
+        'curriculum_design': True,
+        'learning_sequencing': True,
+        'standards_alignment': True,
+        'assessment_planning': True,
+        'technology_integration': True,
+        'differentiation_strategies': True,
+        'competency_mapping': True,
+        'educational_innovation': True
+    }
+    
     def get_agent_name(self) -> str:
         """Nombre del agente"""
-        return "Curriculum Planner - Diseño Curricular"
+        return self.agent_name
     
     def get_system_prompt(self) -> str:
         """Prompt del sistema para el Curriculum Planner"""
@@ -689,14 +702,5 @@ Crea un plan que aproveche la tecnología para potenciar el aprendizaje de maner
     def get_specialized_capabilities(self) -> Dict[str, Any]:
         """Capacidades específicas del Curriculum Planner"""
         base_capabilities = self.get_capabilities()
-        base_capabilities.update({
-            'curriculum_design': True,
-            'learning_sequencing': True,
-            'standards_alignment': True,
-            'assessment_planning': True,
-            'technology_integration': True,
-            'differentiation_strategies': True,
-            'competency_mapping': True,
-            'educational_innovation': True
-        })
+        base_capabilities.update(self.specialized_capabilities)
         return base_capabilities 
\ No newline at end of file
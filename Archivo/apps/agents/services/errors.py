@@ -0,0 +1,53 @@
+"""
+Errores tipados de los proveedores de IA
+
+Sustituyen la detección de fallos por prefijo de texto ("Lo siento...") para
+que el fallback, el hedging y el circuit breaker distingan el tipo de error.
+"""
+
+from typing import Optional
+
+import openai
+import anthropic
+
+
+class ProviderError(Exception):
+    """Error al llamar a un proveedor de IA"""
+
+    def __init__(self, provider: str, message: str, original: Optional[BaseException] = None):
+        super().__init__(f"[{provider}] {message}")
+        self.provider = provider
+        self.original = original
+
+
+class ProviderUnavailableError(ProviderError):
+    """El proveedor no está configurado o no se puede usar ahora"""
+
+
+class ProviderThrottledError(ProviderUnavailableError):
+    """El rate limiter local no dio turno a la llamada (cola llena o plazo agotado)"""
+
+
+class ProviderTimeoutError(ProviderError):
+    """El proveedor no respondió a tiempo"""
+
+
+class ProviderRateLimitError(ProviderError):
+    """El proveedor rechazó la petición por límite de uso (429)"""
+
+
+def classify_provider_error(provider: str, error: BaseException) -> ProviderError:
+    """
+    Convertir una excepción del SDK en un ProviderError tipado
+
+    Args:
+        provider: 'openai' o 'claude'
+        error: Excepción original
+    """
+    if isinstance(error, ProviderError):
+        return error
+    if isinstance(error, (openai.APITimeoutError, anthropic.APITimeoutError, TimeoutError)):
+        return ProviderTimeoutError(provider, str(error) or 'timeout', error)
+    if isinstance(error, (openai.RateLimitError, anthropic.RateLimitError)):
+        return ProviderRateLimitError(provider, str(error), error)
+    return ProviderError(provider, str(error), error)
@@ -19,9 +19,23 @@ class EvaluatorAgent(BaseAIService):
     - Evaluar competencias y habilidades
     """
     
+    # Metadatos de clase (disponibles sin construir el agente)
+    agent_name = "Evaluator - Sistema de Evaluación"
+    specialized_capabilities = {
+        'assessment_creation': True,
+        'automated_grading': True,
+        'rubric_generation': True,
+        'class_analytics': True,
+        'integrity_checking': True,
+        'feedback_generation': True,
+        'competency_evaluation': True,
+        'adaptive_testing': True,
+        'bulk_grading': True
+    }
+    
     def get_agent_name(self) -> str:
         """Nombre del agente"""
-        return "Evaluator - Sistema de Evaluación"
+        return self.agent_name
     
     def get_system_prompt(self) -> str:
         """Prompt del sistema para el Evaluator"""
@@ -162,28 +176,94 @@ FORMATO REQUERIDO:
             student_responses: Lista de respuestas del estudiante
             rubric: Rúbrica específica (opcional)
         """
-        context = {
+        context = self._grading_context(assessment_id, student_responses, rubric)
+        query = f"""
+Califica la siguiente entrega de evaluación usando criterios pedagógicos rigurosos:
+
+EVALUACIÓN ID: {assessment_id}
+
+{self._format_student_responses(student_responses)}
+{self._grading_instructions(rubric)}"""
+        
+        response = self.process_query(query, context)
+        return self._build_grading_result(assessment_id, response)
+    
+    def grade_submission_with_prefix(self, assessment_id: str, student_responses: List[Dict],
+                                     grading_prefix: str, rubric: Dict = None) -> Dict[str, Any]:
+        """
+        Calificar una entrega reutilizando el prefijo común de una calificación masiva.
+        
+        El prefijo (rúbrica + instrucciones) viaja en el prompt de sistema, idéntico
+        en todas las llamadas del lote; solo las respuestas del estudiante cambian.
+        
+        Raises:
+            ProviderError: Si ningún proveedor pudo calificar la entrega
+        """
+        context = self._grading_context(assessment_id, student_responses, rubric)
+        context['shared_prefix'] = grading_prefix
+        # Cede el turno al chat interactivo en el rate limiter
+        context['priority'] = 'batch'
+        query = f"""
+Califica la siguiente entrega según la evaluación, rúbrica e instrucciones indicadas:
+
+{self._format_student_responses(student_responses)}"""
+        
+        response = self.generate(query, context)
+        return self._build_grading_result(assessment_id, response)
+    
+    def build_grading_prefix(self, assessment_id: str, rubric: Dict = None) -> str:
+        """Prefijo común a todas las entregas de una evaluación"""
+        return f"""
+## CALIFICACIÓN EN CURSO
+EVALUACIÓN ID: {assessment_id}
+{self._grading_instructions(rubric)}"""
+    
+    def batch_grade_submissions(self, assessment_id: str, submissions: List[Dict],
+                                rubric: Dict = None, job_id: str = None,
+                                max_concurrency: int = None):
+        """
+        Calificar las entregas de toda una clase con concurrencia acotada.
+        
+        Args:
+            assessment_id: ID de la evaluación
+            submissions: [{'student_id': ..., 'responses': [...]}, ...]
+            rubric: Rúbrica específica (opcional)
+            job_id: ID del trabajo para reanudar un lote interrumpido
+            max_concurrency: Llamadas simultáneas al proveedor
+        
+        Yields:
+            Eventos del lote a medida que terminan las entregas (ver BulkGradingPipeline)
+        """
+        from .bulk_grading import BulkGradingPipeline
+        pipeline = BulkGradingPipeline(self, max_concurrency=max_concurrency)
+        return pipeline.run(assessment_id, submissions, rubric=rubric, job_id=job_id)
+    
+    def _grading_context(self, assessment_id: str, student_responses: List[Dict],
+                         rubric: Dict = None) -> Dict[str, Any]:
+        return {
             'task_type': 'grading',
             'assessment_id': assessment_id,
             'total_responses': len(student_responses),
             'rubric_provided': rubric is not None
         }
-        
-        # Preparar respuestas para evaluación
+    
+    def _format_student_responses(self, student_responses: List[Dict]) -> str:
+        """Preparar respuestas para evaluación"""
         responses_text = ""
         for i, response in enumerate(student_responses, 1):
             question = response.get('question', f'Pregunta {i}')
             answer = response.get('answer', '')
             responses_text += f"\n--- Pregunta {i}: {question} ---\n"
             responses_text += f"Respuesta del estudiante: {answer}\n"
-        
-        query = f"""
-Califica la siguiente entrega de evaluación usando criterios pedagógicos rigurosos:
-
-EVALUACIÓN ID: {assessment_id}
-
-{responses_text}
-
+        return responses_text
+    
+    def _grading_instructions(self, rubric: Dict = None) -> str:
+        rubric_text = ""
+        if rubric:
+            rubric_text = "\nRÚBRICA:\n" + "\n".join(
+                f"- {criterion}: {description}" for criterion, description in rubric.items()
+            ) + "\n"
+        return f"""{rubric_text}
 INSTRUCCIONES DE CALIFICACIÓN:
 1. Evalúa cada respuesta individualmente
 2. Asigna puntajes específicos y justificados
@@ -199,9 +279,8 @@ FORMATO DE SALIDA:
 - Análisis de patrones de error
 - Recomendaciones específicas para mejorar
 """
-        
-        response = self.process_query(query, context)
-        
+    
+    def _build_grading_result(self, assessment_id: str, response: str) -> Dict[str, Any]:
         return {
             'assessment_id': assessment_id,
             'total_score': self._extract_total_score(response),
@@ -367,14 +446,5 @@ Proporciona un reporte detallado de posibles problemas encontrados.
     def get_specialized_capabilities(self) -> Dict[str, Any]:
         """Capacidades específicas del Evaluator"""
         base_capabilities = self.get_capabilities()
-        base_capabilities.update({
-            'assessment_creation': True,
-            'automated_grading': True,
-            'rubric_generation': True,
-            'class_analytics': True,
-            'integrity_checking': True,
-            'feedback_generation': True,
-            'competency_evaluation': True,
-            'adaptive_testing': True
-        })
+        base_capabilities.update(self.specialized_capabilities)
         return base_capabilities 
\ No newline at end of file
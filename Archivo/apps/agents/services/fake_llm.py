@@ -0,0 +1,311 @@
+"""
+Fake LLM - Proveedor local que imita las APIs de OpenAI y Anthropic
+
+Permite hacer pruebas de carga del chat sin gastar crédito de API. El servidor
+(solo librería estándar) responde en /v1/chat/completions y /v1/messages, con
+o sin streaming, usando distribuciones configurables de latencia, ritmo de
+tokens, tamaño de respuesta e inyección de errores (429, 500, timeouts).
+
+Se activa con LLM_PROVIDER_BACKEND=fake: LLMClientProvider apunta los SDKs a
+FAKE_LLM_URL (ver llm_clients.py). Arranque: python manage.py run_fake_llm
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+WORDS = (
+    "el la los las un una de del en para con por sobre como que es son concepto ejemplo "
+    "fracción ecuación función derivada práctica estudiante aprendizaje paso resultado "
+    "importante recuerda primero luego finalmente entonces además problema solución"
+).split()
+
+
+class FakeLLMConfig:
+    """
+    Comportamiento del proveedor simulado.
+
+    Configuración (variables de entorno):
+    - FAKE_LLM_LATENCY_MS: mediana del tiempo hasta el primer token
+    - FAKE_LLM_LATENCY_SIGMA: dispersión log-normal de esa latencia (0 = fija)
+    - FAKE_LLM_TOKENS_PER_SECOND: ritmo de emisión de tokens
+    - FAKE_LLM_RESPONSE_TOKENS: tamaño de la respuesta, "min-max" tokens
+    - FAKE_LLM_ERROR_RATE: proporción de peticiones que fallan
+    - FAKE_LLM_ERROR_KINDS: tipos de error inyectados ("429,500,timeout")
+    - FAKE_LLM_HANG_SECONDS: duración de un error de tipo timeout
+    """
+
+    def __init__(self, **overrides):
+        self.latency_ms = float(os.getenv('FAKE_LLM_LATENCY_MS', 400))
+        self.latency_sigma = float(os.getenv('FAKE_LLM_LATENCY_SIGMA', 0.5))
+        self.tokens_per_second = float(os.getenv('FAKE_LLM_TOKENS_PER_SECOND', 50))
+        self.response_tokens = os.getenv('FAKE_LLM_RESPONSE_TOKENS', '50-300')
+        self.error_rate = float(os.getenv('FAKE_LLM_ERROR_RATE', 0))
+        self.error_kinds = os.getenv('FAKE_LLM_ERROR_KINDS', '429,500,timeout')
+        self.hang_seconds = float(os.getenv('FAKE_LLM_HANG_SECONDS', 60))
+
+        for name, value in overrides.items():
+            if value is not None:
+                setattr(self, name, value)
+
+        low, _, high = str(self.response_tokens).partition('-')
+        self.min_tokens = int(low)
+        self.max_tokens = int(high or low)
+        self.error_kind_list = [kind.strip() for kind in str(self.error_kinds).split(',') if kind.strip()]
+
+    def first_token_delay(self) -> float:
+        median = self.latency_ms / 1000.0
+        if self.latency_sigma <= 0:
+            return median
+        return random.lognormvariate(0, self.latency_sigma) * median
+
+    def response_length(self, max_tokens: Optional[int]) -> int:
+        length = random.randint(self.min_tokens, self.max_tokens)
+        return min(length, max_tokens) if max_tokens else length
+
+    def draw_error(self) -> Optional[str]:
+        if self.error_rate > 0 and self.error_kind_list and random.random() < self.error_rate:
+            return random.choice(self.error_kind_list)
+        return None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'latency_ms': self.latency_ms,
+            'latency_sigma': self.latency_sigma,
+            'tokens_per_second': self.tokens_per_second,
+            'response_tokens': f"{self.min_tokens}-{self.max_tokens}",
+            'error_rate': self.error_rate,
+            'error_kinds': self.error_kind_list,
+            'hang_seconds': self.hang_seconds
+        }
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """Handler HTTP/1.1 (keep-alive) compatible con los SDKs de OpenAI y Anthropic"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeLLM/1.0'
+
+    @property
+    def config(self) -> FakeLLMConfig:
+        return self.server.config
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    # Utilidades HTTP
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _write_chunk(self, data: str):
+        raw = data.encode('utf-8')
+        self.wfile.write(f"{len(raw):X}\r\n".encode('ascii') + raw + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _inject_error(self, provider: str) -> bool:
+        """Responder con un error simulado; True si la petición ya fue atendida"""
+        kind = self.config.draw_error()
+        if kind is None:
+            return False
+
+        self.server.count('errors')
+        if kind == 'timeout':
+            time.sleep(self.config.hang_seconds)
+            self.close_connection = True
+            return True
+
+        status = 429 if kind == '429' else 500
+        message = 'Rate limit exceeded (simulado)' if status == 429 else 'Internal server error (simulado)'
+        if provider == 'openai':
+            payload = {'error': {'message': message, 'type': 'rate_limit_error' if status == 429 else 'server_error'}}
+        else:
+            payload = {'type': 'error', 'error': {'type': 'rate_limit_error' if status == 429 else 'api_error',
+                                                 'message': message}}
+        self._send_json(status, payload, {'retry-after': '1'} if status == 429 else None)
+        return True
+
+    def _tokens(self, count: int) -> Iterator[str]:
+        for index in range(count):
+            word = random.choice(WORDS)
+            yield word if index == 0 else f" {word}"
+
+    def _pace(self, tokens: int):
+        if self.config.tokens_per_second > 0:
+            time.sleep(tokens / self.config.tokens_per_second)
+
+    # Rutas
+
+    def do_GET(self):
+        if self.path.rstrip('/') in ('', '/health'):
+            self._send_json(200, {'status': 'ok', 'config': self.config.as_dict(), 'stats': self.server.get_stats()})
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        body = self._read_json()
+        path = self.path.split('?', 1)[0].rstrip('/')
+        self.server.count('requests')
+
+        if path.endswith('/chat/completions'):
+            if not self._inject_error('openai'):
+                self._openai_completion(body)
+        elif path.endswith('/messages'):
+            if not self._inject_error('claude'):
+                self._anthropic_message(body)
+        else:
+            self._send_json(404, {'error': {'message': f'Ruta no soportada: {path}'}})
+
+    def _prompt_tokens(self, body: Dict[str, Any]) -> int:
+        text = json.dumps(body.get('messages', [])) + str(body.get('system', ''))
+        return len(text) // 4
+
+    def _openai_completion(self, body: Dict[str, Any]):
+        model = body.get('model', 'fake-model')
+        length = self.config.response_length(body.get('max_tokens'))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        time.sleep(self.config.first_token_delay())
+
+        if not body.get('stream'):
+            self._pace(length)
+            text = ''.join(self._tokens(length))
+            self._send_json(200, {
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': created,
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': text},
+                    'finish_reason': 'stop'
+                }],
+                'usage': {
+                    'prompt_tokens': self._prompt_tokens(body),
+                    'completion_tokens': length,
+                    'total_tokens': self._prompt_tokens(body) + length
+                }
+            })
+            return
+
+        def chunk(delta: Dict[str, Any], finish_reason=None) -> str:
+            return "data: " + json.dumps({
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+            }) + "\n\n"
+
+        self._start_stream()
+        self._write_chunk(chunk({'role': 'assistant', 'content': ''}))
+        for token in self._tokens(length):
+            self._write_chunk(chunk({'content': token}))
+            self._pace(1)
+        self._write_chunk(chunk({}, 'stop'))
+        self._write_chunk("data: [DONE]\n\n")
+        self._end_stream()
+
+    def _anthropic_message(self, body: Dict[str, Any]):
+        model = body.get('model', 'fake-model')
+        length = self.config.response_length(body.get('max_tokens'))
+        message_id = f"msg_{uuid.uuid4().hex[:24]}"
+        usage = {'input_tokens': self._prompt_tokens(body), 'output_tokens': length}
+        time.sleep(self.config.first_token_delay())
+
+        if not body.get('stream'):
+            self._pace(length)
+            self._send_json(200, {
+                'id': message_id,
+                'type': 'message',
+                'role': 'assistant',
+                'model': model,
+                'content': [{'type': 'text', 'text': ''.join(self._tokens(length))}],
+                'stop_reason': 'end_turn',
+                'stop_sequence': None,
+                'usage': usage
+            })
+            return
+
+        def event(name: str, data: Dict[str, Any]) -> str:
+            return f"event: {name}\ndata: {json.dumps({'type': name, **data})}\n\n"
+
+        self._start_stream()
+        self._write_chunk(event('message_start', {'message': {
+            'id': message_id, 'type': 'message', 'role': 'assistant', 'model': model,
+            'content': [], 'stop_reason': None, 'stop_sequence': None,
+            'usage': {'input_tokens': usage['input_tokens'], 'output_tokens': 0}
+        }}))
+        self._write_chunk(event('content_block_start', {'index': 0, 'content_block': {'type': 'text', 'text': ''}}))
+        for token in self._tokens(length):
+            self._write_chunk(event('content_block_delta', {'index': 0, 'delta': {'type': 'text_delta', 'text': token}}))
+            self._pace(1)
+        self._write_chunk(event('content_block_stop', {'index': 0}))
+        self._write_chunk(event('message_delta', {
+            'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+            'usage': {'output_tokens': length}
+        }))
+        self._write_chunk(event('message_stop', {}))
+        self._end_stream()
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """Servidor multi-thread del proveedor simulado"""
+
+    daemon_threads = True
+
+    def __init__(self, address, config: Optional[FakeLLMConfig] = None):
+        super().__init__(address, FakeLLMHandler)
+        self.config = config or FakeLLMConfig()
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0}
+
+    def count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self.stats)
+
+
+def run_server(host: str = '127.0.0.1', port: int = 8765, config: Optional[FakeLLMConfig] = None) -> FakeLLMServer:
+    """Crear el servidor (llamar a serve_forever() para atender peticiones)"""
+    server = FakeLLMServer((host, port), config)
+    logger.info(f"Fake LLM escuchando en http://{host}:{port} - {server.config.as_dict()}")
+    return server
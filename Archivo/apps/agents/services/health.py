@@ -0,0 +1,268 @@
+"""
+Health Monitor - Estado de salud cacheado y refrescado en segundo plano
+
+El endpoint /api/agents/health/ ejecutaba todas las comprobaciones en cada
+sonda (el health check del RAG codifica un embedding y lista las colecciones
+de Chroma). Con sondas de Kubernetes cada pocos segundos eso es carga real.
+Aquí cada componente se comprueba en segundo plano con su propio intervalo y
+plazo; las sondas leen la última instantánea, con la antigüedad de cada
+componente, y se separan liveness (el proceso responde) y readiness (los
+componentes críticos están sanos y frescos).
+"""
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+STATUS_ORDER = {'healthy': 0, 'degraded': 1, 'unknown': 2, 'unhealthy': 3}
+
+
+class HealthComponent:
+    """Comprobación de un componente y su último resultado"""
+
+    def __init__(self, name: str, check: Callable[[], Dict[str, Any]], interval: float,
+                 critical: bool = False, stale_after: Optional[float] = None):
+        self.name = name
+        self.check = check
+        self.interval = interval
+        self.critical = critical
+        self.stale_after = stale_after or interval * 3
+        self.result: Optional[Dict[str, Any]] = None
+        self.checked_at: Optional[float] = None
+        self.next_run = 0.0
+        self.running = None
+
+    def state(self, now: float) -> Dict[str, Any]:
+        if self.result is None:
+            return {'status': 'unknown', 'critical': self.critical, 'stale': True, 'checked_at': None}
+
+        age = now - self.checked_at
+        stale = age > self.stale_after
+        state = dict(self.result)
+        state.update(
+            critical=self.critical,
+            age_seconds=round(age, 1),
+            stale=stale,
+        )
+        if stale and state['status'] == 'healthy':
+            # Un resultado viejo ya no garantiza nada
+            state['status'] = 'unknown'
+        return state
+
+
+class HealthMonitor:
+    """
+    Instantánea de salud refrescada en segundo plano.
+
+    Configuración (variables de entorno):
+    - HEALTH_REFRESH_INTERVAL: segundos entre comprobaciones de los componentes ligeros
+    - HEALTH_RAG_INTERVAL: segundos entre comprobaciones del RAG (embedding + Chroma)
+    - HEALTH_CHECK_TIMEOUT: plazo de cada comprobación
+    - HEALTH_STALE_FACTOR: un resultado caduca tras este número de intervalos
+    """
+
+    TICK = 0.5
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.refresh_interval = float(os.getenv('HEALTH_REFRESH_INTERVAL', 15))
+        self.rag_interval = float(os.getenv('HEALTH_RAG_INTERVAL', 60))
+        self.check_timeout = float(os.getenv('HEALTH_CHECK_TIMEOUT', 10))
+        self.stale_factor = float(os.getenv('HEALTH_STALE_FACTOR', 3))
+
+        self.started_at = time.time()
+        self.components: Dict[str, HealthComponent] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='health-check')
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_tick: Optional[float] = None
+
+        self._register_default_components()
+
+    def register(self, name: str, check: Callable[[], Dict[str, Any]], interval: Optional[float] = None,
+                 critical: bool = False):
+        interval = interval or self.refresh_interval
+        with self._lock:
+            self.components[name] = HealthComponent(
+                name, check, interval, critical, stale_after=interval * self.stale_factor
+            )
+
+    def _register_default_components(self):
+        self.register('agents', self._check_agents, critical=True)
+        self.register('llm_providers', self._check_llm_providers)
+        self.register('redis', self._check_redis)
+        self.register('rag', self._check_rag, interval=self.rag_interval)
+
+    # Comprobaciones por componente
+
+    @staticmethod
+    def _check_agents() -> Dict[str, Any]:
+        from .registry import get_agent_manager
+        health = get_agent_manager().health_check()
+        return {
+            'status': health['status'],
+            'agents_online': health['agents_online'],
+            'agents_loaded': health['agents_loaded'],
+            'total_agents': health['total_agents'],
+            'agents_status': health['agents_status'],
+            'metrics': health['metrics'],
+        }
+
+    @staticmethod
+    def _check_llm_providers() -> Dict[str, Any]:
+        from .registry import get_circuit_breakers
+        breakers = get_circuit_breakers()
+        snapshot = breakers.snapshot()
+        all_open = bool(snapshot) and all(b['state'] == 'open' for b in snapshot.values())
+        return {
+            'status': 'unhealthy' if all_open else ('degraded' if breakers.any_open() else 'healthy'),
+            'circuit_breakers': snapshot,
+        }
+
+    @staticmethod
+    def _check_redis() -> Dict[str, Any]:
+        redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+        client = redis.from_url(redis_url, socket_connect_timeout=2, socket_timeout=2)
+        try:
+            started = time.monotonic()
+            client.ping()
+            return {'status': 'healthy', 'latency_ms': round((time.monotonic() - started) * 1000, 1)}
+        finally:
+            client.close()
+
+    @staticmethod
+    def _check_rag() -> Dict[str, Any]:
+        from .registry import get_rag_service
+        rag_service = get_rag_service()
+        if rag_service is None:
+            return {'status': 'unhealthy', 'error': 'Servicio RAG no disponible'}
+        return rag_service.health_check()
+
+    # Refresco en segundo plano
+
+    def start(self):
+        """Arrancar el refresco (idempotente)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='health-monitor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.last_tick = time.time()
+            now = time.monotonic()
+            for component in list(self.components.values()):
+                if component.running is None and now >= component.next_run:
+                    self._launch(component)
+                elif component.running is not None:
+                    self._collect(component)
+            self._stop.wait(self.TICK)
+
+    def _launch(self, component: HealthComponent):
+        component.running = (time.monotonic(), self._executor.submit(component.check))
+
+    def _collect(self, component: HealthComponent):
+        started, future = component.running
+        if not future.done():
+            if time.monotonic() - started < self.check_timeout:
+                return
+            # La comprobación sigue en el pool; no se relanza hasta que termine
+            self._store(component, {'status': 'unhealthy', 'error': f"timeout ({self.check_timeout:.0f}s)"},
+                        started, keep_running=True)
+            return
+
+        try:
+            result = future.result()
+            result.setdefault('status', 'healthy')
+        except Exception as e:
+            self.logger.warning(f"Health check de {component.name} falló: {e}")
+            result = {'status': 'unhealthy', 'error': str(e)}
+        self._store(component, result, started)
+
+    def _store(self, component: HealthComponent, result: Dict[str, Any], started: float,
+               keep_running: bool = False):
+        result['duration_ms'] = round((time.monotonic() - started) * 1000, 1)
+        result['checked_at'] = datetime.now().isoformat()
+        with self._lock:
+            component.result = result
+            component.checked_at = time.monotonic()
+            component.next_run = component.checked_at + component.interval
+            if not keep_running:
+                component.running = None
+
+    def refresh_now(self, timeout: Optional[float] = None):
+        """Comprobar todos los componentes ya (bloqueante; para tests o arranque)"""
+        for component in self.components.values():
+            started = time.monotonic()
+            future = self._executor.submit(component.check)
+            try:
+                result = future.result(timeout=timeout or self.check_timeout)
+                result.setdefault('status', 'healthy')
+            except FutureTimeoutError:
+                result = {'status': 'unhealthy', 'error': 'timeout'}
+            except Exception as e:
+                result = {'status': 'unhealthy', 'error': str(e)}
+            self._store(component, result, started)
+
+    def shutdown(self):
+        self._stop.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # Lectura (sin I/O: solo la instantánea)
+
+    def _refresher_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            components = {name: c.state(now) for name, c in self.components.items()}
+
+        worst = max((STATUS_ORDER.get(c['status'], 2) for c in components.values()), default=0)
+        status = next(name for name, order in STATUS_ORDER.items() if order == worst)
+        return {
+            'status': 'degraded' if status == 'unknown' else status,
+            'components': components,
+            'refresher_alive': self._refresher_alive(),
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'timestamp': datetime.now().isoformat()
+        }
+
+    def liveness(self) -> Dict[str, Any]:
+        """El proceso responde y el refresco sigue vivo"""
+        tick_age = time.time() - self.last_tick if self.last_tick else None
+        alive = self._refresher_alive() and tick_age is not None and tick_age < max(30.0, self.TICK * 20)
+        return {
+            'status': 'alive' if alive else 'dead',
+            'last_refresh_tick_age': round(tick_age, 1) if tick_age is not None else None,
+            'timestamp': datetime.now().isoformat()
+        }
+
+    def readiness(self) -> Dict[str, Any]:
+        """Listo si todos los componentes críticos tienen un resultado fresco y no están caídos"""
+        now = time.monotonic()
+        with self._lock:
+            critical = {name: c.state(now) for name, c in self.components.items() if c.critical}
+
+        blocking = [
+            name for name, state in critical.items()
+            if state['stale'] or state['status'] in ('unhealthy', 'unknown')
+        ]
+        return {
+            'status': 'ready' if not blocking else 'not_ready',
+            'blocking_components': blocking,
+            'components': {name: {'status': s['status'], 'stale': s['stale']} for name, s in critical.items()},
+            'timestamp': datetime.now().isoformat()
+        }
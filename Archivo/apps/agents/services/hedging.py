@@ -0,0 +1,292 @@
+"""
+Hedging - Llamadas a proveedores en carrera para acotar la latencia de cola
+
+En lugar de esperar a que OpenAI falle o agote el timeout antes de probar
+Claude, se lanza el proveedor primario y, si no produjo el primer token dentro
+de un retardo basado en su p95 reciente, se lanza también el secundario. Gana
+el primero que emite un token y el perdedor se cancela.
+
+En la versión con threads el perdedor puede estar bloqueado esperando su
+primer token: cancelar consiste en cerrar su respuesta HTTP (el proveedor la
+registra con register_stream), no solo en marcar un evento.
+"""
+
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from .errors import ProviderError, ProviderUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# (nombre del proveedor, fábrica del stream de texto)
+StreamFactory = Tuple[str, Callable[[], Iterator[str]]]
+AsyncStreamFactory = Tuple[str, Callable[[], AsyncIterator[str]]]
+
+
+class LatencyTracker:
+    """
+    Ventana deslizante de latencias de primer token por proveedor (compartida por el proceso)
+    """
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(provider, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, provider: str, pct: float = 95) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+latency_tracker = LatencyTracker(window=int(os.getenv('LLM_HEDGE_WINDOW', 200)))
+
+
+class _Attempt:
+    """Intento de un proveedor en la carrera: evento de cancelación + stream HTTP abierto"""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self._close: Optional[Callable[[], None]] = None
+        self._lock = threading.Lock()
+
+    def register(self, close: Callable[[], None]):
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._close = close
+                return
+        close()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            close, self._close = self._close, None
+        if close is not None:
+            try:
+                # Desbloquea la lectura del thread que espera el primer token
+                close()
+            except Exception as e:
+                logger.debug(f"Hedging: error cerrando el stream perdedor: {e}")
+
+
+_current_attempt: contextvars.ContextVar = contextvars.ContextVar('hedge_attempt', default=None)
+
+
+def register_stream(close: Callable[[], None]):
+    """
+    Registrar el cierre del stream HTTP del intento de hedging en curso (no-op
+    fuera de hedged_stream). Si el intento ya perdió la carrera se cierra ya.
+    """
+    attempt = _current_attempt.get()
+    if attempt is not None:
+        attempt.register(close)
+
+
+def attempt_cancelled() -> bool:
+    """El intento de hedging en curso perdió la carrera (sus errores no son fallos del proveedor)"""
+    attempt = _current_attempt.get()
+    return attempt is not None and attempt.cancelled.is_set()
+
+
+def hedging_enabled() -> bool:
+    return os.getenv('LLM_HEDGING_ENABLED', 'False').lower() == 'true'
+
+
+def hedge_delay(provider: str) -> float:
+    """
+    Retardo antes de lanzar el proveedor secundario: p95 del primer token del
+    primario (LLM_HEDGE_PERCENTILE), acotado entre LLM_HEDGE_MIN_DELAY y LLM_HEDGE_MAX_DELAY.
+    Sin muestras suficientes se usa LLM_HEDGE_DEFAULT_DELAY.
+    """
+    default_delay = float(os.getenv('LLM_HEDGE_DEFAULT_DELAY', 3.0))
+    min_delay = float(os.getenv('LLM_HEDGE_MIN_DELAY', 0.5))
+    max_delay = float(os.getenv('LLM_HEDGE_MAX_DELAY', 10.0))
+    percentile = float(os.getenv('LLM_HEDGE_PERCENTILE', 95))
+
+    observed = latency_tracker.percentile(provider, percentile)
+    delay = observed if observed is not None else default_delay
+    return max(min_delay, min(max_delay, delay))
+
+
+def hedged_stream(candidates: List[StreamFactory], delay: float) -> Iterator[Tuple[str, str]]:
+    """
+    Carrera entre proveedores con streams bloqueantes (un thread por proveedor).
+
+    Args:
+        candidates: [(proveedor primario, fábrica), (secundario, fábrica), ...]
+        delay: Segundos a esperar el primer token antes de lanzar el siguiente
+
+    Yields:
+        (proveedor ganador, fragmento de texto)
+
+    Raises:
+        ProviderError: Si todos los proveedores fallan antes del primer token
+    """
+    events: "queue.Queue[Tuple[str, Optional[str], Optional[BaseException]]]" = queue.Queue()
+    attempts: Dict[str, _Attempt] = {}
+    pending = list(candidates)
+    started_at: Dict[str, float] = {}
+    failed: Dict[str, BaseException] = {}
+    winner = None
+
+    def run(name: str, factory: Callable[[], Iterator[str]], attempt: _Attempt):
+        _current_attempt.set(attempt)
+        stream = None
+        try:
+            stream = factory()
+            for delta in stream:
+                if attempt.cancelled.is_set():
+                    return
+                events.put((name, delta, None))
+            events.put((name, None, None))
+        except Exception as e:
+            if not attempt.cancelled.is_set():
+                events.put((name, None, e))
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+
+    def launch_next():
+        name, factory = pending.pop(0)
+        attempts[name] = _Attempt()
+        started_at[name] = time.monotonic()
+        # El thread hereda el contexto de la petición (spans de la traza)
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(run, name, factory, attempts[name]),
+            name=f"hedge-{name}", daemon=True
+        ).start()
+
+    launch_next()
+    try:
+        while True:
+            timeout = delay if (winner is None and pending) else None
+            try:
+                name, delta, error = events.get(timeout=timeout)
+            except queue.Empty:
+                logger.info(f"Hedging: sin primer token en {delay:.2f}s, lanzando {pending[0][0]}")
+                launch_next()
+                continue
+
+            if winner is None:
+                if error is not None:
+                    failed[name] = error
+                    if pending:
+                        launch_next()
+                    elif len(failed) == len(started_at):
+                        raise _last_provider_error(name, error)
+                    continue
+
+                winner = name
+                latency_tracker.record(name, time.monotonic() - started_at[name])
+                for other, attempt in attempts.items():
+                    if other != name:
+                        attempt.cancel()
+                if delta is None:
+                    return
+                yield name, delta
+                continue
+
+            if name != winner:
+                continue
+            if error is not None:
+                raise _last_provider_error(name, error)
+            if delta is None:
+                return
+            yield name, delta
+    finally:
+        for attempt in attempts.values():
+            attempt.cancel()
+
+
+async def ahedged_stream(candidates: List[AsyncStreamFactory], delay: float) -> AsyncIterator[Tuple[str, str]]:
+    """
+    Versión async de hedged_stream: una tarea por proveedor, el perdedor se cancela.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+    tasks: Dict[str, asyncio.Task] = {}
+    pending = list(candidates)
+    started_at: Dict[str, float] = {}
+    failed: Dict[str, BaseException] = {}
+    winner = None
+
+    async def run(name: str, factory: Callable[[], AsyncIterator[str]]):
+        stream = factory()
+        try:
+            async for delta in stream:
+                await events.put((name, delta, None))
+            await events.put((name, None, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await events.put((name, None, e))
+        finally:
+            await stream.aclose()
+
+    def launch_next():
+        name, factory = pending.pop(0)
+        started_at[name] = time.monotonic()
+        tasks[name] = asyncio.ensure_future(run(name, factory))
+
+    launch_next()
+    try:
+        while True:
+            timeout = delay if (winner is None and pending) else None
+            try:
+                name, delta, error = await asyncio.wait_for(events.get(), timeout)
+            except asyncio.TimeoutError:
+                logger.info(f"Hedging: sin primer token en {delay:.2f}s, lanzando {pending[0][0]}")
+                launch_next()
+                continue
+
+            if winner is None:
+                if error is not None:
+                    failed[name] = error
+                    if pending:
+                        launch_next()
+                    elif len(failed) == len(started_at):
+                        raise _last_provider_error(name, error)
+                    continue
+
+                winner = name
+                latency_tracker.record(name, time.monotonic() - started_at[name])
+                for other, task in tasks.items():
+                    if other != name:
+                        task.cancel()
+                if delta is None:
+                    return
+                yield name, delta
+                continue
+
+            if name != winner:
+                continue
+            if error is not None:
+                raise _last_provider_error(name, error)
+            if delta is None:
+                return
+            yield name, delta
+    finally:
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+
+
+def _last_provider_error(provider: str, error: BaseException) -> ProviderError:
+    if isinstance(error, ProviderError):
+        return error
+    return ProviderUnavailableError(provider, str(error), error)
@@ -0,0 +1,205 @@
+"""
+LLM Clients - Clientes de IA y tokenizer compartidos por todos los agentes
+
+Cada agente creaba su propio encoder de tiktoken y sus propios clientes de
+OpenAI/Anthropic (cada uno con su pool HTTP). Este proveedor mantiene un único
+tokenizer y un único cliente por proveedor, con un pool keep-alive configurable,
+para que las conexiones TLS se reutilicen entre agentes y peticiones.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+import weakref
+from typing import Any, Dict, Optional
+
+import httpx
+import tiktoken
+from openai import OpenAI, AsyncOpenAI
+from anthropic import Anthropic, AsyncAnthropic
+
+logger = logging.getLogger(__name__)
+
+
+class LLMClientProvider:
+    """
+    Proveedor thread-safe de clientes LLM y tokenizer compartidos.
+
+    Configuración (variables de entorno):
+    - LLM_HTTP_POOL_SIZE: conexiones máximas por proveedor
+    - LLM_HTTP_KEEPALIVE: conexiones keep-alive que se mantienen abiertas
+    - LLM_HTTP_KEEPALIVE_EXPIRY: segundos antes de cerrar una conexión ociosa
+    - LLM_HTTP_CONNECT_TIMEOUT: timeout de conexión en segundos
+    - AGENT_RESPONSE_TIMEOUT: timeout total de la petición en segundos
+    - LLM_MAX_RETRIES: reintentos automáticos del SDK
+    - LLM_PROVIDER_BACKEND: 'real' o 'fake' (proveedor local de fake_llm.py para pruebas de carga)
+    - FAKE_LLM_URL: dirección del proveedor simulado
+    - OPENAI_BASE_URL / ANTHROPIC_BASE_URL: endpoints alternativos de cada proveedor
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.pool_size = int(os.getenv('LLM_HTTP_POOL_SIZE', 20))
+        self.keepalive_connections = int(os.getenv('LLM_HTTP_KEEPALIVE', 10))
+        self.keepalive_expiry = float(os.getenv('LLM_HTTP_KEEPALIVE_EXPIRY', 30))
+        self.connect_timeout = float(os.getenv('LLM_HTTP_CONNECT_TIMEOUT', 5))
+        self.request_timeout = float(os.getenv('AGENT_RESPONSE_TIMEOUT', 30))
+        self.max_retries = int(os.getenv('LLM_MAX_RETRIES', 2))
+        self.backend = os.getenv('LLM_PROVIDER_BACKEND', 'real').lower()
+
+        self._lock = threading.Lock()
+        self._encoding = None
+        self._clients: Dict[str, Any] = {}
+        self._http_clients: Dict[str, httpx.Client] = {}
+        # Los clientes async quedan ligados al event loop donde se crean
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, Any]]" = \
+            weakref.WeakKeyDictionary()
+
+    @property
+    def encoding(self):
+        """Tokenizer compartido (cl100k_base)"""
+        if self._encoding is None:
+            with self._lock:
+                if self._encoding is None:
+                    self._encoding = tiktoken.get_encoding("cl100k_base")
+        return self._encoding
+
+    def _http_client_options(self) -> Dict[str, Any]:
+        return {
+            'limits': httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            'timeout': httpx.Timeout(self.request_timeout, connect=self.connect_timeout)
+        }
+
+    def _build_http_client(self) -> httpx.Client:
+        """Crear un pool HTTP keep-alive para un proveedor"""
+        return httpx.Client(**self._http_client_options())
+
+    @property
+    def is_fake(self) -> bool:
+        return self.backend == 'fake'
+    
+    def _base_url(self, provider: str) -> Optional[str]:
+        """Endpoint del proveedor (None = el del SDK)"""
+        if self.is_fake:
+            fake_url = os.getenv('FAKE_LLM_URL', 'http://127.0.0.1:8765').rstrip('/')
+            # El SDK de OpenAI espera la versión en la URL base; el de Anthropic la añade él
+            return f"{fake_url}/v1" if provider == 'openai' else fake_url
+        if provider == 'openai':
+            return os.getenv('OPENAI_BASE_URL') or None
+        return os.getenv('ANTHROPIC_BASE_URL') or None
+    
+    def _client_options(self, provider: str) -> Dict[str, Any]:
+        options = {
+            'api_key': self._api_key(provider),
+            'max_retries': self.max_retries,
+            'timeout': self.request_timeout
+        }
+        base_url = self._base_url(provider)
+        if base_url:
+            options['base_url'] = base_url
+        return options
+    
+    def _api_key(self, provider: str) -> Optional[str]:
+        """API key del proveedor o None si no está configurada"""
+        if self.is_fake:
+            return 'fake-key'
+        if provider == 'openai':
+            api_key = os.getenv('OPENAI_API_KEY')
+            placeholder = 'sk-your-openai-key-here'
+        else:
+            api_key = os.getenv('ANTHROPIC_API_KEY')
+            placeholder = 'your-claude-key-here'
+        if not api_key or api_key == placeholder:
+            return None
+        return api_key
+
+    def _get_client(self, provider: str) -> Optional[Any]:
+        if provider in self._clients:
+            return self._clients[provider]
+
+        with self._lock:
+            if provider not in self._clients:
+                self._clients[provider] = self._build_client(provider)
+        return self._clients[provider]
+
+    def _build_client(self, provider: str) -> Optional[Any]:
+        api_key = self._api_key(provider)
+        if not api_key:
+            self.logger.warning(f"API key de {provider} no configurada")
+            return None
+        client_class = OpenAI if provider == 'openai' else Anthropic
+
+        try:
+            http_client = self._build_http_client()
+            client = client_class(http_client=http_client, **self._client_options(provider))
+            self._http_clients[provider] = http_client
+            self.logger.info(f"Cliente {provider} compartido inicializado (pool={self.pool_size})")
+            return client
+        except Exception as e:
+            self.logger.error(f"Error inicializando cliente {provider}: {e}")
+            return None
+
+    def get_openai_client(self) -> Optional[OpenAI]:
+        """Cliente OpenAI compartido (None si no está configurado)"""
+        return self._get_client('openai')
+
+    def get_claude_client(self) -> Optional[Anthropic]:
+        """Cliente Anthropic compartido (None si no está configurado)"""
+        return self._get_client('claude')
+
+    def _get_async_client(self, provider: str) -> Optional[Any]:
+        """Cliente async del proveedor para el event loop actual (un pool por loop)"""
+        api_key = self._api_key(provider)
+        if not api_key:
+            return None
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            loop_clients = self._async_clients.setdefault(loop, {})
+            if provider not in loop_clients:
+                client_class = AsyncOpenAI if provider == 'openai' else AsyncAnthropic
+                loop_clients[provider] = client_class(
+                    http_client=httpx.AsyncClient(**self._http_client_options()),
+                    **self._client_options(provider)
+                )
+                self.logger.info(f"Cliente async {provider} inicializado (pool={self.pool_size})")
+            return loop_clients[provider]
+
+    def get_async_openai_client(self) -> Optional[AsyncOpenAI]:
+        """Cliente AsyncOpenAI compartido en el event loop actual"""
+        return self._get_async_client('openai')
+
+    def get_async_claude_client(self) -> Optional[AsyncAnthropic]:
+        """Cliente AsyncAnthropic compartido en el event loop actual"""
+        return self._get_async_client('claude')
+
+    async def aclose(self):
+        """Cerrar los pools HTTP async del event loop actual"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            loop_clients = self._async_clients.pop(loop, {})
+
+        for provider, client in loop_clients.items():
+            try:
+                await client.close()
+            except Exception as e:
+                self.logger.warning(f"Error cerrando cliente async de {provider}: {e}")
+
+    def close(self):
+        """Cerrar los pools HTTP de todos los proveedores"""
+        with self._lock:
+            http_clients = list(self._http_clients.items())
+            self._http_clients.clear()
+            self._clients.clear()
+
+        for provider, http_client in http_clients:
+            try:
+                http_client.close()
+            except Exception as e:
+                self.logger.warning(f"Error cerrando pool HTTP de {provider}: {e}")
@@ -0,0 +1,275 @@
+"""
+Load Generator - Prueba de carga de extremo a extremo del chat de agentes
+
+Reproduce una mezcla realista de consultas por tipo de agente contra
+/api/agents/chat/, /api/agents/chat/async/ o el WebSocket ws/chat/, con
+concurrencia, duración y ritmo de llegada configurables. Informa throughput,
+latencias p50/p95/p99, tiempo hasta el primer token (TTFT) y tasa de error por
+agente. Pensado para usarse con el proveedor simulado (fake_llm.py).
+
+El TTFT solo es real en el WebSocket (evento 'token'); los endpoints HTTP
+devuelven la respuesta completa y para ellos se mide el primer byte.
+"""
+
+import json
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Mezcla por defecto: (agent_type, peso, consultas). None = enrutamiento automático
+DEFAULT_MIX = [
+    ('tutor', 35, [
+        '¿Puedes explicarme cómo sumar fracciones con distinto denominador?',
+        'No entiendo la derivada de x al cuadrado, ¿me ayudas paso a paso?',
+        '¿Qué es la fotosíntesis y por qué es importante?',
+    ]),
+    ('evaluator', 15, [
+        'Evalúa mi respuesta: la mitocondria produce energía para la célula.',
+        '¿Qué nota le pondrías a este resumen sobre la Revolución Francesa?',
+    ]),
+    ('counselor', 10, [
+        'Me siento estresado con los exámenes, ¿qué puedo hacer?',
+        '¿Cómo organizo mejor mi tiempo de estudio?',
+    ]),
+    ('curriculum', 10, [
+        'Diseña un plan de estudio de 4 semanas para álgebra básica.',
+    ]),
+    ('analytics', 10, [
+        'Analiza mi progreso en matemáticas del último mes.',
+    ]),
+    ('content_creator', 10, [
+        'Crea un ejercicio de práctica sobre ecuaciones lineales.',
+    ]),
+    (None, 10, [
+        'Hola, ¿qué me recomiendas estudiar hoy?',
+        'Necesito ayuda con mi tarea de física.',
+    ]),
+]
+
+ENDPOINTS = {
+    'chat': '/api/agents/chat/',
+    'chat-async': '/api/agents/chat/async/',
+    'ws': '/ws/chat/',
+}
+
+
+def load_mix(path: Optional[str]) -> List[tuple]:
+    """Mezcla de consultas desde un JSON [{"agent_type", "weight", "queries"}] o la mezcla por defecto"""
+    if not path:
+        return DEFAULT_MIX
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    return [(e.get('agent_type'), float(e.get('weight', 1)), list(e['queries'])) for e in entries]
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil por rango más cercano (None si no hay muestras)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class LoadGenerator:
+    """
+    Generador de carga asyncio.
+
+    - concurrency: usuarios virtuales en bucle cerrado (sin rate)
+    - rate: llegadas por segundo en bucle abierto (Poisson), limitadas por concurrency
+    - duration / total_requests: cuándo detenerse (lo que ocurra primero)
+    """
+
+    def __init__(self, base_url: str, endpoint: str = 'chat', concurrency: int = 10,
+                 duration: float = 60.0, total_requests: Optional[int] = None,
+                 rate: Optional[float] = None, users: int = 100, timeout: float = 60.0,
+                 mix: Optional[List[tuple]] = None):
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f"Endpoint no soportado: {endpoint} (opciones: {', '.join(ENDPOINTS)})")
+
+        self.base_url = base_url.rstrip('/')
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.duration = duration
+        self.total_requests = total_requests
+        self.rate = rate
+        self.users = users
+        self.timeout = timeout
+        self.mix = mix or DEFAULT_MIX
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._weights = [entry[1] for entry in self.mix]
+        self.samples: List[Dict[str, Any]] = []
+        self._issued = 0
+
+    def _next_request(self) -> Optional[Dict[str, Any]]:
+        if self.total_requests is not None and self._issued >= self.total_requests:
+            return None
+        self._issued += 1
+        agent_type, _, queries = random.choices(self.mix, weights=self._weights)[0]
+        return {
+            'userId': f"loadtest-{random.randrange(self.users)}",
+            'text': random.choice(queries),
+            'agent_type': agent_type
+        }
+
+    # Peticiones
+
+    async def _http_request(self, client: httpx.AsyncClient, payload: Dict[str, Any]) -> Dict[str, Any]:
+        sample = {'requested_agent': payload['agent_type'] or 'auto'}
+        start = time.perf_counter()
+        try:
+            async with client.stream('POST', ENDPOINTS[self.endpoint], json=payload) as response:
+                body = b''
+                async for chunk in response.aiter_bytes():
+                    if 'ttft' not in sample:
+                        sample['ttft'] = time.perf_counter() - start
+                    body += chunk
+            sample['latency'] = time.perf_counter() - start
+            sample['status'] = response.status_code
+            data = json.loads(body or b'{}')
+            sample['agent'] = data.get('agent_used') or sample['requested_agent']
+            sample['ok'] = response.status_code == 200 and data.get('status') == 'success'
+            if not sample['ok']:
+                sample['error'] = data.get('error_type') or f"http_{response.status_code}"
+        except Exception as e:
+            sample.update(latency=time.perf_counter() - start, ok=False, error=type(e).__name__)
+        return sample
+
+    async def _ws_request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        import websockets  # Dependencia opcional, solo para el modo ws
+
+        sample = {'requested_agent': payload['agent_type'] or 'auto'}
+        url = self.base_url.replace('http', 'ws', 1) + ENDPOINTS['ws']
+        start = time.perf_counter()
+        try:
+            async with websockets.connect(url, open_timeout=self.timeout) as ws:
+                await ws.send(json.dumps(payload))
+                while True:
+                    event = json.loads(await asyncio.wait_for(ws.recv(), self.timeout))
+                    if event.get('type') == 'start':
+                        sample['agent'] = event.get('agent_used')
+                    elif event.get('type') == 'token' and 'ttft' not in sample:
+                        sample['ttft'] = time.perf_counter() - start
+                    elif event.get('type') in ('end', 'error'):
+                        sample['ok'] = event['type'] == 'end' and event.get('success', True)
+                        if not sample['ok']:
+                            sample['error'] = event.get('error_type') or 'stream_error'
+                        break
+            sample['latency'] = time.perf_counter() - start
+        except Exception as e:
+            sample.update(latency=time.perf_counter() - start, ok=False, error=type(e).__name__)
+        sample.setdefault('agent', sample['requested_agent'])
+        return sample
+
+    async def _execute(self, client: httpx.AsyncClient, payload: Dict[str, Any]):
+        if self.endpoint == 'ws':
+            sample = await self._ws_request(payload)
+        else:
+            sample = await self._http_request(client, payload)
+        self.samples.append(sample)
+
+    # Bucles de carga
+
+    async def _closed_loop_worker(self, client: httpx.AsyncClient, deadline: float):
+        while time.monotonic() < deadline:
+            payload = self._next_request()
+            if payload is None:
+                return
+            await self._execute(client, payload)
+
+    async def _open_loop(self, client: httpx.AsyncClient, deadline: float):
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        async def run(payload):
+            try:
+                await self._execute(client, payload)
+            finally:
+                slots.release()
+
+        while time.monotonic() < deadline:
+            payload = self._next_request()
+            if payload is None:
+                break
+            await slots.acquire()
+            task = asyncio.ensure_future(run(payload))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            await asyncio.sleep(random.expovariate(self.rate))
+
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def run(self) -> Dict[str, Any]:
+        self.samples = []
+        self._issued = 0
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+
+        start = time.monotonic()
+        deadline = start + self.duration
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=limits) as client:
+            if self.rate:
+                await self._open_loop(client, deadline)
+            else:
+                await asyncio.gather(*(
+                    self._closed_loop_worker(client, deadline) for _ in range(self.concurrency)
+                ))
+        return self.report(time.monotonic() - start)
+
+    # Informe
+
+    @staticmethod
+    def _summarize(samples: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+        latencies = [s['latency'] for s in samples if s['ok']]
+        ttfts = [s['ttft'] for s in samples if s['ok'] and 'ttft' in s]
+        errors: Dict[str, int] = {}
+        for sample in samples:
+            if not sample['ok']:
+                errors[sample['error']] = errors.get(sample['error'], 0) + 1
+
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            'requests': len(samples),
+            'successful': len(latencies),
+            'error_rate': round(1 - len(latencies) / len(samples), 4) if samples else 0.0,
+            'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+            'latency_ms': {
+                'p50': ms(percentile(latencies, 50)),
+                'p95': ms(percentile(latencies, 95)),
+                'p99': ms(percentile(latencies, 99)),
+            },
+            'ttft_ms': {
+                'p50': ms(percentile(ttfts, 50)),
+                'p95': ms(percentile(ttfts, 95)),
+                'p99': ms(percentile(ttfts, 99)),
+            },
+            'errors': errors
+        }
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        by_agent: Dict[str, List[Dict[str, Any]]] = {}
+        for sample in self.samples:
+            by_agent.setdefault(sample.get('agent') or 'unknown', []).append(sample)
+
+        return {
+            'endpoint': self.endpoint,
+            'base_url': self.base_url,
+            'concurrency': self.concurrency,
+            'rate': self.rate,
+            'elapsed_seconds': round(elapsed, 2),
+            'ttft_measure': 'first_token' if self.endpoint == 'ws' else 'first_byte',
+            'overall': self._summarize(self.samples, elapsed),
+            'agents': {
+                agent: self._summarize(samples, elapsed)
+                for agent, samples in sorted(by_agent.items())
+            }
+        }
@@ -0,0 +1,139 @@
+"""
+Message Codec - Codificación compacta de los mensajes de la conversación
+
+ConversationMemory guardaba cada mensaje como JSON con claves largas, fecha
+ISO y un 'metadata' casi siempre vacío; con MAX_CONVERSATION_HISTORY=50 por
+usuario y agente eso es la mayor parte de la memoria de Redis, y cada lectura
+hace un json.loads por mensaje.
+
+Formato v1 (binario): 1 byte de cabecera + cuerpo msgpack
+- cabecera: 0x01 = msgpack v1; con el bit 0x80 el cuerpo va comprimido con zstd
+- cuerpo: {'r': rol (entero para los roles conocidos), 'c': contenido,
+  't': epoch en segundos, 'm': metadatos (se omite si está vacío)}
+
+Las entradas antiguas en JSON (empiezan por '{') se siguen decodificando, así
+que no hace falta migrar: la lista se renueva sola con los mensajes nuevos.
+zstd es opcional (paquete zstandard); sin él los mensajes se guardan sin
+comprimir y solo falla la lectura de entradas comprimidas.
+"""
+
+import os
+import json
+import threading
+from datetime import datetime
+from typing import Any, Dict, Union
+
+import msgpack
+
+try:
+    import zstandard
+except ImportError:  # Dependencia opcional: solo comprime respuestas largas
+    zstandard = None
+
+FORMAT_MSGPACK_V1 = 0x01
+FLAG_ZSTD = 0x80
+
+ROLE_CODES = {'user': 0, 'assistant': 1, 'system': 2}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+_local = threading.local()
+
+
+def _compressor(level: int):
+    # Los (de)compresores de zstandard no son thread-safe: uno por thread
+    compressor = getattr(_local, 'compressor', None)
+    if compressor is None:
+        compressor = _local.compressor = zstandard.ZstdCompressor(level=level)
+    return compressor
+
+
+def _decompressor():
+    decompressor = getattr(_local, 'decompressor', None)
+    if decompressor is None:
+        decompressor = _local.decompressor = zstandard.ZstdDecompressor()
+    return decompressor
+
+
+def _epoch(timestamp: Any) -> int:
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    if timestamp:
+        try:
+            return int(datetime.fromisoformat(str(timestamp)).timestamp())
+        except ValueError:
+            pass
+    return int(datetime.now().timestamp())
+
+
+class MessageCodec:
+    """
+    Codificación de mensajes para las listas conversation:{user}:{agent}.
+
+    Configuración (variables de entorno):
+    - CONVERSATION_ENCODING: 'msgpack' (formato v1) o 'json' (formato antiguo)
+    - CONVERSATION_ZSTD_MIN_BYTES: comprimir con zstd cuerpos de al menos este tamaño (0 = nunca)
+    - CONVERSATION_ZSTD_LEVEL: nivel de compresión zstd
+    """
+
+    def __init__(self):
+        self.encoding = os.getenv('CONVERSATION_ENCODING', 'msgpack').lower()
+        self.zstd_min_bytes = int(os.getenv('CONVERSATION_ZSTD_MIN_BYTES', 1024))
+        self.zstd_level = int(os.getenv('CONVERSATION_ZSTD_LEVEL', 3))
+
+    def encode(self, message: Dict[str, Any]) -> Union[bytes, str]:
+        """Mensaje {'role', 'content', 'timestamp', 'metadata'} -> valor para Redis"""
+        if self.encoding == 'json':
+            return json.dumps(message)
+
+        role = message['role']
+        packed = {
+            'r': ROLE_CODES.get(role, role),
+            'c': message['content'],
+            't': _epoch(message.get('timestamp')),
+        }
+        if message.get('metadata'):
+            packed['m'] = message['metadata']
+        body = msgpack.packb(packed, use_bin_type=True)
+
+        header = FORMAT_MSGPACK_V1
+        if zstandard is not None and 0 < self.zstd_min_bytes <= len(body):
+            compressed = _compressor(self.zstd_level).compress(body)
+            if len(compressed) < len(body):
+                header |= FLAG_ZSTD
+                body = compressed
+        return bytes((header,)) + body
+
+    @staticmethod
+    def decode(raw: Union[bytes, str]) -> Dict[str, Any]:
+        """
+        Valor de Redis -> mensaje con la forma de siempre (timestamp ISO).
+        Acepta el formato v1 y el JSON antiguo (bytes o str).
+
+        Raises:
+            ValueError: Si el valor no corresponde a ningún formato conocido
+        """
+        if isinstance(raw, str):
+            return json.loads(raw)
+        if not raw:
+            raise ValueError("Mensaje vacío")
+
+        header = raw[0]
+        if header == ord('{'):
+            return json.loads(raw)
+        if header & ~FLAG_ZSTD != FORMAT_MSGPACK_V1:
+            raise ValueError(f"Formato de mensaje desconocido: 0x{header:02x}")
+
+        body = raw[1:]
+        if header & FLAG_ZSTD:
+            if zstandard is None:
+                raise ValueError("Mensaje comprimido con zstd y el paquete zstandard no está instalado")
+            body = _decompressor().decompress(body)
+
+        packed = msgpack.unpackb(body, raw=False)
+        role = packed['r']
+        return {
+            'role': ROLE_NAMES.get(role, role),
+            'content': packed['c'],
+            'timestamp': datetime.fromtimestamp(packed['t']).isoformat(),
+            'metadata': packed.get('m') or {}
+        }
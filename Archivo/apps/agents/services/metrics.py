@@ -0,0 +1,403 @@
+"""
+Metrics - Contadores e histogramas de latencia del proceso y entre workers
+
+AgentManager guardaba un promedio móvil en un dict: sin percentiles y solo del
+worker que atendía la petición. Este registro mantiene contadores e
+histogramas de buckets logarítmicos (estilo HDR, ~9% de error relativo) por
+agente, proveedor y etapa, agrega los de todos los workers gunicorn/uvicorn
+en Redis y los expone en formato Prometheus en /metrics.
+
+Cada worker acumula localmente y vuelca solo los incrementos a Redis cada
+METRICS_FLUSH_INTERVAL segundos, así el camino de la petición no toca Redis.
+"""
+
+import os
+import math
+import bisect
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Límites superiores de los buckets: 1ms * 2^(i/8), de 1ms a ~262s
+BUCKET_BOUNDS = [0.001 * 2 ** (i / 8) for i in range(145)]
+# En la exposición Prometheus solo se publica uno de cada 8 límites (potencias de 2 en ms)
+EXPORT_STRIDE = 8
+
+METRIC_HELP = {
+    'agent_requests_total': ('counter', 'Consultas procesadas por agente y resultado'),
+    'agent_request_duration_seconds': ('histogram', 'Tiempo total de route_query por agente'),
+    'llm_requests_total': ('counter', 'Llamadas a proveedores LLM por resultado'),
+    'llm_request_duration_seconds': ('histogram', 'Duración de las llamadas a proveedores LLM'),
+    'llm_ttft_seconds': ('histogram', 'Tiempo hasta el primer token en streaming'),
+    'chat_stage_duration_seconds': ('histogram', 'Duración de cada etapa del pipeline del chat'),
+    'routing_decisions_total': ('counter', 'Decisiones de routing automático por método'),
+}
+
+LabelSet = Tuple[Tuple[str, str], ...]
+SeriesKey = Tuple[str, LabelSet]
+
+
+def _labels(labels: Dict[str, Any]) -> LabelSet:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _encode_series(key: SeriesKey) -> str:
+    name, labels = key
+    return name + '|' + ','.join(f"{k}={v}" for k, v in labels)
+
+
+def _decode_series(raw: str) -> SeriesKey:
+    name, _, labels = raw.partition('|')
+    pairs = tuple(tuple(item.split('=', 1)) for item in labels.split(',') if '=' in item)
+    return name, pairs
+
+
+class Histogram:
+    """Histograma de buckets logarítmicos fijos (fusionable entre workers)"""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def merge(self, other: 'Histogram'):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.total += other.total
+        self.count += other.count
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Percentil interpolado dentro de su bucket (None si está vacío)"""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(pct / 100.0 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank:
+                if index >= len(BUCKET_BOUNDS):
+                    return BUCKET_BOUNDS[-1]
+                lower = BUCKET_BOUNDS[index - 1] if index else 0.0
+                return lower + (BUCKET_BOUNDS[index] - lower) * (rank - seen) / count
+            seen += count
+        return BUCKET_BOUNDS[-1]
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            'count': self.count,
+            'mean_ms': ms(self.mean) if self.count else None,
+            'p50_ms': ms(self.percentile(50)),
+            'p95_ms': ms(self.percentile(95)),
+            'p99_ms': ms(self.percentile(99)),
+        }
+
+
+class MetricsRegistry:
+    """
+    Contadores e histogramas thread-safe, agregados entre workers con Redis.
+
+    Configuración (variables de entorno):
+    - METRICS_REDIS: agregar las métricas de todos los workers en Redis (desactivado por
+      defecto: importar el módulo no debe conectar a Redis ni arrancar el thread de volcado)
+    - METRICS_FLUSH_INTERVAL: segundos entre volcados de incrementos a Redis
+    - METRICS_REDIS_PREFIX: prefijo de las claves en Redis
+    """
+
+    def __init__(self, redis_client=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.flush_interval = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+        self.prefix = os.getenv('METRICS_REDIS_PREFIX', 'metrics')
+
+        self.redis_client = redis_client
+        if self.redis_client is None and os.getenv('METRICS_REDIS', 'False').lower() == 'true':
+            self.redis_client = self._init_redis_client()
+
+        self._lock = threading.Lock()
+        # Totales del worker y los incrementos aún no volcados a Redis
+        self._counters: Dict[SeriesKey, float] = {}
+        self._histograms: Dict[SeriesKey, Histogram] = {}
+        self._pending_counters: Dict[SeriesKey, float] = {}
+        self._pending_histograms: Dict[SeriesKey, Histogram] = {}
+
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        if self.redis_client is not None:
+            self._flusher = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def _init_redis_client(self):
+        try:
+            redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+            client = redis.from_url(redis_url, decode_responses=True)
+            client.ping()
+            return client
+        except Exception as e:
+            self.logger.warning(f"Redis no disponible, métricas solo de este worker: {e}")
+            return None
+
+    # Registro
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+            if self.redis_client is not None:
+                self._pending_counters[key] = self._pending_counters.get(key, 0.0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+            if self.redis_client is not None:
+                pending = self._pending_histograms.get(key)
+                if pending is None:
+                    pending = self._pending_histograms[key] = Histogram()
+                pending.observe(seconds)
+
+    # Agregación en Redis
+
+    def _counters_key(self) -> str:
+        return f"{self.prefix}:counters"
+
+    def _series_index_key(self) -> str:
+        return f"{self.prefix}:histograms"
+
+    def _histogram_key(self, series: str) -> str:
+        return f"{self.prefix}:hist:{series}"
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Volcar los incrementos pendientes del worker a Redis"""
+        if self.redis_client is None:
+            return
+        with self._lock:
+            counters, self._pending_counters = self._pending_counters, {}
+            histograms, self._pending_histograms = self._pending_histograms, {}
+        if not counters and not histograms:
+            return
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key, value in counters.items():
+                pipe.hincrbyfloat(self._counters_key(), _encode_series(key), value)
+            for key, histogram in histograms.items():
+                series = _encode_series(key)
+                redis_key = self._histogram_key(series)
+                pipe.sadd(self._series_index_key(), series)
+                for index, count in enumerate(histogram.counts):
+                    if count:
+                        pipe.hincrby(redis_key, f"b{index}", count)
+                pipe.hincrbyfloat(redis_key, 'sum', histogram.total)
+                pipe.hincrby(redis_key, 'count', histogram.count)
+            pipe.execute()
+        except Exception as e:
+            # Devolver los incrementos para el siguiente volcado
+            self.logger.warning(f"Error volcando métricas a Redis: {e}")
+            with self._lock:
+                for key, value in counters.items():
+                    self._pending_counters[key] = self._pending_counters.get(key, 0.0) + value
+                for key, histogram in histograms.items():
+                    self._pending_histograms.setdefault(key, Histogram()).merge(histogram)
+
+    def _read_redis(self) -> Tuple[Dict[SeriesKey, float], Dict[SeriesKey, Histogram]]:
+        counters = {
+            _decode_series(series): float(value)
+            for series, value in self.redis_client.hgetall(self._counters_key()).items()
+        }
+        series_names = sorted(self.redis_client.smembers(self._series_index_key()))
+        pipe = self.redis_client.pipeline(transaction=False)
+        for series in series_names:
+            pipe.hgetall(self._histogram_key(series))
+
+        histograms = {}
+        for series, raw in zip(series_names, pipe.execute()):
+            histogram = Histogram()
+            for field, value in raw.items():
+                if field == 'sum':
+                    histogram.total = float(value)
+                elif field == 'count':
+                    histogram.count = int(value)
+                elif field.startswith('b'):
+                    index = int(field[1:])
+                    if index < len(histogram.counts):
+                        histogram.counts[index] = int(value)
+            histograms[_decode_series(series)] = histogram
+        return counters, histograms
+
+    def collect(self) -> Tuple[Dict[SeriesKey, float], Dict[SeriesKey, Histogram]]:
+        """Métricas de todos los workers (o de este worker si Redis no está disponible)"""
+        if self.redis_client is not None:
+            self.flush()
+            try:
+                return self._read_redis()
+            except Exception as e:
+                self.logger.warning(f"Error leyendo métricas de Redis: {e}")
+
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {}
+            for key, histogram in self._histograms.items():
+                copy = Histogram()
+                copy.merge(histogram)
+                histograms[key] = copy
+        return counters, histograms
+
+    def local_counter_by(self, name: str, label: str) -> Dict[str, float]:
+        """Totales de un contador de este worker por etiqueta, sin volcar ni leer Redis"""
+        totals: Dict[str, float] = {}
+        with self._lock:
+            for (metric, labels), value in self._counters.items():
+                if metric == name:
+                    group = dict(labels).get(label, '')
+                    totals[group] = totals.get(group, 0.0) + value
+        return totals
+
+    def local_histogram(self, name: str) -> Histogram:
+        """Histograma de este worker con todas las etiquetas fusionadas, sin volcar ni leer Redis"""
+        merged = Histogram()
+        with self._lock:
+            for (metric, _), histogram in self._histograms.items():
+                if metric == name:
+                    merged.merge(histogram)
+        return merged
+
+    def local_mean(self, name: str) -> float:
+        """Media de un histograma en este worker, sin volcar ni leer Redis"""
+        return self.local_histogram(name).mean
+
+    # Consultas
+
+    @staticmethod
+    def _matches(labels: LabelSet, filters: Dict[str, Any]) -> bool:
+        label_map = dict(labels)
+        return all(label_map.get(k) == str(v) for k, v in filters.items())
+
+    def counter_by(self, name: str, label: str, counters: Optional[Dict[SeriesKey, float]] = None,
+                   **filters) -> Dict[str, float]:
+        """Totales de un contador agrupados por una etiqueta"""
+        if counters is None:
+            counters, _ = self.collect()
+        totals: Dict[str, float] = {}
+        for (metric, labels), value in counters.items():
+            if metric == name and self._matches(labels, filters):
+                group = dict(labels).get(label, '')
+                totals[group] = totals.get(group, 0.0) + value
+        return totals
+
+    def histogram_by(self, name: str, label: str,
+                     histograms: Optional[Dict[SeriesKey, Histogram]] = None) -> Dict[str, Histogram]:
+        """Histogramas fusionados agrupados por una etiqueta"""
+        if histograms is None:
+            _, histograms = self.collect()
+        grouped: Dict[str, Histogram] = {}
+        for (metric, labels), histogram in histograms.items():
+            if metric == name:
+                grouped.setdefault(dict(labels).get(label, ''), Histogram()).merge(histogram)
+        return grouped
+
+    def summary(self) -> Dict[str, Any]:
+        """Percentiles por agente, proveedor y etapa"""
+        counters, histograms = self.collect()
+
+        def summarize(name, label):
+            return {group: h.summary() for group, h in sorted(self.histogram_by(name, label, histograms).items())}
+
+        return {
+            'agents': summarize('agent_request_duration_seconds', 'agent'),
+            'providers': summarize('llm_request_duration_seconds', 'provider'),
+            'ttft': summarize('llm_ttft_seconds', 'provider'),
+            'stages': summarize('chat_stage_duration_seconds', 'stage'),
+            'provider_outcomes': {
+                provider: self.counter_by('llm_requests_total', 'outcome', counters, provider=provider)
+                for provider in sorted(self.counter_by('llm_requests_total', 'provider', counters))
+            },
+            'aggregated': self.redis_client is not None,
+        }
+
+    # Exposición Prometheus
+
+    @staticmethod
+    def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+        items = [
+            f'{k}="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for k, v in labels
+        ]
+        return '{' + ','.join(items) + '}' if items else ''
+
+    def render_prometheus(self) -> str:
+        """Formato de texto de Prometheus (versión 0.0.4)"""
+        counters, histograms = self.collect()
+        lines: List[str] = []
+
+        by_name: Dict[str, List] = {}
+        for (name, labels), value in counters.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), histogram in histograms.items():
+            by_name.setdefault(name, []).append((labels, histogram))
+
+        for name in sorted(by_name):
+            kind, help_text = METRIC_HELP.get(
+                name, ('histogram' if isinstance(by_name[name][0][1], Histogram) else 'counter', name)
+            )
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if not isinstance(value, Histogram):
+                    lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+                    continue
+                cumulative = 0
+                for index, count in enumerate(value.counts[:-1]):
+                    cumulative += count
+                    if index % EXPORT_STRIDE == 0:
+                        le = self._format_labels(labels + (('le', f"{BUCKET_BOUNDS[index]:g}"),))
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                le = self._format_labels(labels + (('le', '+Inf'),))
+                lines.append(f"{name}_bucket{le} {value.count}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {value.total:g}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {value.count}")
+
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Borrar las métricas (también las agregadas en Redis)"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._pending_counters.clear()
+            self._pending_histograms.clear()
+        if self.redis_client is not None:
+            try:
+                series = self.redis_client.smembers(self._series_index_key())
+                keys = [self._counters_key(), self._series_index_key()]
+                keys.extend(self._histogram_key(s) for s in series)
+                self.redis_client.delete(*keys)
+            except Exception as e:
+                self.logger.warning(f"Error reiniciando métricas en Redis: {e}")
+
+    def shutdown(self):
+        self._stop.set()
+        self.flush()
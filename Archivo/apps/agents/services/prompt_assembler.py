@@ -0,0 +1,223 @@
+"""
+Prompt Assembler - Construcción del prompt dentro de un presupuesto de tokens
+
+Antes se construía el prompt completo, se tokenizaba entero y, si superaba
+3000 tokens, se volvía a tokenizar y se truncaba a 2000 (pudiendo cortar la
+consulta del usuario, que va al final). El ensamblador recibe secciones con
+prioridad, tokeniza cada una una sola vez y las empaqueta de forma voraz en
+el presupuesto del modelo; la consulta siempre se conserva.
+"""
+
+import os
+import logging
+import threading
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PromptSection:
+    """
+    Fragmento del prompt.
+
+    Args:
+        name: Identificador de la sección ('query', 'history', 'documents'...)
+        text: Contenido de la sección
+        header: Cabecera fija (su conteo se cachea y nunca se trunca)
+        priority: Menor valor = más importante; se empaqueta antes
+        required: Se incluye siempre, aunque no quepa
+        truncate: 'tail' conserva el principio, 'head' conserva el final
+                  (historial: los mensajes más recientes); None = no truncable
+        static: El contenido se repite entre peticiones (se cachea su conteo)
+    """
+
+    __slots__ = ('name', 'text', 'header', 'priority', 'required', 'truncate', 'static', 'order')
+
+    def __init__(self, name: str, text: str, header: str = '', priority: int = 100,
+                 required: bool = False, truncate: Optional[str] = 'tail', static: bool = False):
+        self.name = name
+        self.text = text
+        self.header = header
+        self.priority = priority
+        self.required = required
+        self.truncate = truncate
+        self.static = static
+        self.order = 0
+
+
+class AssembledPrompt:
+    """Resultado del ensamblado"""
+
+    __slots__ = ('system_prompt', 'prompt', 'system_tokens', 'prompt_tokens', 'included', 'truncated', 'dropped')
+
+    def __init__(self, system_prompt: str, prompt: str, system_tokens: int, prompt_tokens: int,
+                 included: List[str], truncated: List[str], dropped: List[str]):
+        self.system_prompt = system_prompt
+        self.prompt = prompt
+        self.system_tokens = system_tokens
+        self.prompt_tokens = prompt_tokens
+        self.included = included
+        self.truncated = truncated
+        self.dropped = dropped
+
+    @property
+    def total_tokens(self) -> int:
+        return self.system_tokens + self.prompt_tokens
+
+
+class PromptAssembler:
+    """
+    Empaqueta secciones priorizadas en un presupuesto de tokens por modelo.
+
+    Configuración (variables de entorno):
+    - PROMPT_TOKEN_BUDGET: tokens de entrada por defecto (sistema + prompt)
+    - PROMPT_TOKEN_BUDGETS: presupuestos por modelo, ej. "gpt-4-turbo=6000,claude-3-sonnet-20240229=6000"
+    - PROMPT_MIN_SECTION_TOKENS: tamaño mínimo de una sección truncada (si no, se descarta)
+    """
+
+    STATIC_CACHE_SIZE = 256
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.default_budget = int(os.getenv('PROMPT_TOKEN_BUDGET', 3000))
+        self.model_budgets = self._parse_budgets(os.getenv('PROMPT_TOKEN_BUDGETS', ''))
+        self.min_section_tokens = int(os.getenv('PROMPT_MIN_SECTION_TOKENS', 32))
+
+        self._lock = threading.Lock()
+        self._static_counts: Dict[str, int] = {}
+
+    @staticmethod
+    def _parse_budgets(raw: str) -> Dict[str, int]:
+        budgets = {}
+        for item in raw.split(','):
+            if '=' not in item:
+                continue
+            model, budget = item.split('=', 1)
+            try:
+                budgets[model.strip()] = int(budget)
+            except ValueError:
+                logger.warning(f"Presupuesto de tokens inválido para {model.strip()}: {budget}")
+        return budgets
+
+    def budget_for(self, model: Optional[str]) -> int:
+        """Presupuesto de tokens de entrada para un modelo"""
+        return self.model_budgets.get(model, self.default_budget)
+
+    # Tokenización
+
+    def _encode(self, text: str) -> Optional[List[int]]:
+        try:
+            return self.encoding.encode(text)
+        except Exception as e:
+            logger.error(f"Error tokenizando sección del prompt: {e}")
+            return None
+
+    @staticmethod
+    def _estimate(text: str) -> int:
+        # Aproximación si el tokenizer falla (~4 caracteres por token)
+        return len(text) // 4 + 1
+
+    def count_static(self, text: str) -> int:
+        """Conteo de tokens cacheado para textos que no cambian (prompts de sistema)"""
+        count = self._static_counts.get(text)
+        if count is not None:
+            return count
+
+        tokens = self._encode(text)
+        count = len(tokens) if tokens is not None else self._estimate(text)
+        with self._lock:
+            if len(self._static_counts) >= self.STATIC_CACHE_SIZE:
+                self._static_counts.pop(next(iter(self._static_counts)))
+            self._static_counts[text] = count
+        return count
+
+    def _truncate(self, section: PromptSection, tokens: Optional[List[int]], limit: int) -> str:
+        if tokens is None:
+            chars = limit * 4
+            text = section.text[-chars:] if section.truncate == 'head' else section.text[:chars]
+        elif section.truncate == 'head':
+            text = self.encoding.decode(tokens[-limit:])
+        else:
+            text = self.encoding.decode(tokens[:limit])
+        text = "..." + text if section.truncate == 'head' else text + "..."
+        return section.header + text
+
+    # Ensamblado
+
+    def assemble(self, system_prompt: str, sections: List[PromptSection],
+                 model: Optional[str] = None, budget: Optional[int] = None) -> AssembledPrompt:
+        """
+        Empaquetar las secciones en el presupuesto.
+
+        Las secciones requeridas entran siempre; el resto se añade por prioridad
+        mientras quepa (truncando la última si se permite). El texto final
+        respeta el orden original de las secciones.
+
+        Args:
+            system_prompt: Prompt de sistema del agente (conteo cacheado)
+            sections: Secciones en el orden en que deben aparecer
+            model: Modelo destino (determina el presupuesto)
+            budget: Presupuesto explícito; 0 o negativo = sin límite
+        """
+        if budget is None:
+            budget = self.budget_for(model)
+        unlimited = budget <= 0
+
+        system_tokens = self.count_static(system_prompt)
+        remaining = budget - system_tokens
+
+        chosen: Dict[str, str] = {}
+        counts: Dict[str, int] = {}
+        truncated: List[str] = []
+        dropped: List[str] = []
+
+        for index, section in enumerate(sections):
+            section.order = index
+
+        # Primero las requeridas (la consulta), después por prioridad
+        ranked = sorted(
+            (s for s in sections if s.text),
+            key=lambda s: (not s.required, s.priority, s.order)
+        )
+        for section in ranked:
+            header_tokens = self.count_static(section.header) if section.header else 0
+            if section.static:
+                tokens = None
+                count = header_tokens + self.count_static(section.text)
+            else:
+                # Cada sección dinámica se tokeniza una única vez
+                tokens = self._encode(section.text)
+                count = header_tokens + (len(tokens) if tokens is not None else self._estimate(section.text))
+
+            if unlimited or section.required or count <= remaining:
+                chosen[section.name] = section.header + section.text
+                counts[section.name] = count
+                remaining -= count
+                continue
+
+            body_limit = remaining - header_tokens
+            if section.truncate and body_limit >= self.min_section_tokens:
+                if tokens is None:
+                    tokens = self._encode(section.text)
+                chosen[section.name] = self._truncate(section, tokens, body_limit)
+                counts[section.name] = remaining
+                truncated.append(section.name)
+                remaining = 0
+                continue
+
+            dropped.append(section.name)
+
+        included = [s.name for s in sections if s.name in chosen]
+        prompt = "\n".join(chosen[name] for name in included)
+
+        if truncated or dropped:
+            logger.info(
+                f"Prompt ajustado a {budget} tokens - truncadas: {truncated or '-'}, "
+                f"descartadas: {dropped or '-'}"
+            )
+
+        return AssembledPrompt(
+            system_prompt, prompt, system_tokens, sum(counts.values()),
+            included, truncated, dropped
+        )
+
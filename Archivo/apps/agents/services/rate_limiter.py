@@ -0,0 +1,404 @@
+"""
+Rate Limiter - Token bucket por proveedor y modelo con admisión en cola
+
+Sin límite propio, una ráfaga (toda una clase abriendo el tutor a la vez)
+producía tormentas de 429 que acababan en fallbacks inútiles. El limitador
+mantiene dos cubetas por (proveedor, modelo), peticiones/minuto y
+tokens/minuto, y hace esperar a las llamadas en una cola acotada con
+prioridades (el chat interactivo pasa antes que la calificación masiva) y
+plazo máximo. Con Redis las cubetas son comunes a todos los workers.
+
+El lock de la cola solo protege estructuras en memoria: la consulta a la
+cubeta (un EVAL con Redis) se hace fuera de él, y la versión async hace cada
+intento de admisión en un thread para no tocar Redis ni el lock desde el
+event loop.
+"""
+
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+
+from .errors import ProviderThrottledError
+
+logger = logging.getLogger(__name__)
+
+# Clases de prioridad: menor valor = se admite antes
+PRIORITIES = {
+    'interactive': 0,
+    'default': 1,
+    'batch': 2
+}
+
+
+class LocalQuota:
+    """Cubetas de peticiones y tokens en memoria del proceso (thread-safe)"""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.request_rate = requests_per_minute / 60.0
+        self.token_rate = tokens_per_minute / 60.0
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.request_level = float(requests_per_minute)
+        self.token_level = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.request_rate:
+            self.request_level = min(self.request_capacity, self.request_level + elapsed * self.request_rate)
+        if self.token_rate:
+            self.token_level = min(self.token_capacity, self.token_level + elapsed * self.token_rate)
+
+    def try_consume(self, tokens: int) -> float:
+        """Consumir 1 petición y `tokens` tokens; devuelve 0 o los segundos a esperar"""
+        with self._lock:
+            self._refill(time.monotonic())
+            # Una llamada mayor que la capacidad se admite con la cubeta llena
+            tokens = min(tokens, self.token_capacity) if self.token_rate else 0
+
+            wait = 0.0
+            if self.request_rate and self.request_level < 1:
+                wait = max(wait, (1 - self.request_level) / self.request_rate)
+            if self.token_rate and self.token_level < tokens:
+                wait = max(wait, (tokens - self.token_level) / self.token_rate)
+            if wait > 0:
+                return wait
+
+            if self.request_rate:
+                self.request_level -= 1
+            if self.token_rate:
+                self.token_level -= tokens
+            return 0.0
+
+    def drain(self):
+        """El proveedor devolvió 429: vaciar las cubetas para que se rellenen al ritmo del cupo"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.request_level = min(self.request_level, 0.0)
+            self.token_level = min(self.token_level, 0.0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                'requests_available': round(self.request_level, 2) if self.request_rate else None,
+                'tokens_available': int(self.token_level) if self.token_rate else None
+            }
+
+
+class RedisQuota:
+    """Cubetas de peticiones y tokens compartidas por todos los workers (script Lua atómico)"""
+
+    CONSUME_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tokens = tonumber(ARGV[6])
+local wait = 0
+local levels = {}
+local specs = {
+    {KEYS[1], tonumber(ARGV[2]), tonumber(ARGV[3]), 1},
+    {KEYS[2], tonumber(ARGV[4]), tonumber(ARGV[5]), tokens}
+}
+for i, spec in ipairs(specs) do
+    local key, rate, capacity, need = spec[1], spec[2], spec[3], spec[4]
+    if rate > 0 then
+        local state = redis.call('HMGET', key, 'level', 'ts')
+        local level = tonumber(state[1]) or capacity
+        local ts = tonumber(state[2]) or now
+        level = math.min(capacity, level + math.max(0, now - ts) * rate)
+        levels[i] = level
+        if need > capacity then need = capacity end
+        spec[4] = need
+        if level < need then
+            wait = math.max(wait, (need - level) / rate)
+        end
+    end
+end
+if wait > 0 or ARGV[7] == 'drain' then
+    for i, spec in ipairs(specs) do
+        if spec[2] > 0 then
+            local level = levels[i]
+            if ARGV[7] == 'drain' then level = math.min(level, 0) end
+            redis.call('HSET', spec[1], 'level', level, 'ts', now)
+            redis.call('EXPIRE', spec[1], math.ceil(spec[3] / spec[2]) + 60)
+        end
+    end
+    return tostring(wait)
+end
+for i, spec in ipairs(specs) do
+    if spec[2] > 0 then
+        redis.call('HSET', spec[1], 'level', levels[i] - spec[4], 'ts', now)
+        redis.call('EXPIRE', spec[1], math.ceil(spec[3] / spec[2]) + 60)
+    end
+end
+return '0'
+"""
+
+    def __init__(self, redis_client, key: str, requests_per_minute: float, tokens_per_minute: float):
+        self.redis_client = redis_client
+        self.keys = [f"{key}:requests", f"{key}:tokens"]
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._script = redis_client.register_script(self.CONSUME_SCRIPT)
+
+    def _call(self, tokens: int, mode: str = 'consume') -> float:
+        return float(self._script(keys=self.keys, args=[
+            time.time(),
+            self.requests_per_minute / 60.0, self.requests_per_minute,
+            self.tokens_per_minute / 60.0, self.tokens_per_minute,
+            tokens, mode
+        ]))
+
+    def try_consume(self, tokens: int) -> float:
+        return self._call(tokens)
+
+    def drain(self):
+        self._call(0, 'drain')
+
+    def snapshot(self) -> Dict[str, Any]:
+        levels = [self.redis_client.hget(key, 'level') for key in self.keys]
+        return {
+            'requests_available': round(float(levels[0]), 2) if levels[0] is not None else None,
+            'tokens_available': int(float(levels[1])) if levels[1] is not None else None,
+            'shared': True
+        }
+
+
+class ProviderRateLimiter:
+    """
+    Limitador compartido por (proveedor, modelo) con cola de admisión.
+
+    Configuración (variables de entorno, 0 = sin límite):
+    - OPENAI_REQUESTS_PER_MINUTE / OPENAI_TOKENS_PER_MINUTE
+    - CLAUDE_REQUESTS_PER_MINUTE / CLAUDE_TOKENS_PER_MINUTE
+    - LLM_RATE_LIMIT_REDIS: compartir las cubetas entre workers
+    - LLM_RATE_LIMIT_MAX_QUEUE: llamadas máximas esperando turno
+    - LLM_RATE_LIMIT_MAX_WAIT: plazo máximo de espera (segundos) del chat interactivo
+    - LLM_RATE_LIMIT_BATCH_MAX_WAIT: plazo máximo de espera de los procesos por lotes
+    """
+
+    REDIS_PREFIX = 'llm_rate'
+
+    def __init__(self, redis_client=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.limits = {
+            'openai': (
+                float(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 0)),
+                float(os.getenv('OPENAI_TOKENS_PER_MINUTE', 0))
+            ),
+            'claude': (
+                float(os.getenv('CLAUDE_REQUESTS_PER_MINUTE', 0)),
+                float(os.getenv('CLAUDE_TOKENS_PER_MINUTE', 0))
+            )
+        }
+        self.max_queue = int(os.getenv('LLM_RATE_LIMIT_MAX_QUEUE', 200))
+        self.max_wait = {
+            'interactive': float(os.getenv('LLM_RATE_LIMIT_MAX_WAIT', 10)),
+            'default': float(os.getenv('LLM_RATE_LIMIT_MAX_WAIT', 10)),
+            'batch': float(os.getenv('LLM_RATE_LIMIT_BATCH_MAX_WAIT', 120))
+        }
+
+        self.redis_client = redis_client
+        if self.redis_client is None and os.getenv('LLM_RATE_LIMIT_REDIS', 'False').lower() == 'true':
+            try:
+                redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+                self.redis_client = redis.from_url(redis_url, decode_responses=True)
+            except Exception as e:
+                self.logger.warning(f"Error conectando a Redis para el rate limiter: {e}")
+
+        self._condition = threading.Condition()
+        self._quotas: Dict[Tuple[str, str], Any] = {}
+        # Cola de admisión por (proveedor, modelo): heap de (prioridad, orden, id)
+        self._queues: Dict[Tuple[str, str], List[Tuple[int, int]]] = {}
+        self._sequence = itertools.count()
+        self.stats = {
+            'admitted': 0,
+            'waited': 0,
+            'rejected_queue_full': 0,
+            'rejected_deadline': 0,
+            'provider_429': 0
+        }
+
+    def is_limited(self, provider: str) -> bool:
+        requests_per_minute, tokens_per_minute = self.limits.get(provider, (0, 0))
+        return bool(requests_per_minute or tokens_per_minute)
+
+    def _quota(self, key: Tuple[str, str]):
+        """Cubeta de (proveedor, modelo); llamar con el lock de la condición tomado"""
+        quota = self._quotas.get(key)
+        if quota is None:
+            requests_per_minute, tokens_per_minute = self.limits[key[0]]
+            if self.redis_client is not None:
+                quota = RedisQuota(
+                    self.redis_client, f"{self.REDIS_PREFIX}:{key[0]}:{key[1]}",
+                    requests_per_minute, tokens_per_minute
+                )
+            else:
+                quota = LocalQuota(requests_per_minute, tokens_per_minute)
+            self._quotas[key] = quota
+        return quota
+
+    # Cola de admisión (llamar con el lock de la condición tomado)
+
+    def _enqueue(self, key: Tuple[str, str], priority: str) -> Tuple[int, int]:
+        queue = self._queues.setdefault(key, [])
+        if len(queue) >= self.max_queue:
+            self.stats['rejected_queue_full'] += 1
+            raise ProviderThrottledError(key[0], f"Cola del rate limiter llena para {key[1]}")
+        entry = (PRIORITIES.get(priority, PRIORITIES['default']), next(self._sequence))
+        heapq.heappush(queue, entry)
+        return entry
+
+    def _dequeue(self, key: Tuple[str, str], entry: Tuple[int, int]):
+        queue = self._queues.get(key, [])
+        if entry in queue:
+            queue.remove(entry)
+            heapq.heapify(queue)
+        self._condition.notify_all()
+
+    # Pasos de admisión (toman el lock solo para la cola; también corren en threads para la API async)
+
+    def _join_queue(self, key: Tuple[str, str], priority: str) -> Tuple[int, int]:
+        with self._condition:
+            return self._enqueue(key, priority)
+
+    def _leave_queue(self, key: Tuple[str, str], entry: Tuple[int, int]):
+        with self._condition:
+            self._dequeue(key, entry)
+
+    def _try_admit(self, key: Tuple[str, str], entry: Tuple[int, int], tokens: int, waited: bool) -> float:
+        """0 si la llamada fue admitida; si no, segundos a esperar antes de reintentar"""
+        with self._condition:
+            # Solo la cabeza de la cola (mayor prioridad, más antigua) puede consumir
+            if self._queues[key][0] != entry:
+                return 0.05
+            quota = self._quota(key)
+
+        # Fuera del lock: con Redis es un round trip (EVAL del script)
+        try:
+            wait = quota.try_consume(tokens)
+        except Exception as e:
+            # Redis caído: no bloquear las llamadas por el limitador
+            self.logger.warning(f"Error en el rate limiter de {key[0]}: {e}")
+            wait = 0.0
+
+        if wait <= 0:
+            with self._condition:
+                # Pudo entrar otra de mayor prioridad mientras tanto: quitar esta, no la cabeza
+                self._dequeue(key, entry)
+                self.stats['admitted'] += 1
+                if waited:
+                    self.stats['waited'] += 1
+        return wait
+
+    def _reject_deadline(self, key: Tuple[str, str], entry: Tuple[int, int], max_wait: float):
+        with self._condition:
+            self._dequeue(key, entry)
+            self.stats['rejected_deadline'] += 1
+        raise ProviderThrottledError(
+            key[0], f"Cupo de {key[1]} agotado: sin turno en {max_wait:.0f}s"
+        )
+
+    # API pública
+
+    def acquire(self, provider: str, model: str, tokens: int,
+                priority: str = 'interactive', max_wait: Optional[float] = None):
+        """
+        Esperar turno para una llamada de `tokens` tokens estimados.
+
+        Raises:
+            ProviderThrottledError: Cola llena o plazo de espera agotado
+        """
+        if not self.is_limited(provider):
+            return
+
+        key = (provider, model)
+        max_wait = self.max_wait.get(priority, self.max_wait['default']) if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        waited = False
+
+        entry = self._join_queue(key, priority)
+        try:
+            while True:
+                wait = self._try_admit(key, entry, tokens, waited)
+                if wait <= 0:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._reject_deadline(key, entry, max_wait)
+                waited = True
+                with self._condition:
+                    self._condition.wait(min(wait, remaining))
+        except BaseException:
+            self._leave_queue(key, entry)
+            raise
+
+    async def aacquire(self, provider: str, model: str, tokens: int,
+                       priority: str = 'interactive', max_wait: Optional[float] = None):
+        """
+        Versión async de acquire. Cada paso que toca la cola o la cubeta corre en
+        un thread (asyncio.to_thread); en el event loop solo se duerme entre intentos.
+        """
+        if not self.is_limited(provider):
+            return
+
+        key = (provider, model)
+        max_wait = self.max_wait.get(priority, self.max_wait['default']) if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        waited = False
+
+        entry = await asyncio.to_thread(self._join_queue, key, priority)
+        try:
+            while True:
+                wait = await asyncio.to_thread(self._try_admit, key, entry, tokens, waited)
+                if wait <= 0:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    await asyncio.to_thread(self._reject_deadline, key, entry, max_wait)
+                waited = True
+                # Sondeo corto: la cabeza de la cola puede cambiar mientras se espera
+                await asyncio.sleep(min(wait, remaining, 0.25))
+        except asyncio.CancelledError:
+            # Sin esperar: la tarea ya está cancelada
+            asyncio.get_running_loop().run_in_executor(None, self._leave_queue, key, entry)
+            raise
+
+    def report_rate_limited(self, provider: str, model: str):
+        """El proveedor respondió 429 pese al limitador: vaciar las cubetas"""
+        if not self.is_limited(provider):
+            return
+        with self._condition:
+            self.stats['provider_429'] += 1
+            quota = self._quota((provider, model))
+        try:
+            quota.drain()
+        except Exception as e:
+            self.logger.warning(f"Error vaciando cubeta de {provider}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._condition:
+            stats = dict(self.stats)
+            stats['queued'] = {f"{p}:{m}": len(q) for (p, m), q in self._queues.items() if q}
+            quotas = dict(self._quotas)
+        stats['buckets'] = {}
+        for (provider, model), quota in quotas.items():
+            try:
+                stats['buckets'][f"{provider}:{model}"] = quota.snapshot()
+            except Exception as e:
+                stats['buckets'][f"{provider}:{model}"] = {'error': str(e)}
+        stats['limits'] = {
+            provider: {'requests_per_minute': rpm, 'tokens_per_minute': tpm}
+            for provider, (rpm, tpm) in self.limits.items()
+        }
+        stats['shared'] = self.redis_client is not None
+        return stats
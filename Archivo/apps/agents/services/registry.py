@@ -0,0 +1,414 @@
+"""
+Service Registry - Registro de servicios compartidos a nivel de proceso
+
+DRF instancia cada vista por petición, así que cualquier servicio creado en
+``__init__`` (AgentManager, EnhancedRAGService) se reconstruía en cada request.
+Este módulo mantiene una única instancia por proceso de cada servicio costoso,
+construida de forma perezosa y thread-safe la primera vez que se solicita.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceRegistry:
+    """
+    Registro thread-safe de servicios compartidos por todas las vistas del proceso.
+
+    Funcionalidades:
+    - Construcción perezosa y única (double-checked locking por servicio)
+    - Warm-up explícito para precargar servicios al arrancar el worker
+    - Shutdown ordenado (orden inverso de construcción)
+    - Backoff tras un fallo de construcción: durante el plazo de reintento se
+      relanza el mismo error sin volver a llamar a la fábrica
+
+    Configuración (variables de entorno):
+    - SERVICE_RETRY_AFTER_SECONDS: espera tras el primer fallo de una fábrica
+    - SERVICE_RETRY_MAX_SECONDS: espera máxima (se duplica en cada fallo seguido)
+    """
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._shutdown_hooks: Dict[str, Optional[Callable[[Any], None]]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._build_order: list = []
+        self._service_locks: Dict[str, threading.Lock] = {}
+        self._failures: Dict[str, Tuple[Exception, float, float]] = {}
+        self._lock = threading.Lock()
+        self.retry_after = float(os.getenv('SERVICE_RETRY_AFTER_SECONDS', 30))
+        self.retry_max = float(os.getenv('SERVICE_RETRY_MAX_SECONDS', 300))
+
+    def register(self, name: str, factory: Callable[[], Any],
+                 shutdown: Optional[Callable[[Any], None]] = None):
+        """
+        Registrar la fábrica de un servicio
+
+        Args:
+            name: Nombre del servicio
+            factory: Callable sin argumentos que construye el servicio
+            shutdown: Hook opcional para liberar recursos del servicio
+        """
+        with self._lock:
+            self._factories[name] = factory
+            self._shutdown_hooks[name] = shutdown
+            self._service_locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str) -> Any:
+        """
+        Obtener la instancia compartida de un servicio, construyéndola si es necesario
+
+        Raises:
+            KeyError: Si el servicio no está registrado
+            Exception: El error de la fábrica; se relanza sin reintentar hasta
+                que pase el plazo de backoff
+        """
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+
+        if name not in self._factories:
+            raise KeyError(f"Servicio '{name}' no registrado")
+        self._raise_if_backing_off(name)
+
+        # Un lock por servicio: construir el RAG no bloquea al AgentManager
+        with self._service_locks[name]:
+            instance = self._instances.get(name)
+            if instance is None:
+                self._raise_if_backing_off(name)
+                logger.info(f"Construyendo servicio compartido: {name}")
+                try:
+                    instance = self._factories[name]()
+                except Exception as e:
+                    self._record_failure(name, e)
+                    raise
+                with self._lock:
+                    self._instances[name] = instance
+                    self._build_order.append(name)
+                    self._failures.pop(name, None)
+        return instance
+
+    def _raise_if_backing_off(self, name: str):
+        failure = self._failures.get(name)
+        if failure is not None and time.monotonic() < failure[1]:
+            raise failure[0]
+
+    def _record_failure(self, name: str, error: Exception):
+        with self._lock:
+            previous = self._failures.get(name)
+            delay = min(previous[2] * 2, self.retry_max) if previous else self.retry_after
+            self._failures[name] = (error, time.monotonic() + delay, delay)
+        logger.error(f"Error construyendo servicio {name} (reintento en {delay:.0f}s): {error}")
+
+    def is_initialized(self, name: str) -> bool:
+        """Verificar si un servicio ya fue construido"""
+        return name in self._instances
+
+    def warm_up(self, names: Optional[Iterable[str]] = None) -> Dict[str, bool]:
+        """
+        Precargar servicios para que la primera petición no pague la inicialización
+
+        Args:
+            names: Servicios a precargar (por defecto todos los registrados)
+
+        Returns:
+            Dict con el resultado de la carga de cada servicio
+        """
+        results = {}
+        for name in list(names or self._factories.keys()):
+            try:
+                self.get(name)
+                results[name] = True
+            except Exception as e:
+                logger.error(f"Error precargando servicio {name}: {e}")
+                results[name] = False
+        return results
+
+    def shutdown(self):
+        """Liberar todos los servicios construidos en orden inverso"""
+        with self._lock:
+            build_order = list(reversed(self._build_order))
+            instances = dict(self._instances)
+            self._instances.clear()
+            self._build_order.clear()
+
+        for name in build_order:
+            instance = instances.get(name)
+            hook = self._shutdown_hooks.get(name)
+            try:
+                if hook:
+                    hook(instance)
+                elif hasattr(instance, 'shutdown'):
+                    instance.shutdown()
+                elif hasattr(instance, 'close'):
+                    instance.close()
+                logger.info(f"Servicio compartido liberado: {name}")
+            except Exception as e:
+                logger.warning(f"Error liberando servicio {name}: {e}")
+
+
+def _build_agent_manager():
+    from .agent_manager import AgentManager
+    manager = AgentManager()
+    manager.response_cache = get_response_cache()
+    manager.single_flight = get_single_flight()
+    if os.getenv('SEMANTIC_ROUTING_ENABLED', 'False').lower() == 'true':
+        manager.semantic_router = _build_semantic_router(manager.routing_config)
+
+    # Agentes a construir por adelantado (el resto se construye al primer uso)
+    preload = [a.strip() for a in os.getenv('AGENTS_PRELOAD', '').split(',') if a.strip()]
+    if preload:
+        manager.preload_agents(preload)
+    return manager
+
+
+def _build_semantic_router(routing_config):
+    from .semantic_router import SemanticRouter
+
+    # Los centroides se calculan una vez con el SentenceTransformer del RAG
+    rag_service = get_rag_service()
+    if rag_service is None:
+        logger.warning("Routing semántico desactivado: servicio RAG no disponible")
+        return None
+    try:
+        return SemanticRouter(rag_service.embedding_model.encode, routing_config)
+    except Exception as e:
+        logger.warning(f"Routing semántico desactivado: {e}")
+        return None
+
+
+def _build_llm_clients():
+    from .llm_clients import LLMClientProvider
+    return LLMClientProvider()
+
+
+def _build_circuit_breakers():
+    from .circuit_breaker import CircuitBreakerRegistry
+    shared = os.getenv('LLM_BREAKER_REDIS', 'False').lower() == 'true'
+    return CircuitBreakerRegistry(get_redis_client() if shared else None)
+
+
+def _build_prompt_assembler():
+    from .prompt_assembler import PromptAssembler
+    return PromptAssembler(get_llm_clients().encoding)
+
+
+def _build_rate_limiter():
+    from .rate_limiter import ProviderRateLimiter
+    return ProviderRateLimiter()
+
+
+def _build_single_flight():
+    from .single_flight import SingleFlight
+    return SingleFlight()
+
+
+def _build_health_monitor():
+    from .health import HealthMonitor
+    monitor = HealthMonitor()
+    monitor.start()
+    return monitor
+
+
+def _build_metrics():
+    from .metrics import MetricsRegistry
+    return MetricsRegistry()
+
+
+def _build_tracer():
+    from .tracing import Tracer
+    return Tracer()
+
+
+def _build_response_cache():
+    from .response_cache import SemanticResponseCache
+
+    def embed(texts):
+        # Reutiliza el SentenceTransformer ya cargado por el servicio RAG
+        rag_service = get_rag_service()
+        if rag_service is None:
+            raise RuntimeError("Servicio RAG no disponible para embeddings")
+        return rag_service.embedding_model.encode(texts)
+
+    return SemanticResponseCache(embed)
+
+
+def _build_redis_client():
+    import redis
+    pool = redis.ConnectionPool.from_url(
+        os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+        decode_responses=False,
+        max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+def _build_context_cache():
+    from .context_cache import ConversationContextCache
+    context_cache = ConversationContextCache(get_redis_client())
+    context_cache.start()
+    return context_cache
+
+
+def _build_rag_service():
+    from rag.services.enhanced_rag import EnhancedRAGService
+    from .tracing import span
+    return EnhancedRAGService(span=span)
+
+
+registry = ServiceRegistry()
+registry.register('llm_clients', _build_llm_clients)
+registry.register('redis', _build_redis_client)
+registry.register('context_cache', _build_context_cache)
+registry.register('agent_manager', _build_agent_manager)
+registry.register('rag_service', _build_rag_service)
+registry.register('response_cache', _build_response_cache)
+registry.register('single_flight', _build_single_flight)
+registry.register('circuit_breakers', _build_circuit_breakers)
+registry.register('prompt_assembler', _build_prompt_assembler)
+registry.register('rate_limiter', _build_rate_limiter)
+registry.register('tracer', _build_tracer)
+registry.register('metrics', _build_metrics)
+registry.register('health_monitor', _build_health_monitor)
+
+atexit.register(registry.shutdown)
+
+
+def get_agent_manager():
+    """Obtener el AgentManager compartido del proceso"""
+    return registry.get('agent_manager')
+
+
+def get_llm_clients():
+    """Obtener el proveedor compartido de clientes LLM y tokenizer"""
+    return registry.get('llm_clients')
+
+
+def get_rag_service():
+    """
+    Obtener el EnhancedRAGService compartido del proceso
+
+    Returns:
+        La instancia compartida o None si el servicio RAG no está disponible
+        (tras un fallo no se reintenta construirlo hasta que pase el backoff)
+    """
+    try:
+        return registry.get('rag_service')
+    except Exception as e:
+        # El fallo ya se registró al construir; aquí solo se repite durante el backoff
+        logger.debug(f"Enhanced RAG Service no disponible: {e}")
+        return None
+
+
+def get_redis_client():
+    """
+    Obtener el cliente Redis compartido del proceso (un único pool de conexiones)
+
+    Es binario (decode_responses=False): la memoria conversacional guarda los
+    mensajes con una codificación compacta que no es texto.
+    """
+    return registry.get('redis')
+
+
+def get_context_cache():
+    """Obtener la caché en proceso de ventanas de conversación (invalidada por versión)"""
+    return registry.get('context_cache')
+
+
+_async_redis_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_async_redis_lock = threading.Lock()
+
+
+def get_async_redis_client():
+    """
+    Obtener el cliente redis.asyncio compartido del event loop actual
+
+    Las conexiones asyncio quedan ligadas al loop que las abrió, así que hay un
+    pool por loop (en un worker ASGI, uno solo para todo el proceso).
+    """
+    import asyncio
+    import redis.asyncio as aioredis
+
+    loop = asyncio.get_running_loop()
+    client = _async_redis_clients.get(loop)
+    if client is None:
+        with _async_redis_lock:
+            client = _async_redis_clients.get(loop)
+            if client is None:
+                pool = aioredis.ConnectionPool.from_url(
+                    os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+                    decode_responses=False,
+                    max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+                )
+                client = aioredis.Redis(connection_pool=pool)
+                _async_redis_clients[loop] = client
+    return client
+
+
+def get_circuit_breakers():
+    """Obtener los circuit breakers por proveedor compartidos del proceso"""
+    return registry.get('circuit_breakers')
+
+
+def get_prompt_assembler():
+    """Obtener el ensamblador de prompts compartido (cachea conteos de prompts estáticos)"""
+    return registry.get('prompt_assembler')
+
+
+def get_rate_limiter():
+    """Obtener el rate limiter por proveedor/modelo compartido del proceso"""
+    return registry.get('rate_limiter')
+
+
+def get_single_flight():
+    """Obtener la capa de coalescencia de consultas compartida del proceso"""
+    return registry.get('single_flight')
+
+
+def get_health_monitor():
+    """Obtener el monitor de salud del proceso (instantánea refrescada en segundo plano)"""
+    return registry.get('health_monitor')
+
+
+def get_metrics():
+    """Obtener el registro de métricas compartido del proceso (agregado entre workers)"""
+    return registry.get('metrics')
+
+
+def get_tracer():
+    """Obtener el tracer compartido del proceso (muestreo y exportación de spans)"""
+    return registry.get('tracer')
+
+
+def get_response_cache():
+    """Obtener la caché semántica de respuestas compartida"""
+    return registry.get('response_cache')
+
+
+def warm_up(names: Optional[Iterable[str]] = None) -> Dict[str, bool]:
+    """Precargar los servicios compartidos del proceso"""
+    return registry.warm_up(names)
+
+
+def shutdown():
+    """Liberar los servicios compartidos del proceso"""
+    registry.shutdown()
+
+
+def warm_up_on_startup():
+    """
+    Lanzar el warm-up en segundo plano si AGENTS_WARMUP_ON_STARTUP está activo.
+    Se invoca desde AgentsConfig.ready() para no bloquear el arranque del worker.
+    """
+    if os.getenv('AGENTS_WARMUP_ON_STARTUP', 'False').lower() != 'true':
+        return None
+
+    thread = threading.Thread(target=warm_up, name='agents-warmup', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,344 @@
+"""
+Response Cache - Caché semántica de respuestas de los agentes
+
+Muchos estudiantes hacen preguntas casi idénticas sobre el mismo material
+("explícame las fracciones"). Esta caché se consulta antes de llamar al LLM:
+la clave combina el agente, el embedding normalizado de la consulta y una
+huella de los documentos recuperados, de modo que una consulta parecida sobre
+los mismos documentos reutiliza la respuesta en milisegundos.
+
+Un seguimiento ("sí", "continúa") depende del historial de quien lo envía,
+así que la huella del historial también forma parte del bucket: solo se
+comparten respuestas entre conversaciones con el mismo historial (en la
+práctica, las primeras preguntas).
+
+Dos niveles:
+- Local (en proceso): LRU acotado con TTL
+- Redis (opcional): compartido entre workers, un hash por bucket con TTL
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import redis
+
+from .text_utils import fingerprint_context, fingerprint_history, normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    """Respuesta cacheada con el embedding de la consulta que la generó"""
+
+    __slots__ = ('key', 'bucket', 'embedding', 'response', 'agent_name', 'created_at')
+
+    def __init__(self, key: str, bucket: str, embedding: np.ndarray, response: str,
+                 agent_name: str, created_at: float):
+        self.key = key
+        self.bucket = bucket
+        self.embedding = embedding
+        self.response = response
+        self.agent_name = agent_name
+        self.created_at = created_at
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'embedding': self.embedding.astype(float).round(6).tolist(),
+            'response': self.response,
+            'agent_name': self.agent_name,
+            'created_at': self.created_at
+        })
+
+    @classmethod
+    def from_json(cls, key: str, bucket: str, raw: str) -> 'CacheEntry':
+        data = json.loads(raw)
+        return cls(
+            key, bucket,
+            np.asarray(data['embedding'], dtype=np.float32),
+            data['response'],
+            data.get('agent_name', ''),
+            float(data.get('created_at', 0))
+        )
+
+
+class SemanticResponseCache:
+    """
+    Caché semántica de respuestas (local + Redis).
+
+    Configuración (variables de entorno):
+    - RESPONSE_CACHE_ENABLED: activar la caché
+    - RESPONSE_CACHE_SIMILARITY: similitud coseno mínima para un hit
+    - RESPONSE_CACHE_TTL: segundos de vida de una respuesta cacheada
+    - RESPONSE_CACHE_MAX_ENTRIES: tamaño máximo del nivel local (LRU)
+    - RESPONSE_CACHE_REDIS: usar el nivel Redis compartido
+    - RESPONSE_CACHE_REDIS_BUCKET_SIZE: respuestas máximas por bucket en Redis
+    """
+
+    REDIS_PREFIX = 'response_cache'
+    # Consultas recientes cuyo embedding se recuerda entre lookup() y store()
+    EMBEDDING_MEMO_SIZE = 256
+
+    def __init__(self, embed_fn: Callable[[List[str]], Any], redis_client=None):
+        """
+        Args:
+            embed_fn: Función que devuelve embeddings para una lista de textos
+                      (se reutiliza el SentenceTransformer del RAG)
+            redis_client: Cliente Redis (opcional)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.embed_fn = embed_fn
+
+        self.enabled = os.getenv('RESPONSE_CACHE_ENABLED', 'False').lower() == 'true'
+        self.similarity_threshold = float(os.getenv('RESPONSE_CACHE_SIMILARITY', 0.95))
+        self.ttl = int(os.getenv('RESPONSE_CACHE_TTL', 3600))
+        self.max_entries = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+        self.redis_bucket_size = int(os.getenv('RESPONSE_CACHE_REDIS_BUCKET_SIZE', 200))
+
+        self.redis_client = redis_client
+        if self.redis_client is None and self.enabled \
+                and os.getenv('RESPONSE_CACHE_REDIS', 'True').lower() == 'true':
+            self.redis_client = self._init_redis_client()
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._buckets: Dict[str, List[str]] = {}
+        # Embeddings calculados por lookup() para que store() no vuelva a codificar la consulta
+        self._embeddings: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+        self.stats = {
+            'local_hits': 0,
+            'redis_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'errors': 0
+        }
+
+    def _init_redis_client(self):
+        try:
+            redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+            return redis.from_url(redis_url, decode_responses=True)
+        except Exception as e:
+            self.logger.warning(f"Error conectando a Redis para la caché de respuestas: {e}")
+            return None
+
+    # Claves
+
+    def _bucket(self, agent_id: str, context: Dict[str, Any]) -> str:
+        history = fingerprint_history(context)
+        bucket = f"{agent_id}:{fingerprint_context(context)}"
+        return f"{bucket}:{history}" if history else bucket
+
+    def _embed(self, query: str, context: Dict[str, Any]) -> np.ndarray:
+        """
+        Embedding normalizado de la consulta tal cual la escribió el usuario: el
+        mismo texto con el que la etapa RAG calcula context['query_embedding'],
+        que se reutiliza si existe. Si no, se calcula una vez y se recuerda para
+        el store() de la misma consulta (el contexto del llamador no se toca).
+        """
+        embedding = context.get('query_embedding')
+        if embedding is None:
+            with self._lock:
+                embedding = self._embeddings.get(query)
+                if embedding is not None:
+                    self._embeddings.move_to_end(query)
+            if embedding is None:
+                embedding = self.embed_fn([query])[0]
+                with self._lock:
+                    self._embeddings[query] = embedding
+                    while len(self._embeddings) > self.EMBEDDING_MEMO_SIZE:
+                        self._embeddings.popitem(last=False)
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    # API pública
+
+    def lookup(self, query: str, agent_id: str, context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Buscar una respuesta cacheada semánticamente equivalente
+
+        Args:
+            context: Contexto de la petición (reutiliza su 'query_embedding' si lo tiene)
+
+        Returns:
+            Dict con 'response', 'agent_name', 'similarity' y 'tier', o None
+        """
+        if not self.enabled:
+            return None
+
+        try:
+            bucket = self._bucket(agent_id, context)
+            embedding = self._embed(query, context)
+
+            result = self._lookup_local(bucket, embedding)
+            tier = 'local'
+            if result is None and self.redis_client is not None:
+                result = self._lookup_redis(bucket, embedding)
+                tier = 'redis'
+
+            with self._lock:
+                if result is None:
+                    self.stats['misses'] += 1
+                    return None
+                self.stats[f'{tier}_hits'] += 1
+
+            entry, similarity = result
+            return {
+                'response': entry.response,
+                'agent_name': entry.agent_name,
+                'similarity': round(float(similarity), 4),
+                'tier': tier
+            }
+        except Exception as e:
+            with self._lock:
+                self.stats['errors'] += 1
+            self.logger.warning(f"Error consultando la caché de respuestas: {e}")
+            return None
+
+    def store(self, query: str, agent_id: str, context: Dict[str, Any],
+              response: str, agent_name: str = ''):
+        """Guardar una respuesta del agente en ambos niveles"""
+        if not self.enabled or not response:
+            return
+
+        try:
+            bucket = self._bucket(agent_id, context)
+            normalized = normalize_query(query)
+            key = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+            entry = CacheEntry(key, bucket, self._embed(query, context), response, agent_name, time.time())
+
+            self._store_local(entry)
+            if self.redis_client is not None:
+                self._store_redis(entry)
+
+            with self._lock:
+                self.stats['stores'] += 1
+        except Exception as e:
+            with self._lock:
+                self.stats['errors'] += 1
+            self.logger.warning(f"Error guardando en la caché de respuestas: {e}")
+
+    def clear(self):
+        """Vaciar el nivel local"""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._embeddings.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas de hits/misses de la caché"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['local_entries'] = len(self._entries)
+        hits = stats['local_hits'] + stats['redis_hits']
+        lookups = hits + stats['misses']
+        stats['hit_rate'] = round(hits / lookups * 100, 2) if lookups else 0
+        stats['enabled'] = self.enabled
+        stats['redis_enabled'] = self.redis_client is not None
+        return stats
+
+    # Nivel local
+
+    def _best_match(self, entries: List[CacheEntry], embedding: np.ndarray):
+        if not entries:
+            return None
+        matrix = np.stack([entry.embedding for entry in entries])
+        similarities = matrix @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.similarity_threshold:
+            return entries[best], similarities[best]
+        return None
+
+    def _lookup_local(self, bucket: str, embedding: np.ndarray):
+        now = time.time()
+        with self._lock:
+            entries = []
+            for entry_id in list(self._buckets.get(bucket, [])):
+                entry = self._entries.get(entry_id)
+                if entry is None:
+                    continue
+                if now - entry.created_at > self.ttl:
+                    self._remove_local(entry_id)
+                    continue
+                entries.append(entry)
+
+            match = self._best_match(entries, embedding)
+            if match is not None:
+                self._entries.move_to_end(f"{bucket}:{match[0].key}")
+            return match
+
+    def _store_local(self, entry: CacheEntry):
+        entry_id = f"{entry.bucket}:{entry.key}"
+        with self._lock:
+            if entry_id not in self._entries:
+                self._buckets.setdefault(entry.bucket, []).append(entry_id)
+            self._entries[entry_id] = entry
+            self._entries.move_to_end(entry_id)
+
+            while len(self._entries) > self.max_entries:
+                oldest_id = next(iter(self._entries))
+                self._remove_local(oldest_id)
+                self.stats['evictions'] += 1
+
+    def _remove_local(self, entry_id: str):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        bucket_ids = self._buckets.get(entry.bucket)
+        if bucket_ids:
+            bucket_ids.remove(entry_id)
+            if not bucket_ids:
+                del self._buckets[entry.bucket]
+
+    # Nivel Redis
+
+    def _redis_key(self, bucket: str) -> str:
+        return f"{self.REDIS_PREFIX}:{bucket}"
+
+    def _lookup_redis(self, bucket: str, embedding: np.ndarray):
+        raw_entries = self.redis_client.hgetall(self._redis_key(bucket))
+        if not raw_entries:
+            return None
+
+        now = time.time()
+        entries = []
+        for key, raw in raw_entries.items():
+            try:
+                entry = CacheEntry.from_json(key, bucket, raw)
+            except (ValueError, KeyError):
+                continue
+            if now - entry.created_at <= self.ttl:
+                entries.append(entry)
+
+        match = self._best_match(entries, embedding)
+        if match is not None:
+            # Promover al nivel local para los siguientes hits
+            self._store_local(match[0])
+        return match
+
+    def _store_redis(self, entry: CacheEntry):
+        redis_key = self._redis_key(entry.bucket)
+        pipe = self.redis_client.pipeline()
+        pipe.hset(redis_key, entry.key, entry.to_json())
+        pipe.expire(redis_key, self.ttl)
+        pipe.hlen(redis_key)
+        _, _, size = pipe.execute()
+
+        if size > self.redis_bucket_size:
+            # Recortar el bucket eliminando las respuestas más antiguas
+            raw_entries = self.redis_client.hgetall(redis_key)
+            by_age = sorted(
+                raw_entries.items(),
+                key=lambda item: json.loads(item[1]).get('created_at', 0)
+            )
+            stale_keys = [key for key, _ in by_age[:size - self.redis_bucket_size]]
+            if stale_keys:
+                self.redis_client.hdel(redis_key, *stale_keys)
@@ -0,0 +1,135 @@
+"""
+Keyword Router - Routing por palabras clave compilado en una sola expresión
+
+_determine_best_agent recorría cada keyword de cada agente con `in` sobre la
+consulta: O(agentes × keywords × longitud) por petición, y con coincidencias a
+mitad de palabra ('nota' en 'anotar'). Aquí la tabla se compila una vez en una
+alternancia factorizada por prefijos, con límite de palabra al inicio y sobre
+texto sin acentos, y una sola pasada devuelve los puntajes de todos los
+agentes. Las consultas repetidas salen de una LRU.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from .text_utils import normalize_query as fold
+
+
+def trie_pattern(words) -> str:
+    """
+    Alternancia factorizada por prefijo común ('plan(?:ificar|ning)?' en vez de
+    'planificar|planning|plan'): el motor de `re` no construye un autómata, así
+    que con cientos de keywords una alternancia plana prueba cada una en cada
+    inicio de palabra. Los opcionales son voraces: gana la keyword más larga.
+    """
+    trie: Dict[str, Dict] = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node: Dict[str, Dict]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            body = '(?:' + body + ')?'
+        return body
+
+    return build(trie)
+
+
+class KeywordRouter:
+    """
+    Puntajes por agente en una pasada de una regex compilada como trie.
+
+    Una keyword coincide al inicio de una palabra y admite sufijos ('explicar'
+    cuenta en 'explicarme'); 'plan' dentro de 'planificar' sigue contando, como
+    con la búsqueda por subcadena, aunque la regex consuma la keyword más larga.
+
+    Configuración (variables de entorno):
+    - ROUTING_CACHE_SIZE: consultas recientes con su resultado en la LRU
+    """
+
+    def __init__(self, routing_config: Dict[str, Dict], cache_size: Optional[int] = None):
+        self.cache_size = cache_size if cache_size is not None else int(os.getenv('ROUTING_CACHE_SIZE', 1024))
+        self._cache: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.compile(routing_config)
+
+    def compile(self, routing_config: Dict[str, Dict]):
+        """(Re)compilar la tabla de routing"""
+        agent_order = list(routing_config)
+        keyword_agents: Dict[str, List[str]] = {}
+        for agent_id, config in routing_config.items():
+            for keyword in config['keywords']:
+                folded = fold(keyword)
+                if folded and agent_id not in keyword_agents.setdefault(folded, []):
+                    keyword_agents[folded].append(agent_id)
+
+        # Keywords contenidas en otra ('plan' en 'planificar'): la regex solo
+        # devuelve la más larga, así que se suman al encontrarla
+        prefixes: Dict[str, Set[str]] = {}
+        for keyword in keyword_agents:
+            prefixes[keyword] = {
+                other for other in keyword_agents
+                if other != keyword and other in keyword and re.search(r'\b' + re.escape(other), keyword)
+            }
+
+        pattern = re.compile(r'\b' + trie_pattern(keyword_agents)) if keyword_agents else None
+
+        with self._lock:
+            self.agent_order = agent_order
+            self.priority = {agent_id: 1.0 / config['priority'] for agent_id, config in routing_config.items()}
+            self.keyword_agents = keyword_agents
+            self.prefixes = prefixes
+            self.pattern = pattern
+            self._cache.clear()
+
+    def matched_keywords(self, query: str) -> Set[str]:
+        if self.pattern is None:
+            return set()
+        matched = set()
+        for match in self.pattern.finditer(fold(query)):
+            keyword = match.group(0)
+            matched.add(keyword)
+            matched.update(self.prefixes[keyword])
+        return matched
+
+    def scores(self, query: str) -> Dict[str, float]:
+        """Puntaje por agente: keywords distintas encontradas × factor de prioridad"""
+        with self._lock:
+            cached = self._cache.get(query)
+            if cached is not None:
+                self._cache.move_to_end(query)
+                return cached
+
+        counts = {agent_id: 0 for agent_id in self.agent_order}
+        for keyword in self.matched_keywords(query):
+            for agent_id in self.keyword_agents[keyword]:
+                counts[agent_id] += 1
+        scores = {agent_id: counts[agent_id] * self.priority[agent_id] for agent_id in self.agent_order}
+
+        if self.cache_size > 0:
+            with self._lock:
+                self._cache[query] = scores
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return scores
+
+    def route(self, query: str) -> Optional[str]:
+        """Agente con mayor puntaje (None si ninguna keyword coincide)"""
+        scores = self.scores(query)
+        best = max(self.agent_order, key=scores.get, default=None)
+        if best is None or scores[best] <= 0:
+            return None
+        return best
+
+    def cache_info(self) -> Dict[str, int]:
+        with self._lock:
+            return {'size': len(self._cache), 'max_size': self.cache_size, 'keywords': len(self.keyword_agents)}
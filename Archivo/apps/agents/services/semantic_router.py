@@ -0,0 +1,87 @@
+"""
+Semantic Router - Routing por similitud con centroides de agente precalculados
+
+El routing por keywords (router.py) no reconoce paráfrasis y cae en tutor
+cuando ninguna palabra coincide. Aquí cada agente se representa por el
+centroide de los embeddings de su descripción y sus consultas de ejemplo,
+calculado una sola vez al arrancar con el SentenceTransformer del RAG. Enrutar
+una consulta es un producto matriz-vector sobre vectores normalizados.
+
+El embedding de la consulta no se calcula aquí: es el mismo que la etapa RAG
+del contexto ya genera para buscar documentos (context['query_embedding']),
+así que el modelo corre una sola vez por petición. Sin embedding, o si la
+decisión no supera el margen de confianza, se usa el routing por keywords.
+"""
+
+import os
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class SemanticRouter:
+    """
+    Clasificador de consultas por similitud coseno con los centroides de agente.
+
+    Configuración (variables de entorno):
+    - SEMANTIC_ROUTING_ENABLED: construir el router al arrancar el AgentManager
+    - SEMANTIC_ROUTING_MIN_SIMILARITY: similitud mínima con el mejor agente
+    - SEMANTIC_ROUTING_MARGIN: ventaja mínima del mejor agente sobre el segundo
+    """
+
+    def __init__(self, embed_fn: Callable[[List[str]], Any], routing_config: Dict[str, Dict[str, Any]]):
+        """
+        Args:
+            embed_fn: Función que devuelve embeddings para una lista de textos
+            routing_config: Tabla de routing del AgentManager (description y examples por agente)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.min_similarity = float(os.getenv('SEMANTIC_ROUTING_MIN_SIMILARITY', 0.35))
+        self.margin = float(os.getenv('SEMANTIC_ROUTING_MARGIN', 0.05))
+
+        self.agent_ids, self.centroids = self._build_centroids(embed_fn, routing_config)
+        self.logger.info(f"Centroides de routing: {len(self.agent_ids)} agentes, dim {self.centroids.shape[1]}")
+
+    @staticmethod
+    def _build_centroids(embed_fn: Callable[[List[str]], Any],
+                         routing_config: Dict[str, Dict[str, Any]]) -> Tuple[List[str], np.ndarray]:
+        agent_ids = list(routing_config)
+        texts, owners = [], []
+        for index, agent_id in enumerate(agent_ids):
+            config = routing_config[agent_id]
+            for text in [config['description']] + list(config.get('examples', [])):
+                texts.append(text)
+                owners.append(index)
+
+        # Un solo batch para todos los textos de todos los agentes
+        vectors = _normalize_rows(np.asarray(embed_fn(texts), dtype=np.float32))
+        centroids = np.zeros((len(agent_ids), vectors.shape[1]), dtype=np.float32)
+        np.add.at(centroids, np.asarray(owners), vectors)
+        return agent_ids, _normalize_rows(centroids)
+
+    def classify(self, query_embedding: Any) -> Tuple[str, float, float]:
+        """
+        Returns:
+            (mejor agente, similitud con su centroide, margen sobre el segundo)
+        """
+        vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        similarities = self.centroids @ (vector / norm if norm else vector)
+
+        best = int(np.argmax(similarities))
+        runner_up = float(np.partition(similarities, -2)[-2]) if len(similarities) > 1 else -1.0
+        return self.agent_ids[best], float(similarities[best]), float(similarities[best]) - runner_up
+
+    def route(self, query_embedding: Any) -> Optional[Tuple[str, float, float]]:
+        """(agente, similitud, margen) si la decisión es confiable; None para usar keywords"""
+        agent_id, similarity, margin = self.classify(query_embedding)
+        if similarity < self.min_similarity or margin < self.margin:
+            return None
+        return agent_id, similarity, margin
@@ -0,0 +1,331 @@
+"""
+Single Flight - Coalescencia de consultas idénticas en curso
+
+Cuando un profesor proyecta una pregunta y 40 estudiantes envían el mismo
+prompt en pocos segundos, route_query hacía 40 llamadas idénticas al LLM.
+Esta capa agrupa las consultas concurrentes con la misma clave (agente,
+consulta normalizada, huella del contexto y del historial de la
+conversación): la primera hace la llamada y las demás esperan su resultado,
+con un plazo máximo por clave. Sin la huella del historial, dos "continúa"
+de estudiantes distintos compartirían una respuesta basada en la
+conversación de uno de ellos.
+
+Funciona entre threads y tareas asyncio del mismo worker; con Redis, un lock
+por clave permite agrupar también entre workers.
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import redis
+
+from .text_utils import fingerprint_context, fingerprint_history, normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class _LeaderAbandoned(Exception):
+    """La llamada líder se canceló: cada seguidor hace su propia llamada"""
+
+
+class _Flight:
+    """Llamada en curso compartida por sus seguidores (threads o tareas asyncio)"""
+
+    __slots__ = ('event', 'result', 'error', 'followers', '_async_waiters', '_lock')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+        self._async_waiters = []
+        self._lock = threading.Lock()
+
+    def add_async_waiter(self) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self.event.is_set():
+                future.set_result(None)
+            else:
+                self._async_waiters.append((loop, future))
+        return future
+
+    def finish(self, result: Any, error: Optional[BaseException]):
+        with self._lock:
+            self.result = result
+            self.error = error
+            self.event.set()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SingleFlight:
+    """
+    Coalescencia de llamadas idénticas en curso.
+
+    Configuración (variables de entorno):
+    - COALESCE_ENABLED: activar la coalescencia (desactivada por defecto)
+    - COALESCE_TIMEOUT: segundos que un seguidor espera a la llamada líder
+    - COALESCE_REDIS: agrupar también entre workers con un lock en Redis
+    - COALESCE_RESULT_TTL: segundos que se publica el resultado en Redis
+    """
+
+    REDIS_PREFIX = 'coalesce'
+    REDIS_POLL_INTERVAL = 0.1
+
+    RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    def __init__(self, redis_client=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.enabled = os.getenv('COALESCE_ENABLED', 'False').lower() == 'true'
+        self.timeout = float(os.getenv('COALESCE_TIMEOUT', 45))
+        self.result_ttl = int(os.getenv('COALESCE_RESULT_TTL', 10))
+
+        self.redis_client = redis_client
+        if self.redis_client is None and self.enabled \
+                and os.getenv('COALESCE_REDIS', 'False').lower() == 'true':
+            try:
+                redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+                self.redis_client = redis.from_url(redis_url, decode_responses=True)
+            except Exception as e:
+                self.logger.warning(f"Error conectando a Redis para la coalescencia: {e}")
+
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self.stats = {
+            'leaders': 0,
+            'coalesced': 0,
+            'redis_coalesced': 0,
+            'timeouts': 0
+        }
+
+    @staticmethod
+    def make_key(agent_id: str, query: str, context: Dict[str, Any]) -> str:
+        """Clave: agente + consulta normalizada + huella de documentos, contexto explícito e historial"""
+        normalized = normalize_query(query)
+        query_hash = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+        context_hash = fingerprint_context(context)
+        history_hash = fingerprint_history(context) or '-'
+        return f"{agent_id}:{context_hash}:{history_hash}:{query_hash}"
+
+    # Registro local
+
+    def _join(self, key: str) -> Tuple[_Flight, bool]:
+        """Unirse a la llamada en curso de la clave o convertirse en líder"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.stats['coalesced'] += 1
+                return flight, False
+            flight = _Flight()
+            self._flights[key] = flight
+            self.stats['leaders'] += 1
+            return flight, True
+
+    def _leave(self, key: str, flight: _Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    @staticmethod
+    def _outcome(flight: _Flight):
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _timed_out(self, key: str):
+        with self._lock:
+            self.stats['timeouts'] += 1
+        self.logger.warning(f"Coalescencia: la llamada líder de {key} superó {self.timeout:.0f}s")
+
+    # API sync (threads)
+
+    def do(self, key: str, fn: Callable[[], str]) -> str:
+        """
+        Ejecutar fn una sola vez para todas las llamadas concurrentes con la misma clave.
+        Si la llamada líder falla, los seguidores reciben la misma excepción.
+        """
+        if not self.enabled:
+            return fn()
+
+        flight, leader = self._join(key)
+        if not leader:
+            if flight.event.wait(self.timeout):
+                try:
+                    return self._outcome(flight)
+                except _LeaderAbandoned:
+                    return fn()
+            self._timed_out(key)
+            return fn()
+
+        try:
+            result = self._run_leader(key, fn)
+        except Exception as e:
+            flight.finish(None, e)
+            raise
+        except BaseException:
+            flight.finish(None, _LeaderAbandoned())
+            raise
+        else:
+            flight.finish(result, None)
+            return result
+        finally:
+            self._leave(key, flight)
+
+    def _run_leader(self, key: str, fn: Callable[[], str]) -> str:
+        if self.redis_client is None:
+            return fn()
+
+        token = self._acquire_redis_lock(key)
+        if token is None:
+            # Otro worker ya está haciendo la llamada: esperar su resultado
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                result, lock_held = self._poll_redis_result(key)
+                if result is not None:
+                    with self._lock:
+                        self.stats['redis_coalesced'] += 1
+                    return result
+                if not lock_held:
+                    break
+                time.sleep(self.REDIS_POLL_INTERVAL)
+            return fn()
+
+        try:
+            result = fn()
+            self._publish_redis_result(key, result)
+            return result
+        finally:
+            self._release_redis_lock(key, token)
+
+    # API async (tareas asyncio)
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[str]]) -> str:
+        """Versión async de do; comparte el registro con los threads del worker"""
+        if not self.enabled:
+            return await fn()
+
+        flight, leader = self._join(key)
+        if not leader:
+            try:
+                await asyncio.wait_for(flight.add_async_waiter(), self.timeout)
+            except asyncio.TimeoutError:
+                self._timed_out(key)
+                return await fn()
+            try:
+                return self._outcome(flight)
+            except _LeaderAbandoned:
+                return await fn()
+
+        try:
+            result = await self._arun_leader(key, fn)
+        except Exception as e:
+            flight.finish(None, e)
+            raise
+        except BaseException:
+            flight.finish(None, _LeaderAbandoned())
+            raise
+        else:
+            flight.finish(result, None)
+            return result
+        finally:
+            self._leave(key, flight)
+
+    async def _arun_leader(self, key: str, fn: Callable[[], Awaitable[str]]) -> str:
+        if self.redis_client is None:
+            return await fn()
+
+        # El cliente Redis es síncrono: sus llamadas van fuera del event loop
+        token = await asyncio.to_thread(self._acquire_redis_lock, key)
+        if token is None:
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                result, lock_held = await asyncio.to_thread(self._poll_redis_result, key)
+                if result is not None:
+                    with self._lock:
+                        self.stats['redis_coalesced'] += 1
+                    return result
+                if not lock_held:
+                    break
+                await asyncio.sleep(self.REDIS_POLL_INTERVAL)
+            return await fn()
+
+        try:
+            result = await fn()
+            await asyncio.to_thread(self._publish_redis_result, key, result)
+            return result
+        finally:
+            await asyncio.to_thread(self._release_redis_lock, key, token)
+
+    # Nivel Redis (entre workers)
+
+    def _lock_key(self, key: str) -> str:
+        return f"{self.REDIS_PREFIX}:lock:{key}"
+
+    def _result_key(self, key: str) -> str:
+        return f"{self.REDIS_PREFIX}:result:{key}"
+
+    def _acquire_redis_lock(self, key: str) -> Optional[str]:
+        """Token del lock si este worker es el líder; None si otro worker ya lo es"""
+        token = uuid.uuid4().hex
+        try:
+            if self.redis_client.set(self._lock_key(key), token, nx=True, px=int(self.timeout * 1000)):
+                # Descartar un resultado anterior de la misma clave
+                self.redis_client.delete(self._result_key(key))
+                return token
+            return None
+        except Exception as e:
+            self.logger.warning(f"Error adquiriendo lock de coalescencia: {e}")
+            return token
+
+    def _poll_redis_result(self, key: str) -> Tuple[Optional[str], bool]:
+        try:
+            pipe = self.redis_client.pipeline()
+            pipe.get(self._result_key(key))
+            pipe.exists(self._lock_key(key))
+            raw, lock_held = pipe.execute()
+        except Exception as e:
+            self.logger.warning(f"Error consultando resultado de coalescencia: {e}")
+            return None, False
+        return (json.loads(raw) if raw else None), bool(lock_held)
+
+    def _publish_redis_result(self, key: str, result: str):
+        try:
+            self.redis_client.set(self._result_key(key), json.dumps(result), ex=self.result_ttl)
+        except Exception as e:
+            self.logger.warning(f"Error publicando resultado de coalescencia: {e}")
+
+    def _release_redis_lock(self, key: str, token: str):
+        try:
+            self.redis_client.eval(self.RELEASE_SCRIPT, 1, self._lock_key(key), token)
+        except Exception as e:
+            self.logger.warning(f"Error liberando lock de coalescencia: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self._flights)
+        stats['enabled'] = self.enabled
+        stats['redis_enabled'] = self.redis_client is not None
+        return stats
@@ -0,0 +1,45 @@
+"""
+Text Utils - Normalización de consultas y huellas del contexto
+
+Funciones puras compartidas por el router de keywords, la caché semántica de
+respuestas y la coalescencia de consultas: así el router no importa la caché
+solo para normalizar texto.
+"""
+
+import hashlib
+import unicodedata
+from typing import Any, Dict
+
+
+def normalize_query(query: str) -> str:
+    """Normalizar la consulta: minúsculas, sin acentos y espacios colapsados"""
+    text = unicodedata.normalize('NFKD', query.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(text.split())
+
+
+def fingerprint_context(context: Dict[str, Any]) -> str:
+    """Huella de los documentos recuperados y del contexto explícito"""
+    digest = hashlib.sha1()
+    for doc in sorted(context.get('relevant_documents') or []):
+        digest.update(str(doc).encode('utf-8'))
+        digest.update(b'\x00')
+    explicit_context = context.get('explicit_context')
+    if explicit_context:
+        digest.update(b'explicit\x00')
+        digest.update(str(explicit_context).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def fingerprint_history(context: Dict[str, Any]) -> str:
+    """Huella del historial de la conversación ('' si no hay historial)"""
+    history = context.get('conversation_history') or []
+    if not history:
+        return ''
+    digest = hashlib.sha1()
+    for message in history:
+        digest.update(str(message.get('role', '')).encode('utf-8'))
+        digest.update(b'\x00')
+        digest.update(str(message.get('content', '')).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()[:16]
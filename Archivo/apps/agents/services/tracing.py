@@ -0,0 +1,342 @@
+"""
+Tracing - Spans por etapa del pipeline del chat
+
+route_query solo registraba el tiempo total, así que un chat lento no decía si
+el problema era Chroma, Redis o el LLM. Cada petición muestreada genera una
+traza con un span por etapa (lectura de memoria, embedding y consulta RAG,
+routing, construcción del prompt, llamada al proveedor con TTFT, parseo y
+escritura de memoria) con atributos como agente, proveedor, tokens o acierto
+de caché.
+
+Los spans se exportan en segundo plano a un fichero JSONL o a un colector
+OpenTelemetry (OTLP/HTTP JSON). Una petición no muestreada solo paga la
+consulta de una ContextVar por etapa.
+
+Uso:
+    with tracer.trace('chat.request', endpoint='chat') as root:
+        with span('rag.search', top_k=5) as s:
+            ...
+            s.set('documents', len(docs))
+"""
+
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar('agents_current_span', default=None)
+
+
+class _NoopSpan:
+    """Span de una petición no muestreada: todas las operaciones son gratuitas"""
+
+    sampled = False
+    trace_id = None
+    span_id = None
+
+    def set(self, key: str, value: Any) -> '_NoopSpan':
+        return self
+
+    def update(self, **attributes) -> '_NoopSpan':
+        return self
+
+    def record_error(self, error: BaseException) -> '_NoopSpan':
+        return self
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """Etapa medida de una traza muestreada"""
+
+    sampled = True
+
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'attributes',
+                 'start_ns', '_started', 'duration', 'error', '_token', '_ended')
+
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: str, parent_id: Optional[str] = None,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self._started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._token = None
+        self._ended = False
+
+    def set(self, key: str, value: Any) -> 'Span':
+        self.attributes[key] = value
+        return self
+
+    def update(self, **attributes) -> 'Span':
+        self.attributes.update(attributes)
+        return self
+
+    def record_error(self, error: BaseException) -> 'Span':
+        self.error = f"{type(error).__name__}: {error}"
+        return self
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    def end(self):
+        """Cerrar el span y encolarlo para exportar (idempotente)"""
+        if self._ended:
+            return
+        self._ended = True
+        self.duration = self.elapsed()
+        self.tracer.submit(self)
+
+    # Con `with` el span pasa a ser el actual: los spans creados dentro son sus hijos.
+    # En generadores usar span(...) + end() sin `with`: la ContextVar no debe
+    # quedar activa entre yields.
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and isinstance(exc, Exception):
+            self.record_error(exc)
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            _current_span.set(None)
+        self.end()
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': datetime.fromtimestamp(self.start_ns / 1e9, tz=timezone.utc).isoformat(),
+            'duration_ms': round((self.duration or 0.0) * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def current_span():
+    """Span activo en el contexto actual (NOOP_SPAN si la petición no se muestrea)"""
+    return _current_span.get() or NOOP_SPAN
+
+
+def span(name: str, parent=None, **attributes):
+    """
+    Crear un span hijo del span activo (o de `parent`).
+    Devuelve NOOP_SPAN si no hay una traza muestreada en curso.
+    """
+    parent = parent if parent is not None else _current_span.get()
+    if parent is None or not parent.sampled:
+        return NOOP_SPAN
+    return Span(parent.tracer, name, parent.trace_id, parent.span_id, attributes)
+
+
+def bind_context(fn: Callable) -> Callable:
+    """Ejecutar fn con el contexto actual (spans incluidos) en otro thread"""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+class JsonlSpanExporter:
+    """Un span por línea en un fichero local"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: List[Span]):
+        lines = ''.join(json.dumps(s.to_dict(), ensure_ascii=False, default=str) + '\n' for s in spans)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+    def close(self):
+        pass
+
+
+class OtlpHttpSpanExporter:
+    """Colector OpenTelemetry vía OTLP/HTTP con codificación JSON"""
+
+    def __init__(self, endpoint: str, service_name: str):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.client = httpx.Client(timeout=5.0)
+
+    @staticmethod
+    def _value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def _span(self, s: Span) -> Dict[str, Any]:
+        encoded = {
+            'traceId': s.trace_id,
+            'spanId': s.span_id,
+            'name': s.name,
+            'kind': 1,
+            'startTimeUnixNano': str(s.start_ns),
+            'endTimeUnixNano': str(s.start_ns + int((s.duration or 0.0) * 1e9)),
+            'attributes': [{'key': k, 'value': self._value(v)} for k, v in s.attributes.items()],
+            'status': {'code': 2, 'message': s.error} if s.error else {'code': 1},
+        }
+        if s.parent_id:
+            encoded['parentSpanId'] = s.parent_id
+        return encoded
+
+    def export(self, spans: List[Span]):
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'apps.agents'}, 'spans': [self._span(s) for s in spans]}]
+        }]}
+        self.client.post(self.endpoint, json=payload).raise_for_status()
+
+    def close(self):
+        self.client.close()
+
+
+class Tracer:
+    """
+    Trazas muestreadas con exportación en segundo plano.
+
+    Configuración (variables de entorno):
+    - TRACING_ENABLED: activar el tracing
+    - TRACE_SAMPLE_RATE: fracción de peticiones trazadas (0-1)
+    - TRACE_EXPORTER: 'jsonl' u 'otlp'
+    - TRACE_FILE: fichero del exportador JSONL
+    - TRACE_OTLP_ENDPOINT: endpoint OTLP/HTTP del colector
+    - TRACE_SERVICE_NAME: service.name de los spans OTLP
+    - TRACE_FLUSH_INTERVAL: segundos entre exportaciones
+    - TRACE_MAX_QUEUE: spans pendientes antes de descartar
+    """
+
+    BATCH_SIZE = 512
+
+    def __init__(self, exporter=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.enabled = os.getenv('TRACING_ENABLED', 'False').lower() == 'true'
+        self.sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', 0.1))
+        self.flush_interval = float(os.getenv('TRACE_FLUSH_INTERVAL', 2))
+        self.exporter = exporter or (self._build_exporter() if self.enabled else None)
+
+        self._queue: 'queue.Queue[Span]' = queue.Queue(maxsize=int(os.getenv('TRACE_MAX_QUEUE', 10000)))
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.stats = {'traces': 0, 'spans': 0, 'exported': 0, 'dropped': 0, 'export_errors': 0}
+
+    def _build_exporter(self):
+        kind = os.getenv('TRACE_EXPORTER', 'jsonl').lower()
+        if kind == 'otlp':
+            return OtlpHttpSpanExporter(
+                os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces'),
+                os.getenv('TRACE_SERVICE_NAME', 'agents')
+            )
+        return JsonlSpanExporter(os.getenv('TRACE_FILE', 'traces.jsonl'))
+
+    def trace(self, name: str, force: bool = False, **attributes):
+        """
+        Span raíz de una petición; decide el muestreo de toda la traza.
+        force=True traza la petición aunque no salga en el muestreo.
+        """
+        if self.exporter is None or not (force or random.random() < self.sample_rate):
+            return NOOP_SPAN
+        with self._lock:
+            self.stats['traces'] += 1
+        return Span(self, name, os.urandom(16).hex(), None, attributes)
+
+    def submit(self, finished: Span):
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(finished)
+            with self._lock:
+                self.stats['spans'] += 1
+        except queue.Full:
+            with self._lock:
+                self.stats['dropped'] += 1
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                self._worker.start()
+
+    def _drain(self) -> List[Span]:
+        batch = []
+        while len(batch) < self.BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _export(self, batch: List[Span]):
+        try:
+            self.exporter.export(batch)
+            with self._lock:
+                self.stats['exported'] += len(batch)
+        except Exception as e:
+            with self._lock:
+                self.stats['export_errors'] += 1
+                self.stats['dropped'] += len(batch)
+            self.logger.warning(f"Error exportando {len(batch)} spans: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Exportar todos los spans pendientes"""
+        batch = self._drain()
+        while batch:
+            self._export(batch)
+            batch = self._drain()
+
+    def shutdown(self):
+        self._stop.set()
+        if self.exporter is not None:
+            self.flush()
+            self.exporter.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats.update(
+            enabled=self.exporter is not None,
+            sample_rate=self.sample_rate,
+            exporter=type(self.exporter).__name__ if self.exporter else None,
+            pending=self._queue.qsize()
+        )
+        return stats
@@ -18,9 +18,12 @@ class TutorAgent(BaseAIService):
     - Sugerir recursos adicionales
     """
     
+    # Metadatos de clase (disponibles sin construir el agente)
+    agent_name = "Tutor Virtual"
+    
     def get_agent_name(self) -> str:
         """Nombre del agente"""
-        return "Tutor Virtual"
+        return self.agent_name
     
     def get_system_prompt(self) -> str:
         """Prompt del sistema para el Tutor Virtual"""
@@ -1,3 +1,1243 @@
-from django.test import TestCase
+import os
+import gzip
+import json
+import tempfile
+import time
+import asyncio
+import threading
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here. 
\ No newline at end of file
+import numpy as np
+
+from django.test import SimpleTestCase
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 (scripts Lua en fakeredis)
+except ImportError:  # dependencias de requirements_test.txt
+    fakeredis = None
+
+from .management.commands.benchmark_router import legacy_scores
+from .services import chat_context, conversation_memory, message_codec
+from .services.bulk_grading import BulkGradingPipeline
+from .services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from .services.context_cache import CHANNEL as INVALIDATION_CHANNEL, ConversationContextCache
+from .services.conversation_memory import ConversationMemory
+from .services.conversation_retention import ConversationArchive, ConversationRetention
+from .services.errors import (
+    ProviderError, ProviderRateLimitError, ProviderThrottledError, ProviderTimeoutError, ProviderUnavailableError
+)
+from .services.hedging import ahedged_stream, hedged_stream, register_stream
+from .services.message_codec import FLAG_ZSTD, FORMAT_MSGPACK_V1, MessageCodec
+from .services.metrics import BUCKET_BOUNDS, Histogram, MetricsRegistry
+from .services.rate_limiter import LocalQuota, ProviderRateLimiter
+from .services.response_cache import SemanticResponseCache
+from .services.router import KeywordRouter
+from .services.single_flight import SingleFlight
+from .services.text_utils import fingerprint_context, fingerprint_history, normalize_query
+
+
+class MessageCodecTests(SimpleTestCase):
+    """Formato v1 (msgpack, zstd opcional) y lectura de las entradas JSON antiguas"""
+
+    def _codec(self, **env):
+        with mock.patch.dict(os.environ, env):
+            return MessageCodec()
+
+    def _message(self, **fields):
+        message = {
+            'role': 'user',
+            'content': 'Explícame las fracciones',
+            'timestamp': '2024-03-01T10:15:30',
+            'metadata': {},
+        }
+        message.update(fields)
+        return message
+
+    def test_msgpack_round_trip(self):
+        codec = self._codec(CONVERSATION_ENCODING='msgpack', CONVERSATION_ZSTD_MIN_BYTES='0')
+        message = self._message(metadata={'source': 'ws'})
+
+        raw = codec.encode(message)
+
+        self.assertIsInstance(raw, bytes)
+        self.assertEqual(raw[0], FORMAT_MSGPACK_V1)
+        self.assertEqual(MessageCodec.decode(raw), message)
+
+    def test_unknown_role_and_empty_metadata(self):
+        codec = self._codec(CONVERSATION_ENCODING='msgpack', CONVERSATION_ZSTD_MIN_BYTES='0')
+        message = self._message(role='tool')
+
+        decoded = MessageCodec.decode(codec.encode(message))
+
+        self.assertEqual(decoded['role'], 'tool')
+        self.assertEqual(decoded['metadata'], {})
+
+    def test_legacy_json_entries(self):
+        message = self._message(role='assistant', metadata={'agent': 'tutor'})
+        legacy = json.dumps(message)
+
+        self.assertEqual(MessageCodec.decode(legacy), message)
+        self.assertEqual(MessageCodec.decode(legacy.encode('utf-8')), message)
+
+    def test_json_encoding_is_readable_by_decode(self):
+        codec = self._codec(CONVERSATION_ENCODING='json')
+        message = self._message()
+
+        raw = codec.encode(message)
+
+        self.assertEqual(json.loads(raw), message)
+        self.assertEqual(MessageCodec.decode(raw), message)
+
+    def test_zstd_flagged_entries(self):
+        if message_codec.zstandard is None:
+            self.skipTest('zstandard no instalado')
+        codec = self._codec(CONVERSATION_ENCODING='msgpack', CONVERSATION_ZSTD_MIN_BYTES='64')
+        message = self._message(role='assistant', content='Una fracción representa partes de un todo. ' * 40)
+
+        raw = codec.encode(message)
+
+        self.assertEqual(raw[0], FORMAT_MSGPACK_V1 | FLAG_ZSTD)
+        self.assertLess(len(raw), len(message['content']))
+        self.assertEqual(MessageCodec.decode(raw), message)
+
+    def test_short_messages_are_not_compressed(self):
+        codec = self._codec(CONVERSATION_ENCODING='msgpack', CONVERSATION_ZSTD_MIN_BYTES='1024')
+
+        self.assertEqual(codec.encode(self._message())[0], FORMAT_MSGPACK_V1)
+
+    def test_rejects_unknown_formats(self):
+        with self.assertRaises(ValueError):
+            MessageCodec.decode(b'')
+        with self.assertRaises(ValueError):
+            MessageCodec.decode(bytes((0x02,)) + b'payload')
+
+
+class KeywordRouterTests(SimpleTestCase):
+    """Paridad con la búsqueda por subcadena que sustituyó (legacy_scores)"""
+
+    ROUTING = {
+        'tutor': {'keywords': ['explicar', 'fracciones', 'ayuda'], 'priority': 1},
+        'curriculum': {'keywords': ['plan', 'planificar', 'curriculo'], 'priority': 2},
+        'evaluator': {'keywords': ['evaluar', 'nota'], 'priority': 2},
+    }
+
+    def setUp(self):
+        self.router = KeywordRouter(self.ROUTING, cache_size=16)
+
+    def test_scores_match_legacy_substring_scoring(self):
+        queries = [
+            'Quiero explicar fracciones equivalentes',
+            'Necesito ayuda para planificar el curriculo',
+            'Puedes evaluar mi examen y darme una nota',
+            'Hola, buenos días',
+        ]
+        for query in queries:
+            with self.subTest(query=query):
+                self.assertEqual(self.router.scores(query), legacy_scores(self.ROUTING, query))
+
+    def test_keyword_contained_in_a_longer_one_still_counts(self):
+        # 'plan' dentro de 'planificar' contaba con la subcadena y sigue contando
+        self.assertEqual(self.router.scores('planificar la semana')['curriculum'], 1.0)
+
+    def test_no_mid_word_matches(self):
+        # La subcadena contaba 'nota' dentro de 'anotar'
+        self.assertEqual(legacy_scores(self.ROUTING, 'voy a anotar la tarea')['evaluator'], 0.5)
+        self.assertEqual(self.router.scores('voy a anotar la tarea')['evaluator'], 0.0)
+
+    def test_accent_and_case_insensitive(self):
+        router = KeywordRouter({'analytics': {'keywords': ['análisis'], 'priority': 1}}, cache_size=0)
+
+        self.assertEqual(router.route('ANALISIS de mis notas'), 'analytics')
+        self.assertEqual(router.route('análisis de mis notas'), 'analytics')
+
+    def test_route_is_none_without_matches(self):
+        self.assertIsNone(self.router.route('Hola, buenos días'))
+        self.assertEqual(self.router.route('explicar fracciones'), 'tutor')
+
+    def test_compile_clears_the_cache(self):
+        self.router.scores('evaluar')
+        self.assertEqual(self.router.cache_info()['size'], 1)
+
+        self.router.compile({'tutor': {'keywords': ['evaluar'], 'priority': 1}})
+
+        self.assertEqual(self.router.cache_info()['size'], 0)
+        self.assertEqual(self.router.route('evaluar'), 'tutor')
+
+
+class HistogramTests(SimpleTestCase):
+    """Percentiles de buckets logarítmicos (~9% de error relativo) y fusión entre workers"""
+
+    def _histogram(self, values):
+        histogram = Histogram()
+        for value in values:
+            histogram.observe(value)
+        return histogram
+
+    def test_empty_histogram(self):
+        histogram = Histogram()
+
+        self.assertIsNone(histogram.percentile(50))
+        self.assertEqual(histogram.mean, 0.0)
+        self.assertEqual(histogram.summary()['count'], 0)
+
+    def test_percentiles_within_bucket_error(self):
+        values = [i / 1000 for i in range(1, 1001)]  # 1ms .. 1s
+        histogram = self._histogram(values)
+
+        for pct, expected in ((50, 0.5), (95, 0.95), (99, 0.99)):
+            with self.subTest(pct=pct):
+                self.assertAlmostEqual(histogram.percentile(pct), expected, delta=expected * 0.09)
+        self.assertAlmostEqual(histogram.mean, sum(values) / len(values))
+
+    def test_percentiles_are_monotonic(self):
+        histogram = self._histogram([0.002, 0.004, 0.03, 0.2, 1.5, 7.0])
+
+        results = [histogram.percentile(pct) for pct in range(1, 101)]
+
+        self.assertEqual(results, sorted(results))
+
+    def test_values_beyond_the_last_bucket(self):
+        histogram = self._histogram([BUCKET_BOUNDS[-1] * 10])
+
+        self.assertEqual(histogram.percentile(99), BUCKET_BOUNDS[-1])
+
+    def test_merge_equals_observing_everything(self):
+        first = [0.01, 0.02, 0.5]
+        second = [0.003, 2.0]
+        merged = self._histogram(first)
+
+        merged.merge(self._histogram(second))
+        expected = self._histogram(first + second)
+
+        self.assertEqual(merged.counts, expected.counts)
+        self.assertEqual(merged.count, 5)
+        self.assertAlmostEqual(merged.total, expected.total)
+        self.assertEqual(merged.percentile(50), expected.percentile(50))
+
+    def test_local_session_metrics_do_not_touch_redis(self):
+        with mock.patch.dict(os.environ, {'METRICS_REDIS': 'False'}):
+            registry = MetricsRegistry()
+        registry.inc('agent_requests_total', agent='tutor', outcome='success')
+        registry.inc('agent_requests_total', agent='tutor', outcome='error')
+        registry.observe('agent_request_duration_seconds', 1.0, agent='tutor')
+        registry.observe('agent_request_duration_seconds', 3.0, agent='evaluator')
+
+        self.assertEqual(registry.local_counter_by('agent_requests_total', 'outcome'),
+                         {'success': 1.0, 'error': 1.0})
+        self.assertEqual(registry.local_mean('agent_request_duration_seconds'), 2.0)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    """Transiciones closed -> open -> half_open -> closed/open (solo ventana local)"""
+
+    ENV = {
+        'LLM_BREAKER_ENABLED': 'True',
+        'LLM_BREAKER_WINDOW': '60',
+        'LLM_BREAKER_MIN_CALLS': '4',
+        'LLM_BREAKER_ERROR_RATE': '0.5',
+        'LLM_BREAKER_SLOW_CALL_SECONDS': '10',
+        'LLM_BREAKER_SLOW_CALL_RATE': '0.75',
+        'LLM_BREAKER_OPEN_SECONDS': '30',
+        'LLM_BREAKER_HALF_OPEN_CALLS': '1',
+    }
+
+    def setUp(self):
+        with mock.patch.dict(os.environ, self.ENV):
+            self.breaker = CircuitBreaker('openai')
+
+    def _open(self):
+        for _ in range(4):
+            self.breaker.record_failure(Exception('500'))
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def _expire_open_period(self):
+        # Sin esperar: retrasar la apertura más allá de LLM_BREAKER_OPEN_SECONDS
+        self.breaker._opened_at -= self.breaker.open_seconds + 1
+
+    def test_stays_closed_below_min_calls(self):
+        for _ in range(3):
+            self.breaker.record_failure(Exception('500'))
+
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_opens_on_error_rate_and_rejects(self):
+        self.breaker.record_success(0.5)
+        self.breaker.record_success(0.5)
+        self.breaker.record_failure(Exception('500'))
+        self.assertEqual(self.breaker.state, CLOSED)
+
+        self.breaker.record_failure(Exception('500'))
+
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow_request())
+        self.assertEqual(self.breaker.stats['rejected'], 1)
+
+    def test_opens_on_slow_call_rate(self):
+        for _ in range(3):
+            self.breaker.record_success(12.0)
+        self.breaker.record_success(0.5)
+
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_half_open_allows_limited_probes_then_closes(self):
+        self._open()
+        self._expire_open_period()
+
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+
+        self.breaker.record_success(0.5)
+
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.snapshot()['window_calls'], 0)
+
+    def test_half_open_failure_or_slow_probe_reopens(self):
+        for outcome in ('failure', 'slow'):
+            with self.subTest(outcome=outcome):
+                self.breaker.reset()
+                self._open()
+                self._expire_open_period()
+                self.assertTrue(self.breaker.allow_request())
+
+                if outcome == 'failure':
+                    self.breaker.record_failure(Exception('timeout'))
+                else:
+                    self.breaker.record_success(12.0)
+
+                self.assertEqual(self.breaker.state, OPEN)
+                self.assertFalse(self.breaker.allow_request())
+
+    def test_state_does_not_reserve_and_unused_probe_is_released(self):
+        self._open()
+        self._expire_open_period()
+
+        for _ in range(3):
+            self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+
+        self.breaker.release_probe()
+
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_unavailable_errors_are_not_provider_failures(self):
+        for _ in range(10):
+            self.breaker.record_failure(ProviderUnavailableError('openai', 'sin API key'))
+
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.stats['failures'], 0)
+
+    def test_disabled_breaker_always_allows(self):
+        with mock.patch.dict(os.environ, dict(self.ENV, LLM_BREAKER_ENABLED='False')):
+            breaker = CircuitBreaker('claude')
+        for _ in range(10):
+            breaker.record_failure(Exception('500'))
+
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow_request())
+
+
+class FakeProviders:
+    """Streams de proveedores falsos: rápidos, que fallan o bloqueados hasta que los cierran"""
+
+    def __init__(self):
+        self.started = []
+        self.closed = {}
+
+    def fast(self, name, *deltas):
+        def factory():
+            self.started.append(name)
+            yield from deltas
+        return name, factory
+
+    def failing(self, name, error):
+        def factory():
+            self.started.append(name)
+            raise error
+            yield  # generador
+        return name, factory
+
+    def blocked(self, name):
+        """Espera su primer token hasta que el hedging cierra la respuesta HTTP (register_stream)"""
+        def factory():
+            self.started.append(name)
+            closed = self.closed[name] = threading.Event()
+            register_stream(closed.set)
+
+            def stream():
+                closed.wait(5)
+                raise ProviderTimeoutError(name, 'conexión cerrada')
+                yield  # generador
+            return stream()
+        return name, factory
+
+    def async_fast(self, name, *deltas):
+        async def factory():
+            self.started.append(name)
+            for delta in deltas:
+                yield delta
+        return name, factory
+
+    def async_blocked(self, name):
+        async def factory():
+            self.started.append(name)
+            closed = self.closed[name] = threading.Event()
+            try:
+                await asyncio.sleep(5)
+                yield 'tarde'
+            finally:
+                closed.set()
+        return name, factory
+
+
+class HedgedStreamTests(SimpleTestCase):
+    """Carrera entre proveedores: gana el primer token y el perdedor se cierra"""
+
+    def setUp(self):
+        self.providers = FakeProviders()
+
+    def test_primary_wins_without_launching_the_hedge(self):
+        candidates = [self.providers.fast('openai', 'Hola', ' mundo'), self.providers.fast('claude', 'otro')]
+
+        result = list(hedged_stream(candidates, delay=1.0))
+
+        self.assertEqual(result, [('openai', 'Hola'), ('openai', ' mundo')])
+        self.assertEqual(self.providers.started, ['openai'])
+
+    def test_hedge_wins_and_the_blocked_primary_is_closed(self):
+        candidates = [self.providers.blocked('openai'), self.providers.fast('claude', 'Hola')]
+
+        result = list(hedged_stream(candidates, delay=0.01))
+
+        self.assertEqual(result, [('claude', 'Hola')])
+        self.assertTrue(self.providers.closed['openai'].wait(1))
+
+    def test_primary_failure_launches_the_hedge_immediately(self):
+        candidates = [
+            self.providers.failing('openai', ProviderRateLimitError('openai', '429')),
+            self.providers.fast('claude', 'Hola'),
+        ]
+
+        self.assertEqual(list(hedged_stream(candidates, delay=10.0)), [('claude', 'Hola')])
+
+    def test_all_providers_fail(self):
+        candidates = [
+            self.providers.failing('openai', ProviderTimeoutError('openai', 'timeout')),
+            self.providers.failing('claude', RuntimeError('500')),
+        ]
+
+        with self.assertRaises(ProviderError) as raised:
+            list(hedged_stream(candidates, delay=10.0))
+
+        self.assertEqual(self.providers.started, ['openai', 'claude'])
+        # El último error, y si no es un ProviderError llega como ProviderUnavailableError
+        self.assertIsInstance(raised.exception, ProviderUnavailableError)
+        self.assertEqual(raised.exception.provider, 'claude')
+
+    def test_async_hedge_wins_and_the_loser_is_closed(self):
+        candidates = [self.providers.async_blocked('openai'), self.providers.async_fast('claude', 'Hola', '!')]
+
+        async def race():
+            return [item async for item in ahedged_stream(candidates, delay=0.01)]
+
+        self.assertEqual(asyncio.run(race()), [('claude', 'Hola'), ('claude', '!')])
+        self.assertTrue(self.providers.closed['openai'].is_set())
+
+    def test_async_all_providers_fail(self):
+        async def failing(name):
+            self.providers.started.append(name)
+            raise ProviderTimeoutError(name, 'timeout')
+            yield  # generador
+
+        candidates = [('openai', lambda: failing('openai')), ('claude', lambda: failing('claude'))]
+
+        async def race():
+            return [item async for item in ahedged_stream(candidates, delay=0.01)]
+
+        with self.assertRaises(ProviderTimeoutError):
+            asyncio.run(race())
+        self.assertEqual(self.providers.started, ['openai', 'claude'])
+
+
+class TokenBucketTests(SimpleTestCase):
+    """Cubetas locales y orden de admisión de la cola por prioridad"""
+
+    KEY = ('openai', 'gpt-4o-mini')
+
+    def _limiter(self, **env):
+        defaults = {
+            'OPENAI_REQUESTS_PER_MINUTE': '60',
+            'OPENAI_TOKENS_PER_MINUTE': '0',
+            'CLAUDE_REQUESTS_PER_MINUTE': '0',
+            'CLAUDE_TOKENS_PER_MINUTE': '0',
+            'LLM_RATE_LIMIT_REDIS': 'False',
+            'LLM_RATE_LIMIT_MAX_QUEUE': '10',
+        }
+        with mock.patch.dict(os.environ, dict(defaults, **env)):
+            return ProviderRateLimiter()
+
+    def test_local_quota_requests_per_minute(self):
+        quota = LocalQuota(requests_per_minute=60, tokens_per_minute=0)
+
+        for _ in range(60):
+            self.assertEqual(quota.try_consume(100), 0.0)
+        wait = quota.try_consume(100)
+
+        self.assertGreater(wait, 0.5)
+        self.assertLessEqual(wait, 1.0)
+
+    def test_local_quota_tokens_per_minute(self):
+        quota = LocalQuota(requests_per_minute=0, tokens_per_minute=6000)
+
+        self.assertEqual(quota.try_consume(4000), 0.0)
+        # Faltan ~2000 tokens a 100 tokens/s
+        self.assertAlmostEqual(quota.try_consume(4000), 20.0, delta=0.5)
+
+    def test_oversized_call_is_admitted_with_a_full_bucket(self):
+        quota = LocalQuota(requests_per_minute=0, tokens_per_minute=1000)
+
+        self.assertEqual(quota.try_consume(50000), 0.0)
+
+    def test_interactive_is_admitted_before_earlier_batch(self):
+        limiter = self._limiter()
+        batch = limiter._join_queue(self.KEY, 'batch')
+        interactive = limiter._join_queue(self.KEY, 'interactive')
+
+        # La de lotes llegó antes pero no es la cabeza: reintenta sin consumir
+        self.assertGreater(limiter._try_admit(self.KEY, batch, 10, waited=False), 0)
+        self.assertEqual(limiter._try_admit(self.KEY, interactive, 10, waited=False), 0)
+        self.assertEqual(limiter._try_admit(self.KEY, batch, 10, waited=True), 0)
+
+        self.assertEqual(limiter._queues[self.KEY], [])
+        self.assertEqual(limiter.stats['admitted'], 2)
+        self.assertEqual(limiter.stats['waited'], 1)
+
+    def test_same_priority_is_first_come_first_served(self):
+        limiter = self._limiter()
+        first = limiter._join_queue(self.KEY, 'default')
+        second = limiter._join_queue(self.KEY, 'default')
+
+        self.assertGreater(limiter._try_admit(self.KEY, second, 10, waited=False), 0)
+        self.assertEqual(limiter._try_admit(self.KEY, first, 10, waited=False), 0)
+        self.assertEqual(limiter._try_admit(self.KEY, second, 10, waited=False), 0)
+
+    def test_head_waits_for_refill_after_429(self):
+        limiter = self._limiter()
+        limiter.report_rate_limited(*self.KEY)
+        entry = limiter._join_queue(self.KEY, 'interactive')
+
+        wait = limiter._try_admit(self.KEY, entry, 10, waited=False)
+
+        self.assertGreater(wait, 0.5)
+        self.assertEqual(limiter._queues[self.KEY], [entry])
+
+    def test_deadline_rejects_and_leaves_the_queue(self):
+        limiter = self._limiter()
+        limiter.report_rate_limited(*self.KEY)
+
+        with self.assertRaises(ProviderThrottledError):
+            limiter.acquire(*self.KEY, tokens=10, max_wait=0)
+
+        self.assertEqual(limiter._queues[self.KEY], [])
+        self.assertEqual(limiter.stats['rejected_deadline'], 1)
+
+    def test_full_queue_rejects(self):
+        limiter = self._limiter(LLM_RATE_LIMIT_MAX_QUEUE='1')
+        limiter._join_queue(self.KEY, 'batch')
+
+        with self.assertRaises(ProviderThrottledError):
+            limiter._join_queue(self.KEY, 'interactive')
+        self.assertEqual(limiter.stats['rejected_queue_full'], 1)
+
+    def test_unlimited_provider_is_not_queued(self):
+        limiter = self._limiter()
+
+        limiter.acquire('claude', 'claude-3-haiku', tokens=10)
+
+        self.assertNotIn(('claude', 'claude-3-haiku'), limiter._queues)
+
+
+class SingleFlightKeyTests(SimpleTestCase):
+    """Composición de la clave de coalescencia: agente, consulta, documentos e historial"""
+
+    def _context(self, **fields):
+        context = {
+            'relevant_documents': ['Las fracciones representan partes de un todo'],
+            'explicit_context': None,
+            'conversation_history': [],
+        }
+        context.update(fields)
+        return context
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query('  ¿Qué   es la FOTOSÍNTESIS? '), '¿que es la fotosintesis?')
+
+    def test_equivalent_queries_share_a_key(self):
+        context = self._context()
+
+        self.assertEqual(
+            SingleFlight.make_key('tutor', 'Explícame las  fracciones', context),
+            SingleFlight.make_key('tutor', 'explicame las fracciones', context)
+        )
+
+    def test_document_order_does_not_change_the_fingerprint(self):
+        self.assertEqual(
+            fingerprint_context({'relevant_documents': ['a', 'b']}),
+            fingerprint_context({'relevant_documents': ['b', 'a']})
+        )
+
+    def test_key_components(self):
+        base = SingleFlight.make_key('tutor', 'continúa', self._context())
+        variants = {
+            'agent': SingleFlight.make_key('evaluator', 'continúa', self._context()),
+            'query': SingleFlight.make_key('tutor', 'sigue', self._context()),
+            'documents': SingleFlight.make_key('tutor', 'continúa', self._context(relevant_documents=['otro'])),
+            'explicit_context': SingleFlight.make_key('tutor', 'continúa', self._context(explicit_context='x')),
+            'history': SingleFlight.make_key('tutor', 'continúa', self._context(
+                conversation_history=[{'role': 'user', 'content': 'Hola'}])),
+        }
+        for component, key in variants.items():
+            with self.subTest(component=component):
+                self.assertNotEqual(key, base)
+
+    def test_different_histories_do_not_coalesce(self):
+        first = self._context(conversation_history=[{'role': 'assistant', 'content': 'Paso 1: ...'}])
+        second = self._context(conversation_history=[{'role': 'assistant', 'content': 'Tema: la célula'}])
+
+        self.assertNotEqual(SingleFlight.make_key('tutor', 'continúa', first),
+                            SingleFlight.make_key('tutor', 'continúa', second))
+
+    def test_history_fingerprint(self):
+        history = [{'role': 'user', 'content': 'Hola'}]
+
+        self.assertEqual(fingerprint_history({'conversation_history': []}), '')
+        self.assertEqual(fingerprint_history({}), '')
+        self.assertEqual(fingerprint_history({'conversation_history': history}),
+                         fingerprint_history({'conversation_history': list(history)}))
+        # El rol forma parte de la huella
+        self.assertNotEqual(fingerprint_history({'conversation_history': history}),
+                            fingerprint_history({'conversation_history': [{'role': 'assistant', 'content': 'Hola'}]}))
+
+    def test_coalescing_is_disabled_by_default(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop('COALESCE_ENABLED', None)
+            self.assertFalse(SingleFlight().enabled)
+
+
+class ResponseCacheKeyTests(SimpleTestCase):
+    """Bucket de la caché semántica (agente, documentos, historial) y un solo embedding por consulta"""
+
+    def setUp(self):
+        self.embedded = []
+
+        def embed(texts):
+            self.embedded.extend(texts)
+            return np.array([[1.0, 0.0, 0.0] for _ in texts], dtype=np.float32)
+
+        with mock.patch.dict(os.environ, {'RESPONSE_CACHE_ENABLED': 'True', 'RESPONSE_CACHE_REDIS': 'False'}):
+            self.cache = SemanticResponseCache(embed)
+
+    def _context(self, history=None):
+        return {
+            'relevant_documents': ['Las fracciones representan partes de un todo'],
+            'conversation_history': history or [],
+        }
+
+    def test_bucket_only_carries_history_when_present(self):
+        without_history = self.cache._bucket('tutor', self._context())
+        with_history = self.cache._bucket('tutor', self._context([{'role': 'user', 'content': 'Hola'}]))
+
+        self.assertEqual(without_history.count(':'), 1)
+        self.assertTrue(with_history.startswith(without_history + ':'))
+
+    def test_responses_are_not_shared_across_histories(self):
+        first = self._context([{'role': 'assistant', 'content': 'Paso 1: ...'}])
+        self.cache.store('continúa', 'tutor', first, 'Paso 2: ...', 'Tutor')
+
+        other = self._context([{'role': 'assistant', 'content': 'Tema: la célula'}])
+        self.assertIsNone(self.cache.lookup('continúa', 'tutor', other))
+
+        same = self._context([{'role': 'assistant', 'content': 'Paso 1: ...'}])
+        self.assertEqual(self.cache.lookup('continúa', 'tutor', same)['response'], 'Paso 2: ...')
+
+    def test_lookup_and_store_embed_the_query_once(self):
+        context = self._context()
+
+        self.assertIsNone(self.cache.lookup('Explícame las fracciones', 'tutor', context))
+        self.cache.store('Explícame las fracciones', 'tutor', context, 'Una fracción...', 'Tutor')
+
+        # El mismo texto que embebe la etapa RAG, y el contexto del llamador no cambia
+        self.assertEqual(self.embedded, ['Explícame las fracciones'])
+        self.assertEqual(context, self._context())
+
+    def test_reuses_the_rag_query_embedding(self):
+        context = dict(self._context(), query_embedding=np.array([[0.0, 2.0, 0.0]], dtype=np.float32))
+
+        self.cache.store('Explícame las fracciones', 'tutor', context, 'Una fracción...', 'Tutor')
+        result = self.cache.lookup('explicame las fracciones', 'tutor', context)
+
+        self.assertEqual(self.embedded, [])
+        self.assertEqual(result['similarity'], 1.0)
+
+
+class RedisMemoryTestCase(SimpleTestCase):
+    """Memoria conversacional sobre fakeredis; el reloj de los contadores es falso"""
+
+    AGENTS = ['tutor', 'evaluator']
+    ENV = {
+        'MAX_CONVERSATION_HISTORY': '4',
+        'CONVERSATION_MAX_AGE_DAYS': '30',
+        'SESSION_TIMEOUT_MINUTES': '60',
+        'CONVERSATION_ENCODING': 'msgpack',
+        'CONVERSATION_CACHE_PUBSUB': 'False',
+    }
+
+    def setUp(self):
+        if fakeredis is None:
+            self.skipTest('fakeredis[lua] no instalado (requirements_test.txt)')
+        # Servidor compartido: los clientes async de cada test ven los mismos datos
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=self.server)
+        # Un día por detrás del reloj real (el de los timestamps de los mensajes):
+        # el backfill no confunde los mensajes del test con historial anterior
+        self.now = time.time() - 24 * 60 * 60
+        self.context_cache = ConversationContextCache(self.redis)
+        # Solo el reloj del módulo: las expiraciones de fakeredis usan el real
+        clock = SimpleNamespace(time=lambda: self.now)
+        for patcher in (
+            mock.patch.dict(os.environ, self.ENV),
+            mock.patch.object(conversation_memory, 'time', clock),
+            mock.patch.object(conversation_memory, 'get_redis_client', lambda: self.redis),
+            mock.patch.object(conversation_memory, 'get_context_cache', lambda: self.context_cache),
+            mock.patch.object(ConversationMemory, 'agent_types', staticmethod(lambda: list(self.AGENTS))),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def memory(self, agent_type='tutor', lua=False):
+        with mock.patch.dict(os.environ, {'CONVERSATION_MEMORY_LUA': str(lua)}):
+            return ConversationMemory('u1', agent_type, redis_client=self.redis)
+
+    def turn(self, memory, minutes=1):
+        self.now += minutes * 60
+        self.assertTrue(memory.add_messages([
+            {'role': 'user', 'content': 'Explícame las fracciones'},
+            {'role': 'assistant', 'content': 'Una fracción representa partes de un todo'},
+        ]))
+
+    def state(self, memory):
+        ttls = [self.redis.ttl(key) for key in (memory.conversation_key, memory.session_key,
+                                                memory.version_key, memory.summary_key)]
+        return {
+            'messages': [(m['role'], m['content']) for m in memory.get_full_history()],
+            'version': self.redis.get(memory.version_key),
+            'session': json.loads(self.redis.get(memory.session_key))['agent_type'],
+            'summary': self.redis.hgetall(memory.summary_key),
+            'expiring': [ttl > 0 for ttl in ttls],
+        }
+
+
+class ChatTurnWriteTests(RedisMemoryTestCase):
+    """Un turno en un round trip: MULTI/EXEC o script Lua, con el mismo resultado"""
+
+    def test_multi_and_lua_write_the_same_state(self):
+        states = []
+        start = self.now
+        for lua in (False, True):
+            self.redis.flushall()
+            self.now = start
+            memory = self.memory(lua=lua)
+            for _ in range(3):
+                self.turn(memory)
+            states.append(self.state(memory))
+
+        multi, lua = states
+        self.assertEqual(multi, lua)
+        self.assertEqual(len(multi['messages']), 4)  # LTRIM a MAX_CONVERSATION_HISTORY
+        self.assertEqual(multi['messages'][0][0], 'assistant')  # el más reciente primero
+        self.assertEqual((multi['version'], multi['session']), (b'3', 'tutor'))
+        self.assertEqual(multi['expiring'], [True] * 4)
+
+    def test_one_round_trip_per_turn(self):
+        memory = self.memory(lua=False)
+        with mock.patch.object(self.redis, 'pipeline', wraps=self.redis.pipeline) as pipeline:
+            self.turn(memory)
+        self.assertEqual(pipeline.call_count, 1)
+
+        memory = self.memory(lua=True)
+        self.turn(memory)  # el primer EVALSHA carga el script (NOSCRIPT + SCRIPT LOAD)
+        with mock.patch.object(self.redis, 'pipeline', wraps=self.redis.pipeline) as pipeline, \
+                mock.patch.object(self.redis, 'evalsha', wraps=self.redis.evalsha) as evalsha:
+            self.turn(memory)
+        self.assertEqual((pipeline.call_count, evalsha.call_count), (0, 1))
+
+    def test_write_publishes_the_invalidation(self):
+        for lua in (False, True):
+            with self.subTest(lua=lua):
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                memory = self.memory(lua=lua)
+
+                self.turn(memory)
+
+                # La primera lectura consume la confirmación de la suscripción
+                message = pubsub.get_message(timeout=1.0) or pubsub.get_message(timeout=1.0)
+                self.assertEqual(message['data'].decode('utf-8'),
+                                 self.context_cache.invalidation_message(memory.conversation_key))
+                pubsub.close()
+
+
+class AsyncConversationMemoryTests(RedisMemoryTestCase):
+    """La API async (redis.asyncio) lee y escribe la misma memoria que la sync"""
+
+    def run_async(self, lua, coroutine):
+        async def run():
+            # El cliente async pertenece al event loop que lo usa
+            client = fakeredis.FakeAsyncRedis(server=self.server)
+            with mock.patch.dict(os.environ, {'CONVERSATION_MEMORY_LUA': str(lua)}):
+                memory = ConversationMemory('u1', 'tutor', redis_client=self.redis,
+                                            async_redis_client=client)
+            try:
+                return await coroutine(memory)
+            finally:
+                await client.aclose()
+        return asyncio.run(run())
+
+    async def aturns(self, memory, count=3):
+        for _ in range(count):
+            self.now += 60
+            self.assertTrue(await memory.aadd_messages([
+                {'role': 'user', 'content': 'Explícame las fracciones'},
+                {'role': 'assistant', 'content': 'Una fracción representa partes de un todo'},
+            ]))
+
+    def test_async_write_matches_sync_write(self):
+        start = self.now
+        memory = self.memory()
+        for _ in range(3):
+            self.turn(memory)
+        expected = self.state(memory)
+
+        for lua in (False, True):
+            with self.subTest(lua=lua):
+                self.redis.flushall()
+                self.now = start
+                self.run_async(lua, self.aturns)
+                self.assertEqual(self.state(self.memory()), expected)
+
+    def test_async_reads_see_sync_writes(self):
+        memory = self.memory()
+        self.turn(memory)
+        self.turn(memory)
+
+        async def read(amemory):
+            self.context_cache.clear()  # forzar la lectura de Redis
+            return await amemory.aget_context(limit=3), await amemory.aget_session_metadata()
+
+        for lua in (False, True):
+            with self.subTest(lua=lua):
+                context, session = self.run_async(lua, read)
+                self.context_cache.clear()
+                self.assertEqual(context, memory.get_context(limit=3))
+                self.assertEqual(len(context), 3)
+                self.assertEqual(session, memory.get_session_metadata())
+                self.assertEqual(session['agent_type'], 'tutor')
+
+    def test_async_write_updates_the_context_cache(self):
+        memory = self.memory()
+        self.turn(memory)
+        memory.get_context(limit=4)  # cachea la ventana (versión 1)
+
+        self.run_async(True, lambda amemory: self.aturns(amemory, count=1))
+
+        entry = self.context_cache.lookup(memory.conversation_key, 4)
+        self.assertEqual(entry.version, 2)
+        cached = [(m['role'], m['content']) for m in memory.get_context(limit=4)]
+        self.assertEqual(cached, self.state(memory)['messages'])
+
+
+class ConversationSummaryTests(RedisMemoryTestCase):
+    """Contadores de conversation_summary:{user}: conversación entera, expiración y reinicio"""
+
+    def test_counts_cover_trimmed_messages(self):
+        for lua in (False, True):
+            with self.subTest(lua=lua):
+                self.redis.flushall()
+                memory = self.memory(lua=lua)
+                for _ in range(3):
+                    self.turn(memory)
+
+                summary = memory.get_conversation_summary()
+
+                self.assertEqual(self.redis.llen(memory.conversation_key), 4)
+                self.assertEqual(summary['total_messages'], 6)
+                self.assertEqual(summary['user_messages'], 3)
+                self.assertEqual(summary['session_duration'], 2.0)
+
+    def test_expired_conversation_is_ignored_and_restarts_the_counters(self):
+        for lua in (False, True):
+            with self.subTest(lua=lua):
+                self.redis.flushall()
+                memory = self.memory(lua=lua)
+                self.turn(memory)
+                self.turn(memory)
+
+                # El EXPIRE de la lista venció; el hash del usuario sigue vivo
+                self.now += 31 * 24 * 60 * 60
+                self.redis.delete(memory.conversation_key)
+
+                self.assertEqual(memory.get_conversation_summary()['total_messages'], 0)
+                self.assertEqual(ConversationMemory.get_user_conversations('u1'), [])
+
+                self.turn(memory)
+                summary = memory.get_conversation_summary()
+
+                self.assertEqual(summary['total_messages'], 2)
+                self.assertEqual(summary['session_duration'], 0)
+                self.assertEqual(summary['conversation_start'], summary['last_activity'])
+
+
+class ContextCacheRaceTests(SimpleTestCase):
+    """Una ventana leída de Redis antes de una invalidación no entra en la LRU"""
+
+    KEY = 'conversation:u1:tutor'
+
+    def setUp(self):
+        with mock.patch.dict(os.environ, {'CONVERSATION_CACHE_SIZE': '2', 'CONVERSATION_CACHE_WINDOW': '4'}):
+            self.cache = ConversationContextCache()
+
+    def message(self, content):
+        return {'role': 'user', 'content': content}
+
+    def test_window_read_before_an_invalidation_is_discarded(self):
+        token = self.cache.read_token()
+        self.cache._on_message(f"otro-worker {self.KEY}")
+
+        self.cache.store(self.KEY, 1, [self.message('viejo')], complete=True, token=token)
+
+        self.assertIsNone(self.cache.lookup(self.KEY, 1))
+        self.assertEqual(self.cache.stats['stale_reads'], 1)
+
+    def test_window_read_after_the_invalidation_is_cached(self):
+        self.cache._on_message(f"otro-worker {self.KEY}")
+        token = self.cache.read_token()
+
+        self.cache.store(self.KEY, 2, [self.message('nuevo')], complete=True, token=token)
+
+        self.assertEqual(self.cache.lookup(self.KEY, 1).version, 2)
+
+    def test_older_version_does_not_replace_a_newer_entry(self):
+        self.cache.store(self.KEY, 5, [self.message('v5')], complete=True, token=self.cache.read_token())
+        self.cache.store(self.KEY, 4, [self.message('v4')], complete=True, token=self.cache.read_token())
+
+        self.assertEqual(self.cache.lookup(self.KEY, 1).messages, [self.message('v5')])
+
+    def test_forgotten_invalidations_and_clear_raise_the_floor(self):
+        for forget in ('overflow', 'clear'):
+            with self.subTest(forget=forget):
+                token = self.cache.read_token()
+                if forget == 'overflow':
+                    # Solo se recuerdan max_size invalidaciones: la de KEY se olvida
+                    for key in (self.KEY, 'conversation:u2:tutor', 'conversation:u3:tutor'):
+                        self.cache.invalidate(key)
+                else:
+                    self.cache.clear()
+
+                self.cache.store(self.KEY, 1, [self.message('viejo')], complete=True, token=token)
+
+                self.assertIsNone(self.cache.lookup(self.KEY, 1))
+
+    def test_own_write_extends_the_window_only_from_the_previous_version(self):
+        self.cache.store(self.KEY, 1, [self.message('1')], complete=True, token=self.cache.read_token())
+
+        self.cache.apply_write(self.KEY, 2, [self.message('2'), self.message('3')])
+        entry = self.cache.lookup(self.KEY, 3)
+        self.assertEqual((entry.version, [m['content'] for m in entry.messages]), (2, ['3', '2', '1']))
+
+        # Otro worker escribió la versión 3: la 4 no puede construirse sobre la 2
+        self.cache.apply_write(self.KEY, 4, [self.message('5')])
+        self.assertIsNone(self.cache.lookup(self.KEY, 1))
+
+
+class ConversationContextRaceTests(RedisMemoryTestCase):
+    """get_context con listener activo: una escritura durante la lectura no deja una ventana vieja"""
+
+    def test_write_during_the_read_is_not_hidden_by_the_cache(self):
+        reader, writer = self.memory(), self.memory()
+        self.turn(writer)
+        self.context_cache.listening = True  # entradas servibles sin revalidar
+        store = self.context_cache.store
+
+        def racing_store(*args, **kwargs):
+            # La ventana ya se leyó de Redis; el turno llega antes de cachearla
+            self.turn(writer)
+            return store(*args, **kwargs)
+
+        with mock.patch.object(self.context_cache, 'store', racing_store):
+            self.assertEqual(len(reader.get_context(limit=10)), 2)
+
+        self.assertEqual(len(reader.get_context(limit=10)), 4)
+
+
+class SummaryBackfillTests(RedisMemoryTestCase):
+    """Backfill único de los contadores para historial anterior al hash (WATCH + reintento)"""
+
+    def write_legacy(self, memory, roles, hours_ago=3):
+        # Como lo escribían las versiones anteriores: solo la lista, sin contadores
+        for index, role in enumerate(roles):
+            timestamp = datetime.fromtimestamp(self.now - hours_ago * 3600 + index * 60).isoformat()
+            message = {'role': role, 'content': 'Mensaje antiguo', 'timestamp': timestamp, 'metadata': {}}
+            self.redis.lpush(memory.conversation_key, memory.codec.encode(message))
+
+    def test_legacy_history_is_counted_once(self):
+        tutor = self.memory('tutor')
+        self.write_legacy(tutor, ['user', 'assistant', 'user'])
+
+        summary = tutor.get_conversation_summary()
+
+        self.assertEqual((summary['total_messages'], summary['user_messages']), (3, 2))
+        self.assertEqual(summary['session_duration'], 2.0)
+        self.assertEqual(self.redis.hget(tutor.summary_key, 'v'), b'1')
+        with mock.patch.object(ConversationMemory, 'get_full_history') as history:
+            self.assertEqual(tutor.get_conversation_summary()['total_messages'], 3)
+        history.assert_not_called()
+
+    def test_concurrent_write_during_the_backfill_is_not_counted_twice(self):
+        tutor = self.memory('tutor')
+        self.write_legacy(tutor, ['user', 'assistant'])
+        original = ConversationMemory.get_full_history
+        calls = []
+
+        def racing(memory):
+            calls.append(memory.agent_type)
+            if len(calls) == 1:
+                # Un turno entre el WATCH y el EXEC: el primer intento aborta
+                self.turn(self.memory('tutor'))
+            return original(memory)
+
+        with mock.patch.object(ConversationMemory, 'get_full_history', racing):
+            summary = tutor.get_conversation_summary()
+
+        self.assertEqual(calls, ['tutor', 'evaluator'] * 2)
+        self.assertEqual((summary['total_messages'], summary['user_messages']), (4, 2))
+        self.assertEqual(tutor.get_conversation_summary(), summary)
+        self.assertEqual(summary['conversation_start'],
+                         datetime.fromtimestamp(int(self.now - 3 * 3600 - 60)).isoformat())
+
+
+class ConversationRetentionTests(RedisMemoryTestCase):
+    """Job de retención: archivo en frío, borrado condicional (Lua) y dry run"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.archive_dir = directory.name
+
+        self.tutor = self.memory('tutor')
+        self.turn(self.tutor)
+        self.turn(self.tutor)
+        # Expira dentro de CONVERSATION_RETENTION_EXPIRING_HOURS (24 por defecto)
+        self.redis.expire(self.tutor.conversation_key, 3600)
+        self.evaluator = self.memory('evaluator')
+        self.turn(self.evaluator)
+
+    def run_retention(self, archive=True, dry_run=False):
+        archive = ConversationArchive(self.archive_dir) if archive else None
+        return ConversationRetention(self.redis, archive=archive, dry_run=dry_run).run()
+
+    def test_expiring_conversations_are_archived_then_deleted(self):
+        version = int(self.redis.get(self.tutor.version_key))
+        self.redis.set('metadata:u2:tutor', '{}')  # huérfana y sin expiración
+
+        report = self.run_retention()
+
+        self.assertEqual((report['archived'], report['deleted'], report['orphans_deleted']), (1, 1, 1))
+        self.assertFalse(self.redis.exists(self.tutor.conversation_key, self.tutor.session_key, 'metadata:u2:tutor'))
+        self.assertEqual(self.redis.llen(self.evaluator.conversation_key), 2)
+        # Borrado junto con sus contadores del resumen y con una versión nueva para las cachés
+        self.assertIsNone(self.redis.hget(self.tutor.summary_key, 'tutor:user'))
+        self.assertEqual(self.redis.hget(self.tutor.summary_key, 'evaluator:user'), b'1')
+        self.assertEqual(int(self.redis.get(self.tutor.version_key)), version + 1)
+
+        with gzip.open(report['archive'], 'rt', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([(r['user_id'], r['agent_type'], r['reason']) for r in records], [('u1', 'tutor', 'expiring')])
+        self.assertEqual([m['role'] for m in records[0]['messages']], ['user', 'assistant', 'user', 'assistant'])
+
+    def test_without_archive_expiring_conversations_expire_on_their_own(self):
+        report = self.run_retention(archive=False)
+
+        self.assertEqual(report['deleted'], 0)
+        self.assertEqual(self.redis.llen(self.tutor.conversation_key), 4)
+
+    def test_dry_run_only_counts(self):
+        report = self.run_retention(dry_run=True)
+
+        self.assertEqual((report['deleted'], report['archived'], report['archive']), (1, 0, None))
+        self.assertEqual(self.redis.llen(self.tutor.conversation_key), 4)
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    def test_conversation_written_since_the_check_is_kept(self):
+        retention = ConversationRetention(self.redis)
+        # Se comprobó con una hora de TTL, pero un turno nuevo renovó el EXPIRE
+        self.turn(self.tutor)
+
+        pipe = self.redis.pipeline(transaction=False)
+        retention._queue_delete(pipe, self.tutor.conversation_key, 3600)
+        self.assertEqual(pipe.execute(), [0])
+
+        self.assertEqual(self.redis.llen(self.tutor.conversation_key), 4)
+
+        pipe = self.redis.pipeline(transaction=False)
+        retention._queue_delete(pipe, self.tutor.conversation_key, self.redis.ttl(self.tutor.conversation_key))
+        self.assertEqual(pipe.execute(), [1])
+        self.assertFalse(self.redis.exists(self.tutor.conversation_key))
+
+
+class ChatStageDeadlineTests(SimpleTestCase):
+    """Plazos por etapa y tope de llamadas vencidas que siguen ocupando threads"""
+
+    def setUp(self):
+        for patcher in (
+            mock.patch.dict(os.environ, {'CHAT_STAGE_TIMEOUTS': 'rag=0.05', 'CHAT_STAGE_MAX_ABANDONED': '1',
+                                         'CHAT_PARALLEL_STAGES': 'True'}),
+            mock.patch.dict(chat_context._abandoned, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Libera los threads colgados antes de restaurar el contador
+        self.backend = threading.Event()
+        self.addCleanup(self.release_backend)
+        self.calls = []
+
+    def hung_rag(self):
+        self.calls.append('rag')
+        self.backend.wait(5)
+        return ['tarde']
+
+    def release_backend(self):
+        self.backend.set()
+        deadline = time.monotonic() + 2
+        while chat_context._abandoned.get('rag') and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_slow_and_failing_stages_degrade(self):
+        def broken():
+            raise RuntimeError('perfil caído')
+
+        results, degraded = chat_context.run_stages({
+            'history': (lambda: ['hola'], []),
+            'rag': (self.hung_rag, []),
+            'profile': (broken, {}),
+        })
+
+        self.assertEqual(results, {'history': ['hola'], 'rag': [], 'profile': {}})
+        self.assertEqual(sorted(degraded), ['profile', 'rag'])
+
+    def test_saturated_stage_is_skipped_until_abandoned_calls_finish(self):
+        stages = {'rag': (self.hung_rag, [])}
+
+        self.assertEqual(chat_context.run_stages(stages)[1], ['rag'])
+        self.assertEqual(chat_context._abandoned['rag'], 1)
+
+        # Con el tope alcanzado ni se lanza
+        self.assertEqual(chat_context.run_stages(stages)[1], ['rag'])
+        self.assertEqual(self.calls, ['rag'])
+
+        self.release_backend()
+        self.assertEqual(chat_context._abandoned['rag'], 0)
+        self.assertEqual(chat_context.run_stages(stages), ({'rag': ['tarde']}, []))
+
+    def test_async_deadline_counts_the_pooled_call(self):
+        async def rag():
+            return await chat_context._in_stage_pool('rag', self.hung_rag)
+
+        async def history():
+            return ['hola']
+
+        stages = {'history': (history, []), 'rag': (rag, [])}
+
+        results, degraded = asyncio.run(chat_context.arun_stages(stages))
+        self.assertEqual((results, degraded), ({'history': ['hola'], 'rag': []}, ['rag']))
+        self.assertEqual(chat_context._abandoned['rag'], 1)
+
+        results, degraded = asyncio.run(chat_context.arun_stages(stages))
+        self.assertEqual(degraded, ['rag'])
+        self.assertEqual(self.calls, ['rag'])
+
+        self.release_backend()
+        self.assertEqual(chat_context._abandoned['rag'], 0)
+
+
+class FakeEvaluator:
+    """grade_submission_with_prefix sin LLM; falla para los estudiantes de `failing`"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.graded = []
+        self._lock = threading.Lock()
+
+    def build_grading_prefix(self, assessment_id, rubric):
+        return f"rubrica:{assessment_id}"
+
+    def grade_submission_with_prefix(self, assessment_id, responses, grading_prefix, rubric):
+        student = responses[0]
+        if student in self.failing:
+            raise ProviderUnavailableError('circuito abierto')
+        with self._lock:
+            self.graded.append(student)
+        return {'score': len(student), 'prefix': grading_prefix}
+
+
+class BulkGradingResumeTests(SimpleTestCase):
+    """Un lote interrumpido se reanuda desde el checkpoint de Redis"""
+
+    SUBMISSIONS = [{'student_id': s, 'responses': [s]} for s in ('ana', 'beto', 'carla', 'dani')]
+
+    def setUp(self):
+        if fakeredis is None:
+            self.skipTest('fakeredis[lua] no instalado (requirements_test.txt)')
+        patcher = mock.patch.dict(os.environ, {'BULK_GRADING_CONCURRENCY': '2',
+                                               'BULK_GRADING_REQUESTS_PER_MINUTE': '0'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis = fakeredis.FakeRedis()
+
+    def run_job(self, evaluator, submissions=None):
+        pipeline = BulkGradingPipeline(evaluator, redis_client=self.redis)
+        return pipeline, list(pipeline.run('quiz-1', submissions or self.SUBMISSIONS))
+
+    def test_resume_grades_only_what_is_missing(self):
+        _, events = self.run_job(FakeEvaluator(failing={'carla'}))
+        self.assertEqual(events[0]['already_graded'], 0)
+        self.assertEqual([e['student_id'] for e in events if e['type'] == 'error'], ['carla'])
+        self.assertEqual((events[-1]['graded'], events[-1]['failed']), (3, 1))
+
+        evaluator = FakeEvaluator()
+        pipeline, events = self.run_job(evaluator)
+
+        self.assertEqual(evaluator.graded, ['carla'])
+        self.assertEqual(events[0]['already_graded'], 3)
+        results = {e['student_id']: e for e in events if e['type'] == 'result'}
+        self.assertEqual(sorted(results), ['ana', 'beto', 'carla', 'dani'])
+        self.assertEqual([s for s, e in results.items() if not e['resumed']], ['carla'])
+        self.assertEqual(results['ana']['result'], {'score': 3, 'prefix': 'rubrica:quiz-1', 'student_id': 'ana'})
+        self.assertEqual((events[-1]['graded'], events[-1]['failed']), (4, 0))
+        self.assertEqual(pipeline.get_progress(events[0]['job_id'])['graded'], 4)
+
+    def test_job_id_ignores_submission_order(self):
+        job_id = BulkGradingPipeline.make_job_id('quiz-1', self.SUBMISSIONS)
+        self.assertEqual(BulkGradingPipeline.make_job_id('quiz-1', self.SUBMISSIONS[::-1]), job_id)
+        self.assertNotEqual(BulkGradingPipeline.make_job_id('quiz-2', self.SUBMISSIONS), job_id)
+        self.assertNotEqual(BulkGradingPipeline.make_job_id('quiz-1', self.SUBMISSIONS[:3]), job_id)
+
+    def test_checkpoint_expires(self):
+        pipeline, events = self.run_job(FakeEvaluator())
+        ttl = self.redis.ttl(pipeline._checkpoint_key(events[0]['job_id']))
+        self.assertTrue(0 < ttl <= pipeline.checkpoint_ttl)
@@ -5,6 +5,9 @@ urlpatterns = [
     # Endpoint principal para comunicación con agentes
     path('chat/', views.AgentChatAPIView.as_view(), name='agent_chat'),
     
+    # Versión async del chat (servida por backend_project/asgi.py)
+    path('chat/async/', views.AsyncAgentChatView.as_view(), name='agent_chat_async'),
+    
     # Endpoint legacy para compatibilidad
     path('send-message/', views.SendMessageAPIView.as_view(), name='send_message'),
     
@@ -18,7 +21,12 @@ urlpatterns = [
     # Content Creator específico
     path('content-creator/', views.ContentCreatorAPIView.as_view(), name='content_creator'),
     
+    # Calificación masiva (Evaluator)
+    path('grading/bulk/', views.BulkGradingAPIView.as_view(), name='bulk_grading'),
+    
     # Utilidades
     path('upload-file/', views.upload_file, name='upload_file'),
     path('health/', views.health_check, name='health_check'),
+    path('health/live/', views.liveness_check, name='liveness_check'),
+    path('health/ready/', views.readiness_check, name='readiness_check'),
 ] 
\ No newline at end of file
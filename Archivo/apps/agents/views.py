@@ -1,15 +1,19 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils.decorators import method_decorator
+from django.views import View
+from asgiref.sync import sync_to_async
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from .serializers import MessageSerializer
-from .services.agent_manager import AgentManager
 from .services.conversation_memory import ConversationMemory, ConversationAnalytics
-from rag.services.enhanced_rag import EnhancedRAGService
+from .services.registry import (
+    get_agent_manager, get_rag_service, get_tracer, get_metrics, get_health_monitor
+)
+from .services.chat_context import abuild_chat_context, build_chat_context, schedule_chat_turn_save
 import json
 import os
 import logging
@@ -24,15 +28,11 @@ class AgentChatAPIView(APIView):
     API principal para comunicación con agentes especializados
     """
     
-    def __init__(self):
-        super().__init__()
-        self.agent_manager = AgentManager()
-        self.rag_service = None
-        try:
-            from rag.services.enhanced_rag import EnhancedRAGService
-            self.rag_service = EnhancedRAGService()
-        except ImportError:
-            logger.warning("Enhanced RAG Service no disponible")
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Servicios compartidos del proceso (se construyen una sola vez)
+        self.agent_manager = get_agent_manager()
+        self.rag_service = get_rag_service()
     
     def post(self, request):
         """Procesar consulta de usuario con agentes IA"""
@@ -48,89 +48,61 @@ class AgentChatAPIView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        try:
-            # Inicializar memoria conversacional
-            # Si no se especifica agente, usar routing automático
-            conversation_agent_type = agent_type or 'tutor'  # Default temporal
-            memory = ConversationMemory(user_id, conversation_agent_type)
-
-            # Obtener contexto conversacional
-            conversation_context = memory.get_context(limit=10)
-
-            # Buscar documentos relevantes si RAG está disponible
-            relevant_docs = []
-            if self.rag_service:
-                try:
-                    relevant_docs = self.rag_service.search_relevant_content(
-                        message, user_id, top_k=5
+        # Traza de la petición (muestreada; X-Trace: 1 la fuerza)
+        with get_tracer().trace('chat.request', force=request.headers.get('X-Trace') == '1',
+                                endpoint='chat', agent_type=agent_type or 'auto'):
+            try:
+                # Memoria conversacional, RAG y perfil de usuario
+                context, memory = build_chat_context(
+                    user_id, message,
+                    agent_type=agent_type,
+                    explicit_context=explicit_context,
+                    rag_service=self.rag_service
+                )
+                relevant_docs = context['relevant_documents']
+
+                # Procesar consulta con Agent Manager
+                agent_response = self.agent_manager.route_query(
+                    query=message,
+                    agent_type=agent_type,
+                    context=context
+                )
+
+                if agent_response['success']:
+                    # Guardar mensajes en memoria sin retrasar la respuesta
+                    schedule_chat_turn_save(
+                        user_id, memory, agent_response['agent_used'],
+                        message, agent_response['response']
                     )
-                except Exception as e:
-                    logger.warning(f"Error en RAG search: {e}")
-
-            # Construir contexto para el agente
-            context = {
-                'user_id': user_id,
-                'conversation_history': conversation_context,
-                'relevant_documents': relevant_docs,
-                'user_profile': self._get_user_profile(user_id),
-                'session_metadata': memory.get_session_metadata(),
-                'explicit_context': explicit_context,
-            }
-
-            # Procesar consulta con Agent Manager
-            agent_response = self.agent_manager.route_query(
-                query=message,
-                agent_type=agent_type,
-                context=context
-            )
-
-            if agent_response['success']:
-                # Guardar mensajes en memoria
-                memory_agent_type = agent_response['agent_used']
-                if memory_agent_type != conversation_agent_type:
-                    # Cambiar a la memoria del agente correcto
-                    memory = ConversationMemory(user_id, memory_agent_type)
-                
-                memory.add_message('user', message)
-                memory.add_message('assistant', agent_response['response'])
 
-                return Response({
-                    'status': 'success',
-                    'response': agent_response['response'],
-                    'agent_used': agent_response['agent_used'],
-                    'agent_name': agent_response['agent_name'],
-                    'context_sources': len(relevant_docs),
-                    'response_time': agent_response['response_time'],
-                    'user_id': user_id
-                }, status=status.HTTP_200_OK)
-            else:
-                # Error en procesamiento
+                    return Response({
+                        'status': 'success',
+                        'response': agent_response['response'],
+                        'agent_used': agent_response['agent_used'],
+                        'agent_name': agent_response['agent_name'],
+                        'context_sources': len(relevant_docs),
+                        'degraded_stages': context['degraded_stages'],
+                        'response_time': agent_response['response_time'],
+                        'user_id': user_id
+                    }, status=status.HTTP_200_OK)
+                else:
+                    # Error en procesamiento
+                    return Response({
+                        'status': 'error',
+                        'error': agent_response.get('error', 'Error desconocido'),
+                        'response': agent_response['response'],
+                        'user_id': user_id
+                    }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            except Exception as e:
+                logger.error(f"Error en AgentChatAPIView: {e}")
                 return Response({
                     'status': 'error',
-                    'error': agent_response.get('error', 'Error desconocido'),
-                    'response': agent_response['response'],
+                    'error': 'Error interno del servidor',
+                    'response': 'Lo siento, hubo un problema procesando tu consulta. Por favor, intenta de nuevo.',
                     'user_id': user_id
                 }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        except Exception as e:
-            logger.error(f"Error en AgentChatAPIView: {e}")
-            return Response({
-                'status': 'error',
-                'error': 'Error interno del servidor',
-                'response': 'Lo siento, hubo un problema procesando tu consulta. Por favor, intenta de nuevo.',
-                'user_id': user_id
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-    def _get_user_profile(self, user_id: str) -> dict:
-        """Obtener perfil del usuario (placeholder - implementar según modelo User)"""
-        return {
-            'user_id': user_id,
-            'name': 'Usuario',
-            'level': '7mo Grado',
-            'preferences': {},
-            'last_active': None
-        }
-
 
 @method_decorator(csrf_exempt, name='dispatch')
 class SendMessageAPIView(AgentChatAPIView):
@@ -139,15 +111,97 @@ class SendMessageAPIView(AgentChatAPIView):
     """
     pass
 
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAgentChatView(View):
+    """
+    Versión async de AgentChatAPIView.post para despliegues ASGI.
+    
+    DRF 3.14 no soporta vistas async, así que es una vista de Django: la llamada
+    al proveedor no ocupa un thread del worker mientras espera la respuesta.
+    """
+    
+    async def post(self, request):
+        """Procesar consulta de usuario con agentes IA (async)"""
+        try:
+            data = json.loads(request.body or b'{}')
+        except json.JSONDecodeError:
+            return JsonResponse({"error": "JSON inválido"}, status=400)
+        
+        user_id = data.get('userId', 'default-user')
+        message = data.get('text') or data.get('message') or data.get('query')
+        agent_type = data.get('agent_type')
+        explicit_context = data.get('context', None)
+        
+        if not message:
+            return JsonResponse(
+                {"error": "El campo 'text', 'message' o 'query' es requerido."},
+                status=400
+            )
+        
+        with get_tracer().trace('chat.request', force=request.headers.get('X-Trace') == '1',
+                                endpoint='chat-async', agent_type=agent_type or 'auto'):
+            try:
+                # La primera vez construyen los servicios: fuera del event loop
+                agent_manager = await sync_to_async(get_agent_manager, thread_sensitive=False)()
+                rag_service = await sync_to_async(get_rag_service, thread_sensitive=False)()
+            
+                # Memoria con redis.asyncio en el loop; RAG y perfil en el pool de threads
+                context, memory = await abuild_chat_context(
+                    user_id, message,
+                    agent_type=agent_type,
+                    explicit_context=explicit_context,
+                    rag_service=rag_service
+                )
+                relevant_docs = context['relevant_documents']
+            
+                agent_response = await agent_manager.aroute_query(
+                    query=message,
+                    agent_type=agent_type,
+                    context=context
+                )
+            
+                if agent_response['success']:
+                    schedule_chat_turn_save(
+                        user_id, memory, agent_response['agent_used'],
+                        message, agent_response['response']
+                    )
+                
+                    return JsonResponse({
+                        'status': 'success',
+                        'response': agent_response['response'],
+                        'agent_used': agent_response['agent_used'],
+                        'agent_name': agent_response['agent_name'],
+                        'context_sources': len(relevant_docs),
+                        'degraded_stages': context['degraded_stages'],
+                        'response_time': agent_response['response_time'],
+                        'user_id': user_id
+                    }, status=200)
+                else:
+                    return JsonResponse({
+                        'status': 'error',
+                        'error': agent_response.get('error', 'Error desconocido'),
+                        'response': agent_response['response'],
+                        'user_id': user_id
+                    }, status=500)
+        
+            except Exception as e:
+                logger.error(f"Error en AsyncAgentChatView: {e}")
+                return JsonResponse({
+                    'status': 'error',
+                    'error': 'Error interno del servidor',
+                    'response': 'Lo siento, hubo un problema procesando tu consulta. Por favor, intenta de nuevo.',
+                    'user_id': user_id
+                }, status=500)
+
 @method_decorator(csrf_exempt, name='dispatch')
 class AgentManagementAPIView(APIView):
     """
     API para gestión y información de agentes
     """
     
-    def __init__(self):
-        super().__init__()
-        self.agent_manager = AgentManager()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.agent_manager = get_agent_manager()
     
     def get(self, request):
         """Obtener información de todos los agentes disponibles"""
@@ -198,7 +252,9 @@ class ConversationHistoryAPIView(APIView):
             else:
                 # Todas las conversaciones del usuario
                 conversations = ConversationMemory.get_user_conversations(user_id)
-                analytics = ConversationAnalytics.analyze_conversation_patterns(user_id)
+                analytics = ConversationAnalytics.analyze_conversation_patterns(
+                    user_id, conversations=conversations
+                )
                 
                 return Response({
                     'status': 'success',
@@ -230,7 +286,7 @@ class ConversationHistoryAPIView(APIView):
                 }, status=status.HTTP_200_OK if success else status.HTTP_500_INTERNAL_SERVER_ERROR)
             else:
                 # Limpiar todas las conversaciones
-                agent_types = ['tutor', 'evaluator', 'counselor', 'curriculum', 'analytics']
+                agent_types = ConversationMemory.agent_types()
                 results = {}
                 
                 for agent in agent_types:
@@ -318,7 +374,10 @@ def upload_file(request):
         if not file_content:
              return JsonResponse({'status': 'error', 'message': f'No se pudo extraer texto o el archivo está vacío: {file_obj.name}'}, status=400)
 
-        rag_service = EnhancedRAGService() # No necesita user_id en el constructor
+        rag_service = get_rag_service()
+        if rag_service is None:
+            return JsonResponse({'status': 'error', 'message': 'El servicio RAG no está disponible en este momento.'}, status=503)
+
         rag_service.process_document(
             document_content=file_content, 
             user_id=user_id,
@@ -336,32 +395,69 @@ def upload_file(request):
         return JsonResponse({'status': 'error', 'message': f"Error interno del servidor al procesar el archivo: {e}"}, status=500)
 
 
+@csrf_exempt
+@require_http_methods(["GET"])
+def prometheus_metrics(request):
+    """
+    Métricas de todos los workers en formato de texto de Prometheus
+    """
+    try:
+        body = get_metrics().render_prometheus()
+    except Exception as e:
+        logger.error(f"Error generando métricas: {e}")
+        return HttpResponse(f"# error: {e}\n", status=500, content_type='text/plain; charset=utf-8')
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @csrf_exempt
 @require_http_methods(["GET"])
 def health_check(request):
     """
-    Endpoint de health check para el sistema de agentes
+    Endpoint de health check para el sistema de agentes.
+    Devuelve la última instantánea del monitor (las comprobaciones van en segundo plano).
     """
     try:
-        agent_manager = AgentManager()
-        health_status = agent_manager.health_check()
+        snapshot = get_health_monitor().snapshot()
+        agents = snapshot['components'].get('agents', {})
         
         return JsonResponse({
-            'status': 'healthy',
-            'timestamp': health_status['timestamp'],
-            'agents_status': health_status['agents_status'],
-            'system_metrics': health_status['metrics']
-        }, status=200)
+            'status': snapshot['status'],
+            'timestamp': snapshot['timestamp'],
+            'agents_status': agents.get('agents_status', {}),
+            'system_metrics': agents.get('metrics', {}),
+            'components': snapshot['components'],
+            'uptime_seconds': snapshot['uptime_seconds']
+        }, status=503 if snapshot['status'] == 'unhealthy' else 200)
         
     except Exception as e:
         logger.error(f"Error en health check: {e}")
         return JsonResponse({
             'status': 'unhealthy',
             'error': str(e),
-            'timestamp': json.dumps(datetime.now().isoformat())
+            'timestamp': datetime.now().isoformat()
         }, status=500)
 
 
+@csrf_exempt
+@require_http_methods(["GET"])
+def liveness_check(request):
+    """
+    Sonda de liveness: el proceso responde y el monitor de salud sigue refrescando
+    """
+    result = get_health_monitor().liveness()
+    return JsonResponse(result, status=200 if result['status'] == 'alive' else 503)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def readiness_check(request):
+    """
+    Sonda de readiness: los componentes críticos tienen un resultado fresco y sano
+    """
+    result = get_health_monitor().readiness()
+    return JsonResponse(result, status=200 if result['status'] == 'ready' else 503)
+
+
 @csrf_exempt
 @require_http_methods(["GET"])
 def agent_capabilities(request, agent_id):
@@ -369,7 +465,7 @@ def agent_capabilities(request, agent_id):
     Obtener capacidades específicas de un agente
     """
     try:
-        agent_manager = AgentManager()
+        agent_manager = get_agent_manager()
         capabilities = agent_manager.get_agent_capabilities(agent_id)
         
         if not capabilities:
@@ -396,9 +492,9 @@ class ContentCreatorAPIView(APIView):
     API específica para el agente creador de contenido interactivo
     """
     
-    def __init__(self):
-        super().__init__()
-        self.agent_manager = AgentManager()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.agent_manager = get_agent_manager()
     
     def post(self, request):
         """Generar contenido interactivo matemático"""
@@ -493,6 +589,80 @@ class ContentCreatorAPIView(APIView):
         })
 
 
+@method_decorator(csrf_exempt, name='dispatch')
+class BulkGradingAPIView(APIView):
+    """
+    Calificación masiva: todas las entregas de una evaluación en una petición.
+    Los resultados se envían como NDJSON (un evento JSON por línea) a medida que terminan.
+    """
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.agent_manager = get_agent_manager()
+    
+    def post(self, request):
+        """Lanzar (o reanudar con el mismo job_id) la calificación de un lote"""
+        try:
+            data = request.data
+            assessment_id = data.get('assessment_id')
+            submissions = data.get('submissions') or []
+            
+            if not assessment_id or not isinstance(submissions, list) or not submissions:
+                return Response({
+                    'error': "Los campos 'assessment_id' y 'submissions' son requeridos"
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            # El pipeline la acota a [1, BULK_GRADING_CONCURRENCY]: cada unidad es un thread
+            max_concurrency = data.get('max_concurrency')
+            if max_concurrency is not None:
+                try:
+                    max_concurrency = int(max_concurrency)
+                except (TypeError, ValueError):
+                    return Response({
+                        'error': "El campo 'max_concurrency' debe ser un entero"
+                    }, status=status.HTTP_400_BAD_REQUEST)
+            
+            evaluator = self.agent_manager.get_agent('evaluator')
+            events = evaluator.batch_grade_submissions(
+                assessment_id,
+                submissions,
+                rubric=data.get('rubric'),
+                job_id=data.get('job_id'),
+                max_concurrency=max_concurrency
+            )
+            
+            def stream():
+                try:
+                    for event in events:
+                        yield json.dumps(event, ensure_ascii=False) + "\n"
+                finally:
+                    events.close()
+            
+            return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+            
+        except Exception as e:
+            logger.error(f"Error en BulkGradingAPIView: {e}")
+            return Response({
+                'status': 'error',
+                'error': 'Error interno del servidor'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+    def get(self, request):
+        """Progreso de un lote a partir de su checkpoint"""
+        from .services.bulk_grading import BulkGradingPipeline
+        
+        job_id = request.query_params.get('job_id')
+        if not job_id:
+            return Response({'error': "El parámetro 'job_id' es requerido"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        pipeline = BulkGradingPipeline(self.agent_manager.get_agent('evaluator'))
+        return Response({
+            'status': 'success',
+            **pipeline.get_progress(job_id)
+        }, status=status.HTTP_200_OK)
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class HealthCheckAPIView(APIView):
     pass 
\ No newline at end of file
@@ -2,6 +2,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from apps.agents.views import prometheus_metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -10,6 +11,8 @@ urlpatterns = [
     path('api/documents/', include('documents.urls')), # URLs de documentos
     # RAG System endpoints
     path('api/rag/', include('rag.urls')),
+    # Métricas Prometheus (agregadas entre workers)
+    path('metrics', prometheus_metrics, name='metrics'),
 ]
 
 # Serve media files during development
@@ -4,7 +4,8 @@ Enhanced RAG Service - Sistema RAG mejorado para agentes especializados
 
 import os
 import logging
-from typing import List, Dict, Any, Optional
+from contextlib import nullcontext
+from typing import Callable, List, Dict, Any, Optional
 from sentence_transformers import SentenceTransformer
 import chromadb
 from chromadb.config import Settings
@@ -13,15 +14,28 @@ from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+
+def _no_span(name: str, **attributes):
+    """Sin tracing: el servicio no depende de quién lo instrumenta"""
+    return nullcontext()
+
+
 class EnhancedRAGService:
     """
     Sistema RAG mejorado que integra con los agentes especializados
     para proporcionar búsqueda semántica avanzada en documentos.
     """
     
-    def __init__(self):
-        """Inicializar el servicio RAG mejorado"""
+    def __init__(self, span: Optional[Callable[..., Any]] = None):
+        """
+        Inicializar el servicio RAG mejorado
+        
+        Args:
+            span: Fábrica de spans span(nombre, **atributos) para instrumentar
+                  el embedding y la consulta vectorial (opcional)
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.span = span or _no_span
         
         # Configuración
         self.embedding_model_name = os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
@@ -122,8 +136,19 @@ class EnhancedRAGService:
             self.logger.error(f"Error procesando documento: {e}")
             raise
     
+    def embed_query(self, query: str) -> np.ndarray:
+        """
+        Embedding de una consulta (matriz de una fila)
+        
+        La etapa RAG del chat lo calcula una vez y lo reutiliza para la búsqueda
+        y para el routing semántico de agentes.
+        """
+        with self.span('rag.embed', model=self.embedding_model_name):
+            return self.embedding_model.encode([query])
+    
     def search_relevant_content(self, query: str, user_id: str, 
-                               top_k: int = 5, filter_metadata: Optional[Dict] = None) -> List[str]:
+                               top_k: int = 5, filter_metadata: Optional[Dict] = None,
+                               query_embedding: Optional[np.ndarray] = None) -> List[str]:
         """
         Buscar contenido relevante para una consulta
         
@@ -132,6 +157,7 @@ class EnhancedRAGService:
             user_id: ID del usuario
             top_k: Número máximo de resultados
             filter_metadata: Filtros adicionales de metadatos
+            query_embedding: Embedding ya calculado de la consulta (ver embed_query)
         
         Returns:
             Lista de chunks relevantes
@@ -141,8 +167,9 @@ class EnhancedRAGService:
             if not query.strip():
                 return []
             
-            # Generar embedding de la consulta
-            query_embedding = self.embedding_model.encode([query])
+            # Generar embedding de la consulta (si no viene ya calculado)
+            if query_embedding is None:
+                query_embedding = self.embed_query(query)
             
             # Obtener colección del usuario
             collection_name = f"user_{user_id}"
@@ -160,12 +187,13 @@ class EnhancedRAGService:
                 where_filter.update(filter_metadata)
             
             # Realizar búsqueda
-            results = collection.query(
-                query_embeddings=query_embedding.tolist(),
-                n_results=min(top_k, 10),  # Máximo 10 resultados
-                where=where_filter,
-                include=["documents", "metadatas", "distances"]
-            )
+            with self.span('rag.vector_query', collection=collection_name, top_k=top_k):
+                results = collection.query(
+                    query_embeddings=query_embedding.tolist(),
+                    n_results=min(top_k, 10),  # Máximo 10 resultados
+                    where=where_filter,
+                    include=["documents", "metadatas", "distances"]
+                )
             
             # Extraer documentos relevantes
             relevant_chunks = []